@@ -22,6 +22,9 @@ BUILTIN_PLUGIN_NAMES = ['entityd.' + n for n in
                          'mesend:MonitoredEntitySender',
                          'kvstore',
                          'monitor:Monitor',
+                         'procfs:ProcFS',
+                         'sampler:SamplerService',
+                         'discovery:DiscoveryService',
                          'hostme:HostEntity',
                          'processme:ProcessEntity',
                          'endpointme:EndpointEntity',
@@ -14,10 +14,22 @@ If multiple Apache instances are running with different configurations
 (but the same executable) then they will be exposed as separate entities
 with different config_path values.
 
+Finding the version, the configuration and the virtual hosts of an
+instance runs apachectl several times.  These are cached for each main
+process, identified by its pid and start time, for as long as none of
+the configuration files, nor the directories of included files, were
+modified.
+
+The mod_status pages are scraped by a :class:`StatusClient`, shared by
+all instances, which keeps its HTTP connections alive and bounds each
+request by a connect and a read timeout.
+
 """
 
 import argparse
 import collections
+import concurrent.futures
+import contextlib
 import itertools
 import logging
 import os
@@ -25,11 +37,21 @@ import pathlib
 import re
 import shlex
 import subprocess
+import threading
+import time
 
 import requests
 
+import entityd.discovery
 import entityd.fileme
+import entityd.mixins
 import entityd.pm
+import entityd.processme
+
+
+#: The processes of Apache instances, the binary is named ``apache2`` on
+#: Debian and ``httpd`` elsewhere.
+MATCHER = entityd.discovery.Matcher('Apache', binary=['apache2', 'httpd'])
 
 
 class ApacheEntity:
@@ -38,6 +60,8 @@ class ApacheEntity:
     def __init__(self):
         self.session = None
         self._host_ueid = None
+        self._metadata = {}
+        self.status_client = None
 
     @staticmethod
     @entityd.pm.hookimpl
@@ -50,10 +74,45 @@ class ApacheEntity:
         config.addentity('Apache', 'entityd.apacheme.ApacheEntity')
         logging.getLogger('requests').setLevel(logging.WARNING)
 
+    @staticmethod
+    @entityd.pm.hookimpl
+    def entityd_addoption(parser):
+        """Add the options for scraping mod_status."""
+        parser.add_argument(
+            '--apache-status-connect-timeout',
+            default=1.0,
+            type=float,
+            help='Seconds to wait for a connection to mod_status.',
+        )
+        parser.add_argument(
+            '--apache-status-read-timeout',
+            default=5.0,
+            type=float,
+            help='Seconds to wait for mod_status to respond.',
+        )
+        parser.add_argument(
+            '--apache-status-threads',
+            default=4,
+            type=int,
+            help='Maximum number of virtual hosts of an Apache probed '
+                 'for mod_status at once.',
+        )
+
     @entityd.pm.hookimpl()
     def entityd_sessionstart(self, session):
         """Store session for later use."""
         self.session = session
+        self.status_client = StatusClient(
+            connect_timeout=session.config.args.apache_status_connect_timeout,
+            read_timeout=session.config.args.apache_status_read_timeout,
+            threads=session.config.args.apache_status_threads)
+        entityd.discovery.service(session).subscribe(MATCHER)
+
+    @entityd.pm.hookimpl
+    def entityd_sessionfinish(self):
+        """Close the connections to mod_status."""
+        if self.status_client:
+            self.status_client.close()
 
     @entityd.pm.hookimpl
     def entityd_find_entity(self, name, attrs, include_ondemand=False):
@@ -72,15 +131,9 @@ class ApacheEntity:
 
         :returns: A :class:`cobe.UEID` for the host.
         """
-        if self._host_ueid:
-            return self._host_ueid
-        results = self.session.pluginmanager.hooks.entityd_find_entity(
-            name='Host', attrs=None)
-        for hosts in results:
-            for host in hosts:
-                self._host_ueid = host.ueid
-                return self._host_ueid
-        raise LookupError('Could not find the host UEID')
+        if not self._host_ueid:
+            self._host_ueid = entityd.mixins.find_host_ueid(self.session)
+        return self._host_ueid
 
     def entities(self, include_ondemand=False):
         """Return a generator of ApacheEntity objects
@@ -105,18 +158,31 @@ class ApacheEntity:
                              traits={'time:posix', 'unit:seconds'})
             for name, (value, traits) in perfdata.items():
                 update.attrs.set(name, value, traits)
-            update.children.add(apache.main_process)
-            for address, port, path in apache.vhosts():
+            stats = apache.status_stats()
+            if stats.latency is not None:
+                update.attrs.set('status:latency', stats.latency,
+                                 traits={'metric:gauge', 'time:duration',
+                                         'unit:seconds'})
+            update.attrs.set('status:failures', stats.failures,
+                             traits={'metric:counter'})
+            if entityd.processme.is_selected(
+                    self.session, apache.main_process.attrs.get('pid').value):
+                update.children.add(apache.main_process)
+            vhosts = apache.vhosts()
+            files = {}
+            if include_ondemand and vhosts:
+                paths = [path for _, _, path in vhosts]
+                results = self.session.pluginmanager.hooks.entityd_find_entity(
+                    name='File', attrs={'path': paths})
+                for entity in itertools.chain.from_iterable(results):
+                    files.setdefault(entity.attrs.get('path').value, entity)
+            for address, port, path in vhosts:
                 vhost = self.create_vhost(address, port, apache=update)
                 update.children.add(vhost)
                 if include_ondemand:
-                    files = itertools.chain.from_iterable(
-                        self.session.pluginmanager.hooks.entityd_find_entity(
-                            name='File', attrs={'path': path}))
-                    files = list(files)
-                    if files:
-                        vhost.children.add(files[0])
-                        yield files[0]
+                    if path in files:
+                        vhost.children.add(files[path])
+                        yield files[path]
                     yield vhost
 
             results = self.session.pluginmanager.hooks.entityd_find_entity(
@@ -130,27 +196,29 @@ class ApacheEntity:
 
     def top_level_apache_processes(self):
         """Find top level Apache processes."""
-        processes = {}
         try:
-            binary = Apache.apache_binary()
+            Apache.apache_binary()
         except ApacheNotFound:
             return []
-        proc_gens = self.session.pluginmanager.hooks.entityd_find_entity(
-            name='Process', attrs={'binary': binary})
-        for entity in itertools.chain.from_iterable(proc_gens):
-            processes[entity.attrs.get('pid').value] = entity
-        return [e for e in processes.values()
-                if e.attrs.get('ppid').value not in processes]
+        return entityd.discovery.service(self.session).processes(MATCHER)
 
     def active_apaches(self):
-        """Return running apache instances on this machine."""
+        """Return running apache instances on this machine.
+
+        The cached metadata of instances no longer running is dropped.
+        """
+        running = set()
         for proc in self.top_level_apache_processes():
             try:
-                apache = Apache(proc)
+                apache = Apache(proc, cache=self._metadata,
+                                status_client=self.status_client)
             except ApacheNotFound:
                 continue
             else:
+                running.add(apache.cache_key)
                 yield apache
+        for key in set(self._metadata) - running:
+            del self._metadata[key]
 
     @staticmethod
     def create_vhost(address, port, apache):
@@ -167,6 +235,11 @@ class ApacheEntity:
 VHost = collections.namedtuple('VHost', ['address', 'port', 'config_path'])
 
 
+#: The latency in seconds of the last successful mod_status request to
+#: an Apache, and the number of its requests which failed.
+StatusStats = collections.namedtuple('StatusStats', ['latency', 'failures'])
+
+
 class ApacheNotFound(Exception):
     """Raised if Apache is not running, or the binaries are not found."""
     pass
@@ -183,18 +256,83 @@ class Apache:
 
     The Apache binaries will be shared across instances. If they cannot be
     found, then instantiating an instance will fail.
+
+    The version, config path, config check result, include files and
+    virtual hosts are only looked up once for an instance.  If a cache
+    is given they are shared with later instances for the same main
+    process, until a configuration file is modified.
+
+    :param proc: The main Apache process entity.
+    :param dict cache: Maps the (pid, starttime) of main processes to
+       their metadata, it is updated by the instance.
+    :param StatusClient status_client: The client to scrape mod_status
+       with, by default a new one.
+
+    :ivar cache_key: The (pid, starttime) of the main process, or
+       ``None`` if the metadata is not cached.
     """
 
     _apache_binary = None
     _apachectl_binary = None
 
-    def __init__(self, proc=None):
-        self._version = None
-        self._config_path = None
+    def __init__(self, proc=None, cache=None, status_client=None):
+        self._metadata = {}
         self.main_process = proc
+        self.cache_key = None
+        self.status_client = status_client or StatusClient()
         # Call these so that if they are missing, we fail early.
         self.apache_binary()
         self.apachectl_binary()
+        if cache is not None and proc is not None:
+            self._load_metadata(cache)
+
+    def _load_metadata(self, cache):
+        """Use the cached metadata of the main process if still valid.
+
+        Otherwise a new cache entry is started, recording the
+        modification times of the configuration straight away so the
+        entry is valid even if the status of the server is unknown.
+        """
+        try:
+            self.cache_key = (self.main_process.attrs.get('pid').value,
+                              self.main_process.attrs.get('starttime').value)
+        except KeyError:
+            return
+        metadata = cache.get(self.cache_key)
+        if metadata and 'mtimes' in metadata:
+            self._metadata = metadata
+            try:
+                if self._config_mtimes() == metadata['mtimes']:
+                    return
+            except (OSError, ApacheNotFound):
+                pass
+            self._metadata = {}
+        cache[self.cache_key] = self._metadata
+        try:
+            self._metadata['mtimes'] = self._config_mtimes()
+        except (OSError, ApacheNotFound):
+            pass
+
+    def _memoise(self, name, func):
+        """Return the metadata item, looking it up with func if unknown."""
+        try:
+            return self._metadata[name]
+        except KeyError:
+            value = self._metadata[name] = func()
+            return value
+
+    def _config_mtimes(self):
+        """The modification times of the configuration.
+
+        Directories of included files are included as well, so adding
+        a file matching an include pattern is noticed.
+
+        :returns: A dict mapping paths to their mtime.
+        """
+        paths = {self.config_path}
+        for include in self.find_all_includes():
+            paths.update([include, os.path.dirname(include)])
+        return {path: os.path.getmtime(path) for path in paths}
 
     @classmethod
     def apachectl_binary(cls):
@@ -251,22 +389,26 @@ class Apache:
     @property
     def config_path(self):
         """The root configuration file."""
-        if not self._config_path:
-            self._config_path = self.apache_config()
-        return self._config_path
+        return self._memoise('config_path', self.apache_config)
 
     @property
     def version(self):
         """The Apache version as a string."""
-        if not self._version:
-            output = subprocess.check_output([self.apachectl_binary(), '-v'],
-                                             universal_newlines=True)
-            lines = output.split('\n')
-            self._version = lines[0].split(':')[1].strip()
-        return self._version
+        return self._memoise('version', self._find_version)
+
+    def _find_version(self):
+        """Get the Apache version from apachectl."""
+        output = subprocess.check_output([self.apachectl_binary(), '-v'],
+                                         universal_newlines=True)
+        lines = output.split('\n')
+        return lines[0].split(':')[1].strip()
 
     def check_config(self):
         """Check if the config passes basic checks."""
+        return self._memoise('config_ok', self._check_config)
+
+    def _check_config(self):
+        """Run the config check of apachectl."""
         try:
             exit_code = subprocess.check_call(
                 [self.apachectl_binary(), '-t', '-f', self.config_path],
@@ -277,10 +419,14 @@ class Apache:
             return False
 
     def config_last_modified(self):
-        """Return the most recent last modified date on config files."""
-        config_files = self.find_all_includes()
-        return max(os.path.getmtime(file) for file in
-                   [self.config_path] + config_files)
+        """Return the most recent last modified date on config files.
+
+        This also records the modification times the cached metadata
+        is checked against.
+        """
+        mtimes = self._memoise('mtimes', self._config_mtimes)
+        return max(mtimes[file] for file in
+                   [self.config_path] + self.find_all_includes())
 
     def performance_data(self):
         """Apache performance information from mod_status.
@@ -288,16 +434,7 @@ class Apache:
         :returns: Dictionary with performance data.
         """
         perfdata = {}
-        response = None
-        for vhost in self.vhosts():
-            addr, port = vhost.address, vhost.port
-            try:
-                response = self.get_apache_status(addr, port)
-                break
-            except ApacheNotFound:
-                continue
-        if not response:
-            raise ApacheNotFound('Could not find address for Apache status')
+        response = self.status_client.scrape(self.config_path, self.vhosts())
         lines = response.text.split('\n')
         for line in lines:
             if line.startswith('Total Accesses'):
@@ -343,8 +480,17 @@ class Apache:
                                       {'metric:gauge'})
         return perfdata
 
+    def status_stats(self):
+        """The :class:`StatusStats` of scraping mod_status."""
+        return self.status_client.stats.get(self.config_path,
+                                            StatusStats(None, 0))
+
     def vhosts(self):
         """Get addresses where Apache is listening"""
+        return self._memoise('vhosts', self._dump_vhosts)
+
+    def _dump_vhosts(self):
+        """Parse the virtual hosts dumped by apachectl."""
         patterns = [r'(?P<addr>\*):(?P<port>\d+)',
                     r'port (?P<port>\d+) namevhost (?P<addr>[^ ]+)',
                     r'(?P<addr>\d+\.\d+\.\d+\.\d+):(?P<port>\d+)']
@@ -405,6 +551,10 @@ class Apache:
 
         :returns: A list of string file paths.
         """
+        return self._memoise('includes', self._find_includes)
+
+    def _find_includes(self):
+        """Glob the files included in the root configuration file."""
         include_globs = []
         config_path = pathlib.Path(self.config_path)
         with config_path.open() as config:
@@ -418,19 +568,150 @@ class Apache:
             includes.extend(map(str, files))
         return includes
 
-    @staticmethod
-    def get_apache_status(addr, port):
+
+class StatusClient:
+    """Client scraping the mod_status pages of Apache instances.
+
+    The HTTP connections are kept alive between requests.  Each request
+    is bounded by a connect and a read timeout so an unresponsive
+    virtual host can not stall the collection.  The virtual host of an
+    Apache which answered last is tried first, if it does not answer
+    the other virtual hosts are probed concurrently and the first
+    response is used.
+
+    A :class:`requests.Session` is not safe to share between threads,
+    so each concurrent request uses its own session from a pool of
+    idle sessions.
+
+    :param float connect_timeout: Seconds to wait for a connection.
+    :param float read_timeout: Seconds to wait for a response.
+    :param int threads: The maximum number of virtual hosts probed at
+       once.
+
+    :ivar stats: Maps the key of each Apache scraped, its config path,
+       to its :class:`StatusStats`.
+    """
+
+    def __init__(self, connect_timeout=1.0, read_timeout=5.0, threads=4):
+        self.timeout = (connect_timeout, read_timeout)
+        self.threads = threads
+        self.stats = {}
+        self._answered = {}
+        self._lock = threading.Lock()
+        self._sessions = []
+        self._pool = None
+
+    def close(self):
+        """Wait for outstanding requests and close the connections."""
+        if self._pool:
+            self._pool.shutdown()
+            self._pool = None
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+
+    @contextlib.contextmanager
+    def _session(self):
+        """Borrow an idle session, creating one if none is idle."""
+        with self._lock:
+            session = self._sessions.pop() if self._sessions else None
+        if session is None:
+            session = requests.Session()
+        try:
+            yield session
+        finally:
+            with self._lock:
+                self._sessions.append(session)
+
+    def get_apache_status(self, addr, port):
         """Gets the response from Apache's server-status page.
 
         :returns: requests.Response with the result.
-        :raises ApacheNotFound: If the Apache binary is not discovered.
+        :raises ApacheNotFound: If mod_status did not answer within the
+           timeouts or answered with an error.
         """
         status_url = 'http://{}:{}/server-status?auto'.format(addr, port)
         try:
-            response = requests.get(status_url)
-        except requests.exceptions.ConnectionError:
+            with self._session() as session:
+                response = session.get(status_url, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
             raise ApacheNotFound(
                 'Running Apache server with mod_status not found at {}'
                 .format(status_url))
         else:
             return response
+
+    def scrape(self, key, vhosts):
+        """Get the server-status page of an Apache.
+
+        Updates the :attr:`stats` of the Apache, a failure is counted
+        when none of the virtual hosts answered.
+
+        :param key: The key of the Apache for :attr:`stats`.
+        :param vhosts: The :class:`VHost` instances of the Apache.
+
+        :raises ApacheNotFound: If none of the virtual hosts answered.
+        :returns: requests.Response with the result.
+        """
+        candidates = sorted({(vhost.address, vhost.port)
+                             for vhost in vhosts})
+        stats = self.stats.get(key, StatusStats(None, 0))
+        answered = self._answered.get(key)
+        if answered in candidates:
+            candidates.remove(answered)
+            result = self._probe(answered)
+        else:
+            result = None
+        if result is None:
+            result = self._probe_all(candidates)
+        if result is None:
+            self._answered.pop(key, None)
+            self.stats[key] = stats._replace(failures=stats.failures + 1)
+            raise ApacheNotFound('Could not find address for Apache status')
+        self._answered[key], latency, response = result
+        self.stats[key] = stats._replace(latency=latency)
+        return response
+
+    def _probe_all(self, candidates):
+        """Probe the virtual hosts until one answers.
+
+        When probing concurrently the requests still outstanding once
+        a virtual host answered are left to finish in the background,
+        :meth:`close` waits for them.
+
+        :returns: The result of :meth:`_probe` for the first virtual
+           host which answered, or ``None`` if none did.
+        """
+        if self.threads <= 1 or len(candidates) <= 1:
+            for vhost in candidates:
+                result = self._probe(vhost)
+                if result is not None:
+                    return result
+            return None
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        futures = [self._pool.submit(self._probe, vhost)
+                   for vhost in candidates]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                if future.result() is not None:
+                    return future.result()
+            return None
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _probe(self, vhost):
+        """Request the server-status page from a virtual host.
+
+        :returns: A tuple of the virtual host, the seconds it took to
+           answer and the response, or ``None`` if the request failed.
+        """
+        start = time.monotonic()
+        try:
+            response = self.get_apache_status(*vhost)
+        except ApacheNotFound:
+            return None
+        return vhost, time.monotonic() - start, response
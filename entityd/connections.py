@@ -8,13 +8,20 @@ https://github.com/giampaolo/psutil/blob/master/psutil/_pslinux.py
 import base64
 import collections
 import contextlib
-import errno
 import os
 import socket
 import struct
 import sys
 import threading
 
+import logbook
+
+import entityd.procfs
+import entityd.sockdiag
+
+
+log = logbook.Logger(__name__)
+
 
 TCP_STATUSES = {
     '01': 'ESTABLISHED',
@@ -82,9 +89,21 @@ class Connections:
     According to [1] it would be possible but not easily.
 
     [1] http://serverfault.com/a/417946
+
+    :param snapshot: Optional :class:`entityd.procfs.Snapshot` to read
+       the sockets owned by processes from.  If not given procfs is
+       read directly at the thread-local procpath.
+    :param backend: Where to read the TCP and UDP sockets from, either
+       ``procfs`` for the /proc/net files or ``netlink`` for the
+       sock_diag netlink interface of the kernel.  When sock_diag is
+       not available the backend falls back to ``procfs``.
+
+    :ivar backend: The backend in use.
     """
 
-    def __init__(self):
+    def __init__(self, snapshot=None, backend='procfs'):
+        self.snapshot = snapshot
+        self.backend = backend
         tcp4 = ("tcp", socket.AF_INET, socket.SOCK_STREAM)
         tcp6 = ("tcp6", socket.AF_INET6, socket.SOCK_STREAM)
         udp4 = ("udp", socket.AF_INET, socket.SOCK_DGRAM)
@@ -126,24 +145,14 @@ class Connections:
         return inodes
 
     def get_all_inodes(self):
-        """Gets all inodes for all processes."""
-        inodes = collections.defaultdict(list)
-        for pid in pids():
-            try:
-                inodes.update(self.get_proc_inodes(pid))
-            except OSError:
-                # os.listdir() is gonna raise a lot of access denied
-                # exceptions in case of unprivileged user; that's fine
-                # as we'll just end up returning a connection with PID
-                # and fd set to None anyway.
-                # Both netstat -an and lsof does the same so it's
-                # unlikely we can do any better.
-                # ENOENT just means a PID disappeared on us.
-                err = sys.exc_info()[1]
-                if err.errno not in (
-                        errno.ENOENT, errno.ESRCH, errno.EPERM, errno.EACCES):
-                    raise
-        return inodes
+        """Gets all inodes for all processes.
+
+        Sockets shared by several processes list all of them.
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = entityd.procfs.Snapshot(procpath())
+        return snapshot.socket_index()
 
     @staticmethod
     def decode_address(addr, family):
@@ -229,6 +238,60 @@ class Connections:
                 yield (fd, family, type_, laddr, raddr, status, pid)
         file.close()
 
+    def process_sockdiag(self, family, type_, inodes, filter_pid=None):  # pylint: disable=too-many-arguments
+        """Dump TCP or UDP sockets over sock_diag.
+
+        The connections are the same as from :meth:`process_inet` for
+        the corresponding /proc/net file.
+
+        :param family: socket.AF_INET or socket.AF_INET6
+        :param type_: socket.SOCK_STREAM or socket.SOCK_DGRAM
+        :param inodes: the dictionary output from ``get_*_inodes()``
+        :param filter_pid: A process ID to filter output
+
+        :raises OSError: If sock_diag is not available.
+        """
+        if type_ == socket.SOCK_STREAM:
+            protocol = socket.IPPROTO_TCP
+        else:
+            protocol = socket.IPPROTO_UDP
+        conns = []
+        for sock in entityd.sockdiag.inet_sockets(family, protocol):
+            if sock.inode in inodes:
+                pid, fd = inodes[sock.inode][0]
+            else:
+                pid, fd = None, -1
+            if filter_pid is not None and filter_pid != pid:
+                continue
+            if type_ == socket.SOCK_STREAM:
+                status = TCP_STATUSES.get('{:02X}'.format(sock.state), 'NONE')
+            else:
+                status = 'NONE'
+            laddr = (sock.src, sock.sport) if sock.sport else ()
+            raddr = (sock.dst, sock.dport) if sock.dport else ()
+            conns.append((fd, family, type_, laddr, raddr, status, pid))
+        return conns
+
+    def inet_sockets(self, fname, family, type_, inodes, filter_pid=None):  # pylint: disable=too-many-arguments
+        """Get the TCP or UDP sockets from the configured backend.
+
+        :param fname: the name of the file in /proc/net listing them
+        :param family: socket.AF_INET or socket.AF_INET6
+        :param type_: socket.SOCK_STREAM or socket.SOCK_DGRAM
+        :param inodes: the dictionary output from ``get_*_inodes()``
+        :param filter_pid: A process ID to filter output
+        """
+        if self.backend == 'netlink':
+            try:
+                return self.process_sockdiag(
+                    family, type_, inodes, filter_pid=filter_pid)
+            except OSError as err:
+                log.warning('sock_diag not available, reading sockets '
+                            'from procfs instead: {}', err)
+                self.backend = 'procfs'
+        return self.process_inet("%s/net/%s" % (procpath(), fname),
+                                 family, type_, inodes, filter_pid=filter_pid)
+
     @staticmethod
     def process_unix(path, family, inodes, filter_pid=None):
         """Parse /proc/net/unix files.
@@ -282,9 +345,8 @@ class Connections:
         ret = []
         for fname, family, type_ in self.tmap[kind]:
             if family in (socket.AF_INET, socket.AF_INET6):
-                socks = self.process_inet(
-                    "%s/net/%s" % (procpath(), fname),
-                    family, type_, inodes, filter_pid=pid)
+                socks = self.inet_sockets(
+                    fname, family, type_, inodes, filter_pid=pid)
             else:
                 socks = self.process_unix(
                     "%s/net/%s" % (procpath(), fname),
@@ -22,6 +22,10 @@ expression to match the attribute value. All entities which match the terms
 given will be added as relations, so specifying an relation with just a `type`
 will add all entities of that type as relations.
 
+During a collection cycle the entities of each type referred to by a
+relation are only looked up once, and all relations to that type, of all
+declarations, are matched against them in the same pass.
+
 Example entity declaration file:
 
 .. yaml::
@@ -49,6 +53,7 @@ import act
 import logbook
 import yaml
 
+import entityd.mixins
 import entityd.pm
 
 
@@ -72,6 +77,13 @@ class DeclarativeEntity:
     # _conf_attrs: A dictionary of lists, the key is the type of the entities
     #              and the list contains DeclCfg objects describing how to
     #              build an entity.
+    # _patterns: A dictionary mapping relation keys to lists of
+    #            (attribute name, compiled regular expression) tuples.
+    # _found: During a collection cycle, a dictionary mapping entity types
+    #         to the list of entities of that type found in the cycle,
+    #         ``None`` outside of collection cycles.
+    # _matches: A dictionary mapping (entity type, relation key) tuples to
+    #           the lists of entities matching the relation in the cycle.
 
     prefix = 'entityd.declentity:'
 
@@ -81,6 +93,9 @@ class DeclarativeEntity:
         self.session = None
         self._conf_attrs = collections.defaultdict(list)
         self._files = {}
+        self._patterns = {}
+        self._found = None
+        self._matches = {}
 
     @staticmethod
     @entityd.pm.hookimpl
@@ -108,6 +123,18 @@ class DeclarativeEntity:
         self.session = session
         self._update_entities()
 
+    @entityd.pm.hookimpl
+    def entityd_collection_before(self, session):  # pylint: disable=unused-argument
+        """Start resolving relations from a snapshot for the cycle."""
+        self._found = {}
+        self._matches = {}
+
+    @entityd.pm.hookimpl
+    def entityd_collection_after(self, session, updates):  # pylint: disable=unused-argument
+        """Drop the entities found for relations in the cycle."""
+        self._found = None
+        self._matches = {}
+
     @entityd.pm.hookimpl
     def entityd_find_entity(self, name, attrs, include_ondemand=False):  # pylint: disable=unused-argument
         """Return an iterator of Monitored Entities.
@@ -216,13 +243,7 @@ class DeclarativeEntity:
         :returns: A :class:`cobe.UEID` for the  host.
         """
         if not self._host_ueid:
-            results = self.session.pluginmanager.hooks.entityd_find_entity(
-                name='Host', attrs=None)
-            if results:
-                host_me = next(iter(results[0]))
-                self._host_ueid = host_me.ueid
-        if not self._host_ueid:
-            raise LookupError('Could not find the host UEID')
+            self._host_ueid = entityd.mixins.find_host_ueid(self.session)
         return self._host_ueid
 
     def _create_declarative_entity(self, config_properties):
@@ -259,7 +280,14 @@ class DeclarativeEntity:
     def _find_entities(self, entity_type, attrs):
         """Find entities of type entity_type matching the description in attrs.
 
-        Returns a generator of all matching entities.
+        Returns an iterator of all matching entities.
+
+        Within a collection cycle the entities of each type are only
+        looked up once.  On the first lookup of a type all relations to
+        that type in the known declarations are matched in one pass
+        over its entities and the matches are kept for the rest of the
+        cycle.  Outside of a collection cycle the entities are looked up
+        on each call.
 
         :param entity_type: The type of the entity to find
 
@@ -271,23 +299,102 @@ class DeclarativeEntity:
             There can be any number of attributes to match, all of which must
                 match successfully for the entitiy to be considered a match.
         """
-        # Get the type, then ask pluginmanager for all entities of that type.
-        # This returns a list of generators, need to iterate through all the
-        # entities in all the generators in the list and test for matching
-        # arguments, then return a generator of those matching entities.
+        key = relation_key(attrs)
+        if self._found is None:
+            entities = self._entities_of(entity_type)
+            return iter(self._match(entities, {key: attrs})[key])
+        try:
+            return iter(self._matches[(entity_type, key)])
+        except KeyError:
+            pass
+        if entity_type in self._found:
+            relations = {key: attrs}
+        else:
+            self._found[entity_type] = list(self._entities_of(entity_type))
+            relations = {relation_key(relation.attrs): relation.attrs
+                         for relation in self._relations(entity_type)}
+            relations[key] = attrs
+        matches = self._match(self._found[entity_type], relations)
+        for rel_key, matched in matches.items():
+            self._matches[(entity_type, rel_key)] = matched
+        return iter(matches[key])
+
+    def _entities_of(self, entity_type):
+        """Ask the plugins for all entities of a type.
+
+        :returns: An iterator of the entities.
+        """
         found_entities = self.session.pluginmanager.hooks.entityd_find_entity(
             name=entity_type, attrs=None)
         for entity_gen in found_entities:
-            for entity in entity_gen:
-                for attr_name, attr_val in attrs.items():
-                    try:
-                        re_term = entity.attrs.get(attr_name).value
-                    except KeyError:
-                        break
-                    if not re.search(attr_val, re_term):
+            yield from entity_gen
+
+    def _relations(self, entity_type):
+        """Get all known relations to entities of a type.
+
+        :returns: An iterator of the RelDesc tuples of all declarations,
+           parents and children, referring to entity_type.
+        """
+        for descriptions in self._conf_attrs.values():
+            for desc in descriptions:
+                for relation in desc.children + desc.parents:
+                    if relation.type == entity_type:
+                        yield relation
+
+    def _match(self, entities, relations):
+        """Match entities against several relations in a single pass.
+
+        :param entities: An iterable of the entities to match.
+        :param relations: A dictionary mapping relation keys to the
+           attributes of the relations, as in RelDesc.attrs.
+
+        :returns: A dictionary mapping the relation keys to the lists of
+           the matching entities.
+        """
+        patterns = {key: self._compiled(key, attrs)
+                    for key, attrs in relations.items()}
+        matches = {key: [] for key in relations}
+        for entity in entities:
+            values = {}
+            for key, terms in patterns.items():
+                for attr_name, pattern in terms:
+                    if attr_name not in values:
+                        try:
+                            values[attr_name] = entity.attrs.get(
+                                attr_name).value
+                        except KeyError:
+                            values[attr_name] = None
+                    value = values[attr_name]
+                    if value is None or not pattern.search(value):
                         break
                 else:
-                    yield entity
+                    matches[key].append(entity)
+        return matches
+
+    def _compiled(self, key, attrs):
+        """Get the compiled regular expressions of a relation.
+
+        :returns: A list of (attribute name, compiled pattern) tuples.
+        """
+        try:
+            return self._patterns[key]
+        except KeyError:
+            terms = [(name, re.compile(pattern))
+                     for name, pattern in attrs.items()]
+            self._patterns[key] = terms
+            return terms
+
+
+def relation_key(attrs):
+    """Get a hashable key identifying the attributes matched by a relation.
+
+    Relations with the same attributes and patterns, regardless of their
+    order, have the same key.
+
+    :param attrs: A dictionary of attribute names to regular expressions,
+       as in RelDesc.attrs.
+    """
+    return tuple(sorted(attrs.items()))
 
 
 class DeclCfg:
@@ -369,7 +476,8 @@ class DeclCfg:
         values are regular expressions used to match on the attribute
         values for entitiy matching.
 
-        Raises ValidationError if any of the relations cannot be validated.
+        Raises ValidationError if any of the relations cannot be validated,
+        including when an attribute is not a valid regular expression.
 
         """
         if isinstance(relation, RelDesc):
@@ -380,8 +488,14 @@ class DeclCfg:
             except KeyError:
                 raise ValidationError(
                     "'type' is required for relation definition")
-            else:
-                return relation
+            for name, pattern in relation.attrs.items():
+                try:
+                    re.compile(pattern)
+                except (re.error, TypeError) as err:
+                    raise ValidationError(
+                        'Bad regular expression for relation attribute '
+                        '{}: {}'.format(name, err))
+            return relation
         else:
             raise ValidationError(
                 'Bad relation description, expected dictionary, got {}'
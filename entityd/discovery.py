@@ -0,0 +1,227 @@
+"""Plugin providing the ``discovery`` session service.
+
+Plugins monitoring services like Apache, MySQL or PostgreSQL first
+need to find the processes of those services.  Rather than each of
+them looking up the processes of its binary, they subscribe a
+:class:`Matcher` to the discovery service.  Once per collection cycle,
+on first use, the service makes a single pass over the processes of
+the shared procfs snapshot checking each against all matchers, so the
+cost of discovery does not grow with the number of services supported.
+
+A matcher matches processes on their binary name, a regular expression
+searched in their command line and the TCP ports they listen on.  Only
+top-level processes are reported: a matching process whose parent
+matches the same matcher is a worker of the same service instance.
+"""
+
+import itertools
+import os
+import re
+
+import logbook
+
+import entityd.pm
+import entityd.procfs
+
+
+log = logbook.Logger(__name__)
+
+
+#: The state of listening sockets in /proc/net/tcp.
+TCP_LISTEN = '0A'
+
+
+class Matcher:
+    """What the processes of a service look like.
+
+    A process matches if it matches all the criteria given.
+
+    :param str name: The name of the service, used in logging.
+    :param binary: The binary name, or a collection of alternative
+       names, the process must have.  Like the ``binary`` attribute of
+       Process entities this is the short name of /proc/<pid>/stat.
+    :param str argv: A regular expression which must be found in the
+       command line of the process, its arguments joined by spaces.
+    :param ports: A collection of TCP ports of which the process must
+       listen on at least one.
+
+    :raises ValueError: If no criteria are given.
+    """
+
+    def __init__(self, name, binary=None, argv=None, ports=None):
+        if binary is None and argv is None and not ports:
+            raise ValueError('Matcher {} has no criteria'.format(name))
+        self.name = name
+        if isinstance(binary, str):
+            binary = {binary}
+        self.binaries = frozenset(binary) if binary is not None else None
+        self.argv = re.compile(argv) if argv is not None else None
+        self.ports = frozenset(ports) if ports else None
+
+    def __repr__(self):
+        return '<Matcher {}>'.format(self.name)
+
+    def match(self, pid, snapshot, listening):
+        """Check whether a process matches.
+
+        The command line and ports are only looked up when the cheaper
+        criteria matched.
+
+        :param int pid: The pid of the process.
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read the
+           process from.
+        :param listening: A callable returning the set of TCP ports the
+           process listens on.
+        """
+        stat = snapshot.stat(pid)
+        if stat is None:
+            return False
+        if (self.binaries is not None and
+                os.fsdecode(stat.comm) not in self.binaries):
+            return False
+        if self.argv is not None:
+            cmdline = snapshot.cmdline(pid)
+            if not cmdline or not self.argv.search(
+                    ' '.join(os.fsdecode(arg) for arg in cmdline)):
+                return False
+        if self.ports is not None and not self.ports & listening(pid):
+            return False
+        return True
+
+
+def listening_sockets(procpath='/proc'):
+    """Read the listening TCP sockets from /proc/net/tcp and tcp6.
+
+    :returns: A dict mapping socket inodes, as strings, to ports.
+    """
+    sockets = {}
+    for name in ['tcp', 'tcp6']:
+        try:
+            fp = open('{}/net/{}'.format(procpath, name))
+        except OSError:
+            continue
+        with fp:
+            next(fp, None)
+            for line in fp:
+                fields = line.split()
+                if len(fields) > 9 and fields[3] == TCP_LISTEN:
+                    port = int(fields[1].rsplit(':', 1)[1], 16)
+                    sockets[fields[9]] = port
+    return sockets
+
+
+class DiscoveryService:
+    """Plugin providing the ``discovery`` session service."""
+
+    def __init__(self):
+        self.session = None
+        self.procpath = '/proc'
+        self.matchers = []
+        self._snapshot = None
+        self._matches = {}
+
+    @entityd.pm.hookimpl
+    def entityd_sessionstart(self, session):
+        """Register the discovery service."""
+        self.session = session
+        self.procpath = session.config.args.procpath
+        session.addservice('discovery', self)
+
+    def subscribe(self, matcher):
+        """Add a matcher to the discovery pass.
+
+        Subscribing all matchers before the first lookup of a cycle
+        means they are all checked in the same pass.
+
+        :returns: The :class:`Matcher`.
+        """
+        if matcher not in self.matchers:
+            self.matchers.append(matcher)
+            self._snapshot = None
+        return matcher
+
+    def unsubscribe(self, matcher):
+        """Remove a matcher from the discovery pass."""
+        if matcher in self.matchers:
+            self.matchers.remove(matcher)
+            self._matches.pop(matcher, None)
+
+    def matches(self, matcher):
+        """Get the top-level processes matching a matcher.
+
+        The matches of all subscribed matchers are found in one pass
+        over the processes, once per procfs snapshot.  A matcher which
+        was not subscribed yet is subscribed first.
+
+        :returns: A sorted list of pids.
+        """
+        self.subscribe(matcher)
+        snapshot = entityd.procfs.snapshot(self.session, self.procpath)
+        if snapshot is not self._snapshot:
+            self._matches = self.discover(snapshot)
+            self._snapshot = snapshot
+        return self._matches[matcher]
+
+    def processes(self, matcher):
+        """Get the Process entities of the top-level matching processes.
+
+        :returns: A list of Process ``EntityUpdate``s, processes which
+           are gone by now are left out.
+        """
+        processes = []
+        for pid in self.matches(matcher):
+            results = self.session.pluginmanager.hooks.entityd_find_entity(
+                name='Process', attrs={'pid': pid})
+            for entity in itertools.chain.from_iterable(results):
+                if entity.attrs.get('pid').value == pid:
+                    processes.append(entity)
+                    break
+        return processes
+
+    def discover(self, snapshot):
+        """Check all processes against all subscribed matchers.
+
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           the processes from.
+
+        :returns: A dict mapping each :class:`Matcher` to a sorted list
+           of the pids of its top-level processes.
+        """
+        sockets = None
+
+        def listening(pid):
+            nonlocal sockets
+            if sockets is None:
+                sockets = listening_sockets(snapshot.procpath)
+            return {sockets[inode] for inode in snapshot.socket_inodes(pid)
+                    if inode in sockets}
+
+        matched = {matcher: set() for matcher in self.matchers}
+        for pid in snapshot.pids:
+            for matcher in self.matchers:
+                if matcher.match(pid, snapshot, listening):
+                    matched[matcher].add(pid)
+        matches = {}
+        for matcher, pids in matched.items():
+            matches[matcher] = sorted(
+                pid for pid in pids
+                if getattr(snapshot.stat(pid), 'ppid', None) not in pids)
+            log.debug('Discovered {} {} process(es)',
+                      len(matches[matcher]), matcher.name)
+        return matches
+
+
+def service(session):
+    """Get the discovery service of a session.
+
+    The discovery plugin may have been disabled, in which case a new
+    service is registered on the session.
+
+    :returns: The :class:`DiscoveryService`.
+    """
+    try:
+        return session.svc.discovery
+    except AttributeError:
+        discovery = DiscoveryService()
+        discovery.entityd_sessionstart(session)
+        return discovery
@@ -8,32 +8,36 @@ import entityd
 log = logbook.Logger(__name__)
 
 
+_UEID_TYPES = {}
+
+
 def get_ueid(class_name, *args):
     """Get a ueid for any docker entity type."""
-    from entityd.docker.container import DockerContainer
-    from entityd.docker.image import DockerImage
-    from entityd.docker.swarm import DockerSecret
-    from entityd.docker.swarm import DockerService
-    from entityd.docker.swarm import DockerSwarm
-    from entityd.docker.daemon import DockerDaemon
-    from entityd.docker.swarm import DockerNetwork
-    from entityd.docker.swarm import DockerNode
-    from entityd.docker.volume import DockerVolume
-    from entityd.docker.volume import DockerVolumeMount
-
-    values = {x.__name__: x for x in [
-        DockerContainer,
-        DockerImage,
-        DockerSecret,
-        DockerService,
-        DockerSwarm,
-        DockerDaemon,
-        DockerNetwork,
-        DockerNode,
-        DockerVolume,
-        DockerVolumeMount,
-    ]}
-    return values[class_name].get_ueid(*args)
+    if not _UEID_TYPES:
+        from entityd.docker.container import DockerContainer
+        from entityd.docker.image import DockerImage
+        from entityd.docker.swarm import DockerSecret
+        from entityd.docker.swarm import DockerService
+        from entityd.docker.swarm import DockerSwarm
+        from entityd.docker.daemon import DockerDaemon
+        from entityd.docker.swarm import DockerNetwork
+        from entityd.docker.swarm import DockerNode
+        from entityd.docker.volume import DockerVolume
+        from entityd.docker.volume import DockerVolumeMount
+
+        _UEID_TYPES.update({x.__name__: x for x in [
+            DockerContainer,
+            DockerImage,
+            DockerSecret,
+            DockerService,
+            DockerSwarm,
+            DockerDaemon,
+            DockerNetwork,
+            DockerNode,
+            DockerVolume,
+            DockerVolumeMount,
+        ]})
+    return _UEID_TYPES[class_name].get_ueid(*args)
 
 
 class BaseDocker(metaclass=abc.ABCMeta):
@@ -4,6 +4,7 @@ import logbook
 from docker.errors import ImageNotFound
 
 import entityd
+import entityd.entityupdate
 import entityd.groups
 from entityd.docker.client import DockerClient
 
@@ -18,9 +19,7 @@ class DockerContainer:
     @classmethod
     def get_ueid(cls, container_id):
         """Get a docker container ueid."""
-        entity = entityd.EntityUpdate(cls.name)
-        entity.attrs.set('id', container_id, traits={'entity:id'})
-        return entity.ueid
+        return entityd.entityupdate.ueid_factory(cls.name, 'id')(container_id)
 
     @entityd.pm.hookimpl
     def entityd_emit_entities(self):
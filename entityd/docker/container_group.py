@@ -2,12 +2,16 @@
 
 Each running container will have a container group with
 a child for each process.
+
+The processes of a container are read from the ``cgroup.procs`` file
+of its cgroup, rather than asking the Docker daemon to run ``ps`` in
+each container.
 """
-import docker
 import logbook
-import syskit
 
 import entityd
+import entityd.processme
+import entityd.procfs
 from entityd.docker.client import DockerClient
 from entityd.docker.container import DockerContainer
 from entityd.mixins import HostEntity
@@ -16,9 +20,17 @@ log = logbook.Logger(__name__)
 
 
 class DockerContainerGroup(HostEntity):
-    """Entity for a grouping of Processes running within a Docker Container."""
+    """Entity for a grouping of Processes running within a Docker Container.
+
+    :ivar process_ueids: Dict mapping ``(pid, starttime)`` to the UEIDs
+       of processes seen in the last collection cycle.
+    """
     name = "Group"
 
+    def __init__(self):
+        super().__init__()
+        self.process_ueids = {}
+
     @entityd.pm.hookimpl
     def entityd_configure(self, config):
         """Register the Process Monitored Entity."""
@@ -34,60 +46,86 @@ class DockerContainerGroup(HostEntity):
                 raise LookupError('Attribute based filtering not supported')
             return self.generate_updates()
 
-    def get_process_ueid(self, pid):
+    def get_process_ueid(self, pid, process_ueids=None):
         """Generate a ueid for a process.
 
+        The UEID is computed from the stat of the process in the procfs
+        snapshot, as :class:`entityd.processme.ProcessEntity` would
+        create it.  UEIDs are cached by pid and starttime.
+
         :param pid: A process id.
+        :param process_ueids: Optional dict to record the UEID in, in
+           addition to the cache.
 
         :returns: A :class:`cobe.UEID` for the given process.
         """
+        snapshot = entityd.procfs.snapshot(self.session)
+        stat = snapshot.stat(int(pid))
+        if stat is None:
+            log.warning("Process ({}) not found", pid)
+            return None
+        key = (stat.pid, stat.starttime)
         try:
-            proc = syskit.Process(int(pid))
-        except syskit.NoSuchProcessError as error:
-            log.warning("Process ({}) not found {}", pid, error)
-        else:
-            entity = entityd.EntityUpdate('Process')
-            entity.attrs.set('pid', proc.pid, traits={'entity:id'})
-            entity.attrs.set('starttime', proc.start_time.timestamp(),
-                             traits={'entity:id'})
-            entity.attrs.set('host', str(self.host_ueid), traits={'entity:id'})
-
-            return entity.ueid
+            ueid = self.process_ueids[key]
+        except KeyError:
+            starttime = entityd.processme.start_time(stat, snapshot.boottime)
+            ueid = entityd.processme.PROCESS_UEID(
+                stat.pid, starttime.timestamp(), str(self.host_ueid))
+            self.process_ueids[key] = ueid
+        if process_ueids is not None:
+            process_ueids[key] = ueid
+        return ueid
 
     def get_missed_process_children(self, pid):
         """Walk the process tree returning child pid's
 
+        The tree is taken from the procfs snapshot of the current
+        collection cycle, so the process table is only read once no
+        matter how many containers are running.
+
         :param pid: A process id.
 
-        :returns a generator of found pid's
+        :returns a list of found pid's
         """
-        missed_processes = []
-        try:
-            proc = syskit.Process(int(pid))
-        except syskit.NoSuchProcessError as error:
-            log.warning("Process ({}) not found {}", pid, error)
-        else:
-            for child_proc in proc.children():
-                missed_processes.append(child_proc.pid)
-                missed_processes.extend(
-                    self.get_missed_process_children(child_proc.pid))
-        return missed_processes
+        snapshot = entityd.procfs.snapshot(self.session)
+        if snapshot.stat(int(pid)) is None:
+            log.warning("Process ({}) not found", pid)
+            return []
+        return snapshot.descendants(int(pid))
+
+    def get_container_pids(self, container):
+        """Get the pids of all processes running in a container.
+
+        The cgroup of the container is found from its main process and
+        the members are read from its ``cgroup.procs``.  If the cgroup
+        filesystem is not available the process tree of the main
+        process is used instead.
+
+        :param container: A :class:`docker.models.containers.Container`.
+
+        :returns: A list of pids.
+        """
+        pid = container.attrs['State'].get('Pid')
+        if not pid:
+            return []
+        cgroup = entityd.procfs.snapshot(self.session).container(pid)
+        if cgroup is not None and cgroup.id == container.id:
+            pids = entityd.procfs.container_pids(self.session, cgroup)
+            if pids is not None:
+                return pids
+        return [pid] + self.get_missed_process_children(pid)
 
     def generate_updates(self):
         """Generates the entity updates for the process group."""
         if not DockerClient.client_available():
             return
 
+        process_ueids = {}
         for container in DockerClient.running_containers():
             if container.status != "running":
                 continue
-            try:
-                top_results = container.top(ps_args="-o pid")
-            except docker.errors.APIError as err:
-                log.warning("Docker APIError: {}", err)
-                continue
-            processes = top_results['Processes']
-            if not processes:
+            pids = self.get_container_pids(container)
+            if not pids:
                 continue
 
             update = entityd.EntityUpdate(self.name)
@@ -100,15 +138,12 @@ class DockerContainerGroup(HostEntity):
             update.children.add(entityd.docker.get_ueid(
                 'DockerContainer', container.id))
 
-            for process in processes:
-                process_ueid = self.get_process_ueid(int(process[0]))
-                if process_ueid:
-                    update.children.add(process_ueid)
-
-            for missed_pid in self.get_missed_process_children(
-                    processes[0][0]):
-                process_ueid = self.get_process_ueid(missed_pid)
+            for pid in pids:
+                if not entityd.processme.is_selected(self.session, pid):
+                    continue
+                process_ueid = self.get_process_ueid(pid, process_ueids)
                 if process_ueid:
                     update.children.add(process_ueid)
 
             yield update
+        self.process_ueids = process_ueids
@@ -1,10 +1,22 @@
-"""Plugin providing the Endpoint Monitored Entity."""
+"""Plugin providing the Endpoint Monitored Entity.
+
+With ``--endpoint-aggregate`` the client side of outbound connections,
+the sockets bound to an ephemeral local port, are not reported as
+individual Endpoints.  They are folded into one "EndpointGroup" per
+process, remote address, remote port and protocol, counting the
+connections in the group.  Listening sockets and the sockets accepted
+by servers are always reported as Endpoints.
+"""
 import argparse
+import collections
 import socket
 
 import entityd
 import entityd.connections
+import entityd.mixins
 import entityd.pm
+import entityd.processme
+import entityd.procfs
 
 
 FAMILIES = {
@@ -21,20 +33,87 @@ PROTOCOLS = {
 }
 
 
-class EndpointEntity:
-    """Plugin to generate endpoint MEs."""
+#: The default range of ephemeral ports, as in
+#: /proc/sys/net/ipv4/ip_local_port_range of Linux.
+EPHEMERAL_PORTS = (32768, 60999)
+
+
+def port_range(value):
+    """Parse a port range given as ``LOW-HIGH``.
+
+    :raises argparse.ArgumentTypeError: If the range is not valid.
+
+    :returns: A tuple of the lowest and highest port in the range.
+    """
+    try:
+        low, high = (int(port) for port in value.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Invalid port range: {!r}'.format(value))
+    if not 0 < low <= high <= 65535:
+        raise argparse.ArgumentTypeError(
+            'Invalid port range: {!r}'.format(value))
+    return low, high
+
+
+def ephemeral_ports(procpath='/proc'):
+    """Read the range of ephemeral ports of the host.
+
+    :returns: A tuple of the lowest and highest port of the range, the
+       default :data:`EPHEMERAL_PORTS` if it can not be read.
+    """
+    path = '{}/sys/net/ipv4/ip_local_port_range'.format(procpath)
+    try:
+        with open(path) as fp:
+            low, high = fp.read().split()
+        return int(low), int(high)
+    except (OSError, ValueError):
+        return EPHEMERAL_PORTS
+
+
+class EndpointEntity(entityd.mixins.HostEntity):
+    """Plugin to generate endpoint MEs.
+
+    The UEIDs of the processes owning endpoints and of the remote
+    endpoints are cached.  Entries are dropped once a whole collection
+    cycle has passed without using them.
+
+    :ivar process_ueids: Dict mapping ``(pid, starttime)`` to the UEID
+       of the Process, for the processes seen in this cycle.
+    :ivar remote_ueids: Dict mapping ``(family, type, raddr)`` to the
+       UEID of the remote Endpoint, for the connections seen in this
+       cycle.
+    :ivar aggregate: Whether client connections are folded into
+       "EndpointGroup" entities.
+    :ivar ephemeral_ports: Tuple of the lowest and highest local port
+       of the client connections aggregated.
+    :ivar threshold: The minimum number of connections of a group, the
+       connections of smaller groups are reported as Endpoints.
+    """
 
     prefix = 'entityd.endpointme:'
 
     def __init__(self):
-        self.session = None
+        super().__init__()
         self.procpath = '/proc'
+        self.backend = 'procfs'
+        self.process_ueids = {}
+        self.remote_ueids = {}
+        self._previous_process_ueids = {}
+        self._previous_remote_ueids = {}
+        self.aggregate = False
+        self.ephemeral_ports = EPHEMERAL_PORTS
+        self.threshold = 1
+        self._connections = None
 
     @staticmethod
     @entityd.pm.hookimpl
     def entityd_configure(config):
-        """Register the Endpoint Monitored Entity."""
+        """Register the Endpoint and EndpointGroup Monitored Entities."""
         config.addentity('Endpoint', 'entityd.endpointme.EndpointEntity')
+        if config.args.endpoint_aggregate:
+            config.addentity('EndpointGroup',
+                             'entityd.endpointme.EndpointEntity')
 
     @entityd.pm.hookimpl
     def entityd_addoption(self, parser):
@@ -51,12 +130,53 @@ class EndpointEntity:
         except argparse.ArgumentError:
             # assume someone else added it.
             pass
+        parser.add_argument(
+            '--endpoint-backend',
+            default='procfs',
+            choices=['procfs', 'netlink'],
+            help='Read TCP and UDP sockets from the /proc/net files or '
+                 'the sock_diag netlink interface, which is faster with '
+                 'many sockets.  Falls back to procfs if sock_diag is '
+                 'not available.  Netlink always reads the sockets of '
+                 'the network namespace entityd runs in, even with '
+                 '--procpath.',
+        )
+        parser.add_argument(
+            '--endpoint-aggregate',
+            action='store_true',
+            help='Fold the client connections, bound to an ephemeral '
+                 'local port, of a process to the same remote address, '
+                 'port and protocol into one EndpointGroup counting '
+                 'the connections.',
+        )
+        parser.add_argument(
+            '--endpoint-ephemeral-ports',
+            type=port_range,
+            metavar='LOW-HIGH',
+            help='The local ports of the client connections aggregated '
+                 'with --endpoint-aggregate.  Defaults to the '
+                 'ip_local_port_range of the host.',
+        )
+        parser.add_argument(
+            '--endpoint-aggregate-threshold',
+            type=int,
+            default=1,
+            metavar='N',
+            help='Only aggregate groups of at least N client '
+                 'connections, the connections of smaller groups are '
+                 'reported as Endpoints.',
+        )
 
     @entityd.pm.hookimpl
     def entityd_sessionstart(self, session):
         """Store the session for later usage."""
         self.session = session
         self.procpath = session.config.args.procpath
+        self.backend = session.config.args.endpoint_backend
+        self.aggregate = session.config.args.endpoint_aggregate
+        self.ephemeral_ports = (session.config.args.endpoint_ephemeral_ports
+                                or ephemeral_ports(self.procpath))
+        self.threshold = session.config.args.endpoint_aggregate_threshold
 
     @entityd.pm.hookimpl
     def entityd_find_entity(self, name, attrs, include_ondemand=False):  # pylint: disable=unused-argument
@@ -65,6 +185,10 @@ class EndpointEntity:
             if attrs is not None:
                 raise LookupError('Attribute based filtering not supported')
             return self.endpoints()
+        elif name == 'EndpointGroup' and self.aggregate:
+            if attrs is not None:
+                raise LookupError('Attribute based filtering not supported')
+            return self.endpoint_groups()
 
     def get_ueid(self, conn):
         """Get a ueid for this endpoint if one exists, else generate one.
@@ -93,24 +217,65 @@ class EndpointEntity:
         return update
 
     def create_update(self, conn):
-        """Create an EntityUpdate from a Connection."""
+        """Create an EntityUpdate from a Connection.
+
+        :returns: The update or ``None`` if the process owning the
+           connection has vanished.
+        """
         update = self.create_local_update(conn)
-        if conn.bound_pid:
-            results = self.session.pluginmanager.hooks.entityd_find_entity(
-                name='Process', attrs={'pid': conn.bound_pid})
-            if results:
-                process = next(iter(results[0]))
-                if not process.exists:
-                    return None
-                else:
-                    update.parents.add(process)
+        if conn.bound_pid and 'Process' in self.session.config.entities:
+            process_ueid = self.get_process_ueid(conn.bound_pid)
+            if process_ueid is None:
+                return None
+            if entityd.processme.is_selected(self.session, conn.bound_pid):
+                update.parents.add(process_ueid)
         if conn.raddr:
             # Remote endpoint relation goes in parents and children
-            remote = self.get_remote_endpoint(conn)
-            update.parents.add(remote.ueid)
-            update.children.add(remote.ueid)
+            remote_ueid = self.get_remote_ueid(conn)
+            update.parents.add(remote_ueid)
+            update.children.add(remote_ueid)
         return update
 
+    def get_process_ueid(self, pid):
+        """Get the UEID of the Process entity of a process.
+
+        This is the same UEID as created by
+        :class:`entityd.processme.ProcessEntity` but only needs the
+        stat of the process from the procfs snapshot.
+
+        :returns: A :class:`cobe.UEID` or ``None`` if the process has
+           vanished.
+        """
+        snapshot = entityd.procfs.snapshot(self.session, self.procpath)
+        stat = snapshot.stat(pid)
+        if stat is None:
+            return None
+        key = (pid, stat.starttime)
+        try:
+            return self.process_ueids[key]
+        except KeyError:
+            pass
+        ueid = self._previous_process_ueids.get(key)
+        if ueid is None:
+            starttime = entityd.processme.start_time(stat, snapshot.boottime)
+            ueid = entityd.processme.PROCESS_UEID(
+                pid, starttime.timestamp(), str(self.host_ueid))
+        self.process_ueids[key] = ueid
+        return ueid
+
+    def get_remote_ueid(self, conn):
+        """Get the UEID of the remote Endpoint of conn."""
+        key = (conn.family, conn.type, conn.raddr)
+        try:
+            return self.remote_ueids[key]
+        except KeyError:
+            pass
+        ueid = self._previous_remote_ueids.get(key)
+        if ueid is None:
+            ueid = self.get_remote_endpoint(conn).ueid
+        self.remote_ueids[key] = ueid
+        return ueid
+
     @staticmethod
     def get_remote_endpoint(conn):
         """Get the UEID of the remote Endpoint of conn."""
@@ -131,19 +296,130 @@ class EndpointEntity:
                          traits={'entity:id'})
         return remote
 
+    def is_client(self, conn, listening):
+        """Whether conn is the client side of an aggregated connection.
+
+        These are the connected sockets of a process bound to an
+        ephemeral local port.  Sockets accepted by a server share the
+        port of the listening socket and are not client connections,
+        even if the server listens on a port in the ephemeral range.
+
+        :param listening: Set of the ``(family, type, port)`` of the
+           listening sockets.
+        """
+        return (self.aggregate
+                and conn.bound_pid
+                and conn.raddr
+                and conn.status != 'LISTEN'
+                and self.ephemeral_ports[0] <= conn.laddr[1]
+                <= self.ephemeral_ports[1]
+                and (conn.family, conn.type, conn.laddr[1]) not in listening)
+
+    def partition(self, conns):
+        """Split connections into Endpoints and EndpointGroups.
+
+        :returns: A tuple of the list of connections reported as
+           Endpoints and a dict mapping ``(pid, family, type, raddr)``
+           to the list of client connections of each EndpointGroup.
+        """
+        endpoints = []
+        groups = collections.defaultdict(list)
+        listening = {(conn.family, conn.type, conn.laddr[1])
+                     for conn in conns if conn.status == 'LISTEN'}
+        for conn in conns:
+            if self.is_client(conn, listening):
+                key = (conn.bound_pid, conn.family, conn.type, conn.raddr)
+                groups[key].append(conn)
+            else:
+                endpoints.append(conn)
+        for key in [k for k, v in groups.items() if len(v) < self.threshold]:
+            endpoints.extend(groups.pop(key))
+        return endpoints, dict(groups)
+
+    def retrieve(self, pid=None):
+        """Retrieve the inet connections and partition them.
+
+        The connections of all processes are retrieved once per procfs
+        snapshot, so the Endpoints and EndpointGroups of a collection
+        cycle share them.  A new snapshot also starts a new cycle of
+        the UEID caches.
+
+        :param pid: Optional. Find only connections for this process.
+
+        :returns: The tuple of :meth:`partition`.
+        """
+        snapshot = entityd.procfs.snapshot(self.session, self.procpath)
+        if (pid is None and self._connections is not None
+                and self._connections[0] is snapshot):
+            return self._connections[1]
+        if pid is None:
+            self._previous_process_ueids = self.process_ueids
+            self._previous_remote_ueids = self.remote_ueids
+            self.process_ueids = {}
+            self.remote_ueids = {}
+        with entityd.connections.set_procpath(self.procpath):
+            connections = entityd.connections.Connections(
+                snapshot, backend=self.backend)
+            conns = connections.retrieve('inet', pid=pid)
+            self.backend = connections.backend
+        partitioned = self.partition(conns)
+        if pid is None:
+            self._connections = (snapshot, partitioned)
+        return partitioned
+
     def endpoints(self, pid=None):
         """Generator of all endpoints.
 
-        Yields all connections of all active processes.
+        Yields all connections of all active processes, except the
+        client connections aggregated into EndpointGroups.
 
         :param pid: Optional. Find only connections for this process.
         """
-        with entityd.connections.set_procpath(self.procpath):
-            connections = entityd.connections.Connections()
-            for conn in connections.retrieve('inet', pid=pid):
-                update = self.create_update(conn)
-                if update:
-                    yield update
+        conns, _ = self.retrieve(pid)
+        for conn in conns:
+            update = self.create_update(conn)
+            if update:
+                yield update
+
+    def endpoint_groups(self):
+        """Generator of the EndpointGroups of all processes."""
+        _, groups = self.retrieve()
+        for conns in groups.values():
+            update = self.create_group_update(conns)
+            if update:
+                yield update
+
+    def create_group_update(self, conns):
+        """Create an EndpointGroup update from its client connections.
+
+        The group is identified by the process owning the connections
+        and the remote address, port and protocol they connect to.
+
+        :returns: The update or ``None`` if the process owning the
+           connections has vanished.
+        """
+        conn = conns[0]
+        process_ueid = self.get_process_ueid(conn.bound_pid)
+        if process_ueid is None:
+            return None
+        update = entityd.EntityUpdate('EndpointGroup')
+        update.label = '{}:{}'.format(conn.raddr[0], conn.raddr[1])
+        update.attrs.set('process', str(process_ueid), traits={'entity:id'})
+        update.attrs.set('addr', conn.raddr[0], traits={'entity:id'})
+        update.attrs.set('port', conn.raddr[1], traits={'entity:id'})
+        update.attrs.set('family', FAMILIES.get(conn.family),
+                         traits={'entity:id'})
+        update.attrs.set('protocol', PROTOCOLS.get(conn.type),
+                         traits={'entity:id'})
+        update.attrs.set('connections', len(conns), traits={'metric:gauge'})
+        if ('Process' in self.session.config.entities
+                and entityd.processme.is_selected(self.session,
+                                                  conn.bound_pid)):
+            update.parents.add(process_ueid)
+        remote_ueid = self.get_remote_ueid(conn)
+        update.parents.add(remote_ueid)
+        update.children.add(remote_ueid)
+        return update
 
     def endpoints_for_process(self, pid):
         """Generator of endpoints for the provided process.
@@ -62,26 +62,70 @@ class EntityUpdate:
 
         :returns: New :class:`EntityUpdate`, with attributes merged.
         """
-        if self.ueid != other.ueid:
-            raise ValueError('Cannot merge update for {0.ueid} with '
-                             'update for {1.ueid}'.format(self, other))
-        new = self.__class__(self.metype)
-        new.label = other.label
-        new.timestamp = other.timestamp
-        new.ttl = other.ttl
-        new.exists = other.exists
-        for attributes in (self.attrs, other.attrs):
-            for attribute in attributes:
-                new.attrs.set(attribute.name,
-                              attribute.value, attribute.traits)
-            for attribute_deleted in attributes.deleted():
-                new.attrs.delete(attribute_deleted)
-        for update in (self, other):
-            for relations_attribute in ('parents', 'children'):
-                for relation in getattr(update, relations_attribute):
-                    getattr(new, relations_attribute).add(relation)
+        return self.merge_all([self, other])
+
+    @classmethod
+    def merge_all(cls, updates):
+        """Merge any number of updates for the same entity together.
+
+        This is equivalent to merging the updates pairwise in order
+        using :meth:`merge`, but only a single new update is created
+        and each of the given updates is folded into it exactly once.
+
+        :param updates: Entity updates to merge, all of which must
+           have the same UEID. Later updates take precedence.
+        :type updates: Sequence of EntityUpdate
+
+        :raises ValueError: If attempting to merge updates with
+            different UEIDs or no updates are given.
+
+        :returns: New :class:`EntityUpdate`, with attributes merged.
+        """
+        if not updates:
+            raise ValueError('Cannot merge an empty sequence of updates')
+        first, *others = updates
+        ueid = first.ueid
+        for other in others:
+            if other.ueid != ueid:
+                raise ValueError('Cannot merge update for {0.ueid} with '
+                                 'update for {1.ueid}'.format(first, other))
+        new = cls(first.metype)
+        new._ueid = first._ueid  # pylint: disable=protected-access
+        for update in updates:
+            update._merge_into(new)  # pylint: disable=protected-access
         return new
 
+    def merge_into(self, target):
+        """Merge this update into another update in place.
+
+        The target update is modified as if it had been replaced by
+        ``target.merge(self)``, but without creating a new update or
+        copying the target's existing attributes and relations.
+
+        :param target: Entity update to merge this one into.
+        :type target: EntityUpdate
+
+        :raises ValueError: If attempting to merge updates with
+            different UEIDs.
+
+        :returns: The target :class:`EntityUpdate`.
+        """
+        if self.ueid != target.ueid:
+            raise ValueError('Cannot merge update for {0.ueid} with '
+                             'update for {1.ueid}'.format(target, self))
+        self._merge_into(target)
+        return target
+
+    def _merge_into(self, target):
+        """Merge this update into the target without checking UEIDs."""
+        target.label = self.label
+        target.timestamp = self.timestamp
+        target.ttl = self.ttl
+        target.exists = self.exists
+        target.attrs.update(self.attrs)
+        target.parents.update(self.parents)
+        target.children.update(self.children)
+
     def set_not_exists(self):
         """Mark this EntityUpdate as non existent."""
         self.exists = False
@@ -108,11 +152,7 @@ class EntityUpdate:
         """
         if self._ueid:
             return self._ueid
-        update = cobe.Update(self.metype)
-        for attribute in self.attrs:
-            update.attributes[attribute.name].set(attribute.value)
-            update.attributes[attribute.name].traits.update(attribute.traits)
-        return update.ueid()
+        return calculate_ueid(self.metype, self.attrs)
 
     @ueid.setter
     def ueid(self, ueid):
@@ -127,6 +167,123 @@ class EntityUpdate:
         self._ueid = cobe.UEID(ueid)
 
 
+def calculate_ueid(metype, attributes):
+    """Calculate the UEID of an entity from its attributes.
+
+    This is how both :attr:`EntityUpdate.ueid` and :class:`UEIDFactory`
+    create UEIDs, so the two always agree.
+
+    :param metype: The entity type.
+    :param attributes: The attributes of the entity, only those with
+       the ``entity:id`` trait are used.
+    :type attributes: Iterable of :class:`UpdateAttr`
+
+    :raises cobe.UEIDError: If a UEID cannot be generated. For example,
+       if one of the identifying attributes is not of a valid type.
+
+    :returns: A :class:`cobe.UEID` for the entity.
+    """
+    update = cobe.Update(metype)
+    for attribute in attributes:
+        update.attributes[attribute.name].set(attribute.value)
+        update.attributes[attribute.name].traits.update(attribute.traits)
+    return update.ueid()
+
+
+class UEIDFactory:
+    """Calculate UEIDs directly from identifying attribute values.
+
+    Building an :class:`EntityUpdate` only to access its UEID is wasteful
+    when the identifying attributes of the entity type are known ahead
+    of time. A factory is a template of an entity type and the ordered
+    names of its identifying attributes; calling it with the attribute
+    values returns the UEID the equivalent update would have::
+
+        factory = UEIDFactory('Process', 'pid', 'starttime', 'host')
+        ueid = factory(1234, 1500000000.0, str(host_ueid))
+
+    Calculated UEIDs are kept in a bounded LRU cache keyed on the
+    values, so relations which are looked up every collection cycle
+    only pay for the hashing once.
+
+    Use :func:`ueid_factory` to obtain a factory shared by all callers.
+
+    :param metype: The entity type the UEIDs are created for.
+    :param names: Names of the identifying attributes, in the same
+       order their values are passed when calling the factory.
+    :param maxsize: Maximum number of UEIDs to cache.
+    """
+
+    def __init__(self, metype, *names, maxsize=4096):
+        self.metype = metype
+        self.names = names
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+
+    def __call__(self, *values):
+        """Get the UEID for the given identifying attribute values.
+
+        :raises TypeError: If the number of values does not match
+           the number of identifying attribute names.
+        :raises cobe.UEIDError: If a UEID cannot be generated from the
+           values. For example, if one of them is not of a valid type.
+
+        :returns: A :class:`cobe.UEID` for the values.
+        """
+        if len(values) != len(self.names):
+            raise TypeError('Expected {} identifying attribute values for '
+                            '{!r} but got {}'.format(
+                                len(self.names), self.metype, len(values)))
+        # Types are part of the key as True == 1 but they are
+        # encoded differently in the UEID.
+        key = values + tuple(type(value) for value in values)
+        try:
+            ueid = self._cache[key]
+        except KeyError:
+            ueid = self._calculate(values)
+            self._cache[key] = ueid
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        except TypeError:
+            return self._calculate(values)  # Unhashable value
+        else:
+            self._cache.move_to_end(key)
+        return ueid
+
+    def _calculate(self, values):
+        """Calculate a UEID without consulting the cache."""
+        return calculate_ueid(self.metype, (
+            UpdateAttr(name, value, {'entity:id'})
+            for name, value in zip(self.names, values)))
+
+    def clear(self):
+        """Drop all cached UEIDs."""
+        self._cache.clear()
+
+
+_UEID_FACTORIES = {}
+
+
+def ueid_factory(metype, *names):
+    """Get the shared :class:`UEIDFactory` for an identity template.
+
+    Factories are keyed on the entity type together with the ordered
+    identifying attribute names, so all plugins creating UEIDs for the
+    same kind of entity share a single cache.
+
+    :param metype: The entity type the UEIDs are created for.
+    :param names: Names of the identifying attributes.
+
+    :returns: A :class:`UEIDFactory`.
+    """
+    try:
+        return _UEID_FACTORIES[(metype, names)]
+    except KeyError:
+        factory = _UEID_FACTORIES[(metype, names)] = \
+            UEIDFactory(metype, *names)
+        return factory
+
+
 UpdateAttr = collections.namedtuple('UpdateAttr', ['name', 'value', 'traits'])
 
 
@@ -179,6 +336,24 @@ class UpdateAttributes:
         """
         return set(self._deleted_attrs)
 
+    def update(self, other):
+        """Update the attributes in place from another collection.
+
+        Attributes set or deleted in the other collection override
+        those in this one; attributes only present in this one are
+        left unchanged. The attributes themselves are shared, not
+        copied, so they should not be modified afterwards.
+
+        :param other: The attributes to apply.
+        :type other: UpdateAttributes
+        """
+        # pylint: disable=protected-access
+        self._attrs.update(other._attrs)
+        self._deleted_attrs.difference_update(other._attrs)
+        for name in other._deleted_attrs:
+            self._attrs.pop(name, None)
+        self._deleted_attrs.update(other._deleted_attrs)
+
     def clear(self, name):
         """Clear an attribute from the update by name.
 
@@ -221,6 +396,18 @@ class UpdateRelations:
                              'as relations but got {!r}'.format(type(ueid)))
         self._relations.add(ueid)
 
+    def update(self, other):
+        """Add all the relations from another set of relations.
+
+        :param other: The relations to add.
+        :type other: UpdateRelations
+        """
+        # Declarative entities replace the relations with a lazily
+        # evaluated iterable which has to be resolved before adding.
+        if not isinstance(self._relations, set):
+            self._relations = set(self._relations)
+        self._relations.update(other)
+
     def discard(self, entity):
         """Discard an entity from the relations of this update.
 
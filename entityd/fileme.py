@@ -2,14 +2,40 @@
 
 Does not return anything for entity collection;
 only returns explicitly requested files.
+
+The same files, like the config files of services, are requested every
+collection.  Their stat results are cached by path and each cached
+file is watched with inotify, the cached result is dropped as soon as
+the file changes.  Watched files are stat'ed again at least every
+``--file-cache-ttl`` seconds in case an event was missed, e.g. when the
+path now leads to another file because a parent directory was renamed.
+At most ``--file-max-watches`` files are watched and cached, the least
+recently requested are dropped first.  Files which could not be
+watched are stat'ed on every request.
 """
 
+import collections
+import errno
 import os
 import stat
+import time
 
 import logbook
 
 import entityd
+import entityd.inotify
+import entityd.mixins
+
+
+#: The inotify events after which a cached file is stat'ed again.
+WATCH_MASK = (entityd.inotify.IN_MODIFY | entityd.inotify.IN_ATTRIB |
+              entityd.inotify.IN_CLOSE_WRITE |
+              entityd.inotify.IN_DELETE_SELF | entityd.inotify.IN_MOVE_SELF)
+
+
+#: A cached stat result, with the inotify watch descriptor of the file
+#: and the monotonic time it was stat'ed at.
+CachedStat = collections.namedtuple('CachedStat', ['stat', 'wd', 'validated'])
 
 
 class FileEntity:
@@ -24,6 +50,12 @@ class FileEntity:
         self.session = None
         self._host_ueid = None
         self.log = logbook.Logger(__name__)
+        self.ttl = 300
+        self.max_watches = 1024
+        self._inotify = None
+        self._cache = collections.OrderedDict()
+        self._watches = {}
+        self._warned = False
 
     @staticmethod
     @entityd.pm.hookimpl
@@ -31,10 +63,46 @@ class FileEntity:
         """Register the File Monitored Entity."""
         config.addentity('File', 'entityd.fileme.FileEntity')
 
+    @staticmethod
+    @entityd.pm.hookimpl
+    def entityd_addoption(parser):
+        """Add the options for the cache of files."""
+        parser.add_argument(
+            '--file-cache-ttl',
+            default=300,
+            type=float,
+            help='Seconds after which a watched file is checked for '
+                 'changes even without an inotify event.',
+        )
+        parser.add_argument(
+            '--file-max-watches',
+            default=1024,
+            type=int,
+            help='The number of files to cache and watch with inotify, '
+                 '0 disables the cache.',
+        )
+
     @entityd.pm.hookimpl
     def entityd_sessionstart(self, session):
-        """Store the session."""
+        """Store the session and start watching files."""
         self.session = session
+        self.ttl = session.config.args.file_cache_ttl
+        self.max_watches = session.config.args.file_max_watches
+        if self.max_watches > 0:
+            try:
+                self._inotify = entityd.inotify.Inotify()
+            except OSError as err:
+                self.log.warning('Not caching files, inotify is not '
+                                 'available: {}', err)
+
+    @entityd.pm.hookimpl
+    def entityd_sessionfinish(self):
+        """Stop watching files."""
+        self._cache.clear()
+        self._watches.clear()
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
 
     @entityd.pm.hookimpl
     def entityd_find_entity(self, name, attrs, include_ondemand=False):  # pylint: disable=unused-argument
@@ -57,16 +125,107 @@ class FileEntity:
 
         :param attrs: Must be supplied to get entities back. Only `path` is
            supported and `path` must be set to the absolute location of an
-           existing file.
+           existing file, or to a list of such locations to look up
+           many files at once.
 
         :return: Iterator of file entities.
         """
         if 'path' in attrs:
-            if os.path.isfile(attrs['path']):
-                yield self.create_entity(path=attrs['path'])
-            else:
-                self.log.debug('Failed to create entity for non-existent file\
-                                at {}', attrs['path'])
+            paths = attrs['path']
+            if isinstance(paths, str):
+                paths = [paths]
+            stats = self.stat_files(paths)
+            for path in paths:
+                if path in stats:
+                    yield self.create_entity(path, stats[path])
+                else:
+                    self.log.debug('Failed to create entity for '
+                                   'non-existent file at {}', path)
+
+    def stat_files(self, paths):
+        """Stat regular files, using the cached results where still valid.
+
+        The pending inotify events are read once for all the paths.
+
+        :param paths: A list of paths.
+
+        :returns: A dict mapping the paths of the regular files which
+           exist to their :class:`os.stat_result`.
+        """
+        self._process_events()
+        now = time.monotonic()
+        stats = {}
+        for path in paths:
+            cached = self._cache.get(path)
+            if cached is not None and now - cached.validated < self.ttl:
+                self._cache.move_to_end(path)
+                stats[path] = cached.stat
+                continue
+            self._forget(path)
+            wd = self._watch(path)
+            try:
+                fstat = os.stat(path)
+            except OSError:
+                fstat = None
+            if fstat is None or not stat.S_ISREG(fstat.st_mode):
+                self._unwatch(wd, path)
+                continue
+            stats[path] = fstat
+            if wd is not None:
+                self._cache[path] = CachedStat(fstat, wd, now)
+                if len(self._cache) > self.max_watches:
+                    self._forget(next(iter(self._cache)))
+        return stats
+
+    def _process_events(self):
+        """Drop the cached files which changed since the last lookup."""
+        if not self._inotify:
+            return
+        for event in self._inotify.read():
+            if event.mask & entityd.inotify.IN_Q_OVERFLOW:
+                for path in list(self._cache):
+                    self._forget(path)
+                return
+            for path in list(self._watches.get(event.wd, ())):
+                self._forget(path)
+
+    def _watch(self, path):
+        """Watch a file.
+
+        :returns: The watch descriptor or ``None`` if the file is not
+           watched.
+        """
+        if not self._inotify:
+            return None
+        try:
+            wd = self._inotify.add_watch(path, WATCH_MASK)
+        except OSError as err:
+            if not self._warned and err.errno == errno.ENOSPC:
+                self.log.warning('Could not watch {}, the inotify watch '
+                                 'limit is reached: {}', path, err)
+                self._warned = True
+            return None
+        self._watches.setdefault(wd, set()).add(path)
+        return wd
+
+    def _unwatch(self, wd, path):
+        """Remove a path from a watch, removing the watch when unused.
+
+        Several paths share a watch when they lead to the same file.
+        """
+        paths = self._watches.get(wd)
+        if paths is None:
+            return
+        paths.discard(path)
+        if not paths:
+            del self._watches[wd]
+            self._inotify.rm_watch(wd)
+
+    def _forget(self, path):
+        """Drop the cached stat result of a file and stop watching it."""
+        cached = self._cache.pop(path, None)
+        if cached is not None:
+            self._unwatch(cached.wd, path)
 
     @property
     def host_ueid(self):  # pragma: no cover
@@ -77,18 +236,18 @@ class FileEntity:
         :returns: A :class:`cobe.UEID` for the  host.
         """
         if not self._host_ueid:
-            results = self.session.pluginmanager.hooks.entityd_find_entity(
-                name='Host', attrs=None)
-            if results:
-                host_me = next(iter(results[0]))
-                self._host_ueid = host_me.ueid
-        if not self._host_ueid:
-            raise LookupError('Could not find the host UEID')
+            self._host_ueid = entityd.mixins.find_host_ueid(self.session)
         return self._host_ueid
 
-    def create_entity(self, path):
-        """Create a File EntityUpdate."""
-        fstat = os.stat(path)
+    def create_entity(self, path, fstat=None):
+        """Create a File EntityUpdate.
+
+        :param str path: The path of the file.
+        :param fstat: The :class:`os.stat_result` of the file, the file
+           is stat'ed if not given.
+        """
+        if fstat is None:
+            fstat = os.stat(path)
         update = entityd.EntityUpdate('File')
         update.label = path
         update.attrs.set('host', str(self.host_ueid),
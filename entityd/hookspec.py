@@ -121,6 +121,15 @@ def entityd_find_entity(name, attrs=None,
     """
 
 
+@entityd.pm.hookdef(firstresult=True)
+def entityd_host_ueid():
+    """Return the UEID of the Host entityd is running on.
+
+    This is cheaper than finding the Host entity with
+    :func:`entityd_find_entity` when only its UEID is needed.
+    """
+
+
 @entityd.pm.hookdef
 def entityd_emit_entities():
     """Return an iterator of entity updates.
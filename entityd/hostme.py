@@ -1,44 +1,66 @@
-"""Plugin providing the Host Monitored Entity."""
+"""Plugin providing the Host Monitored Entity.
 
+The identity and the static facts of the host, like its hostname and
+FQDN, rarely change while some of them are slow to get.
+``socket.getfqdn()`` can block on DNS for seconds.  These are cached
+and refreshed in a background thread once older than
+``--host-facts-ttl``, only the metrics are read every collection.
+"""
+
+import argparse
+import collections
 import os
 import platform
 import socket
 import threading
+import time
 
-import act
 import logbook
 import syskit
-import zmq
 
 import entityd.pm
+import entityd.sampler
+
+
+log = logbook.Logger(__name__)
+
+
+#: The static facts of a host.
+HostFacts = collections.namedtuple('HostFacts', [
+    'hostname', 'fqdn', 'os', 'osversion', 'boottime'])
+
+
+def host_facts():
+    """Gather the static facts of the host.
+
+    :returns: A :class:`HostFacts` instance.
+    """
+    return HostFacts(hostname=socket.gethostname(),
+                     fqdn=socket.getfqdn(),
+                     os=platform.system(),
+                     osversion=platform.release(),
+                     boottime=syskit.boottime().timestamp())
 
 
-class HostCpuUsage(threading.Thread):
-    """A background thread fetching cpu times and calculating percentages.
+class HostCpuUsage:
+    """Fetch cpu times and calculate percentages.
 
-    Accessible via ZMQ Pair/Pair socket; receives a
-    request and responds with  a list of tuples containing the required
-    attribute values: (name, value, traits)
+    This is run as a task of the sampler service.  Every update
+    publishes a new list of tuples of the attribute values, (name,
+    value, traits), as ``last_attributes``.
 
-    :param Context context: The ZMQ context to use
-    :param str endpoint: The ZMQ endpoint to listen for requests on
     :param int interval: The period in seconds to wait between refreshes
 
     :ivar last_cpu_times: Last cpu times reported from syskit
     :ivar last_attributes: The last entity attributes constructed
     """
 
-    def __init__(self, context, endpoint='inproc://hostcpuusage', interval=15):
-        self._context = context
-        self.listen_endpoint = endpoint
+    def __init__(self, interval=15):
+        self.interval = interval
         self.last_cpu_times = None
         self.last_attributes = []
-        self._stream = None
-        self._timer_interval = interval
-        self._log = logbook.Logger('HostCpuUsage')
-        super().__init__()
 
-    def _update_times(self):
+    def update(self):
         """Get current cpu times and update known attributes."""
         attrs = ['usr', 'nice', 'sys', 'idle', 'iowait', 'irq', 'softirq',
                  'steal', 'guest', 'guest_nice']
@@ -59,84 +81,93 @@ class HostCpuUsage(threading.Thread):
         self.last_attributes = attributes
         return attributes
 
-    def run(self):
-        """Run in a loop, restarting on unexpected exceptions."""
-        while True:
-            try:
-                self._run()
-            except Exception:  # pylint: disable=broad-except
-                self._log.exception('An unexpected exception occurred in '
-                                    'HostCpuUsage thread')
-            else:
-                break
-            finally:
-                self.stop()
-
-    def _run(self):
-        """Run the thread main loop.
-
-        Registers the regular timer and polls for
-        events from the incoming request socket.
-        """
-        self._stream = act.zkit.EventStream(self._context)
-        timer = act.zkit.SimpleTimer()
-        timer.schedule(0)
-        sock = self._context.socket(zmq.PAIR)
-        sock.bind(self.listen_endpoint)
-        self._stream.register(sock, self._stream.POLLIN)
-        self._stream.register(timer, self._stream.TIMER)
-        try:
-            for event, _ in self._stream:
-                if event is timer:
-                    self._update_times()
-                    timer.schedule(self._timer_interval * 1000)
-                elif event is sock:
-                    _ = sock.recv_pyobj()
-                    sock.send_pyobj(self.last_attributes)
-        finally:
-            sock.close(linger=0)
-            self._stream.close()
-
-    def stop(self):
-        """Stop the thread safely."""
-        if self._stream:
-            self._stream.send_term()
-
 
 class HostEntity:                    # pylint: disable=too-many-instance-attributes
-    """Plugin to generate Host MEs."""
+    """Plugin to generate Host MEs.
+
+    :ivar facts_ttl: The age in seconds after which the static facts
+       of the host are refreshed.
+    """
 
     def __init__(self):
         self.host_uuid = None
         self.session = None
+        self.facts_ttl = 300
         self._bootid = None
         self._incontainer = None
-        self.cpuusage_sock = None
-        self.cpuusage_thread = None
-        self.zmq_context = None
+        self._host_ueid = None
+        self._facts = None
+        self._facts_time = None
+        self._facts_thread = None
+        self.cpuusage = None
+        self.cpuusage_task = None
+        self.sampler = None
+        self.sampler_task = None
+
+    @entityd.pm.hookimpl
+    def entityd_addoption(self, parser):
+        """Add the options of the Host entity."""
+        try:
+            parser.add_argument(
+                '--procpath',
+                default='/proc',
+                type=str,
+                help='Path to /proc if mounted elsewhere',
+            )
+        except argparse.ArgumentError:
+            # assume someone else added it.
+            pass
+        parser.add_argument(
+            '--host-sample-interval',
+            default=0.0,
+            type=float,
+            metavar='SECONDS',
+            help='Sample the CPU, memory, load, disk and network usage '
+                 'of the host this often and report the minimum, '
+                 'maximum, average and 95th percentile of the samples '
+                 'of each collection period.  Disabled by default.',
+        )
+        parser.add_argument(
+            '--host-facts-ttl',
+            default=300,
+            type=int,
+            metavar='SECONDS',
+            help='Refresh the static facts of the host, like the FQDN '
+                 'and the OS version, once they are older than this.',
+        )
 
     @entityd.pm.hookimpl
     def entityd_sessionstart(self, session):
         """Called when the monitoring session starts."""
         self.session = session
-        self.zmq_context = act.zkit.new_context()
-        self.cpuusage_thread = HostCpuUsage(self.zmq_context)
-        self.cpuusage_thread.start()
-        self.cpuusage_sock = self.zmq_context.socket(zmq.PAIR)
-        self.cpuusage_sock.connect(self.cpuusage_thread.listen_endpoint)
+        self.facts_ttl = session.config.args.host_facts_ttl
+        self._remove_tasks()
+        sampler = entityd.sampler.service(session)
+        self.cpuusage = HostCpuUsage()
+        self.cpuusage_task = sampler.add(
+            'host-cpu', self.cpuusage.update, self.cpuusage.interval)
+        if session.config.args.host_sample_interval > 0:
+            self.sampler = entityd.sampler.HostSampler(
+                interval=session.config.args.host_sample_interval,
+                procpath=session.config.args.procpath)
+            self.sampler_task = self.sampler.start(sampler)
 
     @entityd.pm.hookimpl
     def entityd_sessionfinish(self):
         """Finish the session.
 
-        Stops the thread and closes the socket.
+        Removes the sampling tasks.
         """
-        if self.cpuusage_thread:
-            self.cpuusage_thread.stop()
-            self.cpuusage_thread.join(timeout=2)
-        if self.cpuusage_sock:
-            self.cpuusage_sock.close(linger=0)
-        self.zmq_context.destroy(linger=0)
+        self._remove_tasks()
+        if self._facts_thread:
+            self._facts_thread.join(timeout=2)
+
+    def _remove_tasks(self):
+        """Remove the sampling tasks, if any, from the sampler service."""
+        for task in [self.cpuusage_task, self.sampler_task]:
+            if task:
+                entityd.sampler.service(self.session).remove(task)
+        self.cpuusage_task = self.sampler_task = None
 
     @staticmethod
     @entityd.pm.hookimpl
@@ -152,6 +183,11 @@ class HostEntity:                    # pylint: disable=too-many-instance-attribu
                 raise LookupError('Attribute based filtering not supported')
             return self.hosts()
 
+    @entityd.pm.hookimpl
+    def entityd_host_ueid(self):
+        """Return the UEID of the host."""
+        return self.host_ueid
+
     @property
     def bootid(self):
         """Get and store the boot ID of the executing kernel.
@@ -177,18 +213,63 @@ class HostEntity:                    # pylint: disable=too-many-instance-attribu
             self._incontainer = os.path.isfile('/.dockerenv')
         return self._incontainer
 
+    @property
+    def host_ueid(self):
+        """Get and store the UEID of the host.
+
+        This only needs the boot ID, not the complete Host update.
+
+        :returns: A :class:`cobe.UEID` for the host.
+        """
+        if self._host_ueid is None:
+            update = entityd.EntityUpdate('Host')
+            update.attrs.set('bootid', self.bootid, {'entity:id'})
+            self._host_ueid = update.ueid
+        return self._host_ueid
+
+    @property
+    def facts(self):
+        """The static facts of the host.
+
+        The facts are gathered on first use.  Once older than
+        ``facts_ttl`` they are refreshed in a background thread, the
+        previous facts are returned until that is done.
+
+        :returns: A :class:`HostFacts` instance.
+        """
+        if self._facts is None:
+            self._refresh_facts()
+        elif (time.monotonic() - self._facts_time > self.facts_ttl
+              and not (self._facts_thread
+                       and self._facts_thread.is_alive())):
+            self._facts_thread = threading.Thread(
+                target=self._refresh_facts, name='HostFacts', daemon=True)
+            self._facts_thread.start()
+        return self._facts
+
+    def _refresh_facts(self):
+        """Gather the static facts of the host and store them."""
+        try:
+            facts = host_facts()
+        except Exception:  # pylint: disable=broad-except
+            if self._facts is None:
+                raise
+            log.exception('Failed to refresh the facts of the host')
+        else:
+            self._facts = facts
+        self._facts_time = time.monotonic()
+
     def hosts(self):
         """Generator of Host MEs."""
         update = entityd.EntityUpdate('Host')
-
-        hostname = socket.gethostname()
-        update.label = hostname
-        update.attrs.set('hostname', hostname, {'index'})
-        update.attrs.set('fqdn', socket.getfqdn(), {'index'})
+        facts = self.facts
+        update.label = facts.hostname
+        update.attrs.set('hostname', facts.hostname, {'index'})
+        update.attrs.set('fqdn', facts.fqdn, {'index'})
         update.attrs.set('bootid', self.bootid, {'entity:id'})
         update.attrs.set('uptime', int(syskit.uptime()),
                          {'time:duration', 'unit:seconds', 'metric:counter'})
-        update.attrs.set('boottime', syskit.boottime().timestamp(),
+        update.attrs.set('boottime', facts.boottime,
                          {'time:posix', 'unit:seconds'})
         load = syskit.loadavg()
         update.attrs.set('loadavg_1', load[0], {'metric:gauge'})
@@ -202,18 +283,32 @@ class HostEntity:                    # pylint: disable=too-many-instance-attribu
                          {'unit:bytes', 'metric:gauge'})
         update.attrs.set('used', (memorystats.total - free) * 1024,
                          {'unit:bytes', 'metric:gauge'})
-        update.attrs.set('os', platform.system(), {'index'})
-        update.attrs.set('osversion', platform.release(), {'index'})
+        update.attrs.set('os', facts.os, {'index'})
+        update.attrs.set('osversion', facts.osversion, {'index'})
         self._add_cputime_attrs(update)
+        if self.sampler:
+            self._add_sampled_attrs(update)
         yield update
 
+    def _add_sampled_attrs(self, update):
+        """Add the summaries of the samples of the host metrics.
+
+        Each sampled metric gets a ``sampled:<metric>:<stat>``
+        attribute for the minimum, maximum, average and 95th
+        percentile of its samples since the previous update.
+        """
+        for metric, summary in self.sampler.summary():
+            for stat, value in zip(summary._fields, summary):
+                update.attrs.set('sampled:{}:{}'.format(metric.name, stat),
+                                 value, set(metric.traits))
+        update.attrs.set('sampled:overhead', self.sampler.overhead * 100,
+                         {'metric:gauge', 'unit:percent'})
+
     def _add_cputime_attrs(self, update):
         """Add cputimes and their % values to update.
 
         The first call will return values since system boot; subsequent calls
         will return the values for the period in between calls.
         """
-        self.cpuusage_sock.send_pyobj('REQ')
-        cpupc = self.cpuusage_sock.recv_pyobj()
-        for attr, val, traits in cpupc:
+        for attr, val, traits in self.cpuusage.last_attributes:
             update.attrs.set(attr, val, traits)
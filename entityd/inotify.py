@@ -0,0 +1,120 @@
+"""A minimal interface to the inotify API of Linux.
+
+Only what is needed to notice changes to individual files is wrapped:
+adding and removing watches and reading the pending events without
+blocking.  The system calls are made with ctypes so no extension
+module is needed.
+
+See inotify(7).
+"""
+
+import collections
+import ctypes
+import errno
+import os
+import struct
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+
+#: An inotify event.  The name is only set for events on files in a
+#: watched directory, as bytes.
+Event = collections.namedtuple('Event', ['wd', 'mask', 'cookie', 'name'])
+
+
+_EVENT = struct.Struct('=iIII')
+
+
+def _check(result):
+    """Raise the errno of a failed call as an OSError."""
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify:
+    """An inotify instance.
+
+    The file descriptor is non-blocking, :meth:`read` returns the
+    events pending at the time.
+
+    :raises OSError: If inotify is not available, or the limit of
+       inotify instances is reached.
+    """
+
+    def __init__(self):
+        try:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError) as err:
+            raise OSError(errno.ENOSYS, 'inotify is not available') from err
+        self._fd = _check(init(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def fileno(self):
+        """The file descriptor of the instance."""
+        return self._fd
+
+    @property
+    def closed(self):
+        """Whether the instance is closed."""
+        return self._fd is None
+
+    def close(self):
+        """Close the instance, removing all its watches."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def add_watch(self, path, mask):
+        """Watch a path.
+
+        Watching a path whose inode is already watched returns the
+        watch descriptor of the existing watch, with its mask replaced.
+
+        :raises OSError: If the path can not be watched, e.g. it does not
+           exist or the limit of watches is reached.
+
+        :returns: The watch descriptor.
+        """
+        return _check(self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), ctypes.c_uint32(mask)))
+
+    def rm_watch(self, wd):
+        """Stop watching.
+
+        Watches which the kernel already removed, e.g. because their
+        file was deleted, are ignored.
+        """
+        try:
+            _check(self._libc.inotify_rm_watch(self._fd, wd))
+        except OSError as err:
+            if err.errno != errno.EINVAL:
+                raise
+
+    def read(self):
+        """Read the pending events.
+
+        :returns: A list of :class:`Event` instances, empty if there
+           are none.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append(Event(wd, mask, cookie, name))
@@ -12,6 +12,15 @@ from entityd.kubernetes.group import NamespaceGroup
 RFC_3339_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 log = logbook.Logger(__name__)
 
+POD_UEID = entityd.entityupdate.ueid_factory(
+    'Kubernetes:Pod',
+    'kubernetes:meta:name', 'kubernetes:meta:namespace', 'cluster')
+NAMESPACE_UEID = entityd.entityupdate.ueid_factory(
+    'Kubernetes:Namespace', 'kubernetes:meta:name', 'cluster')
+REPLICASET_UEID = entityd.entityupdate.ueid_factory(
+    'Kubernetes:ReplicaSet',
+    'kubernetes:meta:name', 'kubernetes:meta:namespace', 'cluster')
+
 
 SYMBOLS = {
     'Ki': 1024, 'Mi': 1024**2, 'Gi': 1024**3,
@@ -99,13 +108,7 @@ class BasePlugin(metaclass=ABCMeta):
 
         :returns: A :class:`cobe.UEID` for the pod.
         """
-        update = entityd.EntityUpdate('Kubernetes:Pod')
-        update.attrs.set('kubernetes:meta:name', podname, traits={'entity:id'})
-        update.attrs.set(
-            'kubernetes:meta:namespace', namespace, traits={'entity:id'})
-        update.attrs.set(
-            'cluster', str(self.cluster_ueid), traits={'entity:id'})
-        return update.ueid
+        return POD_UEID(podname, namespace, str(self.cluster_ueid))
 
     def create_namespace_ueid(self, namespace):
         """Create the ueid for a namespace.
@@ -114,12 +117,7 @@ class BasePlugin(metaclass=ABCMeta):
 
         :returns: A :class:`cobe.UEID` for the namespace.
         """
-        update = entityd.EntityUpdate('Kubernetes:Namespace')
-        update.attrs.set('kubernetes:meta:name',
-                         namespace, traits={'entity:id'})
-        update.attrs.set('cluster', str(self.cluster_ueid),
-                         traits={'entity:id', 'entity:ueid'})
-        return update.ueid
+        return NAMESPACE_UEID(namespace, str(self.cluster_ueid))
 
     def create_replicaset_ueid(self, rs_name, namespace):
         """Create the ueid for a replicaset.
@@ -129,13 +127,7 @@ class BasePlugin(metaclass=ABCMeta):
 
         :returns: A :class:`cobe.UEID` for the Replica Set.
         """
-        update = entityd.EntityUpdate('Kubernetes:ReplicaSet')
-        update.attrs.set('kubernetes:meta:name', rs_name, traits={'entity:id'})
-        update.attrs.set(
-            'kubernetes:meta:namespace', namespace, traits={'entity:id'})
-        update.attrs.set(
-            'cluster', str(self.cluster_ueid), traits={'entity:id'})
-        return update.ueid
+        return REPLICASET_UEID(rs_name, namespace, str(self.cluster_ueid))
 
     def create_labelselector(self, resource):
         """Create the `labelSelector` string from resource's selector labels.
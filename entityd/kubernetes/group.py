@@ -4,6 +4,9 @@ import logbook
 import requests
 
 import entityd
+import entityd.entityupdate
+import entityd.kubernetes
+import entityd.pm
 
 log = logbook.Logger(__name__)
 
@@ -76,22 +79,15 @@ class NamespaceGroup:
 
         :returns: A :class:`cobe.UEID` for the namespace.
         """
-        update = entityd.EntityUpdate('Kubernetes:Namespace')
-        update.attrs.set('kubernetes:meta:name',
-                         namespace, traits={'entity:id'})
-        update.attrs.set('cluster', str(cls.get_cluster_ueid(session)),
-                         traits={'entity:id', 'entity:ueid'})
-        return update.ueid
+        return entityd.kubernetes.NAMESPACE_UEID(
+            namespace, str(cls.get_cluster_ueid(session)))
 
     @classmethod
     def get_ueid(cls, namespace_name, session):
         """Get the ueid for a namespace group"""
-        entity = entityd.EntityUpdate(cls.name)
-        entity.attrs.set('kind', cls.kind, traits={'entity:id'})
         id_ueid = cls.create_namespace_ueid(namespace_name, session)
-        entity.attrs.set('id', str(id_ueid), traits={'entity:id'})
-
-        return entity.ueid
+        return entityd.entityupdate.ueid_factory(cls.name, 'kind', 'id')(
+            cls.kind, str(id_ueid))
 
     def log_api_server_unreachable(self):
         """Log once that the Kubernetes API server is unreachable."""
@@ -484,15 +484,8 @@ def create_pod_ueid(pod_name, cluster):
     """
     for pod in cluster.pods:
         if pod_name == pod.meta.name:
-            update = entityd.EntityUpdate('Kubernetes:Pod')
-            update.attrs.set('kubernetes:meta:name', pod_name,
-                             traits={'entity:id'})
-            update.attrs.set(
-                'kubernetes:meta:namespace', pod.meta.namespace,
-                traits={'entity:id'})
-            update.attrs.set(
-                'cluster', _CLUSTER_UEID, traits={'entity:id'})
-            return update.ueid
+            return entityd.kubernetes.POD_UEID(
+                pod_name, pod.meta.namespace, _CLUSTER_UEID)
     raise LookupError("Pod {} not found in the cluster".format(pod_name))
 
 
@@ -5,11 +5,34 @@ A place for commonly needed Mixins to live
 import entityd
 
 
+def find_host_ueid(session):
+    """Find the UEID of the host.
+
+    This uses the :func:`entityd.hookspec.entityd_host_ueid` hook and
+    only falls back to finding the Host entity if no plugin implements
+    it.
+
+    :raises LookupError: If a host UEID cannot be found.
+
+    :returns: A :class:`cobe.UEID` for the host.
+    """
+    ueid = session.pluginmanager.hooks.entityd_host_ueid()
+    if ueid is not None:
+        return ueid
+    results = session.pluginmanager.hooks.entityd_find_entity(
+        name='Host', attrs=None)
+    for hosts in results:
+        for host in hosts:
+            return host.ueid
+    raise LookupError('Could not find the host UEID')
+
+
 class HostEntity:
     """Mixin to help get the host UEID"""
 
     def __init__(self):
         self._host_entity = None
+        self._host_ueid = None
         self.session = None
 
     @entityd.pm.hookimpl()
@@ -44,7 +67,9 @@ class HostEntity:
 
         :returns: A :class:`cobe.UEID` for the host.
         """
-        return self.host_entity.ueid
+        if self._host_ueid is None:
+            self._host_ueid = find_host_ueid(self.session)
+        return self._host_ueid
 
     @property
     def hostname(self):
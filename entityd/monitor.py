@@ -13,6 +13,7 @@ import itertools
 import cobe
 import logbook
 
+import entityd.entityupdate
 import entityd.health
 import entityd.pm
 
@@ -137,15 +138,19 @@ class Monitor:
         updates_ordered = []  # UEID
         updates_sequenced = {}  # UEID : updates
         for update in updates:
-            if update.ueid not in updates_sequenced:
-                updates_ordered.append(update.ueid)
-                updates_sequenced[update.ueid] = []
-            updates_sequenced[update.ueid].append(update)
+            ueid = update.ueid
+            try:
+                updates_sequenced[ueid].append(update)
+            except KeyError:
+                updates_ordered.append(ueid)
+                updates_sequenced[ueid] = [update]
         for ueid in updates_ordered:
-            final, *changes = updates_sequenced[ueid]
-            for change in changes:
-                final = final.merge(change)
-            updates_merged.append(final)
+            updates_ueid = updates_sequenced[ueid]
+            if len(updates_ueid) == 1:
+                updates_merged.append(updates_ueid[0])
+            else:
+                updates_merged.append(
+                    entityd.entityupdate.EntityUpdate.merge_all(updates_ueid))
         return updates_merged
 
     def _send_updates(self, updates):
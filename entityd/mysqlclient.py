@@ -0,0 +1,310 @@
+"""A minimal client of the MySQL client/server protocol.
+
+Only what is needed to query the status of a local MySQL server is
+implemented: connecting over a Unix socket or TCP, authenticating with
+the ``mysql_native_password`` or ``caching_sha2_password`` plugins and
+running text queries.  This way no MySQL driver needs to be installed
+on monitored hosts.
+
+Queries are bounded by a timeout, if the server does not answer in
+time the connection is closed as the protocol state is then unknown.
+
+See https://dev.mysql.com/doc/dev/mysql-server/latest/PAGE_PROTOCOL.html
+"""
+
+import hashlib
+import socket
+import struct
+
+
+CLIENT_LONG_PASSWORD = 0x1
+CLIENT_PROTOCOL_41 = 0x200
+CLIENT_SECURE_CONNECTION = 0x8000
+CLIENT_PLUGIN_AUTH = 0x80000
+CAPABILITIES = (CLIENT_LONG_PASSWORD | CLIENT_PROTOCOL_41 |
+                CLIENT_SECURE_CONNECTION | CLIENT_PLUGIN_AUTH)
+COM_QUIT = 0x01
+COM_QUERY = 0x03
+UTF8_GENERAL_CI = 33
+MAX_PACKET = (1 << 24) - 1
+
+
+class MySQLError(Exception):
+    """An error reported by the server, or a protocol error.
+
+    :ivar code: The MySQL error number, ``None`` for protocol errors.
+    """
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+def _xor(left, right):
+    return bytes(a ^ b for a, b in zip(left, right))
+
+
+def native_password(password, salt):
+    """Scramble a password for ``mysql_native_password``."""
+    if not password:
+        return b''
+    stage1 = hashlib.sha1(password.encode()).digest()
+    stage2 = hashlib.sha1(stage1).digest()
+    return _xor(stage1, hashlib.sha1(salt + stage2).digest())
+
+
+def caching_sha2_password(password, salt):
+    """Scramble a password for ``caching_sha2_password``."""
+    if not password:
+        return b''
+    stage1 = hashlib.sha256(password.encode()).digest()
+    stage2 = hashlib.sha256(stage1).digest()
+    return _xor(stage1, hashlib.sha256(stage2 + salt).digest())
+
+
+_SCRAMBLES = {
+    'mysql_native_password': native_password,
+    'caching_sha2_password': caching_sha2_password,
+}
+
+
+def lenenc_int(data, offset):
+    """Decode a length encoded integer.
+
+    :returns: A tuple of the integer and the offset after it.
+    """
+    first = data[offset]
+    if first < 0xfb:
+        return first, offset + 1
+    if first == 0xfc:
+        return struct.unpack_from('<H', data, offset + 1)[0], offset + 3
+    if first == 0xfd:
+        value = int.from_bytes(data[offset + 1:offset + 4], 'little')
+        return value, offset + 4
+    if first == 0xfe:
+        return struct.unpack_from('<Q', data, offset + 1)[0], offset + 9
+    raise MySQLError('Invalid length encoded integer')
+
+
+def lenenc_str(data, offset):
+    """Decode a length encoded string, ``None`` for SQL NULL.
+
+    :returns: A tuple of the string and the offset after it.
+    """
+    if data[offset] == 0xfb:
+        return None, offset + 1
+    length, offset = lenenc_int(data, offset)
+    return data[offset:offset + length].decode(), offset + length
+
+
+def check(packet):
+    """Raise the error of an ERR packet.
+
+    :raises MySQLError: If the packet is an ERR packet.
+    """
+    if packet and packet[0] == 0xff:
+        code, = struct.unpack_from('<H', packet, 1)
+        message = packet[3:]
+        if message.startswith(b'#'):
+            message = message[6:]
+        raise MySQLError(message.decode(errors='replace'), code)
+
+
+class Connection:
+    """A connection to a MySQL server.
+
+    :param str unix_socket: The path of the Unix socket of the server,
+       if not given TCP is used.
+    :param str host: The host to connect to over TCP.
+    :param int port: The port to connect to over TCP.
+    :param str user: The user to authenticate as.
+    :param str password: The password of the user.
+    :param float timeout: Seconds to wait for the server to answer when
+       connecting and for each query.
+
+    :raises OSError: If the server could not be reached or did not
+       answer in time.
+    :raises MySQLError: If the server refused the connection.
+
+    :ivar server_version: The version the server announced.
+    """
+
+    def __init__(self, unix_socket=None, host='localhost', port=3306,
+                 user='root', password='', timeout=2.0):
+        self.timeout = timeout
+        self.server_version = None
+        self._seq = 0
+        if unix_socket:
+            self._sock = socket.socket(socket.AF_UNIX)
+            address = unix_socket
+        else:
+            self._sock = socket.socket(socket.AF_INET)
+            address = (host, port)
+        try:
+            self._sock.settimeout(timeout)
+            self._sock.connect(address)
+            self._handshake(user, password or '', secure=bool(unix_socket))
+        except BaseException:
+            self._sock.close()
+            self._sock = None
+            raise
+
+    @property
+    def closed(self):
+        """Whether the connection is closed."""
+        return self._sock is None
+
+    def close(self):
+        """Close the connection, telling the server if possible."""
+        if self._sock is None:
+            return
+        try:
+            self._seq = 0
+            self._send(bytes([COM_QUIT]))
+        except OSError:
+            pass
+        finally:
+            self._sock.close()
+            self._sock = None
+
+    def query(self, sql, timeout=None):
+        """Run a query.
+
+        :param str sql: The query.
+        :param float timeout: Seconds to wait for the result, by default
+           the timeout of the connection.
+
+        :raises OSError: If the server did not answer in time, the
+           connection is closed.
+        :raises MySQLError: If the server reported an error.
+
+        :returns: A list of the rows, each a dict mapping the column
+           names to the values as strings or ``None``.  Statements
+           without results return an empty list.
+        """
+        if self._sock is None:
+            raise MySQLError('Connection is closed')
+        try:
+            self._sock.settimeout(timeout or self.timeout)
+            self._seq = 0
+            self._send(bytes([COM_QUERY]) + sql.encode())
+            return self._results()
+        except OSError:
+            self._sock.close()
+            self._sock = None
+            raise
+
+    def _results(self):
+        """Read the response to a query."""
+        packet = self._recv()
+        check(packet)
+        if packet[0] == 0x00:
+            return []
+        count, _ = lenenc_int(packet, 0)
+        names = []
+        for _ in range(count):
+            column = self._recv()
+            offset = 0
+            for _ in range(5):      # catalog, schema, table, org_table, name
+                value, offset = lenenc_str(column, offset)
+            names.append(value)
+        self._recv()                # EOF after the column definitions
+        rows = []
+        while True:
+            packet = self._recv()
+            check(packet)
+            if packet[0] == 0xfe and len(packet) < 9:
+                return rows
+            values = []
+            offset = 0
+            for _ in names:
+                value, offset = lenenc_str(packet, offset)
+                values.append(value)
+            rows.append(dict(zip(names, values)))
+
+    def _handshake(self, user, password, secure):
+        """Read the server greeting and authenticate."""
+        packet = self._recv()
+        check(packet)
+        if packet[0] != 10:
+            raise MySQLError('Unsupported protocol version {}'.format(
+                packet[0]))
+        end = packet.index(b'\0', 1)
+        self.server_version = packet[1:end].decode()
+        offset = end + 5            # connection id
+        salt = packet[offset:offset + 8]
+        offset += 9
+        capabilities, = struct.unpack_from('<H', packet, offset)
+        offset += 2
+        plugin = 'mysql_native_password'
+        if len(packet) > offset:
+            offset += 3             # character set, status flags
+            capabilities |= struct.unpack_from('<H', packet, offset)[0] << 16
+            salt_length = packet[offset + 2]
+            offset += 13
+            if capabilities & CLIENT_SECURE_CONNECTION:
+                length = max(13, salt_length - 8)
+                salt += packet[offset:offset + length - 1]
+                offset += length
+            if capabilities & CLIENT_PLUGIN_AUTH:
+                plugin = packet[offset:].split(b'\0')[0].decode()
+        if plugin not in _SCRAMBLES:
+            plugin = 'mysql_native_password'
+        auth = _SCRAMBLES[plugin](password, salt)
+        self._send(struct.pack('<IIB23x', CAPABILITIES, MAX_PACKET,
+                               UTF8_GENERAL_CI) +
+                   user.encode() + b'\0' +
+                   bytes([len(auth)]) + auth +
+                   plugin.encode() + b'\0')
+        self._authenticate(password, plugin, secure)
+
+    def _authenticate(self, password, plugin, secure):
+        """Handle the authentication exchange until the server is done."""
+        while True:
+            packet = self._recv()
+            check(packet)
+            if packet[0] == 0x00:
+                return
+            if packet[0] == 0xfe:
+                name, _, salt = packet[1:].partition(b'\0')
+                plugin = name.decode()
+                if plugin not in _SCRAMBLES:
+                    raise MySQLError('Unsupported authentication plugin '
+                                     '{}'.format(plugin))
+                if salt.endswith(b'\0'):
+                    salt = salt[:-1]
+                self._send(_SCRAMBLES[plugin](password, salt))
+            elif packet[0] == 0x01 and plugin == 'caching_sha2_password':
+                if packet[1:] == b'\x04':
+                    if not secure:
+                        raise MySQLError('Full caching_sha2_password '
+                                         'authentication needs a Unix '
+                                         'socket')
+                    self._send(password.encode() + b'\0')
+            else:
+                raise MySQLError('Unexpected packet while authenticating')
+
+    def _send(self, payload):
+        """Send a packet."""
+        header = struct.pack('<I', len(payload))[:3] + bytes([self._seq])
+        self._seq = (self._seq + 1) & 0xff
+        self._sock.sendall(header + payload)
+
+    def _recv(self):
+        """Receive a packet.
+
+        :returns: The payload of the packet.
+        """
+        header = self._read(4)
+        self._seq = (header[3] + 1) & 0xff
+        return self._read(int.from_bytes(header[:3], 'little'))
+
+    def _read(self, size):
+        """Read exactly size bytes from the socket."""
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('MySQL server closed the connection')
+            data += chunk
+        return bytes(data)
@@ -7,21 +7,66 @@ MySQL entities are related to top-level processes, configuration file
 entity and the parent host.
 
 Assumes that the MySQL binary is called 'mysqld' for discovery.
+
+With the ``--mysql-metrics`` option the plugin also connects to each
+instance, preferably over its Unix socket, using the credentials of
+the ``[client]`` section of its configuration file.  The connection is
+kept across collections and the global status counters are reported
+as attributes.
 """
 
 import argparse
+import collections
+import getpass
 import itertools
 import os
 import shlex
 
 import logbook
 
+import entityd.discovery
+import entityd.mixins
+import entityd.mysqlclient
 import entityd.pm
+import entityd.processme
 
 
 log = logbook.Logger(__name__)
 
 
+#: The processes of MySQL instances.
+MATCHER = entityd.discovery.Matcher('MySQL', binary='mysqld')
+
+
+#: The variables of SHOW GLOBAL STATUS reported, with their traits.
+STATUS_VARIABLES = {
+    'Uptime': {'metric:counter', 'time:duration', 'unit:seconds'},
+    'Questions': {'metric:counter'},
+    'Queries': {'metric:counter'},
+    'Com_select': {'metric:counter'},
+    'Com_insert': {'metric:counter'},
+    'Com_update': {'metric:counter'},
+    'Com_delete': {'metric:counter'},
+    'Slow_queries': {'metric:counter'},
+    'Bytes_received': {'metric:counter', 'unit:bytes'},
+    'Bytes_sent': {'metric:counter', 'unit:bytes'},
+    'Connections': {'metric:counter'},
+    'Aborted_clients': {'metric:counter'},
+    'Aborted_connects': {'metric:counter'},
+    'Created_tmp_disk_tables': {'metric:counter'},
+    'Innodb_rows_read': {'metric:counter'},
+    'Innodb_rows_inserted': {'metric:counter'},
+    'Innodb_rows_updated': {'metric:counter'},
+    'Innodb_rows_deleted': {'metric:counter'},
+    'Innodb_data_read': {'metric:counter', 'unit:bytes'},
+    'Innodb_data_written': {'metric:counter', 'unit:bytes'},
+    'Threads_connected': {'metric:gauge'},
+    'Threads_running': {'metric:gauge'},
+    'Max_used_connections': {'metric:gauge'},
+    'Open_tables': {'metric:gauge'},
+}
+
+
 class MySQLEntity:
     """Monitor for MySQL instances."""
 
@@ -29,6 +74,10 @@ class MySQLEntity:
         self.session = None
         self._host_ueid = None
         self._log_flag = False
+        self.metrics = False
+        self.query_timeout = 2.0
+        self._connections = {}
+        self._failing = set()
 
     @staticmethod
     @entityd.pm.hookimpl
@@ -36,10 +85,36 @@ class MySQLEntity:
         """Register the MySQL Monitored Entity."""
         config.addentity('MySQL', 'entityd.mysqlme.MySQLEntity')
 
+    @staticmethod
+    @entityd.pm.hookimpl
+    def entityd_addoption(parser):
+        """Add the options for collecting metrics."""
+        parser.add_argument(
+            '--mysql-metrics',
+            action='store_true',
+            help='Connect to MySQL instances to collect their global '
+                 'status counters.',
+        )
+        parser.add_argument(
+            '--mysql-query-timeout',
+            default=2.0,
+            type=float,
+            help='Seconds to wait for MySQL to answer a query.',
+        )
+
     @entityd.pm.hookimpl()
     def entityd_sessionstart(self, session):
         """Store session for later use."""
         self.session = session
+        self.metrics = session.config.args.mysql_metrics
+        self.query_timeout = session.config.args.mysql_query_timeout
+        entityd.discovery.service(session).subscribe(MATCHER)
+
+    @entityd.pm.hookimpl
+    def entityd_sessionfinish(self):
+        """Close the connections to MySQL."""
+        for path in list(self._connections):
+            self._close(path)
 
     @entityd.pm.hookimpl
     def entityd_find_entity(self, name, attrs, include_ondemand=False):
@@ -58,43 +133,83 @@ class MySQLEntity:
 
         :returns: A :class:`cobe.UEID` for the host.
         """
-        if self._host_ueid:
-            return self._host_ueid
-        results = self.session.pluginmanager.hooks.entityd_find_entity(
-            name='Host', attrs=None)
-        for hosts in results:
-            for host in hosts:
-                self._host_ueid = host.ueid
-                return self._host_ueid
-        raise LookupError('Could not find the host UEID')
+        if not self._host_ueid:
+            self._host_ueid = entityd.mixins.find_host_ueid(self.session)
+        return self._host_ueid
 
     def entities(self, include_ondemand):
         """Return MySQLEntity objects."""
-        for proc in self.top_level_mysql_processes():
-            mysql = MySQL(proc)
-            update = entityd.EntityUpdate('MySQL')
-            update.attrs.set('host', str(self.host_ueid),
-                             traits={'entity:id', 'entity:ueid'})
-            try:
-                update.attrs.set('config_path',
-                                 mysql.config_path(), traits={'entity:id'})
-            except MySQLNotFoundError:
-                if not self._log_flag:
-                    log.warning('Could not find config path for MySQL.')
-                    self._log_flag = True
-                return
-            update.attrs.set('process_id', proc.attrs.get('pid').value)
-            if include_ondemand:
-                files = list(itertools.chain.from_iterable(
-                    self.session.pluginmanager.hooks.entityd_find_entity(
-                        name='File', attrs={'path': mysql.config_path()})
-                ))
-                if files:
-                    update.children.add(files[0])
-                    yield files[0]
-            update.children.add(proc)
-            update.parents.add(self.host_ueid)
-            yield update
+        running = set()
+        try:
+            for proc in self.top_level_mysql_processes():
+                mysql = MySQL(proc)
+                update = entityd.EntityUpdate('MySQL')
+                update.attrs.set('host', str(self.host_ueid),
+                                 traits={'entity:id', 'entity:ueid'})
+                try:
+                    update.attrs.set('config_path',
+                                     mysql.config_path(), traits={'entity:id'})
+                except MySQLNotFoundError:
+                    if not self._log_flag:
+                        log.warning('Could not find config path for MySQL.')
+                        self._log_flag = True
+                    return
+                update.attrs.set('process_id', proc.attrs.get('pid').value)
+                if self.metrics:
+                    running.add(mysql.config_path())
+                    for name, (value, traits) in self.performance_data(
+                            mysql).items():
+                        update.attrs.set(name, value, traits)
+                if include_ondemand:
+                    files = list(itertools.chain.from_iterable(
+                        self.session.pluginmanager.hooks.entityd_find_entity(
+                            name='File', attrs={'path': mysql.config_path()})
+                    ))
+                    if files:
+                        update.children.add(files[0])
+                        yield files[0]
+                if entityd.processme.is_selected(
+                        self.session, proc.attrs.get('pid').value):
+                    update.children.add(proc)
+                update.parents.add(self.host_ueid)
+                yield update
+        finally:
+            for path in set(self._connections) - running:
+                self._close(path)
+
+    def performance_data(self, mysql):
+        """Collect the metrics of a MySQL instance.
+
+        The connection to the instance is kept for the next collection.
+        If collecting fails the connection is closed, and a new one is
+        made next time.
+
+        :returns: A dict mapping attribute names to tuples of their
+           value and traits, empty if the metrics could not be
+           collected.
+        """
+        path = mysql.config_path()
+        try:
+            connection = self._connections.get(path)
+            if connection is None or connection.closed:
+                connection = mysql.connect(self.query_timeout)
+                self._connections[path] = connection
+            perfdata = mysql.performance_data(connection)
+        except (OSError, entityd.mysqlclient.MySQLError) as err:
+            if path not in self._failing:
+                log.warning('Could not collect metrics of MySQL {}: {}',
+                            path, err)
+                self._failing.add(path)
+            self._close(path)
+            return {}
+        self._failing.discard(path)
+        return perfdata
+
+    def _close(self, path):
+        """Close the connection to the MySQL of a config file."""
+        connection = self._connections.pop(path, None)
+        if connection:
+            connection.close()
 
     def top_level_mysql_processes(self):
         """Find top level MySQL processes.
@@ -102,19 +217,57 @@ class MySQLEntity:
         :return: List of Process ``EntityUpdate``s whose parent is not
            also 'mysqld'.
         """
-        processes = {}
-        proc_gens = self.session.pluginmanager.hooks.entityd_find_entity(
-            name='Process', attrs={'binary': 'mysqld'})
-        for entity in itertools.chain.from_iterable(proc_gens):
-            processes[entity.attrs.get('pid').value] = entity
-        return [e for e in processes.values()
-                if e.attrs.get('ppid').value not in processes]
+        return entityd.discovery.service(self.session).processes(MATCHER)
 
 
 class MySQLNotFoundError(Exception):
     """Thrown if the MySQL instance cannot be found."""
 
 
+def read_options(path, options=None):
+    """Read a MySQL option file.
+
+    The files named by ``!include`` and ``!includedir`` directives are
+    read as well.  Options are named with dashes, like on the command
+    line.  Files which can not be read are ignored.
+
+    :param str path: The option file.
+    :param options: The options read so far, updated in place.
+
+    :returns: A dict mapping section names to dicts of options.
+    """
+    if options is None:
+        options = collections.defaultdict(dict)
+    try:
+        fp = open(path)
+    except OSError:
+        return options
+    section = None
+    with fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.startswith('!include '):
+                read_options(line.split(None, 1)[1], options)
+            elif line.startswith('!includedir '):
+                directory = line.split(None, 1)[1]
+                try:
+                    names = sorted(os.listdir(directory))
+                except OSError:
+                    continue
+                for name in names:
+                    if name.endswith('.cnf'):
+                        read_options(os.path.join(directory, name), options)
+            elif line.startswith('['):
+                section = line.strip('[]').strip()
+            elif section:
+                name, _, value = line.partition('=')
+                name = name.strip().replace('_', '-')
+                options[section][name] = value.strip().strip('\'"')
+    return options
+
+
 class MySQL:
     """Abstract MySQL instance.
 
@@ -124,6 +277,73 @@ class MySQL:
     def __init__(self, process):
         self.process = process
 
+    def connection_options(self):
+        """The options to connect to this instance with.
+
+        The Unix socket and port are those the server was started with,
+        unless the ``[client]`` section of the config file overrides
+        them.  Without a socket for this instance it is connected to
+        over TCP.  The user and password are those of the ``[client]``
+        section.
+
+        :returns: A dict of keyword arguments for
+           :class:`entityd.mysqlclient.Connection`.
+        """
+        options = read_options(self.config_path())
+        server = dict(options.get('mysqld', {}))
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument('--socket')
+        parser.add_argument('--port')
+        args, _ = parser.parse_known_args(
+            shlex.split(self.process.attrs.get('command').value))
+        server.update({name: value for name, value in vars(args).items()
+                       if value})
+        client = dict(server, **options.get('client', {}))
+        return {
+            'unix_socket': client.get('socket') or None,
+            'host': client.get('host', '127.0.0.1'),
+            'port': int(client.get('port', 3306)),
+            'user': client.get('user', getpass.getuser()),
+            'password': client.get('password', ''),
+        }
+
+    def connect(self, timeout):
+        """Connect to this instance.
+
+        :param float timeout: The timeout of the connection.
+
+        :returns: A :class:`entityd.mysqlclient.Connection`.
+        """
+        return entityd.mysqlclient.Connection(timeout=timeout,
+                                              **self.connection_options())
+
+    @staticmethod
+    def performance_data(connection):
+        """Query the global status and replication lag.
+
+        :param connection: A :class:`entityd.mysqlclient.Connection`.
+
+        :returns: A dict mapping attribute names to tuples of their
+           value and traits.
+        """
+        perfdata = {}
+        for row in connection.query('SHOW GLOBAL STATUS'):
+            name, value = row['Variable_name'], row['Value']
+            if name in STATUS_VARIABLES and value is not None:
+                perfdata[name] = (int(value), set(STATUS_VARIABLES[name]))
+        try:
+            replicas = connection.query('SHOW SLAVE STATUS')
+        except entityd.mysqlclient.MySQLError:
+            replicas = []
+        for row in replicas:
+            lag = row.get('Seconds_Behind_Master',
+                          row.get('Seconds_Behind_Source'))
+            if lag is not None:
+                perfdata['replication:lag'] = (
+                    int(lag), {'metric:gauge', 'time:duration',
+                               'unit:seconds'})
+        return perfdata
+
     def config_path(self):
         """Find the path for the my.cnf config file.
 
@@ -138,7 +358,7 @@ class MySQL:
                  '/usr/etc/my.cnf',
                  os.path.expanduser('~/.my.cnf')]
         command = self.process.attrs.get('command').value
-        parser = argparse.ArgumentParser()
+        parser = argparse.ArgumentParser(add_help=False)
         parser.add_argument('--defaults-file', dest='config')
         args, _ = parser.parse_known_args(shlex.split(command))
         if args.config:
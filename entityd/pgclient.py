@@ -0,0 +1,309 @@
+"""A minimal client of the PostgreSQL frontend/backend protocol.
+
+Only what is needed to query the statistics views of a local
+PostgreSQL server is implemented: connecting over a Unix socket or TCP,
+authenticating with trust, password, MD5 or SCRAM-SHA-256 and running
+simple queries.  This way no PostgreSQL driver needs to be installed on
+monitored hosts.
+
+Queries are bounded by a timeout, if the server does not answer in
+time the connection is closed as the protocol state is then unknown.
+A ``statement_timeout`` can be passed as a startup parameter to make
+the server cancel long queries itself.
+
+See https://www.postgresql.org/docs/current/protocol.html
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import socket
+import struct
+
+
+PROTOCOL_VERSION = 196608
+
+
+AUTH_OK = 0
+AUTH_CLEARTEXT = 3
+AUTH_MD5 = 5
+AUTH_SASL = 10
+AUTH_SASL_CONTINUE = 11
+AUTH_SASL_FINAL = 12
+
+
+class PostgreSQLError(Exception):
+    """An error reported by the server, or a protocol error.
+
+    :ivar code: The SQLSTATE code of the error, ``None`` for protocol
+       errors.
+    """
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+def md5_password(user, password, salt):
+    """Hash a password for MD5 authentication."""
+    inner = hashlib.md5((password + user).encode()).hexdigest()
+    return 'md5' + hashlib.md5(inner.encode() + salt).hexdigest()
+
+
+def _hmac(key, message):
+    return hmac.new(key, message, hashlib.sha256).digest()
+
+
+class ScramSHA256:
+    """The client side of a SCRAM-SHA-256 exchange.
+
+    :ivar first: The client-first-message to send.
+    """
+
+    def __init__(self, password, nonce=None):
+        self.password = password
+        self.nonce = nonce or base64.b64encode(os.urandom(18)).decode()
+        self._first_bare = 'n=,r=' + self.nonce
+        self.first = 'n,,' + self._first_bare
+        self._server_signature = None
+
+    def final(self, server_first):
+        """Answer the server-first-message.
+
+        :returns: The client-final-message.
+        """
+        fields = dict(field.split('=', 1)
+                      for field in server_first.split(','))
+        if not fields['r'].startswith(self.nonce):
+            raise PostgreSQLError('SCRAM nonce mismatch')
+        salted = hashlib.pbkdf2_hmac('sha256', self.password.encode(),
+                                     base64.b64decode(fields['s']),
+                                     int(fields['i']))
+        client_key = _hmac(salted, b'Client Key')
+        without_proof = 'c=biws,r=' + fields['r']
+        message = ','.join([self._first_bare, server_first,
+                            without_proof]).encode()
+        signature = _hmac(hashlib.sha256(client_key).digest(), message)
+        proof = bytes(a ^ b for a, b in zip(client_key, signature))
+        self._server_signature = _hmac(_hmac(salted, b'Server Key'), message)
+        return without_proof + ',p=' + base64.b64encode(proof).decode()
+
+    def verify(self, server_final):
+        """Check the server-final-message proves the server knows us.
+
+        :raises PostgreSQLError: If the server signature is wrong.
+        """
+        fields = dict(field.split('=', 1)
+                      for field in server_final.split(','))
+        if base64.b64decode(fields.get('v', '')) != self._server_signature:
+            raise PostgreSQLError('Invalid SCRAM server signature')
+
+
+def _cstrings(data):
+    """Split a sequence of NUL terminated strings."""
+    return [value.decode(errors='replace')
+            for value in data.split(b'\0') if value]
+
+
+def _error(payload):
+    """Create the exception of an ErrorResponse message."""
+    fields = {}
+    for field in payload.split(b'\0'):
+        if field:
+            fields[field[:1]] = field[1:].decode(errors='replace')
+    return PostgreSQLError(fields.get(b'M', 'Unknown error'),
+                           fields.get(b'C'))
+
+
+class Connection:
+    """A connection to a PostgreSQL server.
+
+    :param str unix_socket: The path of the Unix socket of the server,
+       e.g. ``/var/run/postgresql/.s.PGSQL.5432``.  If not given TCP is
+       used.
+    :param str host: The host to connect to over TCP.
+    :param int port: The port to connect to over TCP.
+    :param str user: The user to authenticate as.
+    :param str password: The password of the user.
+    :param str database: The database to connect to.
+    :param float timeout: Seconds to wait for the server to answer when
+       connecting and for each query.
+    :param dict parameters: Run-time parameters to set for the session,
+       e.g. ``statement_timeout``.
+
+    :raises OSError: If the server could not be reached or did not
+       answer in time.
+    :raises PostgreSQLError: If the server refused the connection.
+
+    :ivar server_parameters: The parameters the server reported, like
+       ``server_version``.
+    """
+
+    def __init__(self, unix_socket=None, host='localhost', port=5432,
+                 user='postgres', password='', database='postgres',
+                 timeout=2.0, parameters=None):
+        self.timeout = timeout
+        self.server_parameters = {}
+        if unix_socket:
+            self._sock = socket.socket(socket.AF_UNIX)
+            address = unix_socket
+        else:
+            self._sock = socket.socket(socket.AF_INET)
+            address = (host, port)
+        startup = {'user': user, 'database': database,
+                   'application_name': 'entityd'}
+        startup.update(parameters or {})
+        try:
+            self._sock.settimeout(timeout)
+            self._sock.connect(address)
+            self._startup(startup, user, password or '')
+        except BaseException:
+            self._sock.close()
+            self._sock = None
+            raise
+
+    @property
+    def closed(self):
+        """Whether the connection is closed."""
+        return self._sock is None
+
+    def close(self):
+        """Close the connection, telling the server if possible."""
+        if self._sock is None:
+            return
+        try:
+            self._send(b'X', b'')
+        except OSError:
+            pass
+        finally:
+            self._sock.close()
+            self._sock = None
+
+    def query(self, sql, timeout=None):
+        """Run a query.
+
+        :param str sql: The query.
+        :param float timeout: Seconds to wait for the result, by default
+           the timeout of the connection.
+
+        :raises OSError: If the server did not answer in time, the
+           connection is closed.
+        :raises PostgreSQLError: If the server reported an error.
+
+        :returns: A list of the rows, each a dict mapping the column
+           names to the values as strings or ``None``.
+        """
+        if self._sock is None:
+            raise PostgreSQLError('Connection is closed')
+        try:
+            self._sock.settimeout(timeout or self.timeout)
+            self._send(b'Q', sql.encode() + b'\0')
+            return self._results()
+        except OSError:
+            self._sock.close()
+            self._sock = None
+            raise
+
+    def _results(self):
+        """Read the response to a simple query until the server is ready."""
+        names = []
+        rows = []
+        error = None
+        while True:
+            kind, payload = self._recv()
+            if kind == b'T':
+                count, = struct.unpack_from('!H', payload)
+                names = []
+                offset = 2
+                for _ in range(count):
+                    end = payload.index(b'\0', offset)
+                    names.append(payload[offset:end].decode())
+                    offset = end + 19   # NUL and the 18 bytes of type info
+            elif kind == b'D':
+                count, = struct.unpack_from('!H', payload)
+                values = []
+                offset = 2
+                for _ in range(count):
+                    length, = struct.unpack_from('!i', payload, offset)
+                    offset += 4
+                    if length < 0:
+                        values.append(None)
+                    else:
+                        values.append(
+                            payload[offset:offset + length].decode())
+                        offset += length
+                rows.append(dict(zip(names, values)))
+            elif kind == b'E':
+                error = _error(payload)
+            elif kind == b'Z':
+                if error:
+                    raise error
+                return rows
+
+    def _startup(self, parameters, user, password):
+        """Send the startup message and authenticate."""
+        body = struct.pack('!I', PROTOCOL_VERSION)
+        for name, value in parameters.items():
+            body += name.encode() + b'\0' + str(value).encode() + b'\0'
+        body += b'\0'
+        self._sock.sendall(struct.pack('!I', len(body) + 4) + body)
+        scram = None
+        while True:
+            kind, payload = self._recv()
+            if kind == b'E':
+                raise _error(payload)
+            elif kind == b'R':
+                code, = struct.unpack_from('!I', payload)
+                if code == AUTH_OK:
+                    continue
+                elif code == AUTH_CLEARTEXT:
+                    self._send(b'p', password.encode() + b'\0')
+                elif code == AUTH_MD5:
+                    self._send(b'p', md5_password(
+                        user, password, payload[4:8]).encode() + b'\0')
+                elif code == AUTH_SASL:
+                    if 'SCRAM-SHA-256' not in _cstrings(payload[4:]):
+                        raise PostgreSQLError('Unsupported SASL mechanisms')
+                    scram = ScramSHA256(password)
+                    first = scram.first.encode()
+                    self._send(b'p', b'SCRAM-SHA-256\0' +
+                               struct.pack('!i', len(first)) + first)
+                elif code == AUTH_SASL_CONTINUE and scram:
+                    self._send(b'p', scram.final(
+                        payload[4:].decode()).encode())
+                elif code == AUTH_SASL_FINAL and scram:
+                    scram.verify(payload[4:].decode())
+                else:
+                    raise PostgreSQLError('Unsupported authentication '
+                                          'method {}'.format(code))
+            elif kind == b'S':
+                name, _, value = payload.rstrip(b'\0').partition(b'\0')
+                self.server_parameters[name.decode()] = value.decode()
+            elif kind == b'Z':
+                return
+
+    def _send(self, kind, payload):
+        """Send a message."""
+        self._sock.sendall(kind + struct.pack('!I', len(payload) + 4) +
+                           payload)
+
+    def _recv(self):
+        """Receive a message.
+
+        :returns: A tuple of the message type and its payload.
+        """
+        header = self._read(5)
+        length, = struct.unpack_from('!I', header, 1)
+        return header[:1], self._read(length - 4)
+
+    def _read(self, size):
+        """Read exactly size bytes from the socket."""
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError(
+                    'PostgreSQL server closed the connection')
+            data += chunk
+        return bytes(data)
@@ -7,8 +7,16 @@ PostrgesSQL entities are related to top-level processes, configuration file
 entity and the parent host.
 
 Assumes that the PostgreSQL binary is called 'postgresql.conf' for discovery.
+
+The config path and connection options of an instance are discovered
+once for each main process.  With the ``--postgres-metrics`` option the
+plugin also keeps a connection to each instance, preferably over its
+Unix socket, and reports the statistics of ``pg_stat_database``,
+``pg_stat_activity`` and ``pg_stat_bgwriter`` as attributes.  The
+password, if one is needed, is looked up in the pgpass file.
 """
 
+import argparse
 import itertools
 import os
 import shlex
@@ -16,12 +24,74 @@ import re
 
 import logbook
 
+import entityd.discovery
+import entityd.mixins
+import entityd.pgclient
 import entityd.pm
+import entityd.processme
 
 
 log = logbook.Logger(__name__)
 
 
+#: The processes of PostgreSQL instances.
+MATCHER = entityd.discovery.Matcher('PostgreSQL', binary='postgres')
+
+
+#: The columns of pg_stat_database reported, summed over all databases,
+#: with their traits.
+DATABASE_COLUMNS = {
+    'numbackends': {'metric:gauge'},
+    'xact_commit': {'metric:counter'},
+    'xact_rollback': {'metric:counter'},
+    'blks_read': {'metric:counter'},
+    'blks_hit': {'metric:counter'},
+    'tup_returned': {'metric:counter'},
+    'tup_fetched': {'metric:counter'},
+    'tup_inserted': {'metric:counter'},
+    'tup_updated': {'metric:counter'},
+    'tup_deleted': {'metric:counter'},
+    'conflicts': {'metric:counter'},
+    'temp_files': {'metric:counter'},
+    'temp_bytes': {'metric:counter', 'unit:bytes'},
+    'deadlocks': {'metric:counter'},
+}
+
+
+DATABASE_QUERY = 'SELECT {} FROM pg_stat_database'.format(', '.join(
+    'sum({0}) AS {0}'.format(column) for column in sorted(DATABASE_COLUMNS)))
+
+
+#: The states of pg_stat_activity, with the names of their attributes.
+ACTIVITY_STATES = {
+    'active': 'activity:active',
+    'idle': 'activity:idle',
+    'idle in transaction': 'activity:idle_in_transaction',
+    'idle in transaction (aborted)': 'activity:idle_in_transaction_aborted',
+    'fastpath function call': 'activity:fastpath_function_call',
+    'disabled': 'activity:disabled',
+}
+
+
+ACTIVITY_QUERY = ('SELECT state, count(*) AS count FROM pg_stat_activity '
+                  'WHERE pid <> pg_backend_pid() GROUP BY state')
+
+
+#: The columns of pg_stat_bgwriter reported, as counters.  Newer
+#: versions moved the checkpoint columns elsewhere, missing columns are
+#: skipped.
+BGWRITER_COLUMNS = ['checkpoints_timed', 'checkpoints_req',
+                    'buffers_checkpoint', 'buffers_clean',
+                    'maxwritten_clean', 'buffers_backend', 'buffers_alloc']
+
+
+BGWRITER_QUERY = 'SELECT * FROM pg_stat_bgwriter'
+
+
+#: The directories PostgreSQL puts its Unix sockets in by default.
+DEFAULT_SOCKET_DIRECTORIES = ['/var/run/postgresql', '/tmp']
+
+
 class PostgreSQLEntity:
     """Monitor for PostgreSQL instances."""
 
@@ -29,6 +99,12 @@ class PostgreSQLEntity:
         self.session = None
         self._host_ueid = None
         self._log_flag = False
+        self.metrics = False
+        self.user = 'postgres'
+        self.database = 'postgres'
+        self.statement_timeout = 2.0
+        self._instances = {}
+        self._failing = set()
 
     @staticmethod
     @entityd.pm.hookimpl
@@ -36,10 +112,49 @@ class PostgreSQLEntity:
         """Register the PostgreSQL Monitored Entity."""
         config.addentity('PostgreSQL', 'entityd.postgresme.PostgreSQLEntity')
 
+    @staticmethod
+    @entityd.pm.hookimpl
+    def entityd_addoption(parser):
+        """Add the options for collecting metrics."""
+        parser.add_argument(
+            '--postgres-metrics',
+            action='store_true',
+            help='Connect to PostgreSQL instances to collect their '
+                 'statistics.',
+        )
+        parser.add_argument(
+            '--postgres-user',
+            default='postgres',
+            help='The PostgreSQL user to collect statistics as.',
+        )
+        parser.add_argument(
+            '--postgres-database',
+            default='postgres',
+            help='The PostgreSQL database to connect to.',
+        )
+        parser.add_argument(
+            '--postgres-statement-timeout',
+            default=2.0,
+            type=float,
+            help='Seconds PostgreSQL may take for a query.',
+        )
+
     @entityd.pm.hookimpl()
     def entityd_sessionstart(self, session):
         """Store session for later use."""
         self.session = session
+        self.metrics = session.config.args.postgres_metrics
+        self.user = session.config.args.postgres_user
+        self.database = session.config.args.postgres_database
+        self.statement_timeout = session.config.args.postgres_statement_timeout
+        entityd.discovery.service(session).subscribe(MATCHER)
+
+    @entityd.pm.hookimpl
+    def entityd_sessionfinish(self):
+        """Close the connections to PostgreSQL."""
+        for postgres in self._instances.values():
+            postgres.close()
+        self._instances.clear()
 
     @entityd.pm.hookimpl
     def entityd_find_entity(self, name, attrs, include_ondemand=False):
@@ -58,45 +173,96 @@ class PostgreSQLEntity:
 
         :returns: A :class:`cobe.UEID` for the host.
         """
-        if self._host_ueid:
-            return self._host_ueid
-        results = self.session.pluginmanager.hooks.entityd_find_entity(
-            name='Host', attrs=None)
-        for hosts in results:
-            for host in hosts:
-                self._host_ueid = host.ueid
-                return self._host_ueid
-        raise LookupError('Could not find the host UEID')
+        if not self._host_ueid:
+            self._host_ueid = entityd.mixins.find_host_ueid(self.session)
+        return self._host_ueid
 
     def entities(self, include_ondemand):
         """Return PostgreSQLEntity objects."""
-        for proc in self.top_level_postgresql_processes():
-            postgres = PostgreSQL(proc)
-            update = entityd.EntityUpdate('PostgreSQL')
-            update.attrs.set('host', str(self.host_ueid),
-                             traits={'entity:id', 'entity:ueid'})
-            try:
-                update.attrs.set(
-                    'config_path',
-                    postgres.config_path(), traits={'entity:id'}
-                )
-            except PostgreSQLNotFoundError:
-                if not self._log_flag:
-                    log.warning('Could not find config path for PostgreSQL.')
-                    self._log_flag = True
-                return
-            update.attrs.set('process_id', proc.attrs.get('pid').value)
-            if include_ondemand:
-                files = list(itertools.chain.from_iterable(
-                    self.session.pluginmanager.hooks.entityd_find_entity(
-                        name='File', attrs={'path': postgres.config_path()})
-                ))
-                if files:
-                    update.children.add(files[0])
-                    yield files[0]
-            update.children.add(proc)
-            update.parents.add(self.host_ueid)
-            yield update
+        running = set()
+        try:
+            for proc in self.top_level_postgresql_processes():
+                key = process_key(proc)
+                postgres = self.instance(key, proc)
+                running.add(key)
+                update = entityd.EntityUpdate('PostgreSQL')
+                update.attrs.set('host', str(self.host_ueid),
+                                 traits={'entity:id', 'entity:ueid'})
+                try:
+                    update.attrs.set(
+                        'config_path',
+                        postgres.config_path(), traits={'entity:id'}
+                    )
+                except PostgreSQLNotFoundError:
+                    if not self._log_flag:
+                        log.warning(
+                            'Could not find config path for PostgreSQL.')
+                        self._log_flag = True
+                    return
+                update.attrs.set('process_id', proc.attrs.get('pid').value)
+                if self.metrics:
+                    for name, (value, traits) in self.performance_data(
+                            postgres).items():
+                        update.attrs.set(name, value, traits)
+                if include_ondemand:
+                    files = list(itertools.chain.from_iterable(
+                        self.session.pluginmanager.hooks.entityd_find_entity(
+                            name='File',
+                            attrs={'path': postgres.config_path()})
+                    ))
+                    if files:
+                        update.children.add(files[0])
+                        yield files[0]
+                if entityd.processme.is_selected(
+                        self.session, proc.attrs.get('pid').value):
+                    update.children.add(proc)
+                update.parents.add(self.host_ueid)
+                yield update
+        finally:
+            for key in set(self._instances) - running:
+                self._instances.pop(key).close()
+
+    def instance(self, key, proc):
+        """Get the PostgreSQL instance of a main process.
+
+        Instances are kept while their process runs, so what was
+        discovered about them and their connection are reused.
+
+        :param key: The :func:`process_key` of the process.
+        :param proc: The main process as an EntityUpdate.
+
+        :returns: A :class:`PostgreSQL` instance.
+        """
+        postgres = self._instances.get(key)
+        if postgres is None:
+            postgres = self._instances[key] = PostgreSQL(proc)
+        postgres.process = proc
+        return postgres
+
+    def performance_data(self, postgres):
+        """Collect the metrics of a PostgreSQL instance.
+
+        If collecting fails the connection is closed, and a new one is
+        made next time.
+
+        :returns: A dict mapping attribute names to tuples of their
+           value and traits, empty if the metrics could not be
+           collected.
+        """
+        path = postgres.config_path()
+        try:
+            connection = postgres.connect(self.user, self.database,
+                                          self.statement_timeout)
+            perfdata = postgres.performance_data(connection)
+        except (OSError, entityd.pgclient.PostgreSQLError) as err:
+            if path not in self._failing:
+                log.warning('Could not collect metrics of PostgreSQL {}: {}',
+                            path, err)
+                self._failing.add(path)
+            postgres.close()
+            return {}
+        self._failing.discard(path)
+        return perfdata
 
     def top_level_postgresql_processes(self):
         """Find top level PostgreSQL processes.
@@ -104,26 +270,96 @@ class PostgreSQLEntity:
         :return: List of Process ``EntityUpdate``s whose parent is not
            also 'PostgreSQL'.
         """
-        processes = {}
-        proc_gens = self.session.pluginmanager.hooks.entityd_find_entity(
-            name='Process', attrs={'binary': 'postgres'})
-        for entity in itertools.chain.from_iterable(proc_gens):
-            processes[entity.attrs.get('pid').value] = entity
-        return [e for e in processes.values()
-                if e.attrs.get('ppid').value not in processes]
+        return entityd.discovery.service(self.session).processes(MATCHER)
 
 
 class PostgreSQLNotFoundError(Exception):
     """Thrown if the PostgreSQL instance cannot be found."""
 
 
+def process_key(proc):
+    """Identify a process across collections, even if its pid is reused.
+
+    :returns: A tuple of the pid and start time of the process.
+    """
+    try:
+        starttime = proc.attrs.get('starttime').value
+    except KeyError:
+        starttime = None
+    return proc.attrs.get('pid').value, starttime
+
+
+def read_settings(path):
+    """Read the settings of a postgresql.conf file.
+
+    Include directives are not followed.  A file which can not be read
+    has no settings.
+
+    :returns: A dict mapping setting names to their values as strings.
+    """
+    settings = {}
+    try:
+        fp = open(path)
+    except OSError:
+        return settings
+    with fp:
+        for line in fp:
+            match = re.match(r"\s*(\w+)\s*=?\s*('(?:[^']|'')*'|[^\s#]+)",
+                             line)
+            if match:
+                value = match.group(2)
+                if value.startswith("'"):
+                    value = value[1:-1].replace("''", "'")
+                settings[match.group(1)] = value
+    return settings
+
+
+def pgpass_password(host, port, database, user, path=None):
+    """Look up a password in the pgpass file, like libpq does.
+
+    :param str path: The pgpass file, by default ``$PGPASSFILE`` or
+       ``~/.pgpass``.
+
+    :returns: The password of the first matching entry, or an empty
+       string.
+    """
+    path = path or os.environ.get('PGPASSFILE',
+                                  os.path.expanduser('~/.pgpass'))
+    try:
+        fp = open(path)
+    except OSError:
+        return ''
+    with fp:
+        for line in fp:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            fields = re.split(r'(?<!\\):', line, maxsplit=4)
+            if len(fields) != 5:
+                continue
+            fields = [field.replace('\\:', ':').replace('\\\\', '\\')
+                      for field in fields]
+            wanted = [host, str(port), database, user]
+            if all(pattern in ('*', value)
+                   for pattern, value in zip(fields, wanted)):
+                return fields[4]
+    return ''
+
+
 class PostgreSQL:
     """Abstract PostgreSQL instance.
 
+    The config path and connection options are only discovered once.
+
     :ivar process: The main PostgreSQL process as an EntityUpdate
+    :ivar connection: The :class:`entityd.pgclient.Connection` to the
+       instance, ``None`` when not connected.
     """
     def __init__(self, process):
         self.process = process
+        self.connection = None
+        self._config_path = None
+        self._connection_options = None
 
     def config_path(self):
         """Finds the path for the postgresql config file.
@@ -134,6 +370,12 @@ class PostgreSQL:
 
         :return: Full path for postgresql config file.
         """
+        if self._config_path is None:
+            self._config_path = self._find_config_path()
+        return self._config_path
+
+    def _find_config_path(self):
+        """Search for the config file."""
         command = self.process.attrs.get('command').value
         comm = shlex.split(command)
         for param in comm:
@@ -155,3 +397,99 @@ class PostgreSQL:
                 return path
         raise PostgreSQLNotFoundError(
             'Could not find config path for PostgreSQL.')
+
+    def connection_options(self):
+        """The Unix socket or TCP port to connect to this instance on.
+
+        These come from the command line of the main process or else
+        from the config file.
+
+        :returns: A dict of keyword arguments for
+           :class:`entityd.pgclient.Connection`.
+        """
+        if self._connection_options is not None:
+            return self._connection_options
+        settings = read_settings(self.config_path())
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument('-p', dest='port')
+        parser.add_argument('-k', dest='unix_socket_directories')
+        parser.add_argument('-c', action='append', default=[])
+        args, _ = parser.parse_known_args(
+            shlex.split(self.process.attrs.get('command').value))
+        for setting in args.c:
+            name, _, value = setting.partition('=')
+            settings[name.replace('-', '_')] = value
+        for name in ['port', 'unix_socket_directories']:
+            if getattr(args, name):
+                settings[name] = getattr(args, name)
+        port = int(settings.get('port', 5432))
+        directories = settings.get(
+            'unix_socket_directories',
+            settings.get('unix_socket_directory',
+                         ','.join(DEFAULT_SOCKET_DIRECTORIES)))
+        unix_socket = None
+        for directory in directories.split(','):
+            directory = directory.strip()
+            if not directory or directory.startswith('@'):
+                continue
+            path = os.path.join(directory, '.s.PGSQL.{}'.format(port))
+            if os.path.exists(path):
+                unix_socket = path
+                break
+        self._connection_options = {'unix_socket': unix_socket,
+                                    'host': '127.0.0.1', 'port': port}
+        return self._connection_options
+
+    def connect(self, user, database, timeout):
+        """Get the connection to this instance, connecting if needed.
+
+        :param str user: The user to connect as.
+        :param str database: The database to connect to.
+        :param float timeout: The statement timeout in seconds, the
+           client waits a second longer for results.
+
+        :returns: A :class:`entityd.pgclient.Connection`.
+        """
+        if self.connection is None or self.connection.closed:
+            options = self.connection_options()
+            host = 'localhost' if options['unix_socket'] else options['host']
+            password = pgpass_password(host, options['port'], database, user)
+            self.connection = entityd.pgclient.Connection(
+                user=user, password=password, database=database,
+                timeout=timeout + 1,
+                parameters={'statement_timeout': int(timeout * 1000)},
+                **options)
+        return self.connection
+
+    def close(self):
+        """Close the connection to this instance."""
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    @staticmethod
+    def performance_data(connection):
+        """Query the statistics views.
+
+        :param connection: A :class:`entityd.pgclient.Connection`.
+
+        :returns: A dict mapping attribute names to tuples of their
+           value and traits.
+        """
+        perfdata = {}
+        for row in connection.query(DATABASE_QUERY):
+            for column, traits in DATABASE_COLUMNS.items():
+                if row.get(column) is not None:
+                    perfdata[column] = (int(row[column]), set(traits))
+        for name in ACTIVITY_STATES.values():
+            perfdata[name] = (0, {'metric:gauge'})
+        for row in connection.query(ACTIVITY_QUERY):
+            name = ACTIVITY_STATES.get(row['state'])
+            if name:
+                perfdata[name] = (int(row['count']), {'metric:gauge'})
+        for row in connection.query(BGWRITER_QUERY):
+            for column in BGWRITER_COLUMNS:
+                if row.get(column) is not None:
+                    perfdata['bgwriter:' + column] = (int(row[column]),
+                                                      {'metric:counter'})
+        return perfdata
@@ -1,55 +1,116 @@
 """Plugin providing the Process Monitored Entity."""
 import argparse
+import collections
+import fnmatch
 import functools
-import threading
+import heapq
+import os
+import pwd
+import resource
+import types
 
-import act
-import logbook
 import syskit
-import zmq
 
+import entityd.docker
 import entityd.docker.client
+import entityd.entityupdate
+import entityd.mixins
 import entityd.pm
+import entityd.procfs
+import entityd.sampler
 
 
-class CpuUsage(threading.Thread):
-    """A background thread to fetch CPU times and calculate percentages.
+#: Factory for Process UEIDs from their pid, starttime and host UEID.
+PROCESS_UEID = entityd.entityupdate.ueid_factory(
+    'Process', 'pid', 'starttime', 'host')
 
-    Accessible via ZMQ Pair/Pair sockets; returning the percentage cpu time
-    calculated most recently, for all known processes.
 
-    :param Context context: The ZMQ context to use
-    :param str endpoint: The ZMQ endpoint to listen for requests on
+#: A sample of the CPU time used by a process.  The starttime is in
+#: clock ticks since boot and only used to detect re-used pids, the
+#: cputime and timestamp are in seconds.
+CpuSample = collections.namedtuple(
+    'CpuSample', ['starttime', 'cputime', 'timestamp'])
+
+
+#: The CPU percentages published by one update of :class:`CpuUsage`.
+#: The version is incremented by every update, the timestamp is that
+#: of the procfs snapshot sampled and the percentages are a read-only
+#: mapping of pid to percentage.
+CpuPercentages = collections.namedtuple(
+    'CpuPercentages', ['version', 'timestamp', 'percentages'])
+
+
+#: The CpuPercentages before the first update.
+NO_CPU_PERCENTAGES = CpuPercentages(0, None, types.MappingProxyType({}))
+
+
+#: The facts of a process which do not change during its lifetime,
+#: read once when the process is first seen.  The attrs are a list of
+#: ``(name, value, traits)`` tuples.  An execve keeps the pid and
+#: starttime but replaces the command, so the facts are keyed on the
+#: comm as well, see :meth:`ProcessEntity.static_facts_key`.
+StaticFacts = collections.namedtuple('StaticFacts', ['ueid', 'label', 'attrs'])
+
+
+#: The Process attributes of the fields of
+#: :class:`entityd.procfs.Credentials`.  The credentials change when a
+#: process drops its privileges, so they are read for every update.
+CREDENTIAL_ATTRS = ('uid', 'euid', 'suid', 'gid', 'egid', 'sgid')
+
+
+#: Size of a memory page, the unit of the rss in /proc/<pid>/stat.
+PAGESIZE = resource.getpagesize()
+
+
+#: Process attributes with secondary indexes for filtered lookups.
+INDEXED_ATTRS = ('binary', 'ppid', 'containerid')
+
+
+class CpuUsage:
+    """Fetch CPU times of processes and calculate percentages.
+
+    This is run as a task of the sampler service.  Every update
+    publishes a new, immutable :class:`CpuPercentages` instance as the
+    ``percentages`` attribute.  Readers in other threads simply read
+    this attribute and may hold on to the object for as long as they
+    need without any locking or copying.
+
     :param int interval: The period in seconds to wait between refreshes
+    :param str procpath: The location procfs is mounted at.
+    :param snapshot: Callable returning the :class:`entityd.procfs.Snapshot`
+       to sample processes from.  Defaults to a new snapshot of
+       procpath for every update.
 
-    :ivar last_run_process: A map of {pid->syskit.Process} from the
+    :ivar last_run_processes: A map of {pid->CpuSample} from the
        last update.
-    :ivar last_run_percentages: A map of {pid->float} percentage values.
+    :ivar percentages: The :class:`CpuPercentages` of the last update.
     """
-    # pylint: disable=too-many-instance-attributes
-    def __init__(self, context,
-                 endpoint='inproc://cpuusage', interval=15, procpath='/proc'):
-        self._context = context
-        self.listen_endpoint = endpoint
+
+    def __init__(self, interval=15, procpath='/proc', snapshot=None):
+        self.interval = interval
         self.last_run_processes = {}
-        self.last_run_percentages = {}
-        self._stream = None
-        self._timer_interval = interval
-        self._log = logbook.Logger('CpuUsage')
+        self.percentages = NO_CPU_PERCENTAGES
         self.procpath = procpath
-        super().__init__()
+        if snapshot is None:
+            snapshot = functools.partial(entityd.procfs.Snapshot, procpath)
+        self._snapshot = snapshot
+
+    @property
+    def last_run_percentages(self):
+        """A read-only map of {pid->float} percentage values."""
+        return self.percentages.percentages
 
     @staticmethod
     def percent_cpu_usage(previous, current):
         """Return the percentage cpu time used since previous update.
 
-        :param syskit.Process previous: The Process object from last update.
-        :param syskit.Process current: The current Process object.
+        :param CpuSample previous: The sample from last update.
+        :param CpuSample current: The current sample.
         """
-        last_cpu_time = float(previous.cputime)
-        last_clock_time = float(previous.refreshed.timestamp())
-        cpu_time = float(current.cputime)
-        clock_time = current.refreshed.timestamp()
+        last_cpu_time = previous.cputime
+        last_clock_time = previous.timestamp
+        cpu_time = current.cputime
+        clock_time = current.timestamp
         cpu_time_passed = cpu_time - last_cpu_time
         clock_time_passed = clock_time - last_clock_time
         if clock_time_passed == 0:
@@ -61,70 +122,358 @@ class CpuUsage(threading.Thread):
         """Update the cpu percentage values we have stored."""
         new_percentages = {}
         new_processes = {}
-        with syskit.set_procpath(self.procpath):
-            for pid in syskit.Process.enumerate():
-                try:
-                    process = syskit.Process(pid)
-                except syskit.NoSuchProcessError:
-                    continue
-                else:
-                    try:
-                        percentage = self.percent_cpu_usage(
-                            self.last_run_processes[pid], process)
-                    except KeyError:
-                        pass
-                    else:
-                        new_percentages[pid] = percentage
-                    new_processes[pid] = process
-            self.last_run_percentages = new_percentages
-            self.last_run_processes = new_processes
-
-    def run(self):
-        while True:
+        snapshot = self._snapshot()
+        for pid in snapshot.pids:
+            stat = snapshot.stat(pid)
+            if stat is None:
+                continue
+            sample = CpuSample(
+                stat.starttime,
+                (stat.utime + stat.stime) / entityd.procfs.CLOCK_TICKS,
+                snapshot.stat_timestamp(pid))
+            previous = self.last_run_processes.get(pid)
+            if previous and previous.starttime == sample.starttime:
+                new_percentages[pid] = self.percent_cpu_usage(previous, sample)
+            new_processes[pid] = sample
+        self.last_run_processes = new_processes
+        self.percentages = CpuPercentages(
+            self.percentages.version + 1, snapshot.timestamp,
+            types.MappingProxyType(new_percentages))
+
+
+def start_time(stat, boottime):
+    """Get the start time of a process from its stat.
+
+    This gives the same time as :attr:`syskit.Process.start_time`, so
+    Process UEIDs can be computed without reading the process.
+
+    :param stat: The :class:`entityd.procfs.StatStruct` of the process.
+    :param float boottime: The boot time of the host in seconds since
+       the epoch, as :attr:`entityd.procfs.Snapshot.boottime`.
+
+    :returns: A :class:`syskit.TimeSpec`.
+    """
+    return (syskit.TimeSpec(boottime, 0)
+            + stat.starttime / entityd.procfs.CLOCK_TICKS)
+
+
+class ProcfsProcess:
+    """A process read directly from a procfs snapshot.
+
+    This is a light-weight alternative to :class:`syskit.Process`
+    which only reads what is needed for Process MEs: the stat, the
+    ``Uid`` and ``Gid`` lines of the status, the cmdline and the exe
+    link.  It provides the same attributes with the same values, except
+    that the CPU times are floats and strings are decoded with the
+    filesystem encoding rather than the locale of the process.
+
+    The stat and credentials are taken from the snapshot on creation,
+    the cmdline and exe are read from procfs on first access.  No
+    reference to the snapshot is kept as processes outlive the
+    collection cycle they were created in.
+
+    :param int pid: The pid of the process.
+    :param snapshot: The :class:`entityd.procfs.Snapshot` to read from.
+
+    :raises ProcessLookupError: If the process does not exist.
+    """
+
+    def __init__(self, pid, snapshot):
+        self._stat = snapshot.stat(pid)
+        self._credentials = snapshot.credentials(pid)
+        if self._stat is None or self._credentials is None:
+            raise ProcessLookupError('No such process: {}'.format(pid))
+        self.pid = pid
+        self._procpath = snapshot.procpath
+        self._boottime = snapshot.boottime
+        self._argv = None
+
+    @property
+    def name(self):
+        """Short name of the process."""
+        return os.fsdecode(self._stat.comm)
+
+    @property
+    def ppid(self):
+        """Parent process ID."""
+        return self._stat.ppid
+
+    @property
+    def sid(self):
+        """Session ID."""
+        return self._stat.session
+
+    @property
+    def start_time(self):
+        """Process start time as a :class:`syskit.TimeSpec`."""
+        return start_time(self._stat, self._boottime)
+
+    @property
+    def utime(self):
+        """Time spent in user mode in seconds."""
+        return self._stat.utime / entityd.procfs.CLOCK_TICKS
+
+    @property
+    def stime(self):
+        """Time spent in system mode in seconds."""
+        return self._stat.stime / entityd.procfs.CLOCK_TICKS
+
+    @property
+    def cputime(self):
+        """Total CPU time in seconds."""
+        return self.utime + self.stime
+
+    @property
+    def vsz(self):
+        """Virtual memory size in bytes."""
+        return self._stat.vsize
+
+    @property
+    def rss(self):
+        """Resident memory size in bytes."""
+        return self._stat.rss * PAGESIZE
+
+    @property
+    def ruid(self):
+        """Real user ID."""
+        return self._credentials.ruid
+
+    @property
+    def euid(self):
+        """Effective user ID."""
+        return self._credentials.euid
+
+    @property
+    def suid(self):
+        """Saved user ID."""
+        return self._credentials.suid
+
+    @property
+    def rgid(self):
+        """Real group ID."""
+        return self._credentials.rgid
+
+    @property
+    def egid(self):
+        """Effective group ID."""
+        return self._credentials.egid
+
+    @property
+    def sgid(self):
+        """Saved group ID."""
+        return self._credentials.sgid
+
+    @property
+    def user(self):
+        """Username of the real user ID.
+
+        :raises syskit.AttrNotAvailableError: If the user is unknown.
+        """
+        try:
+            return pwd.getpwuid(self.ruid).pw_name
+        except KeyError as err:
+            raise syskit.AttrNotAvailableError(str(err))
+
+    @property
+    def argv(self):
+        """List of the command and its arguments.
+
+        :raises syskit.AttrNotAvailableError: For zombie processes.
+        """
+        if self._argv is None:
+            path = '{}/{}/cmdline'.format(self._procpath, self.pid)
             try:
-                self._run()
-            except Exception:  # pylint: disable=broad-except
-                self._log.exception('An unexpected exception occurred in '
-                                    'CpuUsage thread')
-                raise
-            else:
-                break
-            finally:
-                self.stop()
+                with open(path, 'rb') as fp:
+                    self._argv = fp.read().split(b'\0')[:-1]
+            except OSError as err:
+                if err.errno not in entityd.procfs.IGNORED_ERRNOS:
+                    raise
+                self._argv = []
+        if not self._argv and self._stat.state == b'Z':
+            raise syskit.AttrNotAvailableError(
+                'Not available for a zombie process')
+        return [os.fsdecode(arg) for arg in self._argv]
 
-    def _run(self):
-        """Run the thread main loop.
+    @property
+    def argc(self):
+        """Argument count."""
+        return len(self.argv)
+
+    @property
+    def command(self):
+        """Command and arguments as a single string."""
+        try:
+            return ' '.join(self.argv)
+        except syskit.AttrNotAvailableError:
+            return self.name
+
+    @property
+    def exe(self):
+        """Absolute pathname of the executable.
 
-        Registers the regular timer and polls for
-        events from the incoming request socket.
+        :raises syskit.AttrNotAvailableError: If the executable can
+           not be read, e.g. for zombies or processes of other users.
         """
-        self._stream = act.zkit.EventStream(self._context)
-        timer = act.zkit.SimpleTimer()
-        timer.schedule(0)
-        sock = self._context.socket(zmq.PAIR)
-        sock.bind(self.listen_endpoint)
-        self._stream.register(sock, self._stream.POLLIN)
-        self._stream.register(timer, self._stream.TIMER)
+        path = '{}/{}/exe'.format(self._procpath, self.pid)
         try:
-            for event, _ in self._stream:
-                if event is timer:
-                    self.update()
-                    timer.schedule(self._timer_interval * 1000)
-                elif event is sock:
-                    sock.recv_pyobj()
-                    response = self.last_run_percentages
-                    sock.send_pyobj(response)
-        finally:
-            sock.close(linger=0)
-            self._stream.close()
-
-    def stop(self):
-        """Stop the thread safely.
-
-        We have to consume the stream so that close() gets called.
+            return os.readlink(path)
+        except OSError as err:
+            raise syskit.AttrNotAvailableError(str(err))
+
+
+def is_selected(session, pid):
+    """Check if a Process ME is created for a process.
+
+    Plugins creating relations to Process MEs without looking them up
+    should only do so for processes selected by the
+    :class:`ProcessSelection` policy, other processes are never sent.
+
+    :param session: The :class:`entityd.core.Session`.
+    :param int pid: The pid of the process.
+    """
+    for plugin in session.config.entities.get('Process', ()):
+        if isinstance(plugin.obj, ProcessEntity):
+            return plugin.obj.is_selected(pid)
+    return True
+
+
+class ProcessSelection:
+    """Policy selecting which processes to create Process MEs for.
+
+    The policy is applied to the process table before any updates are
+    created, so processes which are not selected cost no more than
+    reading their stat.  By default all processes are selected.
+
+    Processes are first filtered on kernel threads, age, binary and
+    cgroup.  If top-N limits are given only the N processes with the
+    highest CPU usage and, separately, resident memory of the remaining
+    processes are kept.  Finally the ancestors of all selected processes
+    are added so the process tree stays connected to the host.
+
+    Binary and cgroup patterns are shell-style wildcards matched
+    against the process name and each line of /proc/<pid>/cgroup
+    respectively.  If any include patterns are given a process must
+    match at least one of them; a process matching any exclude pattern
+    is never selected.
+
+    :param bool exclude_kernel_threads: Exclude kernel threads.
+    :param float min_age: Minimum age of a process in seconds.
+    :param int top_cpu: Keep only this many processes by CPU usage.
+    :param int top_rss: Keep only this many processes by resident memory.
+    :param include_binaries: List of binary patterns to include.
+    :param exclude_binaries: List of binary patterns to exclude.
+    :param include_cgroups: List of cgroup patterns to include.
+    :param exclude_cgroups: List of cgroup patterns to exclude.
+    """
+
+    #: The PF_KTHREAD flag in /proc/<pid>/stat, set for kernel threads.
+    PF_KTHREAD = 0x00200000
+
+    def __init__(self, *,
+                 exclude_kernel_threads=False, min_age=0, top_cpu=0,
+                 top_rss=0, include_binaries=(), exclude_binaries=(),
+                 include_cgroups=(), exclude_cgroups=()):
+        self.exclude_kernel_threads = exclude_kernel_threads
+        self.min_age = min_age
+        self.top_cpu = top_cpu
+        self.top_rss = top_rss
+        self.include_binaries = list(include_binaries or ())
+        self.exclude_binaries = list(exclude_binaries or ())
+        self.include_cgroups = list(include_cgroups or ())
+        self.exclude_cgroups = list(exclude_cgroups or ())
+
+    @classmethod
+    def from_args(cls, args):
+        """Create the policy from the parsed command line arguments."""
+        return cls(exclude_kernel_threads=args.process_exclude_kthreads,
+                   min_age=args.process_min_age,
+                   top_cpu=args.process_top_cpu,
+                   top_rss=args.process_top_rss,
+                   include_binaries=args.process_include_binary,
+                   exclude_binaries=args.process_exclude_binary,
+                   include_cgroups=args.process_include_cgroup,
+                   exclude_cgroups=args.process_exclude_cgroup)
+
+    @property
+    def selects_all(self):
+        """True if the policy selects every process."""
+        return not (self.exclude_kernel_threads or self.min_age
+                    or self.top_cpu or self.top_rss
+                    or self.include_binaries or self.exclude_binaries
+                    or self.include_cgroups or self.exclude_cgroups)
+
+    @staticmethod
+    def _match(value, patterns):
+        """Check if a value matches any of the patterns."""
+        return any(fnmatch.fnmatchcase(value, pattern)
+                   for pattern in patterns)
+
+    def _filter(self, pid, stat, snapshot):
+        """Check if a process passes the per-process filters.
+
+        :param int pid: The pid of the process.
+        :param stat: The :class:`entityd.procfs.StatStruct` of the process.
+        :param snapshot: The :class:`entityd.procfs.Snapshot`.
+        """
+        # pylint: disable=too-many-return-statements
+        if self.exclude_kernel_threads and stat.flags & self.PF_KTHREAD:
+            return False
+        if self.min_age and snapshot.age(pid) < self.min_age:
+            return False
+        if self.include_binaries or self.exclude_binaries:
+            binary = stat.comm.decode('utf-8', 'replace')
+            if (self.include_binaries
+                    and not self._match(binary, self.include_binaries)):
+                return False
+            if self._match(binary, self.exclude_binaries):
+                return False
+        if self.include_cgroups or self.exclude_cgroups:
+            cgroup = snapshot.cgroup(pid) or []
+            if self.include_cgroups and not any(
+                    self._match(line, self.include_cgroups)
+                    for line in cgroup):
+                return False
+            if any(self._match(line, self.exclude_cgroups)
+                   for line in cgroup):
+                return False
+        return True
+
+    def select(self, pids, snapshot, cpu_percentages):
+        """Select the processes to create Process MEs for.
+
+        :param pids: The pids of the candidate processes.
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           the processes from.
+        :param cpu_percentages: Mapping of pid to CPU usage percentage.
+
+        :returns: A set of the selected pids.
         """
-        if self._stream:
-            self._stream.send_term()
+        pids = set(pids)
+        if self.selects_all:
+            return pids
+        stats = {}
+        for pid in pids:
+            stat = snapshot.stat(pid)
+            if stat is not None and self._filter(pid, stat, snapshot):
+                stats[pid] = stat
+        selected = set(stats)
+        if self.top_cpu or self.top_rss:
+            selected = set()
+            if self.top_cpu:
+                selected.update(heapq.nlargest(
+                    self.top_cpu, stats,
+                    key=lambda pid: cpu_percentages.get(pid, 0)))
+            if self.top_rss:
+                selected.update(heapq.nlargest(
+                    self.top_rss, stats, key=lambda pid: stats[pid].rss))
+        for pid in list(selected):
+            stat = stats[pid]
+            while stat is not None and stat.ppid in pids:
+                if stat.ppid in selected:
+                    break
+                selected.add(stat.ppid)
+                stat = snapshot.stat(stat.ppid)
+        return selected
 
 
 class ProcessEntity:
@@ -134,12 +483,18 @@ class ProcessEntity:
     prefix = 'entityd.processme:'
 
     def __init__(self):
-        self.zmq_context = act.zkit.new_context()
         self.active_processes = {}
+        self.static_facts = {}
+        self.indexes = {}
+        self.usernames = {}
+        self._selected = None
+        self.selection = ProcessSelection()
+        self.backend = 'syskit'
+        self._table_snapshot = None
         self.session = None
         self._host_ueid = None
-        self.cpu_usage_thread = None
-        self.cpu_usage_sock = None
+        self.cpu_usage = None
+        self.cpu_usage_task = None
         self.procpath = '/proc' # Default; set by args in sessionstart
 
     @staticmethod
@@ -163,26 +518,74 @@ class ProcessEntity:
         except argparse.ArgumentError:
             # assume someone else added it.
             pass
+        parser.add_argument(
+            '--process-backend',
+            default='syskit',
+            choices=['syskit', 'procfs'],
+            help='How to read processes: using syskit or by parsing '
+            'procfs directly, which is faster',
+        )
+        parser.add_argument(
+            '--process-exclude-kthreads',
+            action='store_true',
+            help='Do not create Process entities for kernel threads',
+        )
+        parser.add_argument(
+            '--process-min-age',
+            default=0,
+            type=float,
+            help='Minimum age in seconds of processes to create entities for',
+        )
+        parser.add_argument(
+            '--process-top-cpu',
+            default=0,
+            type=int,
+            help='Only create entities for this many processes with the '
+            'highest CPU usage (and their ancestors)',
+        )
+        parser.add_argument(
+            '--process-top-rss',
+            default=0,
+            type=int,
+            help='Only create entities for this many processes with the '
+            'highest resident memory (and their ancestors)',
+        )
+        for action in ['include', 'exclude']:
+            parser.add_argument(
+                '--process-{}-binary'.format(action),
+                action='append',
+                default=[],
+                metavar='PATTERN',
+                help='{} processes with a matching binary name, '
+                'may be given multiple times'.format(action.capitalize()),
+            )
+            parser.add_argument(
+                '--process-{}-cgroup'.format(action),
+                action='append',
+                default=[],
+                metavar='PATTERN',
+                help='{} processes with a matching cgroup, '
+                'may be given multiple times'.format(action.capitalize()),
+            )
 
     @entityd.pm.hookimpl
     def entityd_sessionstart(self, session):
         """Store the session for later usage."""
         self.session = session
-        self.cpu_usage_thread = CpuUsage(self.zmq_context)
-        self.cpu_usage_thread.start()
-        self.cpu_usage_sock = self.zmq_context.socket(zmq.PAIR)
-        self.cpu_usage_sock.connect(self.cpu_usage_thread.listen_endpoint)
         self.procpath = session.config.args.procpath
+        self.selection = ProcessSelection.from_args(session.config.args)
+        self.backend = session.config.args.process_backend
+        self.cpu_usage = CpuUsage(procpath=self.procpath,
+                                  snapshot=self.snapshot)
+        self.cpu_usage_task = entityd.sampler.service(session).add(
+            'process-cpu', self.cpu_usage.update, self.cpu_usage.interval)
 
     @entityd.pm.hookimpl
     def entityd_sessionfinish(self):
         """Safely terminate the plugin."""
-        if self.cpu_usage_thread:
-            self.cpu_usage_thread.stop()
-            self.cpu_usage_thread.join(timeout=2)
-        if self.cpu_usage_sock:
-            self.cpu_usage_sock.close(linger=0)
-        self.zmq_context.destroy(linger=0)
+        if self.cpu_usage_task:
+            entityd.sampler.service(self.session).remove(self.cpu_usage_task)
+            self.cpu_usage_task = None
 
     @entityd.pm.hookimpl
     def entityd_find_entity(self, name, attrs, include_ondemand=False):  # pylint: disable=unused-argument
@@ -202,15 +605,36 @@ class ProcessEntity:
         :returns: A :class:`cobe.UEID` for the  host.
         """
         if not self._host_ueid:
-            results = self.session.pluginmanager.hooks.entityd_find_entity(
-                name='Host', attrs=None)
-            if results:
-                for host_me in results[0]:
-                    self._host_ueid = host_me.ueid
-        if not self._host_ueid:
-            raise LookupError('Could not find the host UEID')
+            self._host_ueid = entityd.mixins.find_host_ueid(self.session)
         return self._host_ueid
 
+    def new_process(self, pid, snapshot=None):
+        """Read a process using the configured backend.
+
+        :param int pid: The pid of the process.
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
+
+        :raises syskit.NoSuchProcessError: If the process does not
+           exist, for the syskit backend.
+        :raises ProcessLookupError: If the process does not exist, for
+           the procfs backend.
+
+        :returns: A :class:`syskit.Process` or :class:`ProcfsProcess`.
+        """
+        if self.backend == 'procfs':
+            if snapshot is None:
+                snapshot = self.snapshot()
+            return ProcfsProcess(pid, snapshot)
+        return syskit.Process(pid)
+
+    def snapshot(self):
+        """Get the procfs snapshot of the current collection cycle.
+
+        :returns: A :class:`entityd.procfs.Snapshot`.
+        """
+        return entityd.procfs.snapshot(self.session, self.procpath)
+
     def get_ueid(self, proc):
         """Generate a ueid for this process.
 
@@ -218,15 +642,10 @@ class ProcessEntity:
 
         :returns: A :class:`cobe.UEID` for the given process.
         """
-        entity = entityd.EntityUpdate('Process')
-        entity.attrs.set('pid', proc.pid, traits={'entity:id'})
-        entity.attrs.set('starttime', proc.start_time.timestamp(),
-                         traits={'entity:id'})
-        entity.attrs.set('host', str(self.host_ueid), traits={'entity:id'})
+        return PROCESS_UEID(
+            proc.pid, proc.start_time.timestamp(), str(self.host_ueid))
 
-        return entity.ueid
-
-    def get_parents(self, proc, procs):
+    def get_parents(self, proc, procs, snapshot=None):
         """Get relations for a process.
 
         Relations may include:
@@ -235,15 +654,19 @@ class ProcessEntity:
 
         :param proc: The process to get relations for.
         :param procs: A dictionary of all processes on the system.
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
 
         :returns: A list of relations, as :class:`cobe.UEID`s.
         """
+        if snapshot is None:
+            snapshot = self.snapshot()
         parents = []
-        ppid = proc.ppid
+        ppid = self.get_ppid(proc, snapshot)
         if ppid:
             if ppid in procs:
                 pproc = procs[ppid]
-                parents.append(self.get_ueid(pproc))
+                parents.append(self.get_static_facts(pproc, snapshot).ueid)
         else:
             parents.append(self.host_ueid)
         return parents
@@ -251,28 +674,36 @@ class ProcessEntity:
     def filtered_processes(self, attrs):
         """Filter processes based on attrs.
 
-        Special case for 'pid' since this should be efficient.
+        Special case for 'pid' since this should be efficient.  When
+        filtering on any of the :data:`INDEXED_ATTRS` the candidate
+        processes are looked up in the indexes and updates are only
+        created for those.
+
+        All updates are created from a single procfs snapshot, also
+        outside of a collection cycle.
         """
+        snapshot = self.snapshot()
         with syskit.set_procpath(self.procpath):
             if 'pid' in attrs and len(attrs) == 1:
-                proc_containers = self.get_process_containers([attrs['pid']])
+                proc_containers = self.get_process_containers(
+                    [attrs['pid']], snapshot)
                 try:
-                    proc = syskit.Process(attrs['pid'])
-                except syskit.NoSuchProcessError:
+                    proc = self.new_process(attrs['pid'], snapshot)
+                except (syskit.NoSuchProcessError, ProcessLookupError):
                     return
-                entity = self.create_process_me(self.active_processes,
-                                                proc, proc_containers)
-                cpupc = self.get_all_cpu_percentages()
-                if cpupc:
-                    try:
-                        entity.attrs.set('cpu', cpupc[proc.pid],
-                                         traits={'metric:gauge',
-                                                 'unit:percent'})
-                    except KeyError:
-                        pass
+                entity = self.create_process_me(
+                    self.active_processes, proc, proc_containers, snapshot)
+                cpupc = self.get_cpu_percentage(proc.pid)
+                if cpupc is not None:
+                    entity.attrs.set('cpu', cpupc,
+                                     traits={'metric:gauge', 'unit:percent'})
                 yield entity
             else:
-                for proc in self.processes():
+                if set(attrs).intersection(INDEXED_ATTRS):
+                    candidates = self.indexed_processes(attrs, snapshot)
+                else:
+                    candidates = self.processes(snapshot)
+                for proc in candidates:
                     try:
                         match = all([proc.attrs.get(name).value == value
                                      for (name, value) in attrs.items()])
@@ -281,46 +712,193 @@ class ProcessEntity:
                     except KeyError:
                         continue
 
-    def processes(self):
-        """Generator of Process MEs."""
-        active = self.update_process_table(self.active_processes)
+    def indexed_processes(self, attrs, snapshot=None):
+        """Generator of Process MEs matching the indexed attrs.
+
+        Only the attributes in :data:`INDEXED_ATTRS` are used, the
+        caller still needs to check any other attributes.
+
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        table = self.process_table(snapshot)
+        pids = None
+        for name, value in attrs.items():
+            if name in INDEXED_ATTRS:
+                matches = self._index(name).get(value, set())
+                pids = matches if pids is None else pids & matches
+        procs = [table[pid] for pid in sorted(pids)]
+        if not procs:
+            return
+        proc_containers = self.get_process_containers(
+            [proc.pid for proc in procs], snapshot)
+        cpu_percentages = self.get_all_cpu_percentages()
+        for proc in procs:
+            update = self.create_process_me(
+                table, proc, proc_containers, snapshot)
+            try:
+                update.attrs.set('cpu', cpu_percentages[proc.pid],
+                                 traits={'metric:gauge', 'unit:percent'})
+            except KeyError:
+                pass
+            yield update
+
+    def process_table(self, snapshot=None):
+        """Get the process table for a procfs snapshot.
+
+        The process table is only updated once per snapshot, i.e. once
+        per collection cycle, no matter how many lookups are made.  The
+        indexes are invalidated whenever the table is updated.
+
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
+
+        :returns: Dict mapping pid to syskit.Process.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        if snapshot is not self._table_snapshot:
+            self.active_processes = self.update_process_table(
+                self.active_processes, snapshot)
+            self._table_snapshot = snapshot
+            self.indexes = {}
+            self.usernames = {}
+            self._selected = None
+        return self.active_processes
+
+    def get_index(self, name):
+        """Get the index of the process table for an attribute.
+
+        Indexes are built on first use after each update of the
+        process table.
+
+        :param name: One of :data:`INDEXED_ATTRS`.
+
+        :returns: Dict mapping attribute values to sets of pids.
+        """
+        self.process_table()
+        return self._index(name)
+
+    def _index(self, name):
+        """Get an index of the process table as last updated.
+
+        Unlike :meth:`get_index` this does not update the process table
+        first, so the index matches the table the caller already has.
+        Outside of a collection cycle every snapshot is new and the
+        table would be updated again.
+        """
+        try:
+            return self.indexes[name]
+        except KeyError:
+            pass
+        table = self.active_processes
+        if name == 'binary':
+            values = ((pid, proc.name) for pid, proc in table.items())
+        elif name == 'ppid':
+            snapshot = self._table_snapshot
+            values = ((pid, self.get_ppid(proc, snapshot))
+                      for pid, proc in table.items())
+        else:
+            values = self.get_process_containers(
+                table.keys(), self._table_snapshot).items()
+        index = collections.defaultdict(set)
+        for pid, value in values:
+            index[value].add(pid)
+        self.indexes[name] = index
+        return index
+
+    @staticmethod
+    def get_ppid(proc, snapshot):
+        """Get the current parent pid of a process.
+
+        :param proc: syskit.Process instance.
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           the ppid from, falls back to the syskit.Process if the
+           process has vanished from it.
+        """
+        stat = snapshot.stat(proc.pid)
+        return proc.ppid if stat is None else stat.ppid
+
+    def processes(self, snapshot=None):
+        """Generator of Process MEs.
+
+        Only processes selected by the :class:`ProcessSelection` policy
+        are included.
+
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        active = self.process_table(snapshot)
         create_me = functools.partial(self.create_process_me, active)
-        processed_ueids = set()
-        proc_containers = self.get_process_containers(active.keys())
         cpu_percentages = self.get_all_cpu_percentages()
-        for proc in active.values():
-            update = create_me(proc, proc_containers)
+        selected = self.selected_pids(snapshot)
+        proc_containers = self.get_process_containers(selected, snapshot)
+        for proc in [p for pid, p in active.items() if pid in selected]:
+            update = create_me(proc, proc_containers, snapshot)
             try:
                 update.attrs.set('cpu', cpu_percentages[proc.pid],
                                  traits={'metric:gauge', 'unit:percent'})
             except KeyError:
                 pass
-            processed_ueids.add(update.ueid)
             yield update
-        self.active_processes = active
 
-    def get_process_containers(self, pids):
+    def selected_pids(self, snapshot=None):
+        """Get the pids of the processes Process MEs are created for.
+
+        The :class:`ProcessSelection` policy is applied once per update
+        of the process table.
+
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
+
+        :returns: A set of pids.
+        """
+        active = self.process_table(snapshot)
+        if self._selected is None:
+            self._selected = self.selection.select(
+                active.keys(), self._table_snapshot,
+                self.get_all_cpu_percentages())
+        return self._selected
+
+    def is_selected(self, pid):
+        """Check if a Process ME is created for a process.
+
+        :param int pid: The pid of the process.
+        """
+        return self.selection.selects_all or pid in self.selected_pids()
+
+    def get_process_containers(self, pids, snapshot=None):
         """Obtain the container IDs for all processes running in containers.
 
+        The container of a process is parsed from its cgroup, which is
+        only read once per process lifetime as the procfs snapshots
+        carry the result over from one cycle to the next.  Only
+        containers Docker reports as running are included, the cgroups
+        of other container runtimes look the same.
+
+        :param pids: The pids of the processes.
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
+
         Returns: A dict of the process PIDs to docker container IDs of format:
 
             {<process pid>: <container ID>, ...}.
         """
         if not entityd.docker.client.DockerClient.client_available():
             return {}
-        containerids = {
-            container.id for container in
-            entityd.docker.client.DockerClient.running_containers()
-        }
+        running = {container.id for container in
+                   entityd.docker.client.DockerClient.running_containers()}
         containers = {}
+        if snapshot is None:
+            snapshot = self.snapshot()
         for pid in pids:
-            try:
-                with open(self.procpath + '/{}/cgroup'.format(pid), 'r') as fp:
-                    for containerid in containerids:
-                        if containerid in fp.readline():
-                            containers[pid] = containerid
-            except (FileNotFoundError, ProcessLookupError):
-                continue
+            container = snapshot.container(pid)
+            if container is not None and container.id in running:
+                containers[pid] = container.id
         return containers
 
     @staticmethod
@@ -331,53 +909,157 @@ class ProcessEntity:
 
         :returns: A :class:`cobe.UEID` for the container.
         """
-        update = entityd.EntityUpdate('Docker:Container')
-        update.attrs.set(
-            'id', container_id, traits={'entity:id'})
-        return update.ueid
+        return entityd.docker.get_ueid('DockerContainer', container_id)
 
-    def update_process_table(self, procs):
-        """Updates the process table, refreshing and adding processes.
+    def update_process_table(self, procs, snapshot=None):
+        """Updates the process table, adding new processes.
+
+        Processes are identified by their pid and starttime.  Processes
+        which were already known are kept as they are, their volatile
+        counters are read from the procfs snapshot when creating their
+        updates.  Only new processes, including re-used pids, are read
+        in full and get a slot for their static facts, which are
+        filled in on first use.  The static facts of processes which
+        no longer exist are dropped.
 
         Returns a dict of active processes.
 
         :param procs: Dictionary mapping pid to syskit.Process
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
 
         """
         active = {}
+        static_facts = {}
+        if snapshot is None:
+            snapshot = self.snapshot()
         with syskit.set_procpath(self.procpath):
-            pids = syskit.Process.enumerate()
-            for pid in pids:
-                if pid in procs:
-                    proc = procs[pid]
-                    try:
-                        proc.refresh()
-                    except syskit.NoSuchProcessError:
-                        pass
-                    else:
-                        active[pid] = proc
-                else:
-                    try:
-                        active[pid] = syskit.Process(pid)
-                    except (syskit.NoSuchProcessError, ProcessLookupError):
-                        pass
-            return active
+            for pid in snapshot.pids:
+                stat = snapshot.stat(pid)
+                if stat is None:
+                    continue
+                key = self.static_facts_key(stat)
+                if pid in procs and key in self.static_facts:
+                    active[pid] = procs[pid]
+                    static_facts[key] = self.static_facts[key]
+                    continue
+                try:
+                    proc = self.new_process(pid, snapshot)
+                except (syskit.NoSuchProcessError, ProcessLookupError):
+                    continue
+                active[pid] = proc
+                static_facts[key] = None
+        self.static_facts = static_facts
+        return active
+
+    @staticmethod
+    def static_facts_key(stat):
+        """Get the key of the static facts of a process.
+
+        Besides the pid and starttime identifying the process this
+        includes the comm, which changes when the process executes a
+        new program.  An execve of a program with the same name, or
+        a change of the arguments in place, is not noticed and the
+        command and arguments of the previous program are kept.
+
+        :param stat: The :class:`entityd.procfs.StatStruct` of the
+           process.
+        """
+        return stat.pid, stat.starttime, stat.comm
+
+    def get_static_facts(self, proc, snapshot=None):
+        """Get the static facts of a process.
+
+        These are cached in the process table if the process is known,
+        otherwise they are read from the process every time.
+
+        :param proc: syskit.Process instance.
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
+
+        :returns: A :class:`StaticFacts` instance.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        stat = snapshot.stat(proc.pid)
+        key = None if stat is None else self.static_facts_key(stat)
+        facts = self.static_facts.get(key)
+        if facts is None:
+            facts = self.read_static_facts(proc)
+            if key in self.static_facts:
+                self.static_facts[key] = facts
+        return facts
+
+    def read_static_facts(self, proc):
+        """Read the facts of a process which do not change.
+
+        :param proc: syskit.Process instance.
+
+        :returns: A :class:`StaticFacts` instance.
+        """
+        attrs = [
+            ('binary', proc.name, {'index'}),
+            ('pid', proc.pid, {'entity:id', 'index:numeric'}),
+            ('starttime', proc.start_time.timestamp(),
+             {'entity:id', 'time:posix', 'unit:seconds'}),
+            ('host', str(self.host_ueid), {'entity:id', 'entity:ueid'}),
+        ]
+        attrs.append(('command', proc.command, {'index'}))
+        try:
+            attrs.extend([
+                ('executable', proc.exe, None),
+                ('args', proc.argv, None),
+                ('argcount', proc.argc, None),
+            ])
+        except AttributeError:
+            # A zombie process doesn't allow access to these attributes
+            pass
+        return StaticFacts(self.get_ueid(proc), proc.name, attrs)
+
+    def get_username(self, uid):
+        """Get the name of a user.
+
+        Names are looked up once per update of the process table.
+
+        :param int uid: The user ID.
+
+        :returns: The username or ``None`` if the user is unknown.
+        """
+        try:
+            return self.usernames[uid]
+        except KeyError:
+            pass
+        try:
+            username = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            username = None
+        self.usernames[uid] = username
+        return username
 
     def get_all_cpu_percentages(self):
         """Return CPU usage percentage since the last sample or process start.
 
-        :param proc: syskit.Process instance.
-        :returns dict: All available percentage (possibly empty).
+        This is the mapping last published by the CPU usage thread, it
+        is not copied and must not be modified.
+
+        :returns: A mapping of pid to percentage (possibly empty).
         """
-        if not self.cpu_usage_sock:
-            return {}
-        self.cpu_usage_sock.send_pyobj(None)
-        if self.cpu_usage_sock.poll(timeout=1000, flags=zmq.POLLIN):
-            return self.cpu_usage_sock.recv_pyobj()
-        else:
-            return {}
+        if not self.cpu_usage:
+            return NO_CPU_PERCENTAGES.percentages
+        return self.cpu_usage.percentages.percentages
+
+    def get_cpu_percentage(self, pid):
+        """Return CPU usage percentage of a single process.
 
-    def create_process_me(self, proctable, proc, proc_containers):
+        :param int pid: The pid of the process.
+
+        :returns: The percentage as a float or ``None`` if it is not
+           known yet.
+        """
+        return self.get_all_cpu_percentages().get(pid)
+
+    def create_process_me(self, proctable, proc, proc_containers,
+                          snapshot=None):
         """Create a new Process ME structure for the process.
 
         Note that an entityd running in a container that shares the hosts's
@@ -391,53 +1073,60 @@ class ProcessEntity:
         Where a process is in a container, but doesn't have a ppid, then
         the UEID of the container of the process is added as a parent.
 
+        Only the volatile counters, credentials, username and session id
+        are read for each update, from the procfs snapshot.  The remaining
+        attributes and the UEID are taken from the static facts cached
+        in the process table.
+
         :param proctable: Dict of pid -> syskit.Process instances for
            all processes on the host.
         :param proc: syskit.Process instance.
         :param proc_containers: Dict of all the PIDs of processes
            running in containers to docker container IDs.
+        :param snapshot: The :class:`entityd.procfs.Snapshot` to read
+           from, defaults to the snapshot of the current cycle.
         """
-        update = entityd.EntityUpdate('Process')
-        update.label = proc.name
-        update.attrs.set('binary', proc.name, {'index'})
-        update.attrs.set('pid', proc.pid, {'entity:id', 'index:numeric'})
-        update.attrs.set('starttime', proc.start_time.timestamp(),
-                         {'entity:id', 'time:posix', 'unit:seconds'})
-        update.attrs.set('ppid', proc.ppid)
+        if snapshot is None:
+            snapshot = self.snapshot()
+        facts = self.get_static_facts(proc, snapshot)
+        update = entityd.EntityUpdate('Process', ueid=facts.ueid)
+        update.label = facts.label
+        for name, value, traits in facts.attrs:
+            update.attrs.set(name, value, traits)
+        stat = snapshot.stat(proc.pid)
+        if stat is None:
+            utime, stime = float(proc.utime), float(proc.stime)
+            ppid, vsz, rss = proc.ppid, proc.vsz, proc.rss
+        else:
+            utime = stat.utime / entityd.procfs.CLOCK_TICKS
+            stime = stat.stime / entityd.procfs.CLOCK_TICKS
+            ppid, vsz, rss = stat.ppid, stat.vsize, stat.rss * PAGESIZE
+        update.attrs.set('ppid', ppid)
+        credentials = snapshot.credentials(proc.pid)
+        if credentials is None:
+            credentials = entityd.procfs.Credentials(
+                proc.ruid, proc.euid, proc.suid,
+                proc.rgid, proc.egid, proc.sgid)
+        for name, value in zip(CREDENTIAL_ATTRS, credentials):
+            update.attrs.set(name, value)
+        username = self.get_username(credentials.ruid)
+        if username is not None:
+            update.attrs.set('username', username)
+        update.attrs.set('sessionid',
+                         proc.sid if stat is None else stat.session)
         if proc.pid in proc_containers:
             update.attrs.set('containerid', proc_containers[proc.pid])
-        update.attrs.set('host', str(self.host_ueid),
-                         {'entity:id', 'entity:ueid'})
-        update.attrs.set('cputime', float(proc.cputime),
+        update.attrs.set('cputime', utime + stime,
                          {'metric:counter', 'time:duration', 'unit:seconds'})
-        update.attrs.set('utime', float(proc.utime),
+        update.attrs.set('utime', utime,
                          {'metric:counter', 'time:duration', 'unit:seconds'})
-        update.attrs.set('stime', float(proc.stime),
+        update.attrs.set('stime', stime,
                          {'metric:counter', 'time:duration', 'unit:seconds'})
-        update.attrs.set('vsz', proc.vsz, {'metric:gauge', 'unit:bytes'})
-        update.attrs.set('rss', proc.rss, {'metric:gauge', 'unit:bytes'})
-        update.attrs.set('uid', proc.ruid)
-        update.attrs.set('euid', proc.euid)
-        update.attrs.set('suid', proc.suid)
-        try:
-            update.attrs.set('username', proc.user)
-        except syskit.AttrNotAvailableError:
-            pass
-        update.attrs.set('gid', proc.rgid)
-        update.attrs.set('egid', proc.egid)
-        update.attrs.set('sgid', proc.sgid)
-        update.attrs.set('sessionid', proc.sid)
-        update.attrs.set('command', proc.command, {'index'})
-        try:
-            update.attrs.set('executable', proc.exe)
-            update.attrs.set('args', proc.argv)
-            update.attrs.set('argcount', proc.argc)
-        except AttributeError:
-            # A zombie process doesn't allow access to these attributes
-            pass
-        for parent in self.get_parents(proc, proctable):
+        update.attrs.set('vsz', vsz, {'metric:gauge', 'unit:bytes'})
+        update.attrs.set('rss', rss, {'metric:gauge', 'unit:bytes'})
+        for parent in self.get_parents(proc, proctable, snapshot):
             update.parents.add(parent)
-        if proc.pid in proc_containers and proc.ppid not in proc_containers:
+        if proc.pid in proc_containers and ppid not in proc_containers:
             update.parents.add(
                 self.get_container_ueid(proc_containers[proc.pid]))
         return update
@@ -0,0 +1,618 @@
+"""Plugin providing a shared per-cycle snapshot of procfs.
+
+Several plugins need to inspect the processes running on the host:
+the process table, per-process CPU usage, the sockets owned by each
+process and the containers processes run in.  Rather than each of
+these walking ``/proc`` independently, this plugin registers a
+``procfs`` service on the session which hands out a single
+:class:`Snapshot` for the duration of a collection cycle.
+
+A snapshot lists the pids once and reads each per-process file at
+most once, lazily, the first time any plugin asks for it.  This keeps
+all consumers consistent with each other within a cycle while only
+paying for the files which are actually used.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import errno
+import os
+import re
+import threading
+import time
+
+import entityd.pm
+
+
+#: The leading fields of the /proc/<pid>/stat structure.
+StatStruct = collections.namedtuple(
+    'StatStruct',
+    ['pid', 'comm', 'state', 'ppid', 'pgrp', 'session', 'tty_nr', 'tpgid',
+     'flags', 'minflt', 'cminflt', 'majflt', 'cmajflt', 'utime', 'stime',
+     'cutime', 'cstime', 'priority', 'nice', 'num_threads', 'itrealvalue',
+     'starttime', 'vsize', 'rss'])
+
+
+#: The real, effective and saved user and group IDs of a process.
+Credentials = collections.namedtuple(
+    'Credentials', ['ruid', 'euid', 'suid', 'rgid', 'egid', 'sgid'])
+
+
+#: Number of integer fields following the state in StatStruct.
+_STAT_INT_FIELDS = len(StatStruct._fields) - 3
+
+
+#: Clock ticks per second, the unit of the times in /proc/<pid>/stat.
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+#: Errors which mean a process vanished or may not be inspected.
+IGNORED_ERRNOS = (errno.ENOENT, errno.ESRCH, errno.EPERM, errno.EACCES)
+
+
+#: The sockets open by a process, read from its fd directory.  All
+#: links were last read at ``timestamp``.  ``fds`` is the frozenset of
+#: the file descriptor names, ``sockets`` maps socket inodes to lists of
+#: ``(pid, fd)``.
+FdTable = collections.namedtuple('FdTable', ['timestamp', 'fds', 'sockets'])
+
+
+#: Seconds the links of file descriptors which were not sockets may be
+#: skipped for.  Socket links are always read again, as closing a socket
+#: and opening a new one commonly reuses the fd number.  A closed file
+#: could be replaced by a socket the same way, the age limit bounds how
+#: long such a socket can go without an owner.
+FD_TABLE_MAX_AGE = 300
+
+
+#: The cgroup of the container a process runs in.  The id is the
+#: 64-character container id, the path is the directory of the cgroup
+#: relative to the cgroup filesystem mount point.
+ContainerCgroup = collections.namedtuple('ContainerCgroup', ['id', 'path'])
+
+
+#: Matches the last component of the cgroup path of a container.  This
+#: is the bare container id for the cgroupfs driver of docker and
+#: containerd (``/docker/<id>``, ``/kubepods/.../<id>``) and prefixed
+#: with the runtime and suffixed with ``.scope`` for the systemd driver
+#: (``docker-<id>.scope``, ``cri-containerd-<id>.scope``,
+#: ``crio-<id>.scope``).
+_CONTAINER_CGROUP_RE = re.compile(
+    r'^(?:(?:docker|cri-containerd|crio|libpod)-)?([0-9a-f]{64})(?:\.scope)?$')
+
+
+def parse_container_cgroup(cgroup):
+    """Find the container cgroup in the lines of /proc/<pid>/cgroup.
+
+    Both cgroup v1 lines (``<id>:<controllers>:<path>``) and the cgroup
+    v2 line (``0::<path>``) are understood.  The path returned is
+    relative to the cgroup mount point: for v1 it is prefixed with the
+    directory of the controller hierarchy.
+
+    :param cgroup: List of lines from /proc/<pid>/cgroup.
+
+    :returns: A :class:`ContainerCgroup` or ``None`` if the process is
+       not in a container.
+    """
+    for line in cgroup:
+        _, controllers, path = line.split(':', 2)
+        match = _CONTAINER_CGROUP_RE.match(path.rsplit('/', 1)[-1])
+        if not match:
+            continue
+        if controllers.startswith('name='):
+            controllers = controllers[5:]
+        if controllers:
+            path = '/' + controllers + path
+        return ContainerCgroup(match.group(1), path)
+    return None
+
+
+def cgroup_procs(path, cgrouppath='/sys/fs/cgroup'):
+    """Get the pids of the processes in a cgroup.
+
+    This reads the ``cgroup.procs`` file of the cgroup directly,
+    without inspecting any processes.
+
+    :param path: The cgroup path relative to the mount point, e.g. the
+       path of a :class:`ContainerCgroup`.
+    :param cgrouppath: The location the cgroup filesystem is mounted at.
+
+    :returns: A list of pids or ``None`` if the cgroup does not exist.
+    """
+    try:
+        with open(cgrouppath + path + '/cgroup.procs', 'rb') as fp:
+            return [int(pid) for pid in fp.read().split()]
+    except OSError as err:
+        if err.errno not in IGNORED_ERRNOS:
+            raise
+        return None
+
+
+class ProcFS:
+    """Plugin providing the ``procfs`` session service.
+
+    :ivar procpath: The location procfs is mounted at.
+    :ivar cgrouppath: The location the cgroup filesystem is mounted at.
+    """
+
+    def __init__(self):
+        self.procpath = '/proc'  # Default; set by args in sessionstart
+        self.cgrouppath = '/sys/fs/cgroup'
+        self._snapshot = None
+        self.threads = 0
+        self._containers = {}
+        self._fd_tables = {}
+        self._lock = threading.Lock()
+
+    @entityd.pm.hookimpl
+    def entityd_addoption(self, parser):
+        """Add the required options to the command line."""
+        # procpath is used by several plugins, so catch duplicate
+        # additions.
+        try:
+            parser.add_argument(
+                '--procpath',
+                default='/proc',
+                type=str,
+                help='Path to /proc if mounted elsewhere',
+            )
+        except argparse.ArgumentError:
+            # assume someone else added it.
+            pass
+        parser.add_argument(
+            '--cgrouppath',
+            default='/sys/fs/cgroup',
+            type=str,
+            help='Path to the cgroup filesystem if mounted elsewhere',
+        )
+        parser.add_argument(
+            '--fd-scan-threads',
+            default=0,
+            type=int,
+            help='Number of threads reading the file descriptors of '
+                 'processes to find their sockets, 0 to read them in '
+                 'the collecting thread',
+        )
+
+    @entityd.pm.hookimpl
+    def entityd_sessionstart(self, session):
+        """Register the procfs service."""
+        self.procpath = session.config.args.procpath
+        self.cgrouppath = session.config.args.cgrouppath
+        self.threads = session.config.args.fd_scan_threads
+        session.addservice('procfs', self)
+
+    @entityd.pm.hookimpl
+    def entityd_collection_before(self, session):  # pylint: disable=unused-argument
+        """Start a new snapshot for the collection cycle."""
+        with self._lock:
+            self._snapshot = self._new_snapshot()
+
+    @entityd.pm.hookimpl
+    def entityd_collection_after(self, session, updates):  # pylint: disable=unused-argument
+        """Drop the snapshot of the finished collection cycle.
+
+        The container cgroups looked up and the fd tables read during
+        the cycle are kept for the next one.
+        """
+        with self._lock:
+            if self._snapshot is not None:
+                self._containers = self._snapshot.containers
+                self._fd_tables = self._snapshot.fd_tables
+            self._snapshot = None
+
+    def _new_snapshot(self):
+        """Create a snapshot carrying over the state of the last cycle."""
+        return Snapshot(self.procpath, self._containers,
+                        fd_tables=self._fd_tables, threads=self.threads)
+
+    def container_pids(self, container):
+        """Get the pids of the processes in a container.
+
+        :param container: A :class:`ContainerCgroup`.
+
+        :returns: A list of pids or ``None`` if the cgroup is gone.
+        """
+        return cgroup_procs(container.path, self.cgrouppath)
+
+    def snapshot(self):
+        """Get the snapshot of the current collection cycle.
+
+        Outside of a collection cycle, e.g. for background threads
+        sampling between cycles, a fresh snapshot is returned instead
+        which is not shared with anyone else.
+
+        :returns: A :class:`Snapshot`.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                return self._new_snapshot()
+            return self._snapshot
+
+
+def snapshot(session, procpath='/proc'):
+    """Get the current snapshot from a session's procfs service.
+
+    The procfs plugin may have been disabled, in which case a private
+    snapshot of the given procpath is returned.
+
+    :param session: The session or ``None`` if there is none.
+    :param procpath: The location procfs is mounted at, used only when
+       there is no procfs service.
+
+    :returns: A :class:`Snapshot`.
+    """
+    try:
+        service = session.svc.procfs
+    except AttributeError:
+        return Snapshot(procpath)
+    else:
+        return service.snapshot()
+
+
+def container_pids(session, container):
+    """Get the pids of the processes in a container.
+
+    This uses the cgroup mount point of the session's procfs service
+    if there is one and the default location otherwise.
+
+    :param session: The session or ``None`` if there is none.
+    :param container: A :class:`ContainerCgroup`.
+
+    :returns: A list of pids or ``None`` if the cgroup is gone.
+    """
+    try:
+        service = session.svc.procfs
+    except AttributeError:
+        return cgroup_procs(container.path)
+    else:
+        return service.container_pids(container)
+
+
+class Snapshot:
+    """A lazily read, consistent view of the processes in procfs.
+
+    The list of pids is read once, on first access.  Per-process files
+    are read at most once each, the first time they are requested, and
+    the parsed result is cached for the lifetime of the snapshot.  A
+    process which has vanished or may not be inspected is reported as
+    ``None`` rather than raising.
+
+    Snapshots may be shared between threads; concurrent readers may
+    both read a file but will never see a partial result.
+
+    The container cgroups of processes are identified by pid and
+    starttime, as they never change during the lifetime of a process
+    they can be carried over from previous snapshots.  So are the fd
+    tables of processes, of which only the links of sockets and new
+    file descriptors are read again, see :data:`FD_TABLE_MAX_AGE`.
+
+    :param procpath: The location procfs is mounted at.
+    :param containers: Optional dict of container cgroups from a
+       previous snapshot, as in its ``containers`` attribute.
+    :param fd_tables: Optional dict of fd tables from a previous
+       snapshot, as in its ``fd_tables`` attribute.
+    :param threads: Number of threads to read the fd directories of
+       all processes with in :meth:`socket_index`, 0 to read them in
+       the calling thread.
+
+    :ivar timestamp: The time the snapshot was started.
+    :ivar containers: Dict mapping ``(pid, starttime)`` to the
+       :class:`ContainerCgroup` or ``None`` for all processes whose
+       container was looked up in this snapshot.
+    :ivar fd_tables: Dict mapping ``(pid, starttime)`` to the
+       :class:`FdTable` of all processes whose sockets were looked up
+       in this snapshot.
+    """
+
+    def __init__(self, procpath='/proc', containers=None,
+                 fd_tables=None, threads=0):
+        self.procpath = procpath
+        self.timestamp = time.time()
+        self.containers = {}
+        self.fd_tables = {}
+        self.threads = threads
+        self._previous_containers = containers or {}
+        self._previous_fd_tables = fd_tables or {}
+        self._pids = None
+        self._boottime = None
+        self._children = None
+        self._stat = {}
+        self._status = {}
+        self._credentials = {}
+        self._cgroup = {}
+        self._cmdline = {}
+        self._socket_inodes = {}
+        self._socket_index = None
+
+    def _read(self, pid, name):
+        """Read a file of a process.
+
+        :returns: The contents as bytes or ``None`` if the process
+           vanished or the file could not be read.
+        """
+        path = '{}/{}/{}'.format(self.procpath, pid, name)
+        try:
+            with open(path, 'rb') as fp:
+                return fp.read()
+        except OSError as err:
+            if err.errno not in IGNORED_ERRNOS:
+                raise
+            return None
+
+    @property
+    def boottime(self):
+        """The time the host booted, in seconds since the epoch."""
+        if self._boottime is None:
+            with open(self.procpath + '/stat', 'rb') as fp:
+                for line in fp:
+                    if line.startswith(b'btime '):
+                        self._boottime = int(line.split()[1])
+                        break
+        return self._boottime
+
+    def age(self, pid):
+        """Get the age of a process at the time of the snapshot.
+
+        :returns: The age in seconds or ``None``.
+        """
+        stat = self.stat(pid)
+        if stat is None:
+            return None
+        return self.timestamp - (self.boottime + stat.starttime / CLOCK_TICKS)
+
+    @property
+    def pids(self):
+        """List of the pids of all processes in the snapshot."""
+        if self._pids is None:
+            self._pids = [int(entry) for entry in os.listdir(self.procpath)
+                          if entry.isdigit()]
+        return self._pids
+
+    def stat(self, pid):
+        """Get the parsed /proc/<pid>/stat of a process.
+
+        :returns: A :class:`StatStruct` or ``None``.
+        """
+        try:
+            return self._stat[pid][0]
+        except KeyError:
+            pass
+        stat = None
+        raw = self._read(pid, 'stat')
+        if raw:
+            head, tail = raw.rsplit(b')', 1)
+            comm = head.split(b'(', 1)[1]
+            state, *fields = tail.split()
+            fields = [int(field) for field in fields[:_STAT_INT_FIELDS]]
+            stat = StatStruct(pid, comm, state, *fields)
+        self._stat[pid] = (stat, time.time())
+        return stat
+
+    def stat_timestamp(self, pid):
+        """The time the stat of a process was read at.
+
+        Reads the stat if this has not yet been done.
+
+        :returns: Time in seconds since the epoch.
+        """
+        self.stat(pid)
+        return self._stat[pid][1]
+
+    def status(self, pid):
+        """Get the fields of /proc/<pid>/status of a process.
+
+        :returns: A dict mapping field names to their unparsed string
+           values, or ``None``.
+        """
+        try:
+            return self._status[pid]
+        except KeyError:
+            pass
+        status = None
+        raw = self._read(pid, 'status')
+        if raw:
+            status = {}
+            for line in raw.decode('utf-8', 'replace').splitlines():
+                key, _, value = line.partition(':')
+                status[key] = value.strip()
+        self._status[pid] = status
+        return status
+
+    def credentials(self, pid):
+        """Get the user and group IDs from /proc/<pid>/status of a process.
+
+        Unlike :meth:`status` this only parses the ``Uid`` and ``Gid``
+        lines.
+
+        :returns: A :class:`Credentials` instance or ``None``.
+        """
+        try:
+            return self._credentials[pid]
+        except KeyError:
+            pass
+        credentials = None
+        raw = self._read(pid, 'status')
+        if raw:
+            uids = gids = None
+            for line in raw.splitlines():
+                if line.startswith(b'Uid:'):
+                    uids = line.split()[1:4]
+                elif line.startswith(b'Gid:'):
+                    gids = line.split()[1:4]
+                    break
+            if uids and gids:
+                credentials = Credentials(*[int(i) for i in uids + gids])
+        self._credentials[pid] = credentials
+        return credentials
+
+    def cgroup(self, pid):
+        """Get the lines of /proc/<pid>/cgroup of a process.
+
+        :returns: A list of strings or ``None``.
+        """
+        try:
+            return self._cgroup[pid]
+        except KeyError:
+            pass
+        cgroup = None
+        raw = self._read(pid, 'cgroup')
+        if raw is not None:
+            cgroup = raw.decode('utf-8', 'replace').splitlines()
+        self._cgroup[pid] = cgroup
+        return cgroup
+
+    def container(self, pid):
+        """Get the container cgroup of a process.
+
+        :returns: A :class:`ContainerCgroup` or ``None`` if the process
+           is not in a container or has vanished.
+        """
+        stat = self.stat(pid)
+        if stat is None:
+            return None
+        key = (pid, stat.starttime)
+        try:
+            return self.containers[key]
+        except KeyError:
+            pass
+        try:
+            container = self._previous_containers[key]
+        except KeyError:
+            cgroup = self.cgroup(pid)
+            if cgroup is None:
+                container = None
+            else:
+                container = parse_container_cgroup(cgroup)
+        self.containers[key] = container
+        return container
+
+    def cmdline(self, pid):
+        """Get the arguments from /proc/<pid>/cmdline of a process.
+
+        :returns: A list of bytes or ``None``.
+        """
+        try:
+            return self._cmdline[pid]
+        except KeyError:
+            pass
+        cmdline = None
+        raw = self._read(pid, 'cmdline')
+        if raw is not None:
+            cmdline = raw.split(b'\0')[:-1]
+        self._cmdline[pid] = cmdline
+        return cmdline
+
+    def socket_inodes(self, pid):
+        """Get the sockets open by a process.
+
+        :returns: A dict mapping socket inodes, as strings, to lists
+           of ``(pid, fd)`` tuples.  The dict is empty if the file
+           descriptors of the process may not be inspected.
+        """
+        try:
+            return self._socket_inodes[pid]
+        except KeyError:
+            pass
+        stat = self.stat(pid)
+        if stat is None:
+            inodes = {}
+        else:
+            inodes = self._fd_table(pid, stat.starttime).sockets
+        self._socket_inodes[pid] = inodes
+        return inodes
+
+    def _fd_table(self, pid, starttime):
+        """Read the fd directory of a process into an :class:`FdTable`.
+
+        The fd names are always listed and the links of sockets and new
+        fds are always read.  The links of fds which were already open
+        and not sockets in the previous table of the process are
+        skipped, until the table is older than :data:`FD_TABLE_MAX_AGE`.
+        """
+        key = (pid, starttime)
+        fdpath = '{}/{}/fd'.format(self.procpath, pid)
+        try:
+            with os.scandir(fdpath) as entries:
+                fds = frozenset(entry.name for entry in entries)
+        except OSError as err:
+            if err.errno not in IGNORED_ERRNOS:
+                raise
+            fds = frozenset()
+        previous = self._previous_fd_tables.get(key)
+        if (previous is not None
+                and self.timestamp - previous.timestamp < FD_TABLE_MAX_AGE):
+            timestamp = previous.timestamp
+            socket_fds = {str(fd) for owners in previous.sockets.values()
+                          for _, fd in owners}
+            unchanged = (previous.fds - socket_fds) & fds
+        else:
+            timestamp = self.timestamp
+            unchanged = frozenset()
+        sockets = {}
+        for fd in fds - unchanged:
+            try:
+                target = os.readlink('{}/{}'.format(fdpath, fd))
+            except OSError:
+                continue    # The file descriptor was closed
+            if target.startswith('socket:['):
+                sockets.setdefault(target[8:-1], []).append((pid, int(fd)))
+        table = FdTable(timestamp, fds, sockets)
+        self.fd_tables[key] = table
+        return table
+
+    def socket_index(self):
+        """Get the sockets open by all processes.
+
+        The fd directories are walked once per snapshot, in a pool of
+        :attr:`threads` threads if there are any.  Sockets shared by
+        several processes, e.g. inherited over a fork, list every
+        process and file descriptor referring to them.
+
+        :returns: A dict mapping socket inodes, as strings, to lists
+           of ``(pid, fd)`` tuples.
+        """
+        if self._socket_index is not None:
+            return self._socket_index
+        if self.threads > 0:
+            with concurrent.futures.ThreadPoolExecutor(self.threads) as pool:
+                tables = list(pool.map(self.socket_inodes, self.pids))
+        else:
+            tables = [self.socket_inodes(pid) for pid in self.pids]
+        index = {}
+        for sockets in tables:
+            for inode, owners in sockets.items():
+                try:
+                    index[inode].extend(owners)
+                except KeyError:
+                    index[inode] = list(owners)
+        self._socket_index = index
+        return index
+
+    def children(self, pid):
+        """Get the pids of the direct children of a process.
+
+        :returns: A list of pids.
+        """
+        if self._children is None:
+            children = collections.defaultdict(list)
+            for child in self.pids:
+                stat = self.stat(child)
+                if stat is not None:
+                    children[stat.ppid].append(child)
+            self._children = children
+        return self._children.get(pid, [])
+
+    def descendants(self, pid):
+        """Get the pids of all the descendants of a process.
+
+        :returns: A list of pids, parents before their children.
+        """
+        descendants = []
+        pending = [pid]
+        while pending:
+            children = self.children(pending.pop())
+            descendants.extend(children)
+            pending.extend(children)
+        return descendants
@@ -0,0 +1,510 @@
+"""Plugin providing the ``sampler`` session service.
+
+Some metrics are sampled in the background between collections, like
+the CPU usage of the host and of processes.  Rather than each of these
+running its own thread, the :class:`SamplerService` runs all of them
+as tasks in a single thread, each at its own interval.  A task failing
+is logged and run again at its next interval without affecting the
+other tasks.  Tasks publish their results by replacing an immutable
+object, e.g. :attr:`Task.result`, which readers use without locking.
+
+The thread only runs while there are tasks.
+
+This module also has the :class:`HostSampler` task.  Collections happen
+once a minute or so, a short spike in CPU usage or network traffic
+between two collections is lost if only the value at collection time
+is reported.  The host sampler samples the host metrics from procfs at
+a higher rate into fixed size ring buffers.  At collection the samples
+of the period since the last collection are summarised as their
+minimum, maximum, average and 95th percentile.  Counters, like the CPU
+times or the bytes received on the network, are sampled as the rate of
+change since the previous sample.  The host sampler measures the CPU
+time it spends sampling.  If that is more than its budget of a
+fraction of a core it doubles the interval of its task, once it is
+well below the budget again it halves it, down to the configured
+interval.
+"""
+
+import collections
+import functools
+import heapq
+import itertools
+import math
+import os
+import re
+import threading
+import time
+
+import logbook
+
+import entityd.pm
+
+
+log = logbook.Logger(__name__)
+
+
+#: A sampled metric: its name and the traits of its attributes.
+Metric = collections.namedtuple('Metric', ['name', 'traits'])
+
+
+#: The summary of the samples of a metric in a period.
+Summary = collections.namedtuple('Summary', ['min', 'max', 'avg', 'p95'])
+
+
+#: The CPU time of the calling thread in seconds.  time.thread_time()
+#: is only available from Python 3.7, it uses the same clock on Linux.
+thread_time = getattr(time, 'thread_time', functools.partial(
+    time.clock_gettime, time.CLOCK_THREAD_CPUTIME_ID))
+
+
+#: The CPU times of /proc/stat which are not busy.
+_IDLE_FIELDS = (3, 4)
+
+
+#: The sector size of the counters in /proc/diskstats.
+SECTOR_SIZE = 512
+
+
+#: Name prefixes of virtual block devices, only used to recognise them
+#: when sysfs is not available.  These are device-mapper, md RAID,
+#: loop and RAM disks, their I/O is also counted on the disks below.
+VIRTUAL_DISKS = ('dm-', 'md', 'loop', 'ram', 'zram')
+
+
+def summarise(samples):
+    """Summarise samples.
+
+    The 95th percentile uses the nearest-rank method.
+
+    :param samples: A non-empty sequence of numbers.
+
+    :returns: A :class:`Summary` of the samples.
+    """
+    ordered = sorted(samples)
+    rank = max(math.ceil(0.95 * len(ordered)), 1)
+    return Summary(min=ordered[0],
+                   max=ordered[-1],
+                   avg=sum(ordered) / len(ordered),
+                   p95=ordered[rank - 1])
+
+
+def read_cputimes(procpath='/proc'):
+    """Read the busy and total CPU times from /proc/stat.
+
+    :returns: A dict mapping ``cpu`` and ``cpu<n>`` for each CPU to a
+       tuple of the busy and the total time in clock ticks.
+    """
+    times = {}
+    with open('{}/stat'.format(procpath)) as fp:
+        for line in fp:
+            if not line.startswith('cpu'):
+                break
+            name, *fields = line.split()
+            fields = [int(field) for field in fields[:8]]
+            total = sum(fields)
+            idle = sum(fields[i] for i in _IDLE_FIELDS)
+            times[name] = (total - idle, total)
+    return times
+
+
+def read_memory(procpath='/proc'):
+    """Read the used memory in bytes from /proc/meminfo.
+
+    Like the ``used`` attribute of the Host this counts buffers and
+    the page cache as free.
+    """
+    meminfo = {}
+    with open('{}/meminfo'.format(procpath)) as fp:
+        for line in fp:
+            name, value = line.split(':', 1)
+            meminfo[name] = int(value.split()[0])
+    free = meminfo['MemFree'] + meminfo['Buffers'] + meminfo['Cached']
+    return (meminfo['MemTotal'] - free) * 1024
+
+
+def read_loadavg(procpath='/proc'):
+    """Read the 1 minute load average from /proc/loadavg."""
+    with open('{}/loadavg'.format(procpath)) as fp:
+        return float(fp.read().split()[0])
+
+
+def whole_disks(names, syspath='/sys'):
+    """Select the whole physical disks of block devices.
+
+    The whole disks are those in /sys/block, which does not list
+    partitions, that are not virtual devices under
+    /sys/devices/virtual/block.  Anything with a
+    /sys/class/block/<name>/partition file is a partition as well.
+
+    If sysfs is not available partitions are recognised by their name
+    being that of another device followed by a number, optionally
+    prefixed by ``p``, and virtual devices by :data:`VIRTUAL_DISKS`.
+
+    :param names: The names of the block devices as in /proc/diskstats.
+    :param str syspath: The location sysfs is mounted at.
+
+    :returns: A set of the names of the whole disks.
+    """
+    names = set(names)
+    try:
+        entries = os.listdir('{}/block'.format(syspath))
+    except OSError:
+        disks = set()
+        for name in names:
+            if name.startswith(VIRTUAL_DISKS):
+                continue
+            if any(re.fullmatch(re.escape(other) + r'p?[0-9]+', name)
+                   for other in names if other != name):
+                continue
+            disks.add(name)
+        return disks
+    disks = set()
+    for entry in entries:
+        name = entry.replace('!', '/')
+        if name not in names:
+            continue
+        device = os.path.realpath('{}/block/{}'.format(syspath, entry))
+        if '/devices/virtual/' in device:
+            continue
+        if os.path.exists(
+                '{}/class/block/{}/partition'.format(syspath, entry)):
+            continue
+        disks.add(name)
+    return disks
+
+
+def read_diskstats(procpath='/proc', syspath='/sys'):
+    """Read the bytes read from and written to disks.
+
+    Only whole physical disks are counted, see :func:`whole_disks`.
+    The I/O of partitions and of virtual devices like device-mapper or
+    md RAID is also counted on the disks below them.
+
+    :returns: A tuple of the total bytes read and written.
+    """
+    devices = {}
+    with open('{}/diskstats'.format(procpath)) as fp:
+        for line in fp:
+            fields = line.split()
+            devices[fields[2]] = (int(fields[5]), int(fields[9]))
+    read = written = 0
+    for name in whole_disks(devices, syspath):
+        sectors_read, sectors_written = devices[name]
+        read += sectors_read
+        written += sectors_written
+    return read * SECTOR_SIZE, written * SECTOR_SIZE
+
+
+def read_netdev(procpath='/proc'):
+    """Read the bytes received and sent on all interfaces but loopback.
+
+    :returns: A tuple of the total bytes received and sent.
+    """
+    received = sent = 0
+    with open('{}/net/dev'.format(procpath)) as fp:
+        for line in fp:
+            if ':' not in line:
+                continue
+            name, counters = line.split(':', 1)
+            if name.strip() == 'lo':
+                continue
+            counters = counters.split()
+            received += int(counters[0])
+            sent += int(counters[8])
+    return received, sent
+
+
+class HostSampler:  # pylint: disable=too-many-instance-attributes
+    """A task sampling the host metrics.
+
+    Use :meth:`start` to run the sampling as a task of the sampler
+    service.  The interval of the task is adapted to the budget each
+    time the samples are summarised.
+
+    :param float interval: The shortest period in seconds between
+       samples.
+    :param int size: The number of samples kept for each metric, older
+       samples are dropped if no collection took them.
+    :param float budget: The fraction of a core the sampling may use.
+    :param str procpath: The location procfs is mounted at.
+    :param str syspath: The location sysfs is mounted at.
+
+    :ivar task: The :class:`Task` running the sampling, if started.
+    :ivar overhead: The fraction of a core used by the sampling since
+       the last summary.
+    """
+
+    def __init__(self, interval=1, size=600, budget=0.01, procpath='/proc',
+                 syspath='/sys'):
+        self.interval = interval
+        self.size = size
+        self.budget = budget
+        self.procpath = procpath
+        self.syspath = syspath
+        self.task = None
+        self.overhead = 0.0
+        self.metrics = {}
+        self._samples = {}
+        self._counters = {}
+        self._busy = 0.0
+        self._since = time.monotonic()
+        self._lock = threading.Lock()
+
+    def start(self, service):
+        """Run the sampling as a task of a sampler service.
+
+        :param service: The :class:`SamplerService`.
+
+        :returns: The new :class:`Task`.
+        """
+        self.task = service.add('host-metrics', self.sample, self.interval)
+        return self.task
+
+    def record(self, name, value, traits):
+        """Record a sample of a metric."""
+        if name not in self._samples:
+            self.metrics[name] = Metric(name, frozenset(traits))
+            self._samples[name] = collections.deque(maxlen=self.size)
+        self._samples[name].append(value)
+
+    def record_rate(self, name, value, traits, now):
+        """Record the rate of change of a counter since its last sample."""
+        previous = self._counters.get(name)
+        self._counters[name] = (now, value)
+        if previous is not None and now > previous[0]:
+            rate = (value - previous[1]) / (now - previous[0])
+            self.record(name, max(rate, 0), traits)
+
+    def sample(self):
+        """Take one sample of all host metrics."""
+        now = time.monotonic()
+        started = thread_time()
+        cputimes = read_cputimes(self.procpath)
+        memory = read_memory(self.procpath)
+        loadavg = read_loadavg(self.procpath)
+        disk_read, disk_written = read_diskstats(self.procpath,
+                                                 self.syspath)
+        net_received, net_sent = read_netdev(self.procpath)
+        with self._lock:
+            for name, (busy, total) in cputimes.items():
+                previous = self._counters.get(name)
+                self._counters[name] = (busy, total)
+                if previous is not None and total > previous[1]:
+                    percent = (busy - previous[0]) / (total - previous[1])
+                    self.record(name, percent * 100,
+                                {'metric:gauge', 'unit:percent'})
+            self.record('memory:used', memory,
+                        {'metric:gauge', 'unit:bytes'})
+            self.record('loadavg_1', loadavg, {'metric:gauge'})
+            rate = {'metric:gauge', 'unit:bytes/s'}
+            self.record_rate('disk:read', disk_read, rate, now)
+            self.record_rate('disk:write', disk_written, rate, now)
+            self.record_rate('net:rx', net_received, rate, now)
+            self.record_rate('net:tx', net_sent, rate, now)
+            self._busy += thread_time() - started
+
+    def summary(self):
+        """Summarise and drop the samples taken since the last summary.
+
+        Also updates :attr:`overhead` and adapts the interval of the
+        task to the budget, see :meth:`adapt_interval`.
+
+        :returns: A list of tuples of a :class:`Metric` and its
+           :class:`Summary`, metrics without samples are left out.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now > self._since:
+                self.overhead = self._busy / (now - self._since)
+            self._busy = 0.0
+            self._since = now
+            summaries = []
+            for name, samples in self._samples.items():
+                if samples:
+                    summaries.append((self.metrics[name],
+                                      summarise(samples)))
+                    samples.clear()
+        self.adapt_interval()
+        return summaries
+
+    def adapt_interval(self):
+        """Adapt the interval of the task to the budget.
+
+        The interval is doubled if the sampling used more than its
+        budget.  If it used less than a quarter of the budget the
+        interval is halved, but never below the configured interval.
+        """
+        task = self.task
+        if task is None:
+            return
+        if self.overhead > self.budget:
+            task.interval *= 2
+            log.warning('Sampling used {:.1%} of a core, sampling every '
+                        '{}s from now on', self.overhead, task.interval)
+        elif (self.overhead < self.budget / 4
+              and task.interval > self.interval):
+            task.interval = max(task.interval / 2, self.interval)
+            log.info('Sampling used {:.1%} of a core, sampling every '
+                     '{}s from now on', self.overhead, task.interval)
+
+
+class Task:
+    """A task run by the :class:`SamplerService`.
+
+    :ivar name: The name of the task, used in logging.
+    :ivar func: The callable run by the task.
+    :ivar interval: The period in seconds between runs, may be changed
+       while the task is scheduled.
+    :ivar result: The value returned by the last successful run,
+       ``None`` before that.
+    :ivar cancelled: Whether the task was removed from the service.
+    """
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.result = None
+        self.cancelled = False
+
+    def __repr__(self):
+        return '<Task {} every {}s>'.format(self.name, self.interval)
+
+    def run(self):
+        """Run the task, logging any exception."""
+        try:
+            self.result = self.func()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('An unexpected exception occurred in sampling '
+                          'task {}', self.name)
+
+
+class SamplerService:
+    """Plugin providing the ``sampler`` session service."""
+
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._current = None
+
+    @entityd.pm.hookimpl
+    def entityd_sessionstart(self, session):
+        """Register the sampler service."""
+        session.addservice('sampler', self)
+
+    @entityd.pm.hookimpl
+    def entityd_sessionfinish(self):
+        """Stop all tasks."""
+        self.stop()
+
+    @property
+    def tasks(self):
+        """The scheduled tasks."""
+        with self._condition:
+            tasks = [task for _, _, task in self._queue]
+            if self._current:
+                tasks.append(self._current)
+            return tasks
+
+    def add(self, name, func, interval):
+        """Schedule a new task.
+
+        The task is first run right away in the calling thread, so its
+        result is available as soon as this returns.
+
+        :param str name: The name of the task, used in logging.
+        :param func: The callable to run, without arguments.
+        :param float interval: The period in seconds between runs.
+
+        :returns: The new :class:`Task`.
+        """
+        task = Task(name, func, interval)
+        task.run()
+        with self._condition:
+            self._push(time.monotonic() + interval, task)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='Sampler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return task
+
+    def remove(self, task):
+        """Stop running a task.
+
+        If this was the last task, this waits for the thread to finish.
+        """
+        self._cancel([task])
+
+    def stop(self):
+        """Stop running all tasks and wait for the thread to finish."""
+        self._cancel(self.tasks)
+
+    def _cancel(self, tasks):
+        """Cancel tasks, waiting for the thread if none are left."""
+        with self._condition:
+            for task in tasks:
+                task.cancelled = True
+            self._queue = [entry for entry in self._queue
+                           if not entry[2].cancelled]
+            heapq.heapify(self._queue)
+            self._condition.notify()
+            idle = not self._queue and (self._current is None
+                                        or self._current.cancelled)
+            thread = self._thread
+        if idle and thread and thread is not threading.current_thread():
+            thread.join(timeout=2)
+
+    def _push(self, due, task):
+        """Queue a task to run at the monotonic time due."""
+        heapq.heappush(self._queue, (due, next(self._counter), task))
+
+    def _next(self):
+        """Wait for the next task which is due.
+
+        :returns: A tuple of the time the task was due and the task, or
+           ``None`` if there are no tasks left.
+        """
+        with self._condition:
+            while self._queue:
+                due, _, task = self._queue[0]
+                delay = due - time.monotonic()
+                if delay <= 0:
+                    heapq.heappop(self._queue)
+                    self._current = task
+                    return due, task
+                self._condition.wait(delay)
+            self._thread = None
+            return None
+
+    def _run(self):
+        """Run the tasks as they become due until there are none left."""
+        while True:
+            entry = self._next()
+            if entry is None:
+                return
+            due, task = entry
+            task.run()
+            with self._condition:
+                self._current = None
+                if not task.cancelled:
+                    self._push(max(due + task.interval, time.monotonic()),
+                               task)
+
+
+def service(session):
+    """Get the sampler service of a session.
+
+    The sampler plugin may have been disabled, in which case a new
+    service is registered on the session.
+
+    :returns: The :class:`SamplerService`.
+    """
+    try:
+        return session.svc.sampler
+    except AttributeError:
+        sampler = SamplerService()
+        session.addservice('sampler', sampler)
+        return sampler
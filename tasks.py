@@ -67,6 +67,27 @@ def jenkins_pytest(ctx):
         raise invoke.Exit(code=res.exited)
 
 
+@invoke.task(help={'scale': 'Comma separated numbers of processes to '
+                             'benchmark, by default 1000,10000.'})
+def benchmark(ctx, scale=None):
+    """Run the scale benchmarks of the host collectors.
+
+    Fails when a benchmark exceeds its budget in
+    tests/benchmarks/budgets.yaml.
+    """
+    pytest_args = [
+        sys.prefix + '/bin/py.test',
+        '-v --no-cov --benchmark',
+        '--junitxml=results/benchmark_results.xml',
+    ]
+    if scale:
+        pytest_args.append('--benchmark-scale ' + scale)
+    pytest_args.append('tests/benchmarks')
+    res = ctx.run(' '.join(pytest_args))
+    if res.exited > 0:
+        raise invoke.Exit(code=res.exited)
+
+
 @invoke.task(pre=[pylint, pytest])
 def check(ctx):  # pylint: disable=unused-argument
     """Perform all checks."""
@@ -0,0 +1,155 @@
+"""Fixtures for the scale benchmarks of the host collectors.
+
+The benchmarks run the collectors against synthetic procfs trees,
+created by :class:`procgen.ProcfsGenerator`, with thousands of processes and
+sockets.  They are skipped unless py.test is given the ``--benchmark``
+option, the number of processes is set with ``--benchmark-scale``.
+"""
+
+import collections
+import resource
+import time
+import tracemalloc
+
+import pytest
+import yaml
+
+import entityd.docker.client
+from procgen import ProcfsGenerator
+
+
+#: The result of a benchmark run.  The wall time is in seconds, the
+#: peak RSS of the process and peak of the allocations traced by
+#: tracemalloc are in MiB.
+Measurement = collections.namedtuple('Measurement', ['wall', 'rss', 'alloc'])
+
+
+def peak_rss():
+    """The peak resident set size of this process, in MiB.
+
+    The peak is reset by :func:`reset_peak_rss` where the kernel
+    supports it, otherwise this is the peak over the process lifetime.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size to the current one."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        pass
+
+
+def measure(func):
+    """Measure a collection cycle.
+
+    The function is called three times: once to warm up caches kept
+    between collection cycles, once timed and once with tracemalloc
+    tracing the allocations.  Tracing slows the function down too much
+    to do both at the same time.
+
+    :returns: A :class:`Measurement` of the steady state.
+    """
+    func()
+    reset_peak_rss()
+    start = time.perf_counter()
+    func()
+    wall = time.perf_counter() - start
+    rss = peak_rss()
+    tracemalloc.start()
+    try:
+        func()
+        _, alloc = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Measurement(wall, rss, alloc / 1024 / 1024)
+
+
+_RESULTS = []
+
+
+def pytest_generate_tests(metafunc):
+    """Parametrise ``procfs_tree`` with the --benchmark-scale numbers."""
+    if 'procfs_tree' in metafunc.fixturenames:
+        scales = [int(scale) for scale in
+                  metafunc.config.getoption('--benchmark-scale').split(',')]
+        metafunc.parametrize('procfs_tree', scales,
+                             indirect=True, scope='session')
+
+
+@pytest.fixture(scope='session')
+def procfs_tree(request, tmpdir_factory):
+    """A :class:`ProcfsGenerator` whose tree has been generated.
+
+    The number of processes is the parameter of the fixture, each
+    tree is only generated once per test session.
+    """
+    path = tmpdir_factory.mktemp('procfs{}'.format(request.param))
+    return ProcfsGenerator(path, request.param).generate()
+
+
+@pytest.fixture(scope='session')
+def budgets(request):
+    """The regression budgets from the --benchmark-budgets file."""
+    with open(request.config.getoption('--benchmark-budgets')) as fp:
+        return yaml.safe_load(fp)
+
+
+@pytest.fixture
+def benchmark(budgets, procfs_tree):
+    """Measure a function and check it against its budget.
+
+    Returns a function taking the name of the benchmark and the
+    function to measure.  The measurement is reported at the end of the
+    test session and the test fails when it exceeds any limit given for
+    the benchmark and scale in the budgets file.
+    """
+    def run(name, func):
+        scale = procfs_tree.processes
+        result = measure(func)
+        _RESULTS.append((name, scale, result))
+        budget = budgets.get(name, {}).get(scale, {})
+        exceeded = ['{} {:.2f} > {}'.format(field, getattr(result, field),
+                                            budget[field])
+                    for field in Measurement._fields
+                    if field in budget
+                    and getattr(result, field) > budget[field]]
+        if exceeded:
+            pytest.fail('{}[{}] over budget: {}'.format(
+                name, scale, ', '.join(exceeded)))
+        return result
+    return run
+
+
+@pytest.fixture
+def docker_client(monkeypatch):
+    """Pretend docker is running, without any containers."""
+    get_client = pytest.MagicMock()
+    client = get_client.return_value
+    client.info.return_value = {'ID': 'benchmark'}
+    client.containers.list.return_value = []
+    monkeypatch.setattr(
+        entityd.docker.client.DockerClient, 'get_client', get_client)
+    return client
+
+
+def pytest_terminal_summary(terminalreporter):
+    """Report the measurements of the benchmarks."""
+    if not _RESULTS:
+        return
+    terminalreporter.section('benchmarks')
+    terminalreporter.write_line('{:<24} {:>8} {:>10} {:>10} {:>10}'.format(
+        'benchmark', 'scale', 'wall (s)', 'rss (MiB)', 'alloc (MiB)'))
+    for name, scale, result in _RESULTS:
+        terminalreporter.write_line(
+            '{:<24} {:>8} {:>10.3f} {:>10.1f} {:>10.1f}'.format(
+                name, scale, result.wall, result.rss, result.alloc))
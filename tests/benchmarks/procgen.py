@@ -0,0 +1,223 @@
+"""Generator of synthetic procfs trees.
+
+The trees have the layout of /proc and /sys/fs/cgroup as far as the
+host collectors read them, so entityd can be pointed at one with its
+``--procpath`` and ``--cgrouppath`` options::
+
+   python tests/benchmarks/procgen.py --processes 10000 /tmp/procfs
+   entityd --procpath /tmp/procfs/proc --cgrouppath /tmp/procfs/cgroup
+"""
+
+import argparse
+import collections
+import os
+import random
+import socket
+import struct
+import time
+
+
+class ProcfsGenerator:
+    """Generator of synthetic procfs trees.
+
+    The tree contains ``processes`` processes forked from pid 1, each
+    with a stat, status, cmdline, cgroup and exe file and a table of
+    file descriptors.  ``sockets`` TCP, UDP and UNIX sockets are spread
+    over the processes and listed in the net directory, a few of them
+    are not owned by any process as for kernel sockets.  The processes
+    are spread over ``containers`` docker containers and the host, the
+    cgroup filesystem tree has a ``cgroup.procs`` file for each
+    container.
+
+    All the randomness is seeded so a generated tree is always the same
+    for the same arguments.
+
+    :param path: The directory to create the ``proc`` and ``cgroup``
+       directories in.
+    :param processes: The number of processes.
+    :param sockets: The number of sockets, defaults to the number of
+       processes.
+    :param fds: The number of non-socket file descriptors per process.
+    :param containers: The number of containers.
+    :param seed: The seed of the random generator.
+
+    :ivar procpath: The path to the procfs tree.
+    :ivar cgrouppath: The path to the cgroup filesystem tree.
+    :ivar containers: List of the ids of the containers.
+    """
+
+    #: The cgroup v1 controllers listed in /proc/<pid>/cgroup.
+    CONTROLLERS = ['pids', 'memory', 'cpu,cpuacct', 'blkio', 'devices',
+                   'freezer', 'net_cls,net_prio', 'name=systemd']
+
+    #: Binaries the processes run.
+    BINARIES = ['/usr/bin/python3', '/usr/sbin/nginx', '/usr/bin/java',
+                '/bin/bash', '/usr/sbin/sshd', '/usr/bin/postgres']
+
+    def __init__(self, path, processes, sockets=None, fds=4,  # pylint: disable=too-many-arguments
+                 containers=10, seed=0):
+        self.procpath = os.path.join(str(path), 'proc')
+        self.cgrouppath = os.path.join(str(path), 'cgroup')
+        self.processes = processes
+        self.sockets = processes if sockets is None else sockets
+        self.fds = fds
+        self.random = random.Random(seed)
+        self.containers = ['{:064x}'.format(self.random.getrandbits(256))
+                           for _ in range(containers)]
+        self.boottime = int(time.time()) - 86400
+
+    def generate(self):
+        """Write the procfs and cgroup filesystem trees.
+
+        :returns: This generator, for chaining.
+        """
+        os.makedirs(os.path.join(self.procpath, 'net'))
+        with open(os.path.join(self.procpath, 'stat'), 'w') as fp:
+            fp.write('cpu  10 20 30 40 0 0 0 0 0 0\n'
+                     'btime {}\n'.format(self.boottime))
+        with open(os.path.join(self.procpath, 'uptime'), 'w') as fp:
+            fp.write('86400.00 300000.00\n')
+        pids = list(range(1, self.processes + 1))
+        owners = collections.defaultdict(list)
+        for inode in range(10000, 10000 + self.sockets):
+            if self.random.random() > 0.01:
+                owners[self.random.choice(pids)].append(inode)
+        members = collections.defaultdict(list)
+        for pid in pids:
+            ppid = self.random.randint(1, max(1, pid // 2)) if pid > 1 else 0
+            container = None
+            if pid > 1 and self.containers and self.random.random() < 0.5:
+                container = self.random.choice(self.containers)
+                members[container].append(pid)
+            self.write_process(pid, ppid, container, owners[pid])
+        self.write_net()
+        for container in self.containers:
+            for controller in self.CONTROLLERS:
+                path = os.path.join(
+                    self.cgrouppath, controller.replace('name=', ''),
+                    'docker', container)
+                os.makedirs(path)
+                with open(os.path.join(path, 'cgroup.procs'), 'w') as fp:
+                    fp.write(''.join('{}\n'.format(pid)
+                                     for pid in members[container]))
+        return self
+
+    def write_process(self, pid, ppid, container, inodes):
+        """Write the directory of a single process."""
+        piddir = os.path.join(self.procpath, str(pid))
+        os.makedirs(os.path.join(piddir, 'fd'))
+        binary = self.random.choice(self.BINARIES)
+        comm = os.path.basename(binary)[:15]
+        starttime = self.random.randint(100, 8640000)
+        utime = self.random.randint(0, 100000)
+        stime = self.random.randint(0, 10000)
+        rss = self.random.randint(100, 100000)
+        fields = [ppid, pid, pid, 0, -1, 4194560, 100, 0, 0, 0, utime,
+                  stime, 0, 0, 20, 0, 1, 0, starttime, rss * 4096 * 4, rss]
+        fields += [0] * 30
+        with open(os.path.join(piddir, 'stat'), 'w') as fp:
+            fp.write('{} ({}) S {}\n'.format(
+                pid, comm, ' '.join(str(field) for field in fields)))
+        with open(os.path.join(piddir, 'statm'), 'w') as fp:
+            fp.write('{} {} 50 10 0 100 0\n'.format(rss * 4, rss))
+        uid = self.random.choice([0, 0, 1000, 65534])
+        with open(os.path.join(piddir, 'status'), 'w') as fp:
+            fp.write('Name:\t{comm}\nUmask:\t0022\nState:\tS (sleeping)\n'
+                     'Tgid:\t{pid}\nNgid:\t0\nPid:\t{pid}\nPPid:\t{ppid}\n'
+                     'TracerPid:\t0\nUid:\t{uid}\t{uid}\t{uid}\t{uid}\n'
+                     'Gid:\t{uid}\t{uid}\t{uid}\t{uid}\nFDSize:\t64\n'
+                     'VmRSS:\t{rss} kB\nThreads:\t1\n'.format(
+                         comm=comm, pid=pid, ppid=ppid, uid=uid, rss=rss * 4))
+        with open(os.path.join(piddir, 'cmdline'), 'wb') as fp:
+            fp.write(binary.encode() + b'\0--worker\0' +
+                     str(pid).encode() + b'\0')
+        with open(os.path.join(piddir, 'cgroup'), 'w') as fp:
+            for index, controller in enumerate(reversed(self.CONTROLLERS)):
+                path = '/docker/' + container if container else '/'
+                fp.write('{}:{}:{}\n'.format(index + 1, controller, path))
+        os.symlink(binary, os.path.join(piddir, 'exe'))
+        fddir = os.path.join(piddir, 'fd')
+        targets = ['/dev/null', 'pipe:[{}]'.format(pid),
+                   'anon_inode:[eventpoll]']
+        targets += ['/var/log/file{}.log'.format(fd) for fd in range(self.fds)]
+        targets = targets[:self.fds]
+        targets += ['socket:[{}]'.format(inode) for inode in inodes]
+        for fd, target in enumerate(targets):
+            os.symlink(target, os.path.join(fddir, str(fd)))
+
+    def write_net(self):
+        """Write the socket tables in the net directory.
+
+        Every tenth socket is a listening TCP socket, one in five is a
+        UDP socket and one in five a UNIX socket.  Sockets with an even
+        inode are IPv4, others IPv6.
+        """
+        tables = {name: [] for name in ['tcp', 'tcp6', 'udp', 'udp6']}
+        unix = []
+        for index, inode in enumerate(range(10000, 10000 + self.sockets)):
+            family = socket.AF_INET if inode % 2 == 0 else socket.AF_INET6
+            port = 1024 + index % 60000
+            if index % 5 == 3:
+                unix.append('0000000000000000: 00000002 00000000 00010000 '
+                            '0001 01 {} /run/sock{}\n'.format(inode, index))
+                continue
+            laddr = self.encode_address('10.0.0.1', family, port)
+            if index % 10 == 0:
+                raddr, state = self.encode_address('0.0.0.0', family, 0), '0A'
+            else:
+                raddr = self.encode_address(
+                    '10.1.{}.{}'.format(index // 250 % 250, index % 250),
+                    family, 1024 + index % 50000)
+                state = '01'
+            name = 'udp' if index % 5 == 1 else 'tcp'
+            if name == 'udp':
+                state = '07'
+            if family == socket.AF_INET6:
+                name += '6'
+            tables[name].append(
+                '{:4d}: {} {} {} 00000000:00000000 00:00000000 00000000  '
+                '1000        0 {} 1 0000000000000000 100 0 0 10 0\n'.format(
+                    len(tables[name]), laddr, raddr, state, inode))
+        for name, lines in tables.items():
+            with open(os.path.join(self.procpath, 'net', name), 'w') as fp:
+                fp.write('  sl  local_address rem_address   st tx_queue '
+                         'rx_queue tr tm->when retrnsmt   uid  timeout '
+                         'inode\n')
+                fp.writelines(lines)
+        with open(os.path.join(self.procpath, 'net', 'unix'), 'w') as fp:
+            fp.write('Num       RefCount Protocol Flags    Type St Inode '
+                     'Path\n')
+            fp.writelines(unix)
+
+    @staticmethod
+    def encode_address(addr, family, port):
+        """Encode an address as in /proc/net/tcp, in host byte order."""
+        packed = socket.inet_aton(addr)
+        if family == socket.AF_INET:
+            words = struct.unpack('=I', packed)
+            return '{:08X}:{:04X}'.format(words[0], port)
+        packed = b'\0' * 10 + b'\xff\xff' + packed
+        words = struct.unpack('=4I', packed)
+        return '{}:{:04X}'.format(
+            ''.join('{:08X}'.format(word) for word in words), port)
+
+
+def main():
+    """Generate a procfs tree from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', help='Directory to create the tree in.')
+    parser.add_argument('--processes', type=int, default=1000)
+    parser.add_argument('--sockets', type=int, default=None)
+    parser.add_argument('--fds', type=int, default=4)
+    parser.add_argument('--containers', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    tree = ProcfsGenerator(args.path, args.processes, sockets=args.sockets,
+                           fds=args.fds, containers=args.containers,
+                           seed=args.seed).generate()
+    print('--procpath {} --cgrouppath {}'.format(
+        tree.procpath, tree.cgrouppath))
+
+
+if __name__ == '__main__':
+    main()
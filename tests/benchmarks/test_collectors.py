@@ -0,0 +1,87 @@
+"""Scale benchmarks of the host collectors.
+
+Run with ``py.test --benchmark tests/benchmarks``, the regression
+budgets are in budgets.yaml.
+"""
+
+import pytest
+
+import entityd.connections
+import entityd.endpointme
+import entityd.hostme
+import entityd.monitor
+import entityd.processme
+import entityd.procfs
+
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture
+def procfs(pm, session, procfs_tree):
+    """The procfs service, reading the synthetic procfs tree."""
+    session.config.args.procpath = procfs_tree.procpath
+    session.config.args.cgrouppath = procfs_tree.cgrouppath
+    procfs = entityd.procfs.ProcFS()
+    pm.register(procfs, 'entityd.procfs.ProcFS')
+    procfs.entityd_sessionstart(session)
+    return procfs
+
+
+@pytest.fixture
+def procent(request, pm, session, procfs, host_entity_plugin, docker_client):  # pylint: disable=unused-argument
+    """The Process collector, reading the synthetic procfs tree."""
+    procent = entityd.processme.ProcessEntity()
+    pm.register(procent, 'entityd.processme.ProcessEntity')
+    procent.entityd_configure(session.config)
+    procent.entityd_sessionstart(session)
+    request.addfinalizer(procent.entityd_sessionfinish)
+    return procent
+
+
+@pytest.fixture
+def endpoint(pm, session, procent):  # pylint: disable=unused-argument
+    """The Endpoint collector, reading the synthetic procfs tree."""
+    endpoint = entityd.endpointme.EndpointEntity()
+    pm.register(endpoint, 'entityd.endpointme.EndpointEntity')
+    endpoint.entityd_configure(session.config)
+    endpoint.entityd_sessionstart(session)
+    return endpoint
+
+
+def collection_cycle(session, func):
+    """Return a function running func in a collection cycle."""
+    def cycle():
+        session.pluginmanager.hooks.entityd_collection_before(
+            session=session)
+        func()
+        session.pluginmanager.hooks.entityd_collection_after(
+            session=session, updates=())
+    return cycle
+
+
+@pytest.mark.parametrize('backend', ['syskit', 'procfs'])
+def test_processes(session, procent, benchmark, backend):
+    procent.backend = backend
+    cycle = collection_cycle(
+        session, lambda: list(procent.entityd_find_entity('Process', None)))
+    benchmark('processes_' + backend, cycle)
+
+
+def test_endpoints(session, endpoint, benchmark):
+    cycle = collection_cycle(
+        session, lambda: list(endpoint.entityd_find_entity('Endpoint', None)))
+    benchmark('endpoints', cycle)
+
+
+def test_connections_retrieve(session, procfs, procfs_tree, benchmark):
+    def retrieve():
+        with entityd.connections.set_procpath(procfs_tree.procpath):
+            connections = entityd.connections.Connections(procfs.snapshot())
+            connections.retrieve('all')
+    benchmark('connections_retrieve', collection_cycle(session, retrieve))
+
+
+def test_collect_entities(session, monitor, endpoint, benchmark):  # pylint: disable=unused-argument
+    entityd.hostme.HostEntity.entityd_configure(session.config)
+    benchmark('collect_entities', monitor.collect_entities)
@@ -0,0 +1,40 @@
+import socket
+
+import entityd.connections
+import entityd.procfs
+
+from procgen import ProcfsGenerator
+
+
+def test_generate(tmpdir):
+    tree = ProcfsGenerator(tmpdir, 50, sockets=100, containers=2).generate()
+    snapshot = entityd.procfs.Snapshot(tree.procpath)
+    assert sorted(snapshot.pids) == list(range(1, 51))
+    assert snapshot.boottime == tree.boottime
+    stat = snapshot.stat(42)
+    assert stat.pid == 42
+    assert 1 <= stat.ppid < 42
+    assert snapshot.credentials(42)
+    containers = {snapshot.container(pid) for pid in snapshot.pids}
+    assert {c.id for c in containers if c} == set(tree.containers)
+    for container in containers - {None}:
+        pids = entityd.procfs.cgroup_procs(container.path, tree.cgrouppath)
+        assert pids
+        assert all(snapshot.container(pid) == container for pid in pids)
+
+
+def test_generate_sockets(tmpdir):
+    tree = ProcfsGenerator(tmpdir, 50, sockets=100).generate()
+    snapshot = entityd.procfs.Snapshot(tree.procpath)
+    with entityd.connections.set_procpath(tree.procpath):
+        conns = entityd.connections.Connections(snapshot).retrieve('all')
+    assert len(conns) == 100
+    assert 90 <= len([c for c in conns if c.bound_pid]) < 100
+    families = {c.family for c in conns}
+    assert families == {socket.AF_INET, socket.AF_INET6, socket.AF_UNIX}
+    inet = [c for c in conns if c.family == socket.AF_INET]
+    assert {c.laddr[0] for c in inet} == {'10.0.0.1'}
+    assert any(c.status == 'LISTEN' for c in inet)
+    assert any(c.raddr and c.raddr[0].startswith('10.1.') for c in inet)
+    inet6 = [c for c in conns if c.family == socket.AF_INET6]
+    assert {c.laddr[0] for c in inet6} == {'::ffff:10.0.0.1'}
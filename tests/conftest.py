@@ -11,6 +11,7 @@ import pytest
 import zmq.auth
 
 import entityd.core
+import entityd.discovery
 import entityd.docker.client
 import entityd.hookspec
 import entityd.hostme
@@ -28,6 +29,31 @@ def pytest_namespace():
     }
 
 
+def pytest_addoption(parser):
+    """Add the options of the scale benchmarks in tests/benchmarks."""
+    group = parser.getgroup('benchmark')
+    group.addoption('--benchmark', action='store_true',
+                    help='Run the scale benchmarks, skipped by default.')
+    group.addoption('--benchmark-scale', default='1000,10000',
+                    help='Comma separated numbers of processes in the '
+                         'synthetic procfs trees benchmarked.')
+    group.addoption('--benchmark-budgets',
+                    default=str(pathlib.Path(__file__).parent.joinpath(
+                        'benchmarks', 'budgets.yaml')),
+                    help='YAML file with the regression budgets the '
+                         'benchmarks fail on.')
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skip the benchmarks unless --benchmark is given."""
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='need --benchmark option to run')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
 @pytest.fixture
 def pm():
     """A PluginManager with the entityd hookspec."""
@@ -39,6 +65,34 @@ def config(pm):
     """An entityd.core.Config instance."""
     ns = types.SimpleNamespace()
     ns.procpath = '/proc'
+    ns.cgrouppath = '/sys/fs/cgroup'
+    ns.fd_scan_threads = 0
+    ns.apache_status_connect_timeout = 1.0
+    ns.apache_status_read_timeout = 5.0
+    ns.apache_status_threads = 4
+    ns.mysql_metrics = False
+    ns.mysql_query_timeout = 2.0
+    ns.postgres_metrics = False
+    ns.postgres_user = 'postgres'
+    ns.postgres_database = 'postgres'
+    ns.postgres_statement_timeout = 2.0
+    ns.file_cache_ttl = 300
+    ns.file_max_watches = 1024
+    ns.host_facts_ttl = 300
+    ns.host_sample_interval = 0
+    ns.endpoint_backend = 'procfs'
+    ns.endpoint_aggregate = False
+    ns.endpoint_ephemeral_ports = None
+    ns.endpoint_aggregate_threshold = 1
+    ns.process_backend = 'syskit'
+    ns.process_exclude_kthreads = False
+    ns.process_min_age = 0
+    ns.process_top_cpu = 0
+    ns.process_top_rss = 0
+    ns.process_include_binary = []
+    ns.process_exclude_binary = []
+    ns.process_include_cgroup = []
+    ns.process_exclude_cgroup = []
     return entityd.core.Config(pm, ns)
 
 
@@ -78,6 +132,20 @@ def host_entity_plugin(pm, session, kvstore):  # pylint: disable=unused-argument
     host_plugin.entityd_sessionfinish()
 
 
+@pytest.fixture
+def discovered(monkeypatch):
+    """Patch service discovery to find the given top-level processes.
+
+    Returns a dict mapping the names of matchers to the lists of pids
+    discovered for them, which tests fill in.  The Process entities of
+    the pids are still looked up with the ``entityd_find_entity`` hook.
+    """
+    found = {}
+    monkeypatch.setattr(entityd.discovery.DiscoveryService, 'matches',
+                        lambda self, matcher: found.get(matcher.name, []))
+    return found
+
+
 @pytest.fixture(autouse=True)
 def path_health(tmpdir, monkeypatch):
     """Use a temporary file as health marker."""
@@ -208,7 +276,8 @@ def mock_cpuusage(request):
     be reverted, e.g. for testing of cpuusage.
     """
     usage = pytest.Mock()
-    usage.listen_endpoint = 'inproc://cpuusage'
+    usage.interval = 15
+    usage.percentages = entityd.processme.NO_CPU_PERCENTAGES
     cpuusage = entityd.processme.CpuUsage
     entityd.processme.CpuUsage = pytest.Mock(return_value=usage)
     hostcpuusage = entityd.hostme.HostCpuUsage
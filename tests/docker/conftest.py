@@ -10,6 +10,7 @@ def running_container():
     attrs = {
         "State": {
             "ExitCode": 0,
+            "Pid": 100,
             "StartedAt": "2017-08-30T10:52:25.439434269Z",
             "Error": "",
             "FinishedAt": "0001-01-01T00:00:00Z",
@@ -45,12 +46,6 @@ def running_container():
         should_exist=True,
         network_id=network_id,
         volume_name=volume_name)
-    container.top.return_value = {
-        "Titles": ["PID"],
-        "Processes": [
-            ['0'], ['1'], ['3']
-        ]
-    }
 
     return container
 
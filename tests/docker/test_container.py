@@ -25,6 +25,12 @@ def test_docker_not_available(monkeypatch, docker_container):
     assert len(list(docker_container.entityd_emit_entities())) == 0
 
 
+def test_get_ueid_matches_update():
+    update = entityd.EntityUpdate('Docker:Container')
+    update.attrs.set('id', 'abcdef', traits={'entity:id'})
+    assert DockerContainer.get_ueid('abcdef') == update.ueid
+
+
 def test_emit_entities(monkeypatch, docker_container,
                        running_container, finished_container):
 
@@ -1,10 +1,11 @@
 import os
-from datetime import datetime
 
 import pytest
 import syskit
 
-from docker.errors import DockerException, APIError
+from docker.errors import DockerException
+import entityd.processme
+import entityd.procfs
 from entityd.docker.client import DockerClient
 from entityd.docker.container import DockerContainer
 from entityd.docker.container_group import DockerContainerGroup
@@ -47,14 +48,38 @@ def test_get_process_ueid(session, container_group):
     container_group.entityd_sessionstart(session)
     container_group.entityd_configure(session.config)
 
-    pid = os.getpid()
-    ueid = container_group.get_process_ueid(pid)
-    assert ueid
+    proc = syskit.Process(os.getpid())
+    update = entityd.EntityUpdate('Process')
+    update.attrs.set('pid', proc.pid, traits={'entity:id'})
+    update.attrs.set('starttime', proc.start_time.timestamp(),
+                     traits={'entity:id'})
+    update.attrs.set('host', str(container_group.host_ueid),
+                     traits={'entity:id'})
+    assert container_group.get_process_ueid(proc.pid) == update.ueid
 
 
+@pytest.fixture
+def container_cgroup(monkeypatch, running_container):
+    """Put the processes 100 to 102 in the cgroup of the running container."""
+    cgroup = entityd.procfs.ContainerCgroup(
+        running_container.id, '/docker/' + running_container.id)
+    procs = {}
+    for pid in [100, 101, 102]:
+        procs[pid] = pytest.MagicMock(
+            name='proc' + str(pid), pid=pid, starttime=1000 + pid)
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'stat',
+                        lambda self, pid: procs.get(pid))
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'container',
+                        lambda self, pid: cgroup if pid in procs else None)
+    monkeypatch.setattr(entityd.procfs, 'cgroup_procs',
+                        pytest.Mock(return_value=sorted(procs)))
+    return procs
+
+
+@pytest.mark.usefixtures('container_cgroup')
 def test_non_running_containers(session, container_group,
-                                 docker_client, running_container,
-                                 finished_container):
+                                docker_client, running_container,
+                                finished_container):
     containers = [running_container, finished_container]
 
     docker_client(client_info={'ID':'foo'}, containers=containers)
@@ -76,22 +101,10 @@ def test_non_running_containers(session, container_group,
         assert entity.attrs.get('id').traits == {'entity:id'}
 
 
-def test_not_running_container_exception_mk2(running_container, docker_client):
-    running_container.top.side_effect = APIError("Mocked APIError")
-    containers = [running_container]
-    docker_client(client_info={'ID':'foo'}, containers=containers)
-    dockerContainerGroup = DockerContainerGroup()
-    assert len(list(dockerContainerGroup.generate_updates())) == 0
-
-
-def test_empty_processes_from_top(session, container_group,
-                                  docker_client, running_container):
-
-    running_container.top.return_value = {"Processes": None}
-    containers = [running_container]
-
-    docker_client(client_info={'ID':'foo'}, containers=containers)
-
+def test_container_without_pid(session, container_group,
+                               docker_client, running_container):
+    running_container.attrs['State']['Pid'] = 0
+    docker_client(client_info={'ID':'foo'}, containers=[running_container])
     container_group.entityd_sessionstart(session)
     container_group.entityd_configure(session.config)
 
@@ -102,51 +115,14 @@ def test_empty_processes_from_top(session, container_group,
     assert len(entities) == 0
 
 
-def test_generate_updates(monkeypatch, session, running_container,
-                          container_group):
-
-    containers = [running_container]
-
-    get_client = pytest.MagicMock()
-    client_instance = get_client.return_value
-    client_instance.info.return_value = {'ID': 'foo'}
-    client_instance.containers.list.return_value = iter(containers)
-    monkeypatch.setattr(DockerClient, "get_client", get_client)
-
-    procs = {}
-    for x in range(5):
-        name = "proc" + str(x)
-        proc = pytest.MagicMock(name=name, pid=x)
-        proc.start_time.timestamp.return_value = datetime.utcnow().timestamp()
-        procs[x] = proc
-
-    # 0
-    # ├── 1
-    # │   ├── 2
-    # │   └── 3
-    # └── 4
-
-    procs[0].children.return_value = iter([procs[1], procs[4]])
-    procs[1].children.return_value = iter([procs[2], procs[3]])
-
-    # We monkey patch over the syskit get process to return a
-    # process from our dict and an exception if it's not present
-    def get_proc(pid):
-        if pid in procs:
-            return procs[pid]
-        else:
-            raise syskit.NoSuchProcessError
-
-    del procs[3]
-
-    monkeypatch.setattr(syskit, "Process", get_proc)
-
+def test_generate_updates(session, running_container, docker_client,
+                          container_group, container_cgroup):
+    docker_client(client_info={'ID':'foo'}, containers=[running_container])
     container_group.entityd_sessionstart(session)
     container_group.entityd_configure(session.config)
 
-    # Add the ueid to the mocked processes to help with the loop below
-    for proc in procs.values():
-        proc.ueid = container_group.get_process_ueid(proc.pid)
+    # A process vanished between reading the cgroup and its stat
+    del container_cgroup[102]
 
     entities = container_group.entityd_find_entity(DockerContainerGroup.name)
     entities_list = list(entities)
@@ -161,5 +137,74 @@ def test_generate_updates(monkeypatch, session, running_container,
     assert entity.attrs.get('id').value == str(container_ueid)
     assert entity.attrs.get('id').traits == {'entity:id'}
     assert container_ueid in entity.children
+    assert len(list(entity.children)) == 3
+    for proc in container_cgroup.values():
+        assert container_group.get_process_ueid(proc.pid) in entity.children
+    entityd.procfs.cgroup_procs.assert_called_once_with(
+        '/docker/' + running_container.id)
+    assert not running_container.top.called
+
+
+def test_generate_updates_not_selected(session, running_container,
+                                       docker_client, container_group,
+                                       container_cgroup, monkeypatch):
+    docker_client(client_info={'ID':'foo'}, containers=[running_container])
+    container_group.entityd_sessionstart(session)
+    container_group.entityd_configure(session.config)
+    monkeypatch.setattr(entityd.processme, 'is_selected',
+                        lambda session, pid: pid != 101)
+    entity, = container_group.entityd_find_entity(DockerContainerGroup.name)
+    assert len(list(entity.children)) == 3
+    assert (container_group.get_process_ueid(container_cgroup[101].pid)
+            not in entity.children)
+
+
+def test_generate_updates_ueids_cached(session, running_container,
+                                       docker_client, container_group,
+                                       container_cgroup, monkeypatch):
+    docker_client(client_info={'ID':'foo'}, containers=[running_container])
+    container_group.entityd_sessionstart(session)
+    container_group.entityd_configure(session.config)
+    list(container_group.entityd_find_entity(DockerContainerGroup.name))
+    assert len(container_group.process_ueids) == 3
+
+    monkeypatch.setattr(entityd.processme, 'start_time',
+                        pytest.Mock(side_effect=AssertionError))
+    del container_cgroup[102]
+    entity, = container_group.entityd_find_entity(DockerContainerGroup.name)
+    assert len(list(entity.children)) == 3
+    assert len(container_group.process_ueids) == 2
+
+
+def test_generate_updates_no_cgroupfs(monkeypatch, session, running_container,
+                                      docker_client, container_group):
+    docker_client(client_info={'ID':'foo'}, containers=[running_container])
+    monkeypatch.setattr(entityd.procfs, 'cgroup_procs',
+                        pytest.Mock(return_value=None))
+    cgroup = entityd.procfs.ContainerCgroup(
+        running_container.id, '/docker/' + running_container.id)
+    procs = {}
+    for x in range(100, 105):
+        procs[x] = pytest.MagicMock(name='proc' + str(x), pid=x,
+                                    starttime=1000 + x)
+
+    # 100
+    # ├── 101
+    # │   ├── 102
+    # │   └── 103
+    # └── 104
+
+    children = {100: [101, 104], 101: [102, 103]}
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'stat',
+                        lambda self, pid: procs.get(pid))
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'children',
+                        lambda self, pid: children.get(pid, []))
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'container',
+                        lambda self, pid: cgroup)
+
+    container_group.entityd_sessionstart(session)
+    container_group.entityd_configure(session.config)
+
+    entity, = container_group.entityd_find_entity(DockerContainerGroup.name)
     for proc in procs.values():
-        assert proc.ueid in entity.children
+        assert container_group.get_process_ueid(proc.pid) in entity.children
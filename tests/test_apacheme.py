@@ -1,5 +1,9 @@
+import http.server
 import os
+import socket
+import socketserver
 import subprocess
+import threading
 import time
 
 import cobe
@@ -104,7 +108,8 @@ def entitygen(pm, session, host_entity_plugin):  # pylint: disable=unused-argume
 
 
 @pytest.fixture
-def patched_entitygen(request, monkeypatch, pm, session, host_entity_plugin):  # pylint: disable=unused-argument
+def patched_entitygen(request, monkeypatch, pm, session, host_entity_plugin,  # pylint: disable=unused-argument
+                      discovered):
     """A entityd.apacheme.ApacheEntity instance.
 
     The plugin will be registered with the PluginManager but no hooks
@@ -113,6 +118,7 @@ def patched_entitygen(request, monkeypatch, pm, session, host_entity_plugin):  #
     This is patched so that it doesn't rely on a live Apache server.
 
     """
+    discovered['Apache'] = [123]
     gen = entityd.apacheme.ApacheEntity()
     pm.register(gen, 'entityd.apacheme.ApacheEntity')
     gen.entityd_sessionstart(session)
@@ -157,7 +163,7 @@ def patched_entitygen(request, monkeypatch, pm, session, host_entity_plugin):  #
 
     response_obj = pytest.Mock(text=server_status_output)
     get_func = pytest.Mock(return_value=response_obj)
-    monkeypatch.setattr(entityd.apacheme.Apache,
+    monkeypatch.setattr(entityd.apacheme.StatusClient,
                         'get_apache_status',
                         get_func)
 
@@ -230,8 +236,24 @@ def test_find_entity_mocked_apache(patched_entitygen):
     assert count
 
 
+def test_find_entity_status_stats(patched_entitygen):
+    entity, = patched_entitygen.entityd_find_entity('Apache', None)
+    assert entity.attrs.get('status:latency').value >= 0
+    assert entity.attrs.get('status:failures').value == 0
+
+
+def test_find_entity_no_latency(patched_entitygen, monkeypatch):
+    monkeypatch.setattr(
+        entityd.apacheme.Apache, 'status_stats',
+        pytest.Mock(return_value=entityd.apacheme.StatusStats(None, 2)))
+    entity, = patched_entitygen.entityd_find_entity('Apache', None)
+    with pytest.raises(KeyError):
+        entity.attrs.get('status:latency')
+    assert entity.attrs.get('status:failures').value == 2
+
+
 def test_find_entity_no_apache_running(patched_entitygen, monkeypatch):
-    monkeypatch.setattr(entityd.apacheme.Apache, 'get_apache_status',
+    monkeypatch.setattr(entityd.apacheme.StatusClient, 'get_apache_status',
                         pytest.Mock(side_effect=ApacheNotFound))
     gen = patched_entitygen.entityd_find_entity('Apache', None)
     assert list(gen) == []
@@ -283,7 +305,7 @@ def test_entity_deleted_running(patched_entitygen, monkeypatch):
     gen = patched_entitygen.entityd_find_entity('Apache', None)
     last_entity = next(gen)
     assert last_entity.metype == 'Apache'
-    monkeypatch.setattr(entityd.apacheme.Apache, 'get_apache_status',
+    monkeypatch.setattr(entityd.apacheme.StatusClient, 'get_apache_status',
                         pytest.Mock(side_effect=ApacheNotFound))
     gen = patched_entitygen.entityd_find_entity('Apache', None)
     with pytest.raises(StopIteration):
@@ -498,7 +520,7 @@ def test_conf_file_from_proc(monkeypatch):
 
 def test_config_check(apache, monkeypatch):
     apache._apachectl_binary = 'apachectl'
-    apache._config_path = FULL_PATH_TO_CONF
+    apache._metadata['config_path'] = FULL_PATH_TO_CONF
     monkeypatch.setattr(subprocess, 'check_call',
                         pytest.Mock(return_value=0))
     assert apache.check_config() is True
@@ -506,11 +528,13 @@ def test_config_check(apache, monkeypatch):
 
 def test_config_check_fails(apache, monkeypatch):
     apache._apachectl_binary = 'apachectl'
-    apache._config_path = FULL_PATH_TO_CONF
+    apache._metadata['config_path'] = FULL_PATH_TO_CONF
     monkeypatch.setattr(subprocess, 'check_call',
                         pytest.Mock(return_value=-1))
     assert apache.check_config() is False
 
+    apache = entityd.apacheme.Apache()
+    apache._metadata['config_path'] = FULL_PATH_TO_CONF
     monkeypatch.setattr(
         subprocess, 'check_call',
         pytest.Mock(side_effect=subprocess.CalledProcessError(-1, '')))
@@ -586,7 +610,7 @@ def test_config_last_modified(apache, tmpdir):
     t = time.time()
     time.sleep(.1)
     tmpfile = tmpdir.join('apache.conf')
-    apache._config_path = str(tmpfile)
+    apache._metadata['config_path'] = str(tmpfile)
     with tmpfile.open('w') as f:
         f.write("Test at: {}".format(t))
 
@@ -632,15 +656,17 @@ def test_performance_data(apache, monkeypatch):
 
     response_obj = pytest.Mock(text=server_status_output)
     get_func = pytest.Mock(return_value=response_obj)
-    monkeypatch.setattr(requests,
+    monkeypatch.setattr(requests.Session,
                         'get',
                         get_func)
+    apache._metadata['config_path'] = FULL_PATH_TO_CONF
     monkeypatch.setattr(apache,
                         'vhosts',
                         pytest.Mock(return_value=[VHost('localhost', 80, '')]))
     perfdata = apache.performance_data()
 
-    get_func.assert_called_with('http://localhost:80/server-status?auto')
+    get_func.assert_called_with('http://localhost:80/server-status?auto',
+                                timeout=(1.0, 5.0))
 
     assert perfdata['TotalAccesses'] == (1081, {'metric:counter'})
     assert perfdata['TotalkBytes'] == (704, {'metric:counter', 'unit:bytes'})
@@ -677,9 +703,10 @@ def test_performance_data(apache, monkeypatch):
 
 
 def test_performance_data_fails(apache, monkeypatch):
-    monkeypatch.setattr(requests, 'get',
+    monkeypatch.setattr(requests.Session, 'get',
                         pytest.Mock(
                             side_effect=requests.exceptions.ConnectionError))
+    apache._metadata['config_path'] = FULL_PATH_TO_CONF
     monkeypatch.setattr(
         apache, 'vhosts',
         pytest.Mock(return_value=set([VHost('incorrect.com', 1111, '')])))
@@ -690,7 +717,7 @@ def test_performance_data_fails(apache, monkeypatch):
 def test_listening_addresses(apache, monkeypatch):
     # pylint: disable=line-too-long
     apache._apachectl_binary = 'apachectl'
-    apache._config_path = '/path/to.conf'
+    apache._metadata['config_path'] = '/path/to.conf'
     monkeypatch.setattr(subprocess, 'check_output',
                         pytest.Mock(return_value="""\
         VirtualHost configuration:
@@ -779,6 +806,323 @@ def test_get_all_includes(tmpdir):
         </VirtualHost>
     """)
     apache = entityd.apacheme.Apache()
-    apache._config_path = str(conf)
+    apache._metadata['config_path'] = str(conf)
     includes = apache.find_all_includes()
     assert str(site) in includes
+
+
+@pytest.fixture
+def apache_conf(tmpdir):
+    """An Apache config including the files in sites-enabled."""
+    conf = tmpdir.join('apacheconf', 'apache2.conf')
+    conf.write('ServerName localhost\n'
+               'IncludeOptional sites-enabled/*.conf\n', ensure=True)
+    tmpdir.join('apacheconf', 'sites-enabled', '000-default.conf').write(
+        '<VirtualHost *:80>\n</VirtualHost>\n', ensure=True)
+    return conf
+
+
+@pytest.fixture
+def apachectl_calls(monkeypatch):
+    """Mock apachectl, returning the mock of check_output."""
+    def check_output(args, **kwargs):  # pylint: disable=unused-argument
+        if '-v' in args or '-V' in args:
+            return APACHECTL__V
+        return '    *:80    localhost (/etc/apache2/sites-enabled/a.conf:1)\n'
+    output = pytest.Mock(side_effect=check_output)
+    monkeypatch.setattr(subprocess, 'check_output', output)
+    monkeypatch.setattr(subprocess, 'check_call', pytest.Mock(return_value=0))
+    return output
+
+
+def apache_proc(conf, starttime=456):
+    proc = entityd.EntityUpdate('Process')
+    proc.attrs.set('pid', 123, traits={'entity:id'})
+    proc.attrs.set('starttime', starttime, traits={'entity:id'})
+    proc.attrs.set('command', 'apache2 -f {}'.format(conf))
+    return proc
+
+
+def collect_metadata(apache):
+    return (apache.version, apache.config_path, apache.check_config(),
+            apache.vhosts(), apache.config_last_modified())
+
+
+def test_metadata_cached(apache, apache_conf, apachectl_calls):  # pylint: disable=unused-argument
+    cache = {}
+    first = entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache)
+    metadata = collect_metadata(first)
+    calls = apachectl_calls.call_count
+    second = entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache)
+    assert collect_metadata(second) == metadata
+    assert apachectl_calls.call_count == calls
+    assert subprocess.check_call.call_count == 1
+    assert list(cache) == [(123, 456)]
+
+
+def test_metadata_cached_status_fails(apache, apache_conf, apachectl_calls):  # pylint: disable=unused-argument
+    cache = {}
+    client = pytest.Mock()
+    client.scrape.side_effect = ApacheNotFound
+    for _ in range(2):
+        apache = entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache,
+                                         status_client=client)
+        with pytest.raises(ApacheNotFound):
+            apache.performance_data()
+    assert client.scrape.call_count == 2
+    assert apachectl_calls.call_count == 2
+    assert 'mtimes' in cache[(123, 456)]
+
+
+def test_metadata_vhosts_once(apache, apache_conf, apachectl_calls):  # pylint: disable=unused-argument
+    apache = entityd.apacheme.Apache(apache_proc(apache_conf))
+    assert apache.vhosts() is apache.vhosts()
+    assert apachectl_calls.call_count == 2
+    assert apache.cache_key is None
+
+
+def test_metadata_config_modified(apache, apache_conf, apachectl_calls):  # pylint: disable=unused-argument
+    cache = {}
+    collect_metadata(
+        entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache))
+    calls = apachectl_calls.call_count
+    site = apache_conf.dirpath('sites-enabled', '000-default.conf')
+    os.utime(str(site), (0, 0))
+    apache = entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache)
+    collect_metadata(apache)
+    assert apachectl_calls.call_count == 2 * calls
+    assert apache.config_last_modified() == apache_conf.mtime()
+
+
+def test_metadata_include_added(apache, apache_conf, apachectl_calls):  # pylint: disable=unused-argument
+    cache = {}
+    collect_metadata(
+        entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache))
+    sites = apache_conf.dirpath('sites-enabled')
+    sites.join('001-new.conf').write('')
+    os.utime(str(sites), (0, 0))
+    apache = entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache)
+    assert str(sites.join('001-new.conf')) in apache.find_all_includes()
+
+
+def test_metadata_config_removed(apache, apache_conf, apachectl_calls):  # pylint: disable=unused-argument
+    cache = {}
+    collect_metadata(
+        entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache))
+    apache_conf.dirpath('sites-enabled', '000-default.conf').remove()
+    apache = entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache)
+    assert apache.find_all_includes() == []
+
+
+def test_metadata_process_restarted(apache, apache_conf, apachectl_calls):  # pylint: disable=unused-argument
+    cache = {}
+    collect_metadata(
+        entityd.apacheme.Apache(apache_proc(apache_conf), cache=cache))
+    calls = apachectl_calls.call_count
+    collect_metadata(entityd.apacheme.Apache(
+        apache_proc(apache_conf, starttime=789), cache=cache))
+    assert apachectl_calls.call_count == 2 * calls
+    assert set(cache) == {(123, 456), (123, 789)}
+
+
+def test_metadata_dropped_when_not_running(apache, monkeypatch):  # pylint: disable=unused-argument
+    gen = entityd.apacheme.ApacheEntity()
+    monkeypatch.setattr(gen, 'top_level_apache_processes',
+                        pytest.Mock(return_value=[apache_proc('/a.conf')]))
+    gen._metadata[(1, 2)] = {}
+    apaches = list(gen.active_apaches())
+    assert [apache.cache_key for apache in apaches] == [(123, 456)]
+    assert list(gen._metadata) == [(123, 456)]
+
+
+STATUS = 'Total Accesses: 1081\nBusyWorkers: 1\n'
+
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    """Serves mod_status, recording the client address of requests.
+
+    The response status is the ``status`` attribute of the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.server.clients.append(self.client_address)
+        body = STATUS.encode()
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class StatusServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server handling each connection in its own thread.
+
+    Connections are kept alive, so :meth:`stop` closes them to let
+    their threads finish.
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StatusHandler)
+        self.clients = []
+        self.status = 200
+        self.connections = []
+        self.threads = []
+
+    def process_request_thread(self, request, client_address):
+        self.connections.append(request)
+        self.threads.append(threading.current_thread())
+        super().process_request_thread(request, client_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in self.threads:
+            thread.join()
+
+
+@pytest.fixture
+def status_server(request):
+    """A local HTTP server stub of mod_status."""
+    server = StatusServer()
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.start()
+
+    def stop():
+        server.stop()
+        thread.join()
+    request.addfinalizer(stop)
+    return server
+
+
+@pytest.fixture
+def silent_vhost(request):
+    """A vhost accepting connections but never answering."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(8)
+    request.addfinalizer(sock.close)
+    return VHost(*sock.getsockname(), config_path='')
+
+
+@pytest.fixture
+def status_vhost(status_server):
+    return VHost(*status_server.server_address, config_path='')
+
+
+@pytest.fixture
+def client(request):
+    client = entityd.apacheme.StatusClient(connect_timeout=0.5,
+                                           read_timeout=0.3)
+    request.addfinalizer(client.close)
+    return client
+
+
+def test_status_client_get(client, status_vhost):
+    response = client.get_apache_status(status_vhost.address,
+                                        status_vhost.port)
+    assert response.text == STATUS
+
+
+def test_status_client_timeout(client, silent_vhost):
+    start = time.monotonic()
+    with pytest.raises(ApacheNotFound):
+        client.get_apache_status(silent_vhost.address, silent_vhost.port)
+    assert time.monotonic() - start < 2
+
+
+def test_status_client_http_error(client, status_server, status_vhost):
+    status_server.status = 404
+    with pytest.raises(ApacheNotFound):
+        client.get_apache_status(status_vhost.address, status_vhost.port)
+
+
+def test_status_client_keep_alive(client, status_server, status_vhost):
+    for _ in range(3):
+        client.scrape('apache', [status_vhost])
+    assert len(status_server.clients) == 3
+    assert len(set(status_server.clients)) == 1
+
+
+def test_scrape_concurrent(status_vhost, silent_vhost):
+    client = entityd.apacheme.StatusClient(read_timeout=1)
+    vhosts = [silent_vhost, status_vhost,
+              VHost('localhost', silent_vhost.port, 'other.conf')]
+    start = time.monotonic()
+    response = client.scrape('apache', vhosts)
+    assert time.monotonic() - start < 0.5
+    assert response.text == STATUS
+    stats = client.stats['apache']
+    assert stats.failures == 0
+    assert 0 < stats.latency < 0.5
+    client.close()
+
+
+def test_scrape_none_answered(client, silent_vhost):
+    vhosts = [silent_vhost, VHost('localhost', silent_vhost.port, 'a.conf')]
+    for failures in [1, 2]:
+        with pytest.raises(ApacheNotFound):
+            client.scrape('apache', vhosts)
+        assert client.stats['apache'] == (None, failures)
+
+
+def test_scrape_sessions_not_shared(client, monkeypatch):
+    in_use = set()
+    shared = []
+
+    def get(session, *args, **kwargs):  # pylint: disable=unused-argument
+        shared.append(session in in_use)
+        in_use.add(session)
+        time.sleep(0.05)
+        in_use.discard(session)
+        return pytest.Mock(text=STATUS)
+    monkeypatch.setattr(requests.Session, 'get', get)
+    vhosts = [VHost('127.0.0.1', port, '') for port in range(1, 5)]
+    client.scrape('apache', vhosts)
+    client.close()
+    assert shared == [False] * 4
+
+
+def test_scrape_remembers_vhost(client, status_server, status_vhost,
+                                silent_vhost):
+    client.scrape('apache', [silent_vhost, status_vhost])
+    start = time.monotonic()
+    client.scrape('apache', [silent_vhost, status_vhost])
+    assert time.monotonic() - start < 0.2
+    assert client.stats['apache'].failures == 0
+    assert len(status_server.clients) == 2
+
+
+def test_scrape_remembered_vhost_gone(client, status_vhost, silent_vhost):
+    client.scrape('apache', [status_vhost])
+    with pytest.raises(ApacheNotFound):
+        client.scrape('apache', [silent_vhost])
+    assert client.stats['apache'].failures == 1
+
+
+def test_scrape_sequential(status_vhost, silent_vhost):
+    client = entityd.apacheme.StatusClient(read_timeout=0.1, threads=1)
+    response = client.scrape('apache', [silent_vhost, status_vhost])
+    assert response.text == STATUS
+    client.close()
+
+
+def test_performance_data_stub_server(apache, client, status_vhost,
+                                      monkeypatch):
+    apache.status_client = client
+    apache._metadata['config_path'] = FULL_PATH_TO_CONF
+    monkeypatch.setattr(apache, 'vhosts',
+                        pytest.Mock(return_value={status_vhost}))
+    assert apache.performance_data()['BusyWorkers'] == (1, {'metric:gauge'})
+    stats = apache.status_stats()
+    assert stats.failures == 0
+    assert stats.latency > 0
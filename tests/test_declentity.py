@@ -220,6 +220,21 @@ def test_invalid_relation(declent, config, session, tmpdir, loghandler):
     assert loghandler.has_warning(re.compile(r'Bad relation'))
 
 
+def test_invalid_relation_regex(declent, config, session, tmpdir, loghandler):
+    conf_file = tmpdir.join('test.entity')
+    conf_file.write("""
+        type: Test
+        children:
+            - type: Process
+              command: proc[
+        """)
+    config.args.declentity_dir = pathlib.Path(tmpdir.strpath)
+    declent.entityd_configure(config)
+    declent.entityd_sessionstart(session)
+    assert 'Test' not in declent._conf_attrs.keys()
+    assert loghandler.has_warning(re.compile(r'Bad regular expression'))
+
+
 def test_entity_removed_on_file_remove(declent, session, config, conf_file):
     config.args.declentity_dir = pathlib.Path(conf_file.strpath).parent
     declent.entityd_configure(config)
@@ -376,6 +391,110 @@ def test_children_and_parents(declent, session, config, conf_file, pm):
     assert set(entity.parents) == set([procent2.ueid])
 
 
+@pytest.fixture
+def mock_proc(pm):
+    """Register a plugin finding two Process entities.
+
+    The plugin records the names of the types it was asked for.
+    """
+    procent = entityd.entityupdate.EntityUpdate('Process')
+    procent.attrs.set('command', 'proccommand -a')
+    procent2 = entityd.entityupdate.EntityUpdate('Process')
+    procent2.attrs.set('command', 'redis-server')
+
+    class MockProc:
+        calls = []
+        entities = [procent, procent2]
+
+        @entityd.pm.hookimpl
+        def entityd_find_entity(self, name, attrs, include_ondemand=False):  # pylint: disable=unused-argument
+            self.calls.append(name)
+            if name == 'Process':
+                yield from self.entities
+    mockproc = MockProc()
+    pm.register(mockproc, 'entityd.procme.MockProc')
+    return mockproc
+
+
+def test_relations_found_once_per_cycle(declent, session, config, tmpdir,
+                                        mock_proc):
+    tmpdir.join('test.entity').write(textwrap.dedent("""
+        type: Test
+        children:
+            - type: Process
+              command: proccommand
+        parents:
+            - type: Process
+              command: redis
+        ---
+        type: Other
+        children:
+            - type: Process
+        """))
+    config.args.declentity_dir = pathlib.Path(tmpdir.strpath)
+    declent.entityd_configure(config)
+    declent.entityd_sessionstart(session)
+    procent, procent2 = mock_proc.entities
+    declent.entityd_collection_before(session)
+    test = next(declent.entityd_find_entity('Test', None))
+    other = next(declent.entityd_find_entity('Other', None))
+    assert set(test.children) == {procent.ueid}
+    assert set(test.parents) == {procent2.ueid}
+    assert set(other.children) == {procent.ueid, procent2.ueid}
+    assert mock_proc.calls.count('Process') == 1
+    declent.entityd_collection_after(session, ())
+    test = next(declent.entityd_find_entity('Test', None))
+    assert set(test.children) == {procent.ueid}
+    assert mock_proc.calls.count('Process') == 2
+
+
+def test_relations_found_again_next_cycle(declent, session, config, conf_file,
+                                          mock_proc):
+    config.args.declentity_dir = pathlib.Path(conf_file.strpath).parent
+    declent.entityd_configure(config)
+    declent.entityd_sessionstart(session)
+    procent, procent2 = mock_proc.entities
+    declent.entityd_collection_before(session)
+    test = next(declent.entityd_find_entity('Test', None))
+    assert set(test.parents) == {procent2.ueid}
+    declent.entityd_collection_after(session, ())
+    procent3 = entityd.entityupdate.EntityUpdate('Process')
+    procent3.attrs.set('command', 'redis-sentinel')
+    mock_proc.entities = [procent, procent3]
+    declent.entityd_collection_before(session)
+    test = next(declent.entityd_find_entity('Test', None))
+    assert set(test.parents) == {procent3.ueid}
+    declent.entityd_collection_after(session, ())
+
+
+def test_relation_added_during_cycle(declent, session, mock_proc):
+    declent.entityd_sessionstart(session)
+    procent, procent2 = mock_proc.entities
+    declent.entityd_collection_before(session)
+    assert list(declent._find_entities('Process', {'command': 'redis'})) == [
+        procent2]
+    assert list(declent._find_entities('Process', {'command': 'proc'})) == [
+        procent]
+    assert mock_proc.calls.count('Process') == 1
+    declent.entityd_collection_after(session, ())
+
+
+def test_patterns_compiled_once(declent, session, mock_proc, monkeypatch):
+    declent.entityd_sessionstart(session)
+    compile_ = pytest.Mock(wraps=re.compile)
+    monkeypatch.setattr(entityd.declentity.re, 'compile', compile_)
+    for _ in range(3):
+        found = declent._find_entities('Process', {'command': 'redis'})
+        assert list(found) == [mock_proc.entities[1]]
+    assert compile_.call_count == 1
+
+
+def test_relation_key():
+    key = entityd.declentity.relation_key({'a': 'x', 'b': 'y'})
+    assert key == entityd.declentity.relation_key({'b': 'y', 'a': 'x'})
+    assert key != entityd.declentity.relation_key({'a': 'x'})
+
+
 def test_one_file_two_entities(declent, session, config, tmpdir):
     conf_file = tmpdir.join('test.entity')
     conf_file.write(textwrap.dedent("""
@@ -0,0 +1,172 @@
+import os
+
+import pytest
+
+import entityd.discovery
+import entityd.pm
+import entityd.procfs
+
+
+def make_proc(procdir, pid, ppid=1, comm='cat', args=('-u',), sockets=()):
+    """Create a fake process in a procfs tree."""
+    piddir = procdir.join(str(pid))
+    piddir.ensure_dir()
+    fields = [ppid, pid, pid, 0, -1, 4194304, 100, 0, 0, 0, 10, 5,
+              0, 0, 20, 0, 1, 0, 1000, 1024000, 200, 100]
+    piddir.join('stat').write('{} ({}) S {}\n'.format(
+        pid, comm, ' '.join(str(field) for field in fields)))
+    piddir.join('cmdline').write_binary(
+        b''.join(arg.encode() + b'\0' for arg in (comm,) + tuple(args)))
+    piddir.join('fd').ensure_dir()
+    for fd, inode in enumerate(sockets, 3):
+        os.symlink('socket:[{}]'.format(inode),
+                   str(piddir.join('fd', str(fd))))
+    return piddir
+
+
+@pytest.fixture
+def procdir(tmpdir):
+    procdir = tmpdir.join('proc')
+    procdir.join('net', 'tcp').write(
+        '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when '
+        'retrnsmt   uid  timeout inode\n'
+        '   0: 00000000:1F90 00000000:0000 0A 00000000:00000000 00:00000000 '
+        '00000000     0        0 1111 1 0000000000000000 100 0 0 10 0\n'
+        '   1: 0100007F:1F90 0100007F:D431 01 00000000:00000000 00:00000000 '
+        '00000000     0        0 2222 1 0000000000000000 20 4 30 10 -1\n',
+        ensure=True)
+    procdir.join('net', 'tcp6').write(
+        '  sl  local_address                         remote_address          '
+        '              st tx_queue rx_queue tr tm->when retrnsmt   uid  '
+        'timeout inode\n'
+        '   0: 00000000000000000000000000000000:18EB '
+        '00000000000000000000000000000000:0000 0A 00000000:00000000 '
+        '00:00000000 00000000     0        0 3333 1 0000000000000000 100 0 0 '
+        '10 0\n')
+    make_proc(procdir, 1, ppid=0, comm='init')
+    make_proc(procdir, 100, comm='postgres')
+    make_proc(procdir, 101, ppid=100, comm='postgres')
+    make_proc(procdir, 200, comm='postgres', args=('-D', '/srv/pg'))
+    make_proc(procdir, 300, comm='java',
+              args=('-cp', 'x.jar', 'org.apache.catalina.startup.Bootstrap'),
+              sockets=[1111, 2222])
+    make_proc(procdir, 301, ppid=300, comm='java', args=('Other',))
+    make_proc(procdir, 400, comm='redis-server', sockets=[3333])
+    return procdir
+
+
+@pytest.fixture
+def discovery(procdir, session):
+    session.config.args.procpath = str(procdir)
+    discovery = entityd.discovery.DiscoveryService()
+    discovery.entityd_sessionstart(session)
+    return discovery
+
+
+def test_matcher_needs_criteria():
+    with pytest.raises(ValueError):
+        entityd.discovery.Matcher('nothing')
+
+
+def test_listening_sockets(procdir):
+    assert entityd.discovery.listening_sockets(str(procdir)) == {
+        '1111': 8080, '3333': 6379}
+    assert entityd.discovery.listening_sockets('/does/not/exist') == {}
+
+
+def test_binary(discovery):
+    matcher = entityd.discovery.Matcher('PostgreSQL', binary='postgres')
+    assert discovery.matches(matcher) == [100, 200]
+
+
+def test_binary_alternatives(discovery):
+    matcher = entityd.discovery.Matcher('Any',
+                                        binary=['redis-server', 'java'])
+    assert discovery.matches(matcher) == [300, 400]
+
+
+def test_argv(discovery):
+    matcher = entityd.discovery.Matcher('Tomcat', binary='java',
+                                        argv=r'catalina\.startup')
+    assert discovery.matches(matcher) == [300]
+    matcher = entityd.discovery.Matcher('Data', argv='-D /srv/')
+    assert discovery.matches(matcher) == [200]
+
+
+def test_ports(discovery):
+    matcher = entityd.discovery.Matcher('Redis', ports=[6379])
+    assert discovery.matches(matcher) == [400]
+    matcher = entityd.discovery.Matcher('Web', binary='java',
+                                        ports=[80, 8080])
+    assert discovery.matches(matcher) == [300]
+
+
+def test_worker_of_other_service_is_top_level(discovery):
+    matcher = entityd.discovery.Matcher('Other', argv='Other')
+    assert discovery.matches(matcher) == [301]
+
+
+def test_one_pass_per_snapshot(discovery, session, monkeypatch):
+    snapshot = entityd.procfs.Snapshot(session.config.args.procpath)
+    monkeypatch.setattr(entityd.procfs, 'snapshot',
+                        lambda session, procpath: snapshot)
+    postgres = discovery.subscribe(
+        entityd.discovery.Matcher('PostgreSQL', binary='postgres'))
+    redis = discovery.subscribe(
+        entityd.discovery.Matcher('Redis', binary='redis-server'))
+    monkeypatch.setattr(discovery, 'discover',
+                        pytest.Mock(wraps=discovery.discover))
+    assert discovery.matches(postgres) == [100, 200]
+    assert discovery.matches(redis) == [400]
+    assert discovery.matches(postgres) == [100, 200]
+    assert discovery.discover.call_count == 1
+    discovery.unsubscribe(redis)
+    assert discovery.matchers == [postgres]
+
+
+def test_new_snapshot_rediscovers(discovery, procdir, session, monkeypatch):
+    snapshots = iter([
+        entityd.procfs.Snapshot(session.config.args.procpath),
+        entityd.procfs.Snapshot(session.config.args.procpath),
+    ])
+    current = [next(snapshots)]
+    monkeypatch.setattr(entityd.procfs, 'snapshot',
+                        lambda session, procpath: current[0])
+    matcher = entityd.discovery.Matcher('PostgreSQL', binary='postgres')
+    assert discovery.matches(matcher) == [100, 200]
+    procdir.join('200').remove()
+    assert discovery.matches(matcher) == [100, 200]
+    current[0] = next(snapshots)
+    assert discovery.matches(matcher) == [100]
+
+
+def test_subscribing_rediscovers(discovery, session, monkeypatch):
+    snapshot = entityd.procfs.Snapshot(session.config.args.procpath)
+    monkeypatch.setattr(entityd.procfs, 'snapshot',
+                        lambda session, procpath: snapshot)
+    redis = entityd.discovery.Matcher('Redis', binary='redis-server')
+    discovery.matches(redis)
+    matcher = entityd.discovery.Matcher('PostgreSQL', binary='postgres')
+    assert discovery.matches(matcher) == [100, 200]
+
+
+def test_processes(discovery, pm):
+    class ProcessPlugin:
+        @staticmethod
+        @entityd.pm.hookimpl
+        def entityd_find_entity(name, attrs, include_ondemand=False):  # pylint: disable=unused-argument
+            if name == 'Process' and attrs['pid'] != 200:
+                update = entityd.EntityUpdate('Process')
+                update.attrs.set('pid', attrs['pid'])
+                return [update]
+    pm.register(ProcessPlugin(), 'entityd.processme')
+    matcher = entityd.discovery.Matcher('PostgreSQL', binary='postgres')
+    processes = discovery.processes(matcher)
+    assert [proc.attrs.get('pid').value for proc in processes] == [100]
+
+
+def test_service(session):
+    discovery = entityd.discovery.service(session)
+    assert isinstance(discovery, entityd.discovery.DiscoveryService)
+    assert session.svc.discovery is discovery
+    assert entityd.discovery.service(session) is discovery
@@ -1,14 +1,19 @@
+import argparse
 import os
 import re
 import socket
 
+import cobe
 import pytest
+import syskit
 
 import entityd.connections
 import entityd.core
 import entityd.endpointme
 import entityd.kvstore
 import entityd.processme
+import entityd.procfs
+import entityd.sockdiag
 
 
 @pytest.fixture
@@ -199,20 +204,20 @@ def test_get_entities_with_relocated_procfs(request, pm, session, tmpdir,
 
 
 def test_endpoint_for_deleted_process(request, pm, session, host_entity_plugin,  # pylint: disable=unused-argument
-                                      kvstore, local_socket, conn):  # pylint: disable=unused-argument
+                                      kvstore, local_socket, conn,  # pylint: disable=unused-argument
+                                      monkeypatch):
     endpoint_gen = entityd.endpointme.EndpointEntity()
     endpoint_gen.session = session
 
     pm.register(entityd.processme.ProcessEntity(), name='entityd.processme')
     pm.hooks.entityd_plugin_registered(pluginmanager=pm,
                                        name='entityd.processme')
+    session.config.addentity('Process', 'entityd.processme')
     pm.hooks.entityd_sessionstart(session=endpoint_gen.session)
     request.addfinalizer(pm.hooks.entityd_sessionfinish)
 
-    proc = entityd.EntityUpdate('Process')
-    proc.set_not_exists()
-    session.pluginmanager.hooks.entityd_find_entity = pytest.Mock()
-    session.pluginmanager.hooks.entityd_find_entity.return_value = [[proc]]
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'stat',
+                        lambda self, pid: None)
 
     # If the process no longer exists, then the endpoint shouldn't be returned
     entities = endpoint_gen.endpoints_for_process(os.getpid())
@@ -220,6 +225,85 @@ def test_endpoint_for_deleted_process(request, pm, session, host_entity_plugin,
     pm.hooks.entityd_sessionfinish()
 
 
+@pytest.fixture
+def endpoint_cycle(pm, session, host_entity_plugin, kvstore, endpoint_gen):  # pylint: disable=unused-argument
+    """The endpoint plugin, with Process entities enabled."""
+    session.config.addentity('Process', 'entityd.endpointme.EndpointEntity')
+    endpoint_gen.entityd_sessionstart(session)
+    return endpoint_gen
+
+
+def test_process_parent(endpoint_cycle, session, local_socket, monkeypatch):
+    pm = session.pluginmanager
+    procent = entityd.processme.ProcessEntity()
+    procent.entityd_sessionstart(session)
+    process = procent.get_ueid(syskit.Process(os.getpid()))
+    procent.entityd_sessionfinish()
+    find_entity = pytest.Mock(wraps=pm.hooks.entityd_find_entity)
+    monkeypatch.setattr(pm.hooks, 'entityd_find_entity', find_entity)
+    endpoint, = [e for e in endpoint_cycle.endpoints(os.getpid())
+                 if e.attrs.get('port').value == local_socket.getsockname()[1]]
+    assert process in endpoint.parents
+    assert not [c for c in find_entity.call_args_list
+                if c[1]['name'] == 'Process']
+
+
+def test_process_not_selected(endpoint_cycle, session, local_socket,
+                              monkeypatch):
+    procent = entityd.processme.ProcessEntity()
+    procent.entityd_sessionstart(session)
+    process = procent.get_ueid(syskit.Process(os.getpid()))
+    procent.entityd_sessionfinish()
+    monkeypatch.setattr(entityd.processme, 'is_selected',
+                        lambda session, pid: False)
+    endpoint, = [e for e in endpoint_cycle.endpoints(os.getpid())
+                 if e.attrs.get('port').value == local_socket.getsockname()[1]]
+    assert process not in endpoint.parents
+
+
+def test_process_ueid_matches_update(endpoint_cycle):
+    proc = syskit.Process(os.getpid())
+    update = entityd.EntityUpdate('Process')
+    update.attrs.set('pid', proc.pid, traits={'entity:id'})
+    update.attrs.set('starttime', proc.start_time.timestamp(),
+                     traits={'entity:id'})
+    update.attrs.set('host', str(endpoint_cycle.host_ueid),
+                     traits={'entity:id'})
+    assert endpoint_cycle.get_process_ueid(os.getpid()) == update.ueid
+
+
+def test_process_ueid_status_vanished(endpoint_cycle, session, monkeypatch):
+    # A process exiting between reading its stat and its status
+    procent = entityd.processme.ProcessEntity()
+    procent.entityd_sessionstart(session)
+    process = procent.get_ueid(syskit.Process(os.getpid()))
+    procent.entityd_sessionfinish()
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'credentials',
+                        lambda self, pid: None)
+    assert endpoint_cycle.get_process_ueid(os.getpid()) == process
+
+
+def test_process_ueid_cached(endpoint_cycle, local_socket, remote_socket,
+                             monkeypatch):
+    conn = local_socket.accept()[0]  # pylint: disable=unused-variable
+    list(endpoint_cycle.endpoints())
+    key = (os.getpid(), entityd.procfs.Snapshot().stat(os.getpid()).starttime)
+    assert endpoint_cycle.process_ueids[key]
+    remotes = {(socket.AF_INET, socket.SOCK_STREAM, sock.getsockname())
+               for sock in [local_socket, remote_socket]}
+    assert remotes <= set(endpoint_cycle.remote_ueids)
+    endpoint_cycle.process_ueids[key] = cobe.UEID('a' * 32)
+    list(endpoint_cycle.endpoints())
+    assert endpoint_cycle.process_ueids[key] == cobe.UEID('a' * 32)
+    monkeypatch.setattr(entityd.connections.Connections, 'retrieve',
+                        lambda self, kind, pid=None: [])
+    list(endpoint_cycle.endpoints())
+    list(endpoint_cycle.endpoints())
+    assert not endpoint_cycle.process_ueids
+    assert not endpoint_cycle.remote_ueids
+    assert not endpoint_cycle._previous_process_ueids  # pylint: disable=protected-access
+
+
 def test_get_ueid_new(endpoint_gen, conn):
     ueid = endpoint_gen.get_ueid(conn)
     assert ueid
@@ -255,3 +339,122 @@ def test_multiple_fds():
     s1.bind(('127.0.0.1', 12345))
     conns = entityd.connections.Connections().retrieve('all', os.getpid())
     assert len(conns) == count + 1
+
+
+def test_shared_socket_all_owners(tmpdir):
+    procdir = tmpdir.join('proc')
+    procdir.join('net', 'unix').write(
+        'Num       RefCount Protocol Flags    Type St Inode Path\n'
+        '0000000000000000: 00000003 00000000 00010000 0001 01 1234 /run/s\n',
+        ensure=True)
+    for pid in [42, 43]:
+        procdir.join(str(pid), 'stat').write(
+            '{} (cat) S 1 {} {} 0 -1 0 0 0 0 0 0 0 0 0 20 0 1 0 1000 0 0\n'
+            .format(pid, pid, pid), ensure=True)
+        procdir.join(str(pid), 'fd').ensure_dir()
+        os.symlink('socket:[1234]', str(procdir.join(str(pid), 'fd', '3')))
+    with entityd.connections.set_procpath(str(procdir)):
+        conns = entityd.connections.Connections().retrieve('unix')
+    assert sorted(conn.bound_pid for conn in conns) == [42, 43]
+
+
+def test_backend_fallback_kept(monkeypatch, session, endpoint_gen,
+                               local_socket):  # pylint: disable=unused-argument
+    session.config.args.endpoint_backend = 'netlink'
+    endpoint_gen.entityd_sessionstart(session)
+    assert endpoint_gen.backend == 'netlink'
+    monkeypatch.setattr(entityd.sockdiag, 'inet_sockets',
+                        pytest.Mock(side_effect=PermissionError))
+    list(endpoint_gen.endpoints(pid=os.getpid()))
+    assert endpoint_gen.backend == 'procfs'
+    list(endpoint_gen.endpoints(pid=os.getpid()))
+    assert entityd.sockdiag.inet_sockets.call_count == 1
+
+
+def test_port_range():
+    assert entityd.endpointme.port_range('1024-2048') == (1024, 2048)
+    for value in ['1024', '2048-1024', '0-10', 'a-b']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            entityd.endpointme.port_range(value)
+
+
+def test_ephemeral_ports(tmpdir):
+    assert (entityd.endpointme.ephemeral_ports(str(tmpdir)) ==
+            entityd.endpointme.EPHEMERAL_PORTS)
+    tmpdir.join('sys', 'net', 'ipv4', 'ip_local_port_range').write(
+        '40000\t50000\n', ensure=True)
+    assert entityd.endpointme.ephemeral_ports(str(tmpdir)) == (40000, 50000)
+
+
+def test_configure_aggregate(endpoint_gen, config):
+    config.args.endpoint_aggregate = True
+    endpoint_gen.entityd_configure(config)
+    assert endpoint_gen in (x.obj for x in config.entities['EndpointGroup'])
+
+
+@pytest.fixture
+def clients(request, local_socket):
+    """Three client connections to local_socket, accepted."""
+    socks = []
+    for _ in range(3):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(local_socket.getsockname())
+        socks.extend([client, local_socket.accept()[0]])
+    for sock in socks:
+        request.addfinalizer(sock.close)
+    return socks[::2]
+
+
+@pytest.fixture
+def endpoint_aggregate(session, endpoint_cycle):
+    """The endpoint plugin aggregating clients on any local port."""
+    session.config.args.endpoint_aggregate = True
+    session.config.args.endpoint_ephemeral_ports = (1, 65535)
+    endpoint_cycle.entityd_sessionstart(session)
+    return endpoint_cycle
+
+
+def test_aggregate(endpoint_aggregate, local_socket, clients):
+    server = local_socket.getsockname()
+    endpoints = list(endpoint_aggregate.endpoints(os.getpid()))
+    ports = [e.attrs.get('port').value for e in endpoints]
+    assert ports.count(server[1]) == 4
+    for client in clients:
+        assert client.getsockname()[1] not in ports
+    group, = [g for g in endpoint_aggregate.endpoint_groups()
+              if (g.attrs.get('addr').value,
+                  g.attrs.get('port').value) == server]
+    assert group.metype == 'EndpointGroup'
+    assert group.attrs.get('connections').value == 3
+    assert group.attrs.get('connections').traits == {'metric:gauge'}
+    assert group.attrs.get('protocol').value == 'TCP'
+    process_ueid = endpoint_aggregate.get_process_ueid(os.getpid())
+    assert group.attrs.get('process').value == str(process_ueid)
+    remote = endpoint_aggregate.remote_ueids[
+        (socket.AF_INET, socket.SOCK_STREAM, server)]
+    assert set(group.parents) == {process_ueid, remote}
+    assert set(group.children) == {remote}
+
+
+def test_aggregate_threshold(session, endpoint_aggregate, local_socket,
+                             clients):
+    session.config.args.endpoint_aggregate_threshold = 4
+    endpoint_aggregate.entityd_sessionstart(session)
+    server = local_socket.getsockname()
+    assert not [g for g in endpoint_aggregate.endpoint_groups()
+                if (g.attrs.get('addr').value,
+                    g.attrs.get('port').value) == server]
+    ports = {e.attrs.get('port').value
+             for e in endpoint_aggregate.endpoints(os.getpid())}
+    assert {c.getsockname()[1] for c in clients} <= ports
+
+
+def test_aggregate_retrieve_once(endpoint_aggregate, monkeypatch):
+    snapshot = entityd.procfs.Snapshot()
+    monkeypatch.setattr(entityd.procfs, 'snapshot',
+                        lambda session, procpath: snapshot)
+    retrieve = pytest.Mock(return_value=[])
+    monkeypatch.setattr(entityd.connections.Connections, 'retrieve', retrieve)
+    list(endpoint_aggregate.entityd_find_entity('EndpointGroup', None))
+    list(endpoint_aggregate.entityd_find_entity('Endpoint', None))
+    assert retrieve.call_count == 1
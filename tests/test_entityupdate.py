@@ -331,6 +331,94 @@ class TestMerge:
         merged = old.merge(new)
         assert set(getattr(merged, relations)) == {relation.ueid}
 
+    def test_merge_all(self):
+        updates = []
+        for index in range(3):
+            update = entityd.EntityUpdate('Foo')
+            update.label = index
+            update.attrs.set('spam', index)
+            update.attrs.set(str(index), index)
+            update.parents.add(cobe.UEID(str(index) * 32))
+            updates.append(update)
+        updates[1].attrs.delete('0')
+        merged = entityd.EntityUpdate.merge_all(updates)
+        assert merged not in updates
+        assert merged.label == 2
+        assert merged.attrs.get('spam').value == 2
+        assert {attr.name for attr in merged.attrs} == {'spam', '1', '2'}
+        assert merged.attrs.deleted() == {'0'}
+        assert set(merged.parents) == {
+            cobe.UEID('0' * 32), cobe.UEID('1' * 32), cobe.UEID('2' * 32)}
+        assert updates[0].attrs.get('spam').value == 0
+
+    def test_merge_all_pairwise(self):
+        updates = []
+        for index in range(4):
+            update = entityd.EntityUpdate('Foo')
+            update.attrs.set('spam', index)
+            if index % 2:
+                update.attrs.delete('eggs')
+            else:
+                update.attrs.set('eggs', index)
+            update.children.add(cobe.UEID(str(index) * 32))
+            updates.append(update)
+        pairwise = updates[0]
+        for update in updates[1:]:
+            pairwise = pairwise.merge(update)
+        merged = entityd.EntityUpdate.merge_all(updates)
+        assert list(merged.attrs) == list(pairwise.attrs)
+        assert merged.attrs.deleted() == pairwise.attrs.deleted()
+        assert set(merged.children) == set(pairwise.children)
+
+    def test_merge_all_ueid_mismatch(self):
+        with pytest.raises(ValueError):
+            entityd.EntityUpdate.merge_all([
+                entityd.EntityUpdate('Foo'),
+                entityd.EntityUpdate('Foo'),
+                entityd.EntityUpdate('Bar'),
+            ])
+
+    def test_merge_all_empty(self):
+        with pytest.raises(ValueError):
+            entityd.EntityUpdate.merge_all([])
+
+    def test_merge_all_explicit_ueid(self):
+        old = entityd.EntityUpdate('Foo', ueid='a' * 32)
+        new = entityd.EntityUpdate('Foo', ueid='a' * 32)
+        merged = entityd.EntityUpdate.merge_all([old, new])
+        assert merged.ueid == cobe.UEID('a' * 32)
+
+    def test_merge_into(self):
+        target = entityd.EntityUpdate('Foo')
+        target.label = 'target'
+        target.attrs.set('spam', 'eggs')
+        target.attrs.set('ham', 'eggs')
+        update = entityd.EntityUpdate('Foo')
+        update.label = 'update'
+        update.attrs.set('spam', 'chicken')
+        update.attrs.delete('ham')
+        update.parents.add(cobe.UEID('a' * 32))
+        assert update.merge_into(target) is target
+        assert target.label == 'update'
+        assert target.attrs.get('spam').value == 'chicken'
+        assert target.attrs.deleted() == {'ham'}
+        assert set(target.parents) == {cobe.UEID('a' * 32)}
+
+    def test_merge_into_ueid_mismatch(self):
+        with pytest.raises(ValueError):
+            entityd.EntityUpdate('Foo').merge_into(entityd.EntityUpdate('Bar'))
+
+    @relations
+    def test_merge_into_lazy_relations(self, relations):
+        target = entityd.EntityUpdate('Foo')
+        getattr(target, relations)._relations = (
+            cobe.UEID(char * 32) for char in 'ab')
+        update = entityd.EntityUpdate('Foo')
+        getattr(update, relations).add(cobe.UEID('c' * 32))
+        update.merge_into(target)
+        assert set(getattr(target, relations)) == {
+            cobe.UEID('a' * 32), cobe.UEID('b' * 32), cobe.UEID('c' * 32)}
+
 
 class TestUpdateRelations:
 
@@ -372,3 +460,68 @@ class TestUpdateRelations:
         relations = entityd.entityupdate.UpdateRelations()
         relations.add(entityd.EntityUpdate('Foo', 'a' * 32))
         assert 'a' * 32 not in relations
+
+
+class TestUEIDFactory:
+
+    def test_ueid(self):
+        update = entityd.EntityUpdate('Foo')
+        update.attrs.set('spam', 'eggs', traits={'entity:id'})
+        update.attrs.set('count', 10, traits={'entity:id', 'index'})
+        update.attrs.set('other', 'value')
+        factory = entityd.entityupdate.UEIDFactory('Foo', 'spam', 'count')
+        assert factory('eggs', 10) == update.ueid
+
+    def test_ueid_no_attributes(self):
+        factory = entityd.entityupdate.UEIDFactory('Type')
+        assert factory() == entityd.EntityUpdate('Type').ueid
+
+    def test_wrong_number_of_values(self):
+        factory = entityd.entityupdate.UEIDFactory('Foo', 'spam')
+        with pytest.raises(TypeError):
+            factory('eggs', 'ham')
+
+    def test_ueid_wrong_type(self):
+        factory = entityd.entityupdate.UEIDFactory('Foo', 'spam')
+        with pytest.raises(cobe.UEIDError):
+            factory(('eggs',))
+
+    def test_unhashable(self):
+        update = entityd.EntityUpdate('Foo')
+        update.attrs.set('spam', ['eggs'], traits={'entity:id'})
+        factory = entityd.entityupdate.UEIDFactory('Foo', 'spam')
+        assert factory(['eggs']) == update.ueid
+
+    def test_cached(self, monkeypatch):
+        factory = entityd.entityupdate.UEIDFactory('Foo', 'spam')
+        ueid = factory('eggs')
+        monkeypatch.setattr(factory, '_calculate', pytest.Mock())
+        assert factory('eggs') is ueid
+        assert not factory._calculate.called
+
+    def test_cache_bool_int(self):
+        factory = entityd.entityupdate.UEIDFactory('Foo', 'spam')
+        assert factory(1) != factory(True)
+
+    def test_cache_evict(self):
+        factory = entityd.entityupdate.UEIDFactory('Foo', 'spam', maxsize=2)
+        factory('a')
+        factory('b')
+        factory('a')
+        factory('c')
+        assert [key[0] for key in factory._cache] == ['a', 'c']
+
+    def test_clear(self):
+        factory = entityd.entityupdate.UEIDFactory('Foo', 'spam')
+        factory('eggs')
+        factory.clear()
+        assert not factory._cache
+
+    def test_shared(self):
+        factory = entityd.entityupdate.ueid_factory('Foo', 'spam', 'ham')
+        assert entityd.entityupdate.ueid_factory(
+            'Foo', 'spam', 'ham') is factory
+        assert entityd.entityupdate.ueid_factory(
+            'Foo', 'ham', 'spam') is not factory
+        assert entityd.entityupdate.ueid_factory(
+            'Bar', 'spam', 'ham') is not factory
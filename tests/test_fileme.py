@@ -1,8 +1,10 @@
+import os
 import re
 
 import pytest
 
 import entityd.fileme
+import entityd.inotify
 
 
 @pytest.fixture
@@ -51,3 +53,167 @@ def test_calling_with_non_existent_path(tmpdir, loghandler, session, fileent):
         next(entities)
     assert loghandler.has_debug(re.compile(r'Failed to create entity'))
     assert loghandler.has_debug(re.compile(str(file_)))
+
+
+@pytest.fixture
+def cached_fileent(request, session, fileent):
+    """A FileEntity with its cache started."""
+    fileent.entityd_sessionstart(session)
+    request.addfinalizer(fileent.entityd_sessionfinish)
+    return fileent
+
+
+@pytest.fixture
+def stat_calls(monkeypatch):
+    """Count the calls of os.stat by the fileme module."""
+    calls = pytest.Mock(wraps=os.stat)
+    monkeypatch.setattr(entityd.fileme.os, 'stat', calls)
+    return calls
+
+
+def find_files(fileent, paths):
+    return {entity.attrs.get('path').value: entity for entity in
+            fileent.entityd_find_entity('File', attrs={'path': paths})}
+
+
+def test_cached(tmpdir, cached_fileent, stat_calls):
+    file = tmpdir.join('cached.conf')
+    file.write('x')
+    first = find_files(cached_fileent, str(file))[str(file)]
+    second = find_files(cached_fileent, str(file))[str(file)]
+    assert stat_calls.call_count == 1
+    assert second is not first
+    assert second.attrs.get('size').value == 1
+
+
+def test_modified(tmpdir, cached_fileent):
+    file = tmpdir.join('modified.conf')
+    file.write('x')
+    find_files(cached_fileent, str(file))
+    file.write('xyz')
+    entity = find_files(cached_fileent, str(file))[str(file)]
+    assert entity.attrs.get('size').value == 3
+
+
+def test_replaced(tmpdir, cached_fileent):
+    file = tmpdir.join('replaced.conf')
+    file.write('x')
+    find_files(cached_fileent, str(file))
+    tmpdir.join('new.conf').write('xy')
+    tmpdir.join('new.conf').rename(file)
+    entity = find_files(cached_fileent, str(file))[str(file)]
+    assert entity.attrs.get('size').value == 2
+
+
+def test_deleted(tmpdir, cached_fileent):
+    file = tmpdir.join('deleted.conf')
+    file.write('x')
+    find_files(cached_fileent, str(file))
+    file.remove()
+    assert find_files(cached_fileent, str(file)) == {}
+    assert not cached_fileent._cache  # pylint: disable=protected-access
+    assert not cached_fileent._watches  # pylint: disable=protected-access
+
+
+def test_chmod(tmpdir, cached_fileent):
+    file = tmpdir.join('chmod.conf')
+    file.write('x')
+    file.chmod(0o600)
+    find_files(cached_fileent, str(file))
+    file.chmod(0o644)
+    entity = find_files(cached_fileent, str(file))[str(file)]
+    assert entity.attrs.get('permissions').value == '-rw-r--r--'
+
+
+def test_revalidated(tmpdir, cached_fileent, stat_calls):
+    cached_fileent.ttl = 0
+    file = tmpdir.join('revalidated.conf')
+    file.write('x')
+    find_files(cached_fileent, str(file))
+    find_files(cached_fileent, str(file))
+    assert stat_calls.call_count == 2
+    assert len(cached_fileent._watches) == 1  # pylint: disable=protected-access
+
+
+def test_batch(tmpdir, cached_fileent, stat_calls, loghandler):
+    paths = [str(tmpdir.join('{}.conf'.format(i))) for i in range(3)]
+    for path in paths:
+        with open(path, 'w') as fp:
+            fp.write('x')
+    missing = str(tmpdir.join('missing.conf'))
+    entities = list(cached_fileent.entityd_find_entity(
+        'File', attrs={'path': paths + [missing, str(tmpdir)]}))
+    assert [entity.attrs.get('path').value for entity in entities] == paths
+    assert stat_calls.call_count == 5
+    assert loghandler.has_debug(re.compile(missing))
+    find_files(cached_fileent, paths)
+    assert stat_calls.call_count == 5
+
+
+def test_same_file_two_paths(tmpdir, cached_fileent):
+    file = tmpdir.join('target.conf')
+    file.write('x')
+    link = tmpdir.join('link.conf')
+    link.mksymlinkto(file)
+    find_files(cached_fileent, [str(file), str(link)])
+    assert len(cached_fileent._watches) == 1  # pylint: disable=protected-access
+    file.write('xy')
+    files = find_files(cached_fileent, [str(file), str(link)])
+    assert files[str(link)].attrs.get('size').value == 2
+
+
+def test_max_watches(tmpdir, cached_fileent, stat_calls):
+    cached_fileent.max_watches = 2
+    paths = [str(tmpdir.join('{}.conf'.format(i))) for i in range(3)]
+    for path in paths:
+        with open(path, 'w') as fp:
+            fp.write('x')
+    find_files(cached_fileent, paths[:2])
+    find_files(cached_fileent, paths[0])
+    find_files(cached_fileent, paths[2])
+    assert list(cached_fileent._cache) == [paths[0], paths[2]]  # pylint: disable=protected-access
+    assert len(cached_fileent._watches) == 2  # pylint: disable=protected-access
+    find_files(cached_fileent, paths[0])
+    assert stat_calls.call_count == 3
+
+
+def test_queue_overflow(tmpdir, cached_fileent, stat_calls, monkeypatch):
+    file = tmpdir.join('overflow.conf')
+    file.write('x')
+    find_files(cached_fileent, str(file))
+    monkeypatch.setattr(
+        cached_fileent._inotify, 'read',  # pylint: disable=protected-access
+        lambda: [entityd.inotify.Event(-1, entityd.inotify.IN_Q_OVERFLOW,
+                                       0, b'')])
+    find_files(cached_fileent, str(file))
+    assert stat_calls.call_count == 2
+
+
+def test_inotify_unavailable(tmpdir, session, fileent, stat_calls,
+                             monkeypatch, loghandler):
+    monkeypatch.setattr(entityd.inotify, 'Inotify',
+                        pytest.Mock(side_effect=OSError('no inotify')))
+    fileent.entityd_sessionstart(session)
+    assert loghandler.has_warning()
+    file = tmpdir.join('uncached.conf')
+    file.write('x')
+    find_files(fileent, str(file))
+    find_files(fileent, str(file))
+    assert stat_calls.call_count == 2
+
+
+def test_cache_disabled(session, fileent):
+    session.config.args.file_max_watches = 0
+    fileent.entityd_sessionstart(session)
+    assert fileent._inotify is None  # pylint: disable=protected-access
+
+
+def test_sessionfinish(tmpdir, session, fileent):
+    fileent.entityd_sessionstart(session)
+    inotify = fileent._inotify  # pylint: disable=protected-access
+    file = tmpdir.join('finish.conf')
+    file.write('x')
+    find_files(fileent, str(file))
+    fileent.entityd_sessionfinish()
+    assert inotify.closed
+    assert not fileent._cache  # pylint: disable=protected-access
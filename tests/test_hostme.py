@@ -1,16 +1,18 @@
+import argparse
 import functools
 import platform
 import socket
+import threading
 import time
 
 import collections
 import pytest
 
-import act
 import syskit
 
 import entityd.hookspec
 import entityd.hostme
+import entityd.sampler
 
 
 @pytest.fixture(autouse=True)
@@ -26,6 +28,9 @@ def host_gen(monkeypatch):
                                           interval=0.1))
     host_gen = entityd.hostme.HostEntity()
     session = pytest.Mock()
+    session.config.args.host_facts_ttl = 300
+    session.config.args.host_sample_interval = 0
+    session.svc.sampler = entityd.sampler.SamplerService()
     host_gen.entityd_sessionstart(session)
     # Disable actual sqlite database persistence
     host_gen.session.svc.kvstore.get.side_effect = KeyError
@@ -57,6 +62,7 @@ def test_configure():
 
 def test_session_stored_on_start(request):
     session = pytest.Mock()
+    session.config.args.host_sample_interval = 0
     he = entityd.hostme.HostEntity()
     request.addfinalizer(he.entityd_sessionfinish)
     he.entityd_sessionstart(session)
@@ -159,6 +165,89 @@ def test_total(host):
     assert host.attrs.get('total').traits == {'metric:gauge', 'unit:bytes'}
 
 
+def test_host_ueid(host_gen):
+    host = next(host_gen.entityd_find_entity(name='Host', attrs=None))
+    assert host_gen.host_ueid == host.ueid
+    assert host_gen.entityd_host_ueid() == host.ueid
+
+
+def test_host_ueid_without_update(host_gen, monkeypatch):
+    monkeypatch.setattr(host_gen, 'hosts', pytest.Mock())
+    monkeypatch.setattr(socket, 'getfqdn', pytest.Mock())
+    assert host_gen.host_ueid
+    assert not host_gen.hosts.called
+    assert not socket.getfqdn.called
+
+
+def test_facts_cached(host_gen, monkeypatch):
+    facts = host_gen.facts
+    monkeypatch.setattr(entityd.hostme, 'host_facts', pytest.Mock())
+    assert host_gen.facts is facts
+    host = next(host_gen.entityd_find_entity(name='Host', attrs=None))
+    assert host.attrs.get('fqdn').value == facts.fqdn
+    assert not entityd.hostme.host_facts.called
+
+
+def test_facts_refreshed(host_gen, monkeypatch):
+    facts = host_gen.facts
+    new_facts = facts._replace(fqdn='new.example.com')
+    resolved = threading.Event()
+    def host_facts():
+        resolved.wait()
+        return new_facts
+    monkeypatch.setattr(entityd.hostme, 'host_facts', host_facts)
+    host_gen.facts_ttl = 0
+    assert host_gen.facts is facts
+    assert host_gen.facts is facts
+    resolved.set()
+    host_gen._facts_thread.join()
+    assert host_gen.facts is new_facts
+
+
+def test_facts_refresh_failed(host_gen, monkeypatch):
+    facts = host_gen.facts
+    monkeypatch.setattr(entityd.hostme, 'host_facts',
+                        pytest.Mock(side_effect=OSError))
+    host_gen._refresh_facts()
+    assert host_gen.facts is facts
+
+
+def test_sampling_disabled_by_default():
+    parser = argparse.ArgumentParser()
+    entityd.hostme.HostEntity().entityd_addoption(parser)
+    args = parser.parse_args([])
+    assert not args.host_sample_interval
+
+
+def test_sampler_task_interval(host_gen):
+    host_gen.entityd_sessionfinish()
+    host_gen.session.config.args.host_sample_interval = 0.01
+    host_gen.session.config.args.procpath = '/proc'
+    host_gen.entityd_sessionstart(host_gen.session)
+    assert host_gen.sampler_task is host_gen.sampler.task
+    host_gen.sampler_task.interval = 0.04
+    next(host_gen.entityd_find_entity(name='Host', attrs=None))
+    assert host_gen.sampler_task.interval >= 0.02
+
+
+def test_sampled(host_gen):
+    host_gen.entityd_sessionfinish()
+    host_gen.session.config.args.host_sample_interval = 0.01
+    host_gen.session.config.args.procpath = '/proc'
+    host_gen.entityd_sessionstart(host_gen.session)
+    host_gen.sampler.sample()
+    time.sleep(0.05)
+    host_gen.sampler.sample()
+    host = next(host_gen.entityd_find_entity(name='Host', attrs=None))
+    for stat in ['min', 'max', 'avg', 'p95']:
+        attr = host.attrs.get('sampled:cpu:' + stat)
+        assert 0 <= attr.value <= 100
+        assert attr.traits == {'metric:gauge', 'unit:percent'}
+        assert host.attrs.get('sampled:memory:used:' + stat).value > 0
+    assert host.attrs.get('sampled:overhead').traits == {'metric:gauge',
+                                                         'unit:percent'}
+
+
 def test_cpu_usage(host_gen):
     entities = list(host_gen.entityd_find_entity(name='Host', attrs=None))
     host = entities[0]
@@ -212,37 +301,21 @@ CpuTimes = collections.namedtuple('CpuTimes',
 class TestHostCpuUsage:
 
     @pytest.fixture
-    def context(self):
-        return act.zkit.new_context()
+    def cpuusage(self):
+        return entityd.hostme.HostCpuUsage(interval=0.1)
 
-    @pytest.fixture
-    def cpuusage(self, context):
-        return entityd.hostme.HostCpuUsage(context, interval=0.1)
-
-    def test_timer(self, monkeypatch, cpuusage):
-        """Test the timer is firing, and triggers an update."""
-        monkeypatch.setattr(cpuusage, '_update_times',
-                            pytest.Mock(side_effect=cpuusage.stop))
-        cpuusage.start()
-        cpuusage.join()
-        assert cpuusage._update_times.called
-
-    def test_exception_logged(self, monkeypatch, cpuusage):
-        monkeypatch.setattr(cpuusage, '_run',
-                            pytest.Mock(side_effect=ZeroDivisionError))
-        monkeypatch.setattr(cpuusage, '_log', pytest.Mock())
-        stop = lambda self: monkeypatch.setattr(cpuusage,
-                                                '_run', pytest.Mock())
-        cpuusage._log.exception.side_effect = stop
-        cpuusage.start()
-        cpuusage.join(timeout=2)
-        assert cpuusage._log.exception.called
+    def test_task(self, host_gen):
+        task = host_gen.cpuusage_task
+        assert task in host_gen.session.svc.sampler.tasks
+        assert task.func == host_gen.cpuusage.update
+        host_gen.entityd_sessionfinish()
+        assert not host_gen.session.svc.sampler.tasks
 
     def test_first_update(self, cpuusage):
         # On the first update, percentages not included
         assert not cpuusage.last_cpu_times
         assert not cpuusage.last_attributes
-        cpuusage._update_times()
+        cpuusage.update()
         assert cpuusage.last_cpu_times
         for name, _, traits in cpuusage.last_attributes:
             assert not name.startswith('cpu:')
@@ -253,8 +326,8 @@ class TestHostCpuUsage:
         times = syskit.cputimes()
         monkeypatch.setattr(syskit, 'cputimes',
                             pytest.Mock(return_value=times))
-        cpuusage._update_times()
-        cpuusage._update_times()
+        cpuusage.update()
+        cpuusage.update()
         for name, _, traits in cpuusage.last_attributes:
             assert not name.startswith('cpu:')
             assert 'unit:percent' not in traits
@@ -265,11 +338,11 @@ class TestHostCpuUsage:
         times = syskit.cputimes()
         monkeypatch.setattr(syskit, 'cputimes',
                             pytest.Mock(return_value=times))
-        cpuusage._update_times()
+        cpuusage.update()
         new_times = CpuTimes(*(val + 1 for val in times))
         monkeypatch.setattr(syskit, 'cputimes',
                             pytest.Mock(return_value=new_times))
-        cpuusage._update_times()
+        cpuusage.update()
         count = 0
         percentage = 100.0 / len(new_times)
         for name, value, traits in cpuusage.last_attributes:
@@ -284,12 +357,12 @@ class TestHostCpuUsage:
         times = syskit.cputimes()
         monkeypatch.setattr(syskit, 'cputimes',
                             pytest.Mock(return_value=times))
-        cpuusage._update_times()
+        cpuusage.update()
         new_times = CpuTimes(*(val + int(i == 0)
                                for i, val in enumerate(times)))
         monkeypatch.setattr(syskit, 'cputimes',
                             pytest.Mock(return_value=new_times))
-        cpuusage._update_times()
+        cpuusage.update()
         count = 0
         for name, value, _ in cpuusage.last_attributes:
             if name == 'cpu:usr':
@@ -0,0 +1,70 @@
+import pytest
+
+import entityd.inotify
+
+
+@pytest.fixture
+def inotify(request):
+    inotify = entityd.inotify.Inotify()
+    request.addfinalizer(inotify.close)
+    return inotify
+
+
+def test_no_events(inotify):
+    assert inotify.read() == []
+
+
+def test_modify(tmpdir, inotify):
+    file = tmpdir.join('file')
+    file.write('x')
+    wd = inotify.add_watch(str(file), entityd.inotify.IN_MODIFY)
+    file.write('y')
+    events = inotify.read()
+    assert events
+    assert all(event.wd == wd for event in events)
+    assert all(event.mask & entityd.inotify.IN_MODIFY for event in events)
+    assert inotify.read() == []
+
+
+def test_delete(tmpdir, inotify):
+    file = tmpdir.join('file')
+    file.write('x')
+    wd = inotify.add_watch(str(file), entityd.inotify.IN_DELETE_SELF)
+    file.remove()
+    masks = [event.mask for event in inotify.read()]
+    assert masks == [entityd.inotify.IN_DELETE_SELF,
+                     entityd.inotify.IN_IGNORED]
+    inotify.rm_watch(wd)
+
+
+def test_same_inode(tmpdir, inotify):
+    file = tmpdir.join('file')
+    file.write('x')
+    link = tmpdir.join('link')
+    link.mksymlinkto(file)
+    assert (inotify.add_watch(str(file), entityd.inotify.IN_MODIFY) ==
+            inotify.add_watch(str(link), entityd.inotify.IN_MODIFY))
+
+
+def test_missing(tmpdir, inotify):
+    with pytest.raises(FileNotFoundError):
+        inotify.add_watch(str(tmpdir.join('missing')),
+                          entityd.inotify.IN_MODIFY)
+
+
+def test_rm_watch(tmpdir, inotify):
+    file = tmpdir.join('file')
+    file.write('x')
+    wd = inotify.add_watch(str(file), entityd.inotify.IN_MODIFY)
+    inotify.rm_watch(wd)
+    assert [event.mask for event in inotify.read()] == [
+        entityd.inotify.IN_IGNORED]
+    file.write('y')
+    assert inotify.read() == []
+
+
+def test_close(inotify):
+    assert not inotify.closed
+    inotify.close()
+    assert inotify.closed
+    inotify.close()
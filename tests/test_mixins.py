@@ -1,5 +1,7 @@
+import cobe
 import pytest
 
+import entityd.mixins
 from entityd.mixins import HostEntity
 
 
@@ -21,6 +23,29 @@ def test_host_ueid(session, host_entity):
     assert host_entity.host_ueid
 
 
+def test_host_ueid_no_find_entity(session, host_entity, host_entity_plugin,
+                                  monkeypatch):
+    monkeypatch.setattr(host_entity_plugin, 'hosts', pytest.Mock())
+    host_entity.entityd_sessionstart(session)
+    assert host_entity.host_ueid == host_entity_plugin.host_ueid
+    assert not host_entity_plugin.hosts.called
+
+
+def test_find_host_ueid_fallback(pm, session):
+    class Host:
+        @staticmethod
+        @entityd.pm.hookimpl
+        def entityd_find_entity(name, attrs):  # pylint: disable=unused-argument
+            yield entityd.EntityUpdate('Host', ueid='a' * 32)
+    pm.register(Host(), 'Host')
+    assert entityd.mixins.find_host_ueid(session) == cobe.UEID('a' * 32)
+
+
+def test_find_host_ueid_not_found(session):
+    with pytest.raises(LookupError):
+        entityd.mixins.find_host_ueid(session)
+
+
 @pytest.mark.non_container
 def test_hostname(session, host_entity):
     host_entity.entityd_sessionstart(session)
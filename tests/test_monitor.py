@@ -166,3 +166,9 @@ def test_merge_updates(monkeypatch, monitor):
     assert merged_2.ueid == update_2.ueid
     assert merged_3.ueid == update_5.ueid
     assert merged_1.attrs.get('spam').value == 4
+
+
+def test_merge_updates_unmerged(monitor):
+    update_1 = entityd.EntityUpdate('Foo')
+    update_2 = entityd.EntityUpdate('Bar')
+    assert monitor._merge_updates([update_1, update_2]) == [update_1, update_2]
@@ -1,16 +1,23 @@
+import hashlib
 import os
+import socket
+import struct
 import tempfile
+import threading
 
 import pytest
 
 import entityd.fileme
 import entityd.hostme
+import entityd.mysqlclient
 import entityd.mysqlme
 import entityd.processme
 
 
 @pytest.fixture
-def procent(request, pm, session, host_entity_plugin, monkeypatch):  # pylint: disable=unused-argument
+def procent(request, pm, session, host_entity_plugin, monkeypatch,  # pylint: disable=unused-argument
+            discovered):
+    discovered['MySQL'] = [123]
     procent = entityd.processme.ProcessEntity()
     proc = entityd.EntityUpdate('Process')
     proc.attrs.set('pid', 123)
@@ -70,6 +77,20 @@ def test_mysql_process_but_no_files_with_log(monkeypatch,
     assert mock_mysql._log_flag is True
 
 
+def test_mysql_process_but_no_files_closes_vanished(monkeypatch, mock_mysql):
+    def config_path_mock(self):  # pylint: disable=unused-argument
+        raise entityd.mysqlme.MySQLNotFoundError()
+    monkeypatch.setattr(entityd.mysqlme.MySQL,
+                        'config_path', config_path_mock)
+    connection = pytest.Mock()
+    mock_mysql._connections['/gone/my.cnf'] = connection
+    entities = mock_mysql.entityd_find_entity(
+        name='MySQL', attrs=None, include_ondemand=False)
+    assert list(entities) == []
+    assert not mock_mysql._connections
+    assert connection.close.called
+
+
 def test_mysql_process_but_no_files_no_log(monkeypatch,
                                            mock_mysql, loghandler):
     def config_path_mock(self):  # pylint: disable=unused-argument
@@ -85,7 +106,7 @@ def test_mysql_process_but_no_files_no_log(monkeypatch,
     assert mock_mysql._log_flag is True
 
 
-def test_multiple_processes(monkeypatch, procent, mock_mysql):
+def test_multiple_processes(monkeypatch, procent, discovered, mock_mysql):
     p1 = entityd.EntityUpdate('Process')
     p1.attrs.set('pid', 123)
     p1.attrs.set('ppid', 0)
@@ -103,6 +124,7 @@ def test_multiple_processes(monkeypatch, procent, mock_mysql):
     p3.attrs.set('command', 'mysqld')
     monkeypatch.setattr(
         procent, 'filtered_processes', pytest.Mock(return_value=[p1, p2, p3]))
+    discovered['MySQL'] = [123, 789]
     entities = mock_mysql.entityd_find_entity(
         name='MySQL', attrs=None, include_ondemand=False)
     pids = sorted(e.attrs.get('process_id').value for e in entities)
@@ -181,3 +203,347 @@ def test_config_pathoverride(command, path):
     proc.attrs.set('command', command)
     mysql = entityd.mysqlme.MySQL(proc)
     assert mysql.config_path() == path
+
+
+def lenenc(value):
+    if value is None:
+        return b'\xfb'
+    value = str(value).encode()
+    return bytes([len(value)]) + value
+
+
+class MySQLStub:
+    """A stand-in MySQL server listening on a Unix socket.
+
+    It authenticates clients with mysql_native_password, serving one
+    client at a time.  Queries in ``results`` are answered with their
+    tuple of column names and rows, queries in ``hang`` are never
+    answered and any other query fails.
+    """
+
+    SALT = b'abcdefghijklmnopqrst'
+
+    def __init__(self, path, user='monitor', password='secret'):
+        self.path = path
+        self.user = user
+        self.stored = hashlib.sha1(hashlib.sha1(password.encode())
+                                   .digest()).digest()
+        self.results = {}
+        self.hang = set()
+        self.queries = []
+        self.connections = 0
+        self._stopping = False
+        self._listener = socket.socket(socket.AF_UNIX)
+        self._listener.bind(path)
+        self._listener.listen(1)
+        self._listener.settimeout(0.05)
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._thread.join()
+        self._listener.close()
+
+    def _serve(self):
+        while not self._stopping:
+            try:
+                conn, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(0.05)
+            self.connections += 1
+            try:
+                self._session(conn)
+            except (ConnectionError, StopIteration):
+                pass
+            finally:
+                conn.close()
+
+    def _recv(self, conn):
+        header = b''
+        while len(header) < 4:
+            try:
+                chunk = conn.recv(4 - len(header))
+            except socket.timeout:
+                if self._stopping:
+                    raise StopIteration
+                continue
+            if not chunk:
+                raise ConnectionError
+            header += chunk
+        length = int.from_bytes(header[:3], 'little')
+        return header[3], conn.recv(length)
+
+    @staticmethod
+    def _send(conn, seq, payload):
+        conn.sendall(struct.pack('<I', len(payload))[:3] + bytes([seq]) +
+                     payload)
+
+    def _session(self, conn):
+        caps = 0x000fffff
+        self._send(conn, 0, b'\x0a5.7.0-stub\0' + struct.pack('<I', 1) +
+                   self.SALT[:8] + b'\0' + struct.pack('<H', caps & 0xffff) +
+                   bytes([33]) + struct.pack('<HH', 2, caps >> 16) +
+                   bytes([21]) + b'\0' * 10 + self.SALT[8:] + b'\0' +
+                   b'mysql_native_password\0')
+        _, response = self._recv(conn)
+        end = response.index(b'\0', 32)
+        user = response[32:end].decode()
+        token = response[end + 2:end + 2 + response[end + 1]]
+        stage1 = bytes(a ^ b for a, b in zip(
+            token, hashlib.sha1(self.SALT + self.stored).digest()))
+        if user != self.user or hashlib.sha1(stage1).digest() != self.stored:
+            self._send(conn, 2, b'\xff' + struct.pack('<H', 1045) +
+                       b'#28000Access denied')
+            return
+        self._send(conn, 2, b'\x00\x00\x00\x02\x00\x00\x00')
+        while True:
+            _, packet = self._recv(conn)
+            if packet[0] == 0x01:
+                return
+            query = packet[1:].decode()
+            self.queries.append(query)
+            if query in self.hang:
+                continue
+            if query not in self.results:
+                self._send(conn, 1, b'\xff' + struct.pack('<H', 1064) +
+                           b'#42000You have an error in your SQL syntax')
+                continue
+            columns, rows = self.results[query]
+            packets = [bytes([len(columns)])]
+            for name in columns:
+                packets.append(b''.join(lenenc(field) for field in [
+                    'def', '', '', '', name, name]) + b'\x0c' + b'\0' * 12)
+            packets.append(b'\xfe\x00\x00\x02\x00')
+            for row in rows:
+                packets.append(b''.join(lenenc(value) for value in row))
+            packets.append(b'\xfe\x00\x00\x02\x00')
+            for seq, payload in enumerate(packets, 1):
+                self._send(conn, seq, payload)
+
+
+@pytest.fixture
+def mysql_stub(request):
+    """A stand-in MySQL server, answering SHOW GLOBAL STATUS."""
+    path = os.path.join(tempfile.mkdtemp(), 'mysqld.sock')
+    stub = MySQLStub(path)
+    stub.results['SHOW GLOBAL STATUS'] = (['Variable_name', 'Value'], [
+        ('Uptime', '3600'),
+        ('Questions', '1234'),
+        ('Bytes_sent', '4096'),
+        ('Threads_connected', '3'),
+        ('Ssl_cipher', ''),
+        ('Not_reported', '7'),
+    ])
+    stub.results['SHOW SLAVE STATUS'] = (['Seconds_Behind_Master'], [])
+
+    def stop():
+        stub.stop()
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+    request.addfinalizer(stop)
+    return stub
+
+
+@pytest.fixture
+def connection(request, mysql_stub):
+    connection = entityd.mysqlclient.Connection(
+        unix_socket=mysql_stub.path, user='monitor', password='secret',
+        timeout=0.5)
+    request.addfinalizer(connection.close)
+    return connection
+
+
+@pytest.fixture
+def mysql_instance(tmpdir, mysql_stub):
+    """A MySQL instance whose config file points at the stand-in."""
+    conf = tmpdir.join('my.cnf')
+    conf.write('[mysqld]\n'
+               'socket = {}\n'
+               '[client]\n'
+               'user = monitor\n'
+               'password = "secret"\n'.format(mysql_stub.path))
+    proc = entityd.EntityUpdate('Process')
+    proc.attrs.set('pid', 123)
+    proc.attrs.set('command', 'mysqld --defaults-file={}'.format(conf))
+    return entityd.mysqlme.MySQL(proc)
+
+
+@pytest.fixture
+def mysqlent(request):
+    mysqlent = entityd.mysqlme.MySQLEntity()
+    mysqlent.metrics = True
+    request.addfinalizer(mysqlent.entityd_sessionfinish)
+    return mysqlent
+
+
+def test_query(connection):
+    assert connection.server_version == '5.7.0-stub'
+    rows = connection.query('SHOW GLOBAL STATUS')
+    assert rows[0] == {'Variable_name': 'Uptime', 'Value': '3600'}
+    assert len(rows) == 6
+
+
+def test_query_null(connection, mysql_stub):
+    mysql_stub.results['SHOW SLAVE STATUS'] = (
+        ['Seconds_Behind_Master'], [(None,)])
+    assert connection.query('SHOW SLAVE STATUS') == [
+        {'Seconds_Behind_Master': None}]
+
+
+def test_query_error(connection):
+    with pytest.raises(entityd.mysqlclient.MySQLError) as err:
+        connection.query('SELECT nonsense')
+    assert err.value.code == 1064
+    assert 'syntax' in str(err.value)
+    assert connection.query('SHOW GLOBAL STATUS')
+
+
+def test_query_timeout(connection, mysql_stub):
+    mysql_stub.hang.add('SELECT SLEEP(10)')
+    with pytest.raises(OSError):
+        connection.query('SELECT SLEEP(10)', timeout=0.1)
+    assert connection.closed
+    with pytest.raises(entityd.mysqlclient.MySQLError):
+        connection.query('SHOW GLOBAL STATUS')
+
+
+def test_access_denied(mysql_stub):
+    with pytest.raises(entityd.mysqlclient.MySQLError) as err:
+        entityd.mysqlclient.Connection(unix_socket=mysql_stub.path,
+                                       user='monitor', password='wrong')
+    assert err.value.code == 1045
+
+
+def test_lenenc_int():
+    assert entityd.mysqlclient.lenenc_int(b'\xfa', 0) == (250, 1)
+    assert entityd.mysqlclient.lenenc_int(b'\xfc\x00\x01', 0) == (256, 3)
+    assert entityd.mysqlclient.lenenc_int(b'\xfd\x00\x00\x01', 0) == (
+        1 << 16, 4)
+    assert entityd.mysqlclient.lenenc_int(
+        b'\xfe' + struct.pack('<Q', 1 << 40), 0) == (1 << 40, 9)
+
+
+def test_read_options(tmpdir):
+    tmpdir.join('conf.d', 'client.cnf').write(
+        '[client]\npassword = \'secret\'\n', ensure=True)
+    tmpdir.join('conf.d', 'README').write('[client]\nuser = nobody\n')
+    tmpdir.join('extra.cnf').write('[mysqld]\nport=3307\n')
+    conf = tmpdir.join('my.cnf')
+    conf.write('# comment\n'
+               '!includedir {}\n'
+               '!include {}\n'
+               '!include /does/not/exist.cnf\n'
+               '[client]\n'
+               'user = monitor\n'
+               '[mysqld]\n'
+               'skip_name_resolve\n'.format(tmpdir.join('conf.d'),
+                                             tmpdir.join('extra.cnf')))
+    options = entityd.mysqlme.read_options(str(conf))
+    assert options['client'] == {'user': 'monitor', 'password': 'secret'}
+    assert options['mysqld'] == {'port': '3307', 'skip-name-resolve': ''}
+
+
+def test_connection_options(mysql_instance, mysql_stub):
+    assert mysql_instance.connection_options() == {
+        'unix_socket': mysql_stub.path, 'host': '127.0.0.1', 'port': 3306,
+        'user': 'monitor', 'password': 'secret'}
+
+
+def test_connection_options_command(tmpdir):
+    conf = tmpdir.join('my.cnf')
+    conf.write('[mysqld]\nsocket = /ignored.sock\n')
+    proc = entityd.EntityUpdate('Process')
+    proc.attrs.set('command', 'mysqld --defaults-file={} --socket= '
+                              '--port=3310'.format(conf))
+    options = entityd.mysqlme.MySQL(proc).connection_options()
+    assert options['unix_socket'] == '/ignored.sock'
+    assert options['port'] == 3310
+    conf.write('[mysqld]\n')
+    options = entityd.mysqlme.MySQL(proc).connection_options()
+    assert options['unix_socket'] is None
+
+
+def test_connection_options_datadir_short(tmpdir):
+    # -h is the short form of --datadir, not a request for help
+    conf = tmpdir.join('my.cnf')
+    conf.write('[mysqld]\n')
+    proc = entityd.EntityUpdate('Process')
+    proc.attrs.set('command', 'mysqld -h /var/lib/mysql --defaults-file={} '
+                              '--port=3310'.format(conf))
+    mysql = entityd.mysqlme.MySQL(proc)
+    assert mysql.config_path() == str(conf)
+    assert mysql.connection_options()['port'] == 3310
+
+
+def test_connection_options_no_socket(tmpdir, monkeypatch):
+    monkeypatch.setattr(os.path, 'exists', pytest.Mock(return_value=True))
+    conf = tmpdir.join('my.cnf')
+    conf.write('[mysqld]\nport = 3307\n')
+    proc = entityd.EntityUpdate('Process')
+    proc.attrs.set('command', 'mysqld --defaults-file={}'.format(conf))
+    options = entityd.mysqlme.MySQL(proc).connection_options()
+    assert options['unix_socket'] is None
+    assert options['port'] == 3307
+
+
+def test_performance_data(mysqlent, mysql_instance, mysql_stub):
+    perfdata = mysqlent.performance_data(mysql_instance)
+    assert perfdata == {
+        'Uptime': (3600, {'metric:counter', 'time:duration',
+                          'unit:seconds'}),
+        'Questions': (1234, {'metric:counter'}),
+        'Bytes_sent': (4096, {'metric:counter', 'unit:bytes'}),
+        'Threads_connected': (3, {'metric:gauge'}),
+    }
+    assert mysqlent.performance_data(mysql_instance) == perfdata
+    assert mysql_stub.connections == 1
+
+
+def test_performance_data_replication_lag(mysqlent, mysql_instance,
+                                          mysql_stub):
+    mysql_stub.results['SHOW SLAVE STATUS'] = (
+        ['Slave_IO_State', 'Seconds_Behind_Master'], [('Waiting', '42')])
+    perfdata = mysqlent.performance_data(mysql_instance)
+    assert perfdata['replication:lag'] == (
+        42, {'metric:gauge', 'time:duration', 'unit:seconds'})
+
+
+def test_performance_data_no_replication_privilege(mysqlent, mysql_instance,
+                                                   mysql_stub):
+    del mysql_stub.results['SHOW SLAVE STATUS']
+    perfdata = mysqlent.performance_data(mysql_instance)
+    assert 'Questions' in perfdata
+    assert 'replication:lag' not in perfdata
+
+
+def test_performance_data_timeout(mysqlent, mysql_instance, mysql_stub,
+                                  loghandler):
+    mysqlent.query_timeout = 0.1
+    mysql_stub.hang.add('SHOW GLOBAL STATUS')
+    assert mysqlent.performance_data(mysql_instance) == {}
+    assert loghandler.has_warning()
+    mysql_stub.hang.clear()
+    assert mysqlent.performance_data(mysql_instance)
+    assert mysql_stub.connections == 2
+
+
+def test_performance_data_unreachable(mysqlent, mysql_instance, mysql_stub,
+                                      loghandler):
+    mysql_stub.stop()
+    assert mysqlent.performance_data(mysql_instance) == {}
+    assert loghandler.has_warning()
+    mysql_stub.stop = lambda: None
+
+
+def test_get_entities_with_metrics(mock_mysql, mysql_instance, monkeypatch):
+    monkeypatch.setattr(entityd.mysqlme.MySQL, 'connection_options',
+                        mysql_instance.connection_options)
+    mock_mysql.metrics = True
+    entity = next(mock_mysql.entityd_find_entity(
+        name='MySQL', attrs=None, include_ondemand=False))
+    assert entity.attrs.get('Questions').value == 1234
+    assert entity.attrs.get('Questions').traits == {'metric:counter'}
+    mock_mysql.entityd_sessionfinish()
+    assert not mock_mysql._connections
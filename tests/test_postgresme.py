@@ -1,15 +1,25 @@
+import base64
+import hashlib
+import hmac
+import os
+import socket
+import struct
 import tempfile
+import threading
 
 import pytest
 
 import entityd.fileme
 import entityd.hostme
+import entityd.pgclient
 import entityd.postgresme
 import entityd.processme
 
 
 @pytest.fixture
-def procent(request, pm, session, host_entity_plugin, monkeypatch):  # pylint: disable=unused-argument
+def procent(request, pm, session, host_entity_plugin, monkeypatch,  # pylint: disable=unused-argument
+            discovered):
+    discovered['PostgreSQL'] = [123]
     procent = entityd.processme.ProcessEntity()
     proc = entityd.EntityUpdate('Process')
     proc.attrs.set('pid', 123)
@@ -78,6 +88,21 @@ def test_postgresql_process_but_no_files_with_log(monkeypatch,
     assert mock_postgres._log_flag is True
 
 
+def test_postgresql_process_but_no_files_closes_vanished(monkeypatch,
+                                                        mock_postgres):
+    def config_path_mock(self):  # pylint: disable=unused-argument
+        raise entityd.postgresme.PostgreSQLNotFoundError()
+    monkeypatch.setattr(entityd.postgresme.PostgreSQL,
+                        'config_path', config_path_mock)
+    vanished = pytest.Mock()
+    mock_postgres._instances[(456, 789)] = vanished
+    entities = mock_postgres.entityd_find_entity(
+        name='PostgreSQL', attrs=None, include_ondemand=False)
+    assert list(entities) == []
+    assert (456, 789) not in mock_postgres._instances
+    assert vanished.close.called
+
+
 def test_postgresql_process_but_no_files_no_log(monkeypatch,
                                                 mock_postgres, loghandler):
     # This covers situation of entityd running in container
@@ -94,7 +119,7 @@ def test_postgresql_process_but_no_files_no_log(monkeypatch,
     assert mock_postgres._log_flag is True
 
 
-def test_multiple_processes(monkeypatch, procent, mock_postgres):
+def test_multiple_processes(monkeypatch, procent, discovered, mock_postgres):
     p1 = entityd.EntityUpdate('Process')
     p1.attrs.set('pid', 123)
     p1.attrs.set('ppid', 0)
@@ -112,6 +137,7 @@ def test_multiple_processes(monkeypatch, procent, mock_postgres):
     p3.attrs.set('command', 'postgres')
     monkeypatch.setattr(
         procent, 'filtered_processes', pytest.Mock(return_value=[p1, p2, p3]))
+    discovered['PostgreSQL'] = [123, 789]
     entities = mock_postgres.entityd_find_entity(
         name='PostgreSQL', attrs=None, include_ondemand=False)
     pids = sorted(e.attrs.get('process_id').value for e in entities)
@@ -202,3 +228,402 @@ def test_config_pathoverride(command, path):
     proc.attrs.set('command', command)
     postgres = entityd.postgresme.PostgreSQL(proc)
     assert postgres.config_path() == path
+
+
+class PostgreSQLStub:
+    """A stand-in PostgreSQL server listening on a Unix socket.
+
+    It authenticates clients with the ``auth`` method, one of
+    ``trust``, ``md5`` or ``scram``, serving one client at a time.
+    Queries in ``results`` are answered with their tuple of column
+    names and rows, queries in ``hang`` are never answered and any other
+    query fails.
+    """
+
+    SALT = b'salt'
+    SCRAM_SALT = b'scram-salt'
+
+    def __init__(self, directory, user='monitor', password='secret',
+                 auth='md5'):
+        self.path = os.path.join(directory, '.s.PGSQL.5432')
+        self.user = user
+        self.password = password
+        self.auth = auth
+        self.results = {}
+        self.hang = set()
+        self.queries = []
+        self.startups = []
+        self.connections = 0
+        self._stopping = False
+        self._listener = socket.socket(socket.AF_UNIX)
+        self._listener.bind(self.path)
+        self._listener.listen(1)
+        self._listener.settimeout(0.05)
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._thread.join()
+        self._listener.close()
+
+    def _serve(self):
+        while not self._stopping:
+            try:
+                conn, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(0.05)
+            self.connections += 1
+            try:
+                self._session(conn)
+            except (ConnectionError, StopIteration):
+                pass
+            finally:
+                conn.close()
+
+    def _read(self, conn, size):
+        data = b''
+        while len(data) < size:
+            try:
+                chunk = conn.recv(size - len(data))
+            except socket.timeout:
+                if self._stopping:
+                    raise StopIteration
+                continue
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def _recv(self, conn):
+        kind = self._read(conn, 1)
+        length, = struct.unpack('!I', self._read(conn, 4))
+        return kind, self._read(conn, length - 4)
+
+    @staticmethod
+    def _send(conn, kind, payload):
+        conn.sendall(kind + struct.pack('!I', len(payload) + 4) + payload)
+
+    def _error(self, conn, code, message):
+        self._send(conn, b'E', b'SERROR\0C' + code + b'\0M' +
+                   message + b'\0\0')
+
+    def _session(self, conn):
+        length, = struct.unpack('!I', self._read(conn, 4))
+        startup = self._read(conn, length - 4)[4:].split(b'\0')
+        params = {name.decode(): value.decode()
+                  for name, value in zip(startup[::2], startup[1::2])
+                  if name}
+        self.startups.append(params)
+        if not getattr(self, '_auth_' + self.auth)(conn, params['user']):
+            self._error(conn, b'28P01', b'password authentication failed')
+            return
+        self._send(conn, b'R', struct.pack('!I', 0))
+        self._send(conn, b'S', b'server_version\0' + b'10.0-stub\0')
+        self._send(conn, b'Z', b'I')
+        while True:
+            kind, payload = self._recv(conn)
+            if kind == b'X':
+                return
+            query = payload.rstrip(b'\0').decode()
+            self.queries.append(query)
+            if query in self.hang:
+                continue
+            if query not in self.results:
+                self._error(conn, b'42601', b'syntax error')
+                self._send(conn, b'Z', b'I')
+                continue
+            columns, rows = self.results[query]
+            self._send(conn, b'T', struct.pack('!H', len(columns)) + b''.join(
+                name.encode() + b'\0' + b'\0' * 18 for name in columns))
+            for row in rows:
+                values = b''
+                for value in row:
+                    if value is None:
+                        values += struct.pack('!i', -1)
+                    else:
+                        values += struct.pack('!i', len(value)) + \
+                            value.encode()
+                self._send(conn, b'D', struct.pack('!H', len(row)) + values)
+            self._send(conn, b'C', b'SELECT\0')
+            self._send(conn, b'Z', b'I')
+
+    def _auth_trust(self, conn, user):  # pylint: disable=unused-argument
+        return user == self.user
+
+    def _auth_md5(self, conn, user):
+        self._send(conn, b'R', struct.pack('!I', 5) + self.SALT)
+        _, payload = self._recv(conn)
+        inner = hashlib.md5((self.password + self.user).encode()).hexdigest()
+        expected = 'md5' + hashlib.md5(inner.encode() +
+                                       self.SALT).hexdigest()
+        return user == self.user and payload == expected.encode() + b'\0'
+
+    def _auth_scram(self, conn, user):
+        self._send(conn, b'R', struct.pack('!I', 10) +
+                   b'SCRAM-SHA-256\0\0')
+        _, payload = self._recv(conn)
+        mechanism, _, rest = payload.partition(b'\0')
+        assert mechanism == b'SCRAM-SHA-256'
+        client_first = rest[4:].decode()
+        client_first_bare = client_first.split(',', 2)[2]
+        nonce = client_first_bare.split('r=', 1)[1] + 'server'
+        server_first = 'r={},s={},i=4096'.format(
+            nonce, base64.b64encode(self.SCRAM_SALT).decode())
+        self._send(conn, b'R', struct.pack('!I', 11) + server_first.encode())
+        _, payload = self._recv(conn)
+        without_proof, _, proof = payload.decode().rpartition(',p=')
+        message = ','.join([client_first_bare, server_first,
+                            without_proof]).encode()
+        salted = hashlib.pbkdf2_hmac('sha256', self.password.encode(),
+                                     self.SCRAM_SALT, 4096)
+        stored_key = hashlib.sha256(hmac.new(salted, b'Client Key',
+                                             'sha256').digest()).digest()
+        signature = hmac.new(stored_key, message, 'sha256').digest()
+        client_key = bytes(a ^ b for a, b in zip(base64.b64decode(proof),
+                                                 signature))
+        if hashlib.sha256(client_key).digest() != stored_key:
+            return False
+        server_key = hmac.new(salted, b'Server Key', 'sha256').digest()
+        server_final = 'v=' + base64.b64encode(
+            hmac.new(server_key, message, 'sha256').digest()).decode()
+        self._send(conn, b'R', struct.pack('!I', 12) + server_final.encode())
+        return user == self.user
+
+
+@pytest.fixture
+def postgres_stub(request):
+    """A stand-in PostgreSQL server, answering the statistics queries."""
+    directory = tempfile.mkdtemp()
+    stub = PostgreSQLStub(directory)
+    columns = sorted(entityd.postgresme.DATABASE_COLUMNS)
+    stub.results[entityd.postgresme.DATABASE_QUERY] = (
+        columns, [[str(number) for number, _ in enumerate(columns, 1)]])
+    stub.results[entityd.postgresme.ACTIVITY_QUERY] = (['state', 'count'], [
+        ('active', '2'), ('idle in transaction', '1'), (None, '5')])
+    stub.results[entityd.postgresme.BGWRITER_QUERY] = (
+        ['checkpoints_timed', 'buffers_alloc', 'stats_reset'],
+        [('10', '20', '2018-01-01 00:00:00+00')])
+
+    def stop():
+        stub.stop()
+        os.unlink(stub.path)
+        os.rmdir(directory)
+    request.addfinalizer(stop)
+    return stub
+
+
+@pytest.fixture
+def connection(request, postgres_stub):
+    connection = entityd.pgclient.Connection(
+        unix_socket=postgres_stub.path, user='monitor', password='secret',
+        timeout=0.5)
+    request.addfinalizer(connection.close)
+    return connection
+
+
+@pytest.fixture
+def postgres_instance(tmpdir, monkeypatch, postgres_stub):
+    """A PostgreSQL instance whose config file points at the stand-in."""
+    conf = tmpdir.join('postgresql.conf')
+    conf.write("# comment\n"
+               "port = 5432\t\t# (change requires restart)\n"
+               "unix_socket_directories = '{}'\n".format(
+                   os.path.dirname(postgres_stub.path)))
+    pgpass = tmpdir.join('pgpass')
+    pgpass.write('localhost:5432:postgres:monitor:secret\n')
+    monkeypatch.setenv('PGPASSFILE', str(pgpass))
+    proc = entityd.EntityUpdate('Process')
+    proc.attrs.set('pid', 123)
+    proc.attrs.set('command', 'postgres -c config_file={}'.format(conf))
+    return entityd.postgresme.PostgreSQL(proc)
+
+
+@pytest.fixture
+def postgresent(request):
+    postgresent = entityd.postgresme.PostgreSQLEntity()
+    postgresent.metrics = True
+    postgresent.user = 'monitor'
+    request.addfinalizer(postgresent.entityd_sessionfinish)
+    return postgresent
+
+
+def test_query(connection):
+    assert connection.server_parameters['server_version'] == '10.0-stub'
+    rows = connection.query(entityd.postgresme.ACTIVITY_QUERY)
+    assert rows == [{'state': 'active', 'count': '2'},
+                    {'state': 'idle in transaction', 'count': '1'},
+                    {'state': None, 'count': '5'}]
+
+
+def test_query_error(connection):
+    with pytest.raises(entityd.pgclient.PostgreSQLError) as err:
+        connection.query('SELECT nonsense')
+    assert err.value.code == '42601'
+    assert 'syntax' in str(err.value)
+    assert connection.query(entityd.postgresme.BGWRITER_QUERY)
+
+
+def test_query_timeout(connection, postgres_stub):
+    postgres_stub.hang.add('SELECT pg_sleep(10)')
+    with pytest.raises(OSError):
+        connection.query('SELECT pg_sleep(10)', timeout=0.1)
+    assert connection.closed
+    with pytest.raises(entityd.pgclient.PostgreSQLError):
+        connection.query(entityd.postgresme.BGWRITER_QUERY)
+
+
+@pytest.mark.parametrize('auth', ['trust', 'md5', 'scram'])
+def test_authentication(postgres_stub, auth):
+    postgres_stub.auth = auth
+    connection = entityd.pgclient.Connection(
+        unix_socket=postgres_stub.path, user='monitor', password='secret',
+        timeout=0.5, parameters={'statement_timeout': 500})
+    connection.close()
+    assert postgres_stub.startups[-1] == {
+        'user': 'monitor', 'database': 'postgres',
+        'application_name': 'entityd', 'statement_timeout': '500'}
+
+
+@pytest.mark.parametrize('auth', ['md5', 'scram'])
+def test_authentication_failed(postgres_stub, auth):
+    postgres_stub.auth = auth
+    with pytest.raises(entityd.pgclient.PostgreSQLError) as err:
+        entityd.pgclient.Connection(unix_socket=postgres_stub.path,
+                                    user='monitor', password='wrong')
+    assert err.value.code == '28P01'
+
+
+def test_scram_server_signature():
+    scram = entityd.pgclient.ScramSHA256('secret', nonce='abc')
+    scram.final('r=abcdef,s={},i=4096'.format(
+        base64.b64encode(b'salt').decode()))
+    with pytest.raises(entityd.pgclient.PostgreSQLError):
+        scram.verify('v=' + base64.b64encode(b'forged').decode())
+
+
+def test_read_settings(tmpdir):
+    conf = tmpdir.join('postgresql.conf')
+    conf.write("#port = 5433\n"
+               "port=5434 # comment\n"
+               "listen_addresses = '*'\n"
+               "search_path = '\"$user\", public'\n"
+               "unix_socket_directories 'it''s'\n")
+    assert entityd.postgresme.read_settings(str(conf)) == {
+        'port': '5434',
+        'listen_addresses': '*',
+        'search_path': '"$user", public',
+        'unix_socket_directories': "it's",
+    }
+    assert entityd.postgresme.read_settings('/does/not/exist') == {}
+
+
+def test_pgpass_password(tmpdir):
+    pgpass = tmpdir.join('pgpass')
+    pgpass.write('# comment\n'
+                 'otherhost:*:*:*:nope\n'
+                 'localhost:5432:postgres:monitor:se\\:cret:too\n'
+                 '*:*:*:*:fallback\n')
+    assert entityd.postgresme.pgpass_password(
+        'localhost', 5432, 'postgres', 'monitor',
+        str(pgpass)) == 'se:cret:too'
+    assert entityd.postgresme.pgpass_password(
+        'localhost', 5433, 'postgres', 'monitor', str(pgpass)) == 'fallback'
+    assert entityd.postgresme.pgpass_password(
+        'localhost', 5432, 'postgres', 'monitor', '/does/not/exist') == ''
+
+
+def test_connection_options(postgres_instance, postgres_stub):
+    assert postgres_instance.connection_options() == {
+        'unix_socket': postgres_stub.path, 'host': '127.0.0.1',
+        'port': 5432}
+
+
+def test_connection_options_command(tmpdir, monkeypatch):
+    monkeypatch.setattr(entityd.postgresme, 'DEFAULT_SOCKET_DIRECTORIES',
+                        [str(tmpdir)])
+    tmpdir.join('.s.PGSQL.5433').write('')
+    conf = tmpdir.join('postgresql.conf')
+    conf.write("unix_socket_directories = '/does/not/exist'\n")
+    proc = entityd.EntityUpdate('Process')
+    proc.attrs.set('command', 'postgres -c config_file={} -p 5433 '
+                              '-c unix_socket_directories=,{}'.format(
+                                  conf, tmpdir))
+    options = entityd.postgresme.PostgreSQL(proc).connection_options()
+    assert options['unix_socket'] == str(tmpdir.join('.s.PGSQL.5433'))
+    assert options['port'] == 5433
+    proc.attrs.set('command', 'postgres -c config_file={}'.format(conf))
+    options = entityd.postgresme.PostgreSQL(proc).connection_options()
+    assert options == {'unix_socket': None, 'host': '127.0.0.1',
+                       'port': 5432}
+
+
+def test_connection_options_listen_address(tmpdir, monkeypatch):
+    # -h is the listen address of postgres, not a request for help
+    monkeypatch.setattr(entityd.postgresme, 'DEFAULT_SOCKET_DIRECTORIES',
+                        [str(tmpdir)])
+    tmpdir.join('.s.PGSQL.5433').write('')
+    conf = tmpdir.join('postgresql.conf')
+    conf.write('')
+    proc = entityd.EntityUpdate('Process')
+    proc.attrs.set('command', 'postgres -h 0.0.0.0 -D /x -p 5433 '
+                              '-c config_file={}'.format(conf))
+    options = entityd.postgresme.PostgreSQL(proc).connection_options()
+    assert options['unix_socket'] == str(tmpdir.join('.s.PGSQL.5433'))
+    assert options['port'] == 5433
+
+
+def test_performance_data(postgresent, postgres_instance, postgres_stub):
+    perfdata = postgresent.performance_data(postgres_instance)
+    columns = sorted(entityd.postgresme.DATABASE_COLUMNS)
+    assert perfdata['numbackends'] == (columns.index('numbackends') + 1,
+                                       {'metric:gauge'})
+    assert perfdata['temp_bytes'] == (columns.index('temp_bytes') + 1,
+                                      {'metric:counter', 'unit:bytes'})
+    assert perfdata['activity:active'] == (2, {'metric:gauge'})
+    assert perfdata['activity:idle_in_transaction'] == (1, {'metric:gauge'})
+    assert perfdata['activity:idle'] == (0, {'metric:gauge'})
+    assert perfdata['bgwriter:checkpoints_timed'] == (10, {'metric:counter'})
+    assert perfdata['bgwriter:buffers_alloc'] == (20, {'metric:counter'})
+    assert 'bgwriter:buffers_clean' not in perfdata
+    assert len(perfdata) == (len(columns) +
+                             len(entityd.postgresme.ACTIVITY_STATES) + 2)
+    assert postgresent.performance_data(postgres_instance) == perfdata
+    assert postgres_stub.connections == 1
+    assert postgres_stub.startups[0]['statement_timeout'] == '2000'
+
+
+def test_performance_data_timeout(postgresent, postgres_instance,
+                                  postgres_stub, loghandler):
+    postgresent.statement_timeout = 0.1
+    postgres_stub.hang.add(entityd.postgresme.DATABASE_QUERY)
+    assert postgresent.performance_data(postgres_instance) == {}
+    assert loghandler.has_warning()
+    assert postgres_instance.connection is None
+    postgres_stub.hang.clear()
+    assert postgresent.performance_data(postgres_instance)
+    assert postgres_stub.connections == 2
+
+
+def test_performance_data_unreachable(postgresent, postgres_instance,
+                                      postgres_stub, loghandler):
+    postgres_stub.stop()
+    assert postgresent.performance_data(postgres_instance) == {}
+    assert loghandler.has_warning()
+    postgres_stub.stop = lambda: None
+
+
+def test_get_entities_with_metrics(mock_postgres, postgres_instance,
+                                   monkeypatch):
+    monkeypatch.setattr(entityd.postgresme.PostgreSQL, 'connection_options',
+                        postgres_instance.connection_options)
+    mock_postgres.metrics = True
+    mock_postgres.user = 'monitor'
+    entity = next(mock_postgres.entityd_find_entity(
+        name='PostgreSQL', attrs=None, include_ondemand=False))
+    assert entity.attrs.get('activity:active').value == 2
+    instances = list(mock_postgres._instances.values())  # pylint: disable=protected-access
+    assert instances[0].connection
+    mock_postgres.entityd_sessionfinish()
+    assert instances[0].connection is None
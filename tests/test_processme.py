@@ -1,21 +1,25 @@
+import argparse
 import collections
 import functools
+import gc
 import os
+import pwd
 import subprocess
 import time
+import weakref
 
-import act
 import cobe
 import docker
 import requests
 import pytest
-import zmq
 
 import syskit
 
 import entityd.hookspec
 import entityd.hostme
 import entityd.processme
+import entityd.procfs
+import entityd.sampler
 
 import entityd.core
 import entityd.kvstore
@@ -43,7 +47,8 @@ def module_mock_cpuusage(monkeypatch):
     actually need it mocking out, which this performs.
     """
     cpuusage = pytest.Mock()
-    cpuusage.listen_endpoint = 'inproc://cpuusage'
+    cpuusage.percentages = entityd.processme.NO_CPU_PERCENTAGES
+    cpuusage.interval = 15
     monkeypatch.setattr(entityd.processme, 'CpuUsage',
                         pytest.Mock(return_value=cpuusage))
 
@@ -132,12 +137,9 @@ def process_entity(procent, request, session, kvstore):  # pylint: disable=unuse
 
 
 @pytest.fixture
-def syskit_user_error(monkeypatch):
-    """Mock syskit to generate an error if user attribute is requested."""
-    @property
-    def syskit_error(self):  # pylint: disable=unused-argument
-        raise syskit.AttrNotAvailableError
-    monkeypatch.setattr(syskit.Process, 'user', syskit_error)
+def unknown_user(monkeypatch):
+    """Mock pwd to not know the user of any process."""
+    monkeypatch.setattr(pwd, 'getpwuid', pytest.Mock(side_effect=KeyError))
 
 
 @pytest.fixture
@@ -244,6 +246,27 @@ def test_get_process_containers_handles_missing_process(container,
         pids) == {container_top_pid: containerid}
 
 
+def test_get_process_containers_docker_only(monkeypatch):
+    # Other container runtimes use the same cgroup paths as Docker
+    docker_id, crio_id = 'a' * 64, 'b' * 64
+    monkeypatch.setattr(entityd.docker.client.DockerClient,
+                        'client_available', lambda: True)
+    monkeypatch.setattr(entityd.docker.client.DockerClient,
+                        'running_containers',
+                        lambda: [pytest.Mock(id=docker_id)])
+    snapshot = pytest.Mock()
+    snapshot.container.side_effect = {
+        1: entityd.procfs.ContainerCgroup(
+            docker_id, '/docker/' + docker_id),
+        2: entityd.procfs.ContainerCgroup(
+            crio_id, '/kubepods.slice/crio-{}.scope'.format(crio_id)),
+        3: None,
+    }.get
+    procent = entityd.processme.ProcessEntity()
+    assert procent.get_process_containers([1, 2, 3], snapshot) == {
+        1: docker_id}
+
+
 @pytest.mark.non_container
 def test_get_container_data_when_no_docker_client(
         container, no_docker_client, procent):   # pylint: disable=unused-argument
@@ -310,6 +333,107 @@ def test_find_entity_with_binary(
     assert proc.attrs.get('binary').value == 'py.test'
 
 
+@pytest.fixture
+def procfs(session):
+    """A procfs service holding a snapshot as during a collection cycle."""
+    procfs = entityd.procfs.ProcFS()
+    procfs.entityd_sessionstart(session)
+    procfs.entityd_collection_before(session)
+    return procfs
+
+
+def test_find_entity_with_binary_indexed(
+        mock_docker_client, procent, session, kvstore, procfs, monkeypatch):  # pylint: disable=unused-argument
+    procent.entityd_sessionstart(session)
+    create_me = pytest.Mock(wraps=procent.create_process_me)
+    monkeypatch.setattr(procent, 'create_process_me', create_me)
+    entities = list(procent.entityd_find_entity(
+        'Process', {'binary': 'py.test', 'pid': os.getpid()}))
+    assert [e.attrs.get('pid').value for e in entities] == [os.getpid()]
+    binary = syskit.Process(os.getpid()).name
+    assert create_me.call_count == len(procent.get_index('binary')[binary])
+    assert create_me.call_count < len(procent.active_processes)
+
+
+def test_find_entity_with_ppid(
+        mock_docker_client, procent, session, kvstore, procfs):  # pylint: disable=unused-argument
+    procent.entityd_sessionstart(session)
+    entities = procent.entityd_find_entity('Process', {'ppid': os.getppid()})
+    pids = [e.attrs.get('pid').value for e in entities]
+    assert os.getpid() in pids
+    assert os.getppid() not in pids
+
+
+def test_find_entity_with_indexed_no_match(
+        mock_docker_client, procent, session, kvstore, procfs):  # pylint: disable=unused-argument
+    procent.entityd_sessionstart(session)
+    entities = procent.entityd_find_entity('Process',
+                                           {'binary': 'no-such-binary'})
+    assert not list(entities)
+
+
+def test_find_entity_with_containerid(procent, session, procfs, monkeypatch):  # pylint: disable=unused-argument
+    procent._host_ueid = 'host'  # pylint: disable=protected-access
+    monkeypatch.setattr(procent, 'get_process_containers',
+                        lambda pids: {os.getpid(): 'abcdef'}
+                        if os.getpid() in pids else {})
+    entities = list(procent.filtered_processes({'containerid': 'abcdef'}))
+    assert [e.attrs.get('pid').value for e in entities] == [os.getpid()]
+    assert entities[0].attrs.get('containerid').value == 'abcdef'
+
+
+def test_process_table_once_per_snapshot(procent, session, procfs,
+                                         monkeypatch):
+    update_table = pytest.Mock(return_value={})
+    monkeypatch.setattr(procent, 'update_process_table', update_table)
+    procent.session = session
+    procent.process_table()
+    procent.get_index('binary')
+    assert update_table.call_count == 1
+    procfs.entityd_collection_after(session, ())
+    procfs.entityd_collection_before(session)
+    procent.process_table()
+    assert update_table.call_count == 2
+    assert not procent.indexes
+
+
+def test_indexed_lookup_outside_cycle(monkeypatch):
+    # Without a collection cycle every snapshot is new, the index must
+    # still be built from the table being looked up in.
+    procent = entityd.processme.ProcessEntity()
+    table = {1: pytest.Mock(pid=1), 2: pytest.Mock(pid=2)}
+    for proc in table.values():
+        proc.name = 'cat'
+    update_table = pytest.Mock(side_effect=[table, {3: pytest.Mock(pid=3)}])
+    monkeypatch.setattr(procent, 'update_process_table', update_table)
+    monkeypatch.setattr(procent, 'get_process_containers',
+                        pytest.Mock(return_value={}))
+    monkeypatch.setattr(procent, 'create_process_me',
+                        lambda table, proc, containers, snapshot: proc)
+    assert list(procent.indexed_processes({'binary': 'cat'})) == [
+        table[1], table[2]]
+    assert update_table.call_count == 1
+
+
+@pytest.mark.parametrize('attrs', [
+    {'pid': os.getpid()},
+    {'binary': syskit.Process(os.getpid()).name},
+    {'command': syskit.Process(os.getpid()).command},
+])
+def test_lookup_outside_cycle_one_snapshot(monkeypatch, attrs):
+    # Without a collection cycle every snapshot is new, a lookup must
+    # create its updates from a single one.
+    procent = entityd.processme.ProcessEntity()
+    procent._host_ueid = 'host'  # pylint: disable=protected-access
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'pids', [os.getpid()])
+    snapshot = pytest.Mock(wraps=entityd.procfs.snapshot)
+    monkeypatch.setattr(entityd.procfs, 'snapshot', snapshot)
+    updates = list(procent.filtered_processes(attrs))
+    assert [update.attrs.get('pid').value for update in updates] == [
+        os.getpid()]
+    assert snapshot.call_count == 1
+
+
 def test_get_ueid_new(kvstore, session, procent):  # pylint: disable=unused-argument
     procent.entityd_sessionstart(session)
     proc = syskit.Process(os.getpid())
@@ -337,6 +461,19 @@ def test_get_ueid(mock_docker_client, session, host_entity_plugin):  # pylint: d
     procent.entityd_sessionfinish()
 
 
+def test_get_ueid_matches_update(session, host_entity_plugin):  # pylint: disable=unused-argument
+    procent = entityd.processme.ProcessEntity()
+    procent.entityd_sessionstart(session)
+    proc = syskit.Process(os.getpid())
+    update = entityd.EntityUpdate('Process')
+    update.attrs.set('pid', proc.pid, traits={'entity:id'})
+    update.attrs.set('starttime', proc.start_time.timestamp(),
+                     traits={'entity:id'})
+    update.attrs.set('host', str(procent.host_ueid), traits={'entity:id'})
+    assert procent.get_ueid(proc) == update.ueid
+    procent.entityd_sessionfinish()
+
+
 def test_get_parents_nohost_noparent(session, kvstore, procent):  # pylint: disable=unused-argument
     procent.entityd_sessionstart(session)
     proc = syskit.Process(os.getpid())
@@ -358,6 +495,8 @@ def test_get_parents_parent(procent, session, kvstore, host_entity_plugin):  # p
 def test_root_process_has_host_parent(procent, session, kvstore, monkeypatch):  #pylint: disable=unused-argument
     procent.entityd_sessionstart(session)
     hostupdate = entityd.EntityUpdate('Host')
+    monkeypatch.setattr(session.pluginmanager.hooks, 'entityd_host_ueid',
+                        pytest.Mock(return_value=None))
     monkeypatch.setattr(session.pluginmanager.hooks,
                         'entityd_find_entity',
                         pytest.Mock(return_value=[[hostupdate]]))
@@ -381,7 +520,7 @@ def test_find_single_container_parent(container_entities):
 
 
 def test_no_possible_username_possible(
-        mock_docker_client, syskit_user_error, process_entity):  # pylint: disable=unused-argument
+        mock_docker_client, unknown_user, process_entity):  # pylint: disable=unused-argument
     with pytest.raises(KeyError):
         process_entity.attrs.get('username')
 
@@ -438,31 +577,138 @@ def test_processes_deleted(
 
 
 def test_update_process_table():
-    active = entityd.processme.ProcessEntity().update_process_table({})
+    procent = entityd.processme.ProcessEntity()
+    active = procent.update_process_table({})
     assert isinstance(active[os.getpid()], syskit.Process)
-    pt2 = entityd.processme.ProcessEntity().update_process_table(active)
+    pt2 = procent.update_process_table(active)
     assert pt2[os.getpid()] is active[os.getpid()]
 
 
+def test_static_facts_cached(monkeypatch):
+    procent = entityd.processme.ProcessEntity()
+    procent._host_ueid = 'host'  # pylint: disable=protected-access
+    monkeypatch.setattr(procent, 'get_ueid', pytest.Mock())
+    active = procent.update_process_table({})
+    active = procent.update_process_table(active)
+    proc = active[os.getpid()]
+    facts = procent.get_static_facts(proc)
+    assert procent.get_static_facts(proc) is facts
+    assert procent.get_ueid.call_count == 1
+    stat = entityd.procfs.Snapshot().stat(os.getpid())
+    assert procent.static_facts[(os.getpid(), stat.starttime,
+                                 stat.comm)] is facts
+
+
+def test_credentials_not_static(monkeypatch):
+    # Credentials and the session change when a daemon drops privileges
+    procent = entityd.processme.ProcessEntity()
+    facts = entityd.processme.StaticFacts(
+        cobe.UEID('a' * 32), 'cat', [('command', 'cat', {'index'})])
+    monkeypatch.setattr(procent, 'get_static_facts',
+                        pytest.Mock(return_value=facts))
+    monkeypatch.setattr(procent, 'get_parents', pytest.Mock(return_value=[]))
+    credentials = [entityd.procfs.Credentials(0, 0, 0, 0, 0, 0)]
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'credentials',
+                        lambda self, pid: credentials[0])
+    proc = pytest.Mock(pid=os.getpid())
+    update = procent.create_process_me({}, proc, {})
+    assert update.attrs.get('uid').value == 0
+    assert update.attrs.get('sgid').value == 0
+    credentials[0] = entityd.procfs.Credentials(0, 33, 33, 0, 33, 33)
+    update = procent.create_process_me({}, proc, {})
+    assert update.attrs.get('uid').value == 0
+    assert update.attrs.get('euid').value == 33
+    assert update.attrs.get('sgid').value == 33
+    assert (update.attrs.get('sessionid').value ==
+            entityd.procfs.Snapshot().stat(os.getpid()).session)
+
+
+def test_username_not_static(monkeypatch):
+    # The username follows the real user ID
+    procent = entityd.processme.ProcessEntity()
+    facts = entityd.processme.StaticFacts(
+        cobe.UEID('a' * 32), 'cat', [('command', 'cat', {'index'})])
+    monkeypatch.setattr(procent, 'get_static_facts',
+                        pytest.Mock(return_value=facts))
+    monkeypatch.setattr(procent, 'get_parents', pytest.Mock(return_value=[]))
+    credentials = [entityd.procfs.Credentials(0, 0, 0, 0, 0, 0)]
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'credentials',
+                        lambda self, pid: credentials[0])
+    proc = pytest.Mock(pid=os.getpid())
+    update = procent.create_process_me({}, proc, {})
+    assert update.attrs.get('username').value == pwd.getpwuid(0).pw_name
+    credentials[0] = entityd.procfs.Credentials(
+        2 ** 31, 2 ** 31, 2 ** 31, 0, 0, 0)
+    update = procent.create_process_me({}, proc, {})
+    assert update.attrs.get('uid').value == 2 ** 31
+    with pytest.raises(KeyError):
+        update.attrs.get('username')
+
+
+def test_get_username_cached(monkeypatch):
+    procent = entityd.processme.ProcessEntity()
+    getpwuid = pytest.Mock(wraps=pwd.getpwuid)
+    monkeypatch.setattr(pwd, 'getpwuid', getpwuid)
+    assert procent.get_username(0) == procent.get_username(0)
+    assert procent.get_username(2 ** 31) is None
+    assert procent.get_username(2 ** 31) is None
+    assert getpwuid.call_count == 2
+
+
+def test_update_process_table_exec(monkeypatch):
+    # An execve keeps the pid and starttime but changes the comm
+    procent = entityd.processme.ProcessEntity()
+    proc = pytest.Mock()
+    stat = entityd.procfs.Snapshot().stat(os.getpid())
+    key = procent.static_facts_key(stat._replace(comm=b'sh'))
+    procent.static_facts = {key: pytest.Mock()}
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'pids', [os.getpid()])
+    pt = procent.update_process_table({os.getpid(): proc})
+    assert pt[os.getpid()] is not proc
+    assert key not in procent.static_facts
+    assert procent.static_facts[procent.static_facts_key(stat)] is None
+
+
+def test_static_facts_unknown_process(monkeypatch):
+    procent = entityd.processme.ProcessEntity()
+    procent._host_ueid = 'host'  # pylint: disable=protected-access
+    monkeypatch.setattr(procent, 'get_ueid', pytest.Mock())
+    proc = syskit.Process(os.getpid())
+    procent.get_static_facts(proc)
+    procent.get_static_facts(proc)
+    assert procent.get_ueid.call_count == 2
+    assert not procent.static_facts
+
+
+def test_update_process_table_pid_reused(monkeypatch):
+    procent = entityd.processme.ProcessEntity()
+    proc = pytest.Mock()
+    procent.static_facts = {(os.getpid(), -1): pytest.Mock()}
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'pids', [os.getpid()])
+    pt = procent.update_process_table({os.getpid(): proc})
+    assert pt[os.getpid()] is not proc
+    assert (os.getpid(), -1) not in procent.static_facts
+
+
 def test_process_table_vanished(monkeypatch):
     # A process vanishes during creation
     monkeypatch.setattr(syskit, 'Process',
                         pytest.Mock(side_effect=syskit.NoSuchProcessError))
-    monkeypatch.setattr(syskit.Process, 'enumerate',
-                        pytest.Mock(return_value=[42]))
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'pids', [os.getpid()])
     pt = entityd.processme.ProcessEntity().update_process_table({})
     assert not pt
 
 
 def test_process_table_vanished_refresh(monkeypatch):
-    # A process vanishes during creation
-    proc = syskit.Process(os.getpid())
-    proc.refresh = pytest.Mock(side_effect=syskit.NoSuchProcessError)
-    monkeypatch.setattr(syskit.Process, 'enumerate',
-                        pytest.Mock(return_value=[os.getpid()]))
-    pt = entityd.processme.ProcessEntity().update_process_table(
-        {os.getpid(): proc})
+    # A known process vanishes
+    procent = entityd.processme.ProcessEntity()
+    active = procent.update_process_table({})
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'pids', [42])
+    monkeypatch.setattr(entityd.procfs.Snapshot, 'stat',
+                        lambda self, pid: None)
+    pt = procent.update_process_table(active)
     assert not pt
+    assert not procent.static_facts
 
 
 def test_specific_process_deleted(
@@ -561,7 +807,7 @@ def test_cpu_usage_sock_not_present_all(
 def test_cpu_usage_attr_is_present(
         mock_docker_client, cpuusage_interval, procent, session, kvstore): # pylint: disable=unused-argument
     procent.entityd_sessionstart(session)
-    assert procent.cpu_usage_thread.is_alive()
+    assert procent.cpu_usage_task in session.svc.sampler.tasks
     while True:
         entities = procent.entityd_find_entity('Process', {'pid': os.getpid()})
         entity = next(entities)
@@ -623,6 +869,8 @@ def test_host_ueid_cached(procent, session, host_entity_plugin):
 
 def test_host_ueid_no_host_plugin(monkeypatch, procent, session):
     procent.entityd_sessionstart(session)
+    monkeypatch.setattr(session.pluginmanager.hooks, 'entityd_host_ueid',
+                        pytest.Mock(return_value=None))
     monkeypatch.setattr(
         session.pluginmanager.hooks,
         'entityd_find_entity',
@@ -634,6 +882,8 @@ def test_host_ueid_no_host_plugin(monkeypatch, procent, session):
 
 def test_host_ueid_no_host_entity(monkeypatch, procent, session):
     procent.entityd_sessionstart(session)
+    monkeypatch.setattr(session.pluginmanager.hooks, 'entityd_host_ueid',
+                        pytest.Mock(return_value=None))
     monkeypatch.setattr(
         session.pluginmanager.hooks,
         'entityd_find_entity',
@@ -643,128 +893,355 @@ def test_host_ueid_no_host_entity(monkeypatch, procent, session):
         assert procent.host_ueid
 
 
-class TestCpuUsage:
+@pytest.fixture
+def synthetic_proc(tmpdir):
+    """A synthetic procfs tree with a few processes.
+
+    Returns the path to the procfs tree.
+    """
+    procdir = tmpdir.join('proc')
+    # syskit may cache the boot time, so use the real one
+    btime = entityd.procfs.Snapshot().boottime
+    procdir.join('stat').write('cpu  1 2 3 4\nbtime {}\n'.format(btime),
+                               ensure=True)
+    procdir.join('uptime').write('1000.00 2000.00\n')
+    procs = [
+        (1, 0, b'init', b'S', b'/sbin/init\0splash\0'),
+        (42, 1, b'my (odd) name', b'R', b'/usr/bin/odd\0-x\0--y=1\0'),
+        (43, 42, b'defunct', b'Z', b''),
+    ]
+    for pid, ppid, comm, state, cmdline in procs:
+        piddir = procdir.join(str(pid))
+        piddir.ensure_dir()
+        fields = [ppid, pid, pid, 0, -1, 4194304, 100, 0, 0, 0, 731, 269,
+                  0, 0, 20, 0, 1, 0, 12345, 1024000, 200, 100]
+        piddir.join('stat').write_binary(b'%d (%s) %s %s\n' % (
+            pid, comm, state, ' '.join(str(f) for f in fields).encode()))
+        piddir.join('statm').write('250 200 50 10 0 100 0\n')
+        piddir.join('status').write(
+            'Name:\t{}\nState:\t{}\nUid:\t{uid}\t{uid}\t{uid}\t{uid}\n'
+            'Gid:\t{gid}\t7\t{gid}\t{gid}\n'.format(
+                comm.decode(), state.decode(),
+                uid=os.getuid(), gid=os.getgid()))
+        piddir.join('cmdline').write_binary(cmdline)
+        piddir.join('environ').write_binary(b'LANG=C.UTF-8\0')
+        os.symlink('/', str(piddir.join('cwd')))
+        if state != b'Z':
+            os.symlink('/usr/bin/odd', str(piddir.join('exe')))
+    return str(procdir)
+
+
+@pytest.mark.parametrize('pid', [1, 42, 43])
+def test_procfs_process_equivalent_to_syskit(synthetic_proc, pid):
+    snapshot = entityd.procfs.Snapshot(synthetic_proc)
+    proc = entityd.processme.ProcfsProcess(pid, snapshot)
+    with syskit.set_procpath(synthetic_proc):
+        sysproc = syskit.Process(pid)
+        for attr in ['pid', 'name', 'ppid', 'sid', 'vsz', 'rss', 'ruid',
+                     'euid', 'suid', 'rgid', 'egid', 'sgid', 'user',
+                     'command']:
+            assert getattr(proc, attr) == getattr(sysproc, attr), attr
+        for attr in ['utime', 'stime', 'cputime']:
+            assert getattr(proc, attr) == float(getattr(sysproc, attr)), attr
+        assert proc.start_time.timestamp() == sysproc.start_time.timestamp()
+        for attr in ['exe', 'argv', 'argc']:
+            try:
+                expected = getattr(sysproc, attr)
+            except AttributeError:
+                with pytest.raises(AttributeError):
+                    getattr(proc, attr)
+            else:
+                assert getattr(proc, attr) == expected, attr
+
+
+def test_procfs_process_current():
+    proc = entityd.processme.ProcfsProcess(
+        os.getpid(), entityd.procfs.Snapshot())
+    sysproc = syskit.Process(os.getpid())
+    assert proc.start_time.timestamp() == sysproc.start_time.timestamp()
+    assert proc.argv == sysproc.argv
+    assert proc.exe == sysproc.exe
+    assert proc.user == sysproc.user
+
+
+def test_procfs_process_releases_snapshot(synthetic_proc):
+    # Processes are kept across cycles and must not pin their snapshot
+    snapshot = entityd.procfs.Snapshot(synthetic_proc)
+    proc = entityd.processme.ProcfsProcess(42, snapshot)
+    ref = weakref.ref(snapshot)
+    del snapshot
+    gc.collect()
+    assert ref() is None
+    assert proc.argv == ['/usr/bin/odd', '-x', '--y=1']
+    assert proc.exe == '/usr/bin/odd'
+    assert proc.start_time.timestamp()
+
+
+def test_procfs_process_vanished(tmpdir):
+    with pytest.raises(ProcessLookupError):
+        entityd.processme.ProcfsProcess(42, entityd.procfs.Snapshot(
+            str(tmpdir)))
+
+
+def test_procfs_backend_entities(
+        mock_docker_client, procent, session, kvstore):  # pylint: disable=unused-argument
+    procent.entityd_sessionstart(session)
+    syskit_entity = next(procent.entityd_find_entity(
+        'Process', {'pid': os.getpid()}))
+    procent.backend = 'procfs'
+    procent.active_processes = {}
+    procfs_entity = next(procent.entityd_find_entity(
+        'Process', {'pid': os.getpid()}))
+    assert procfs_entity.ueid == syskit_entity.ueid
+    for attr in syskit_entity.attrs:
+        if attr.name in ['cputime', 'utime', 'stime', 'vsz', 'rss', 'cpu']:
+            continue
+        assert procfs_entity.attrs.get(attr.name) == attr
+
+
+def test_procfs_backend_process_table(procent, session, monkeypatch):
+    session.config.args.process_backend = 'procfs'
+    monkeypatch.setattr(syskit, 'Process',
+                        pytest.Mock(side_effect=AssertionError))
+    procent.entityd_sessionstart(session)
+    active = procent.update_process_table({})
+    assert isinstance(active[os.getpid()], entityd.processme.ProcfsProcess)
+
+
+class TestProcessSelection:
+
+    class FakeSnapshot:
+        """Snapshot with processes given as (ppid, comm, flags, rss, age)."""
+
+        def __init__(self, procs, cgroups=None):
+            self.procs = procs
+            self.cgroups = cgroups or {}
+
+        def stat(self, pid):
+            try:
+                ppid, comm, flags, rss, _ = self.procs[pid]
+            except KeyError:
+                return None
+            return pytest.Mock(pid=pid, ppid=ppid, comm=comm,
+                               flags=flags, rss=rss)
+
+        def age(self, pid):
+            return self.procs[pid][4]
+
+        def cgroup(self, pid):
+            return self.cgroups.get(pid, ['0::/'])
 
     @pytest.fixture
-    def context(self):
-        return act.zkit.new_context()
+    def snapshot(self):
+        kthread = entityd.processme.ProcessSelection.PF_KTHREAD
+        return self.FakeSnapshot({
+            1: (0, b'init', 0, 100, 1000),
+            2: (0, b'kthreadd', kthread, 0, 1000),
+            3: (2, b'kworker/0:1', kthread, 0, 1000),
+            10: (1, b'sshd', 0, 200, 500),
+            11: (10, b'bash', 0, 300, 5),
+            12: (11, b'java', 0, 5000, 400),
+            13: (11, b'sh', 0, 50, 1),
+        }, cgroups={12: ['0::/docker/abc']})
+
+    def select(self, snapshot, cpu=None, **kwargs):
+        selection = entityd.processme.ProcessSelection(**kwargs)
+        return selection.select(snapshot.procs.keys(), snapshot, cpu or {})
+
+    def test_default(self, snapshot):
+        selection = entityd.processme.ProcessSelection()
+        assert selection.selects_all
+        assert self.select(snapshot) == set(snapshot.procs)
+
+    def test_kernel_threads(self, snapshot):
+        assert self.select(snapshot, exclude_kernel_threads=True) == {
+            1, 10, 11, 12, 13}
+
+    def test_min_age_keeps_ancestors(self, snapshot):
+        assert self.select(snapshot, min_age=10) == {1, 2, 3, 10, 11, 12}
+
+    def test_binaries(self, snapshot):
+        assert self.select(snapshot, include_binaries=['ja*']) == {
+            1, 10, 11, 12}
+        assert self.select(snapshot, exclude_binaries=['k*', 'sh']) == {
+            1, 10, 11, 12}
+
+    def test_cgroups(self, snapshot):
+        assert self.select(snapshot, include_cgroups=['*/docker/*']) == {
+            1, 10, 11, 12}
+        assert 12 not in self.select(snapshot,
+                                     exclude_cgroups=['*/docker/*'])
+
+    def test_top_rss(self, snapshot):
+        assert self.select(snapshot, top_rss=1) == {1, 10, 11, 12}
+
+    def test_top_cpu(self, snapshot):
+        assert self.select(snapshot, top_cpu=1, cpu={13: 90.0, 12: 5.0}) == {
+            1, 10, 11, 13}
+
+    def test_top_cpu_and_rss(self, snapshot):
+        assert self.select(snapshot, top_cpu=1, top_rss=1,
+                           cpu={13: 90.0}) == {1, 10, 11, 12, 13}
+
+    def test_vanished(self, snapshot):
+        selection = entityd.processme.ProcessSelection(min_age=1)
+        assert selection.select([1, 42], snapshot, {}) == {1}
+
+    def test_from_args(self, procent):
+        parser = argparse.ArgumentParser()
+        procent.entityd_addoption(parser)
+        args = parser.parse_args([
+            '--process-exclude-kthreads', '--process-min-age', '2.5',
+            '--process-top-cpu', '10', '--process-exclude-binary', 'sh',
+            '--process-exclude-binary', 'bash',
+            '--process-include-cgroup', '*/docker/*'])
+        selection = entityd.processme.ProcessSelection.from_args(args)
+        assert selection.exclude_kernel_threads
+        assert selection.min_age == 2.5
+        assert selection.top_cpu == 10
+        assert selection.top_rss == 0
+        assert selection.exclude_binaries == ['sh', 'bash']
+        assert selection.include_cgroups == ['*/docker/*']
+        assert not selection.include_binaries
+        assert not selection.selects_all
+
+
+def test_processes_selection(
+        mock_docker_client, procent, proctable, monkeypatch, session, kvstore):  # pylint: disable=unused-argument
+    procent.entityd_sessionstart(session)
+    monkeypatch.setattr(procent, 'update_process_table',
+                        pytest.Mock(return_value=proctable))
+    create_me = pytest.Mock(wraps=procent.create_process_me)
+    monkeypatch.setattr(procent, 'create_process_me', create_me)
+    procent.selection = entityd.processme.ProcessSelection(
+        exclude_binaries=['*'])
+    assert not list(procent.processes())
+    assert not create_me.called
+
+
+def test_is_selected(mock_docker_client, procent, proctable, monkeypatch,  # pylint: disable=unused-argument
+                     session, kvstore, procfs):  # pylint: disable=unused-argument
+    procent.entityd_configure(session.config)
+    procent.entityd_sessionstart(session)
+    update_table = pytest.Mock(return_value=proctable)
+    monkeypatch.setattr(procent, 'update_process_table', update_table)
+    assert entityd.processme.is_selected(session, os.getpid())
+    assert not update_table.called
+    procent.selection = entityd.processme.ProcessSelection(
+        exclude_binaries=[syskit.Process(os.getpid()).name])
+    assert not entityd.processme.is_selected(session, os.getpid())
+    assert entityd.processme.is_selected(session, os.getppid())
+    assert procent.selected_pids() == {os.getppid()}
+    assert update_table.call_count == 1
+
+
+def test_is_selected_no_process_entity(session):
+    assert entityd.processme.is_selected(session, os.getpid())
+
+
+class TestCpuUsage:
 
     @pytest.fixture
-    def cpuusage(self, context):
-        return entityd.processme.CpuUsage(context, interval=0.1)
-
-    def test_timer(self, monkeypatch, cpuusage):
-        """Test the timer is firing, and triggers an update."""
-        monkeypatch.setattr(cpuusage, 'update',
-                            pytest.Mock(side_effect=cpuusage.stop))
-        cpuusage.start()
-        cpuusage.join()
-        assert cpuusage.update.called
-
-    def test_exception_logged(self, monkeypatch, cpuusage):
-        monkeypatch.setattr(cpuusage, '_run',
-                            pytest.Mock(side_effect=ZeroDivisionError))
-        monkeypatch.setattr(cpuusage, '_log', pytest.Mock())
-        stop = lambda self: monkeypatch.setattr(cpuusage,
-                                                '_run', pytest.Mock())
-        cpuusage._log.exception.side_effect = stop
-        cpuusage.start()
-        cpuusage.join(timeout=2)
-        assert cpuusage._log.exception.called
+    def cpuusage(self):
+        return entityd.processme.CpuUsage(interval=0.1)
+
+    def test_task(self, procent, session):
+        procent.entityd_sessionstart(session)
+        task = procent.cpu_usage_task
+        assert task in session.svc.sampler.tasks
+        assert task.func == procent.cpu_usage.update
+        procent.entityd_sessionfinish()
+        assert task not in session.svc.sampler.tasks
 
     def test_update(self, cpuusage):
         """Test the update functionality."""
         cpuusage.update()
         first_run = cpuusage.last_run_processes.items()
-        for key, proc in first_run:
-            assert isinstance(proc, syskit.Process)
+        assert os.getpid() in cpuusage.last_run_processes
+        for key, sample in first_run:
+            assert isinstance(sample, entityd.processme.CpuSample)
         assert not cpuusage.last_run_percentages
         cpuusage.update()
-        for key, proc in cpuusage.last_run_processes.items():
+        for key, sample in cpuusage.last_run_processes.items():
             if key in [k for k, p in first_run]:
-                assert isinstance(proc, syskit.Process)
+                assert isinstance(sample, entityd.processme.CpuSample)
                 assert cpuusage.last_run_percentages.get(key) is not None
 
     def test_one_proc_cpu_calculation(self, cpuusage):
-        proc = pytest.Mock()
-        proc.pid = 1
-        proc.cputime = 0.0
         now = time.time()
-        proc.start_time.timestamp.return_value = now
-        proc.refreshed.timestamp.return_value = now
-        assert cpuusage.percent_cpu_usage(proc, proc) == 0.0
-
-        proc1 = pytest.Mock()
-        proc1.start_time.timestamp.return_value = proc.start_time.timestamp()
-        proc1.cputime = 1.0
-        now += 1
-        proc1.refreshed.timestamp.return_value = now
-        assert cpuusage.percent_cpu_usage(proc, proc1) >= 99.0
-
-        proc2 = pytest.Mock()
-        proc2.cputime = 2.0
-        proc2.start_time.timestamp.return_value = proc.start_time.timestamp()
-        now += 2
-        proc2.refreshed.timestamp.return_value = now
-        assert cpuusage.percent_cpu_usage(proc1, proc2) == 50
-
-    def test_get_all(self, request, context, cpuusage):
-        request.addfinalizer(cpuusage.join)
-        request.addfinalizer(cpuusage.stop)
-        cpuusage.start()
-        req = context.socket(zmq.PAIR)
-
-        def fin():
-            req.close(linger=0)
-
-        request.addfinalizer(fin)
-        req.connect('inproc://cpuusage')
-        pid = os.getpid()
-        while True:
-            req.send_pyobj(None)
-            pc = req.recv_pyobj()
-            if not pc:
-                continue
-            else:
-                assert isinstance(pc, dict)
-                assert isinstance(pc[pid], float)
-                break
+        sample = entityd.processme.CpuSample(100, 0.0, now)
+        assert cpuusage.percent_cpu_usage(sample, sample) == 0.0
+
+        sample1 = entityd.processme.CpuSample(100, 1.0, now + 1)
+        assert cpuusage.percent_cpu_usage(sample, sample1) >= 99.0
 
-    def test_cpu_usage_returns_dictionary(self, request, context, cpuusage):
-        """ processme.py used to return a float if a pid was sent in, which
-        caused it to throw a TypeError and crash. This test is to ensure that
-        it always returns a dictionary"""
-        request.addfinalizer(cpuusage.join)
-        request.addfinalizer(cpuusage.stop)
-        cpuusage.start()
+        sample2 = entityd.processme.CpuSample(100, 2.0, now + 3)
+        assert cpuusage.percent_cpu_usage(sample1, sample2) == 50
 
-        req = context.socket(zmq.PAIR)
-        def fin():
-            req.close(linger=0)
+    def test_update_pid_reused(self, cpuusage):
+        cpuusage.last_run_processes = {
+            os.getpid(): entityd.processme.CpuSample(-1, 0.0, time.time()),
+        }
+        cpuusage.update()
+        assert os.getpid() not in cpuusage.last_run_percentages
+        assert os.getpid() in cpuusage.last_run_processes
+
+    def test_update_uses_snapshot(self, tmpdir):
+        snapshot = entityd.procfs.Snapshot(str(tmpdir))
+        cpuusage = entityd.processme.CpuUsage(snapshot=lambda: snapshot)
+        cpuusage.update()
+        assert cpuusage.last_run_processes == {}
 
-        request.addfinalizer(fin)
-        req.connect('inproc://cpuusage')
+    def test_get_all(self, request, cpuusage):
+        sampler = entityd.sampler.SamplerService()
+        request.addfinalizer(sampler.stop)
+        sampler.add('process-cpu', cpuusage.update, cpuusage.interval)
         pid = os.getpid()
         while True:
-            req.send_pyobj(pid)
-            pc = req.recv_pyobj()
-            if pc is None:
+            pc = cpuusage.percentages
+            if not pc.percentages:
+                time.sleep(0.1)
                 continue
             else:
-                assert isinstance(pc, dict)
+                assert pc.version >= 2
+                assert isinstance(pc.percentages[pid], float)
                 break
 
+    def test_percentages_published(self, cpuusage):
+        assert cpuusage.percentages is entityd.processme.NO_CPU_PERCENTAGES
+        cpuusage.update()
+        first = cpuusage.percentages
+        assert first.version == 1
+        assert first.timestamp
+        cpuusage.update()
+        second = cpuusage.percentages
+        assert second.version == 2
+        assert not first.percentages
+        assert isinstance(second.percentages[os.getpid()], float)
+        with pytest.raises(TypeError):
+            second.percentages[os.getpid()] = 0.0
+
+    def test_get_cpu_percentage(self, cpuusage):
+        procent = entityd.processme.ProcessEntity()
+        assert procent.get_cpu_percentage(os.getpid()) is None
+        procent.cpu_usage = cpuusage
+        cpuusage.update()
+        cpuusage.update()
+        assert isinstance(procent.get_cpu_percentage(os.getpid()), float)
+        assert procent.get_cpu_percentage(-1) is None
+        assert (procent.get_all_cpu_percentages()
+                is cpuusage.percentages.percentages)
+
     def test_missing_pid(self, monkeypatch, request,
                          session, host_entity_plugin):   # pylint: disable=unused-argument
         procent = entityd.processme.ProcessEntity()
         _cpuusage = entityd.processme.CpuUsage
         monkeypatch.setattr(entityd.processme, 'CpuUsage',
-                            lambda context, **kwargs: _cpuusage(context,
-                                                                interval=10))
+                            lambda **kwargs: _cpuusage(interval=10))
         request.addfinalizer(procent.entityd_sessionfinish)
         procent.entityd_sessionstart(session)
         time.sleep(0.1)
-        procent.cpu_usage_thread.update()
+        procent.cpu_usage.update()
         time.sleep(0.1)
         popen = subprocess.Popen(["sleep", "5"],
                                  stdout=subprocess.PIPE,
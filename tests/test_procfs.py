@@ -0,0 +1,435 @@
+import argparse
+import os
+import socket
+
+import pytest
+
+import entityd.procfs
+
+
+def make_proc(procdir, pid, ppid=1, comm='cat', utime=10, stime=5,
+              starttime=1000, cgroup='0::/'):
+    """Create a fake process in a procfs tree."""
+    piddir = procdir.join(str(pid))
+    piddir.ensure_dir()
+    fields = [ppid, pid, pid, 0, -1, 4194304, 100, 0, 0, 0, utime, stime,
+              0, 0, 20, 0, 1, 0, starttime, 1024000, 200, 100]
+    piddir.join('stat').write('{} ({}) S {}\n'.format(
+        pid, comm, ' '.join(str(field) for field in fields)))
+    piddir.join('status').write(
+        'Name:\t{}\nState:\tS (sleeping)\nPPid:\t{}\n'
+        'Uid:\t1000\t1000\t1000\t1000\n'.format(comm, ppid))
+    piddir.join('cgroup').write(cgroup + '\n')
+    piddir.join('cmdline').write_binary(comm.encode() + b'\0-u\0')
+    piddir.join('fd').ensure_dir()
+    return piddir
+
+
+@pytest.fixture
+def procdir(tmpdir):
+    procdir = tmpdir.join('proc')
+    procdir.ensure_dir()
+    procdir.join('net').ensure_dir()
+    procdir.join('self').ensure_dir()
+    return procdir
+
+
+@pytest.fixture
+def snapshot(procdir):
+    return entityd.procfs.Snapshot(str(procdir))
+
+
+def test_pids(procdir, snapshot):
+    make_proc(procdir, 1, ppid=0)
+    make_proc(procdir, 42)
+    assert sorted(snapshot.pids) == [1, 42]
+
+
+def test_pids_read_once(procdir, snapshot):
+    make_proc(procdir, 1, ppid=0)
+    assert snapshot.pids == [1]
+    make_proc(procdir, 42)
+    assert snapshot.pids == [1]
+
+
+def test_stat(procdir, snapshot):
+    make_proc(procdir, 42, comm='my (odd) name', utime=7, stime=3,
+              starttime=1234)
+    stat = snapshot.stat(42)
+    assert stat.pid == 42
+    assert stat.comm == b'my (odd) name'
+    assert stat.state == b'S'
+    assert stat.ppid == 1
+    assert stat.utime == 7
+    assert stat.stime == 3
+    assert stat.starttime == 1234
+    assert stat.vsize == 1024000
+    assert stat.rss == 200
+
+
+def test_stat_real_process():
+    snapshot = entityd.procfs.Snapshot()
+    stat = snapshot.stat(os.getpid())
+    assert stat.pid == os.getpid()
+    assert stat.ppid == os.getppid()
+
+
+def test_stat_cached(procdir, snapshot):
+    piddir = make_proc(procdir, 42)
+    stat = snapshot.stat(42)
+    timestamp = snapshot.stat_timestamp(42)
+    piddir.join('stat').remove()
+    assert snapshot.stat(42) is stat
+    assert snapshot.stat_timestamp(42) == timestamp
+
+
+def test_boottime(procdir, snapshot):
+    procdir.join('stat').write('cpu  1 2 3 4\nbtime 1500000000\n')
+    assert snapshot.boottime == 1500000000
+
+
+def test_age(procdir, snapshot):
+    procdir.join('stat').write('btime 1500000000\n')
+    make_proc(procdir, 42, starttime=entityd.procfs.CLOCK_TICKS * 10)
+    snapshot.timestamp = 1500000100
+    assert snapshot.age(42) == 90
+    assert snapshot.age(43) is None
+
+
+def test_age_real_process():
+    assert entityd.procfs.Snapshot().age(os.getpid()) >= 0
+
+
+def test_stat_vanished(snapshot):
+    assert snapshot.stat(42) is None
+
+
+def test_status(procdir, snapshot):
+    make_proc(procdir, 42)
+    status = snapshot.status(42)
+    assert status['Name'] == 'cat'
+    assert status['PPid'] == '1'
+    assert status['Uid'].split() == ['1000'] * 4
+
+
+def test_status_vanished(snapshot):
+    assert snapshot.status(42) is None
+
+
+def test_cgroup(procdir, snapshot):
+    make_proc(procdir, 42, cgroup='12:cpu:/docker/abc')
+    assert snapshot.cgroup(42) == ['12:cpu:/docker/abc']
+
+
+def test_cgroup_vanished(snapshot):
+    assert snapshot.cgroup(42) is None
+
+
+def test_cmdline(procdir, snapshot):
+    make_proc(procdir, 42)
+    assert snapshot.cmdline(42) == [b'cat', b'-u']
+
+
+def test_cmdline_vanished(snapshot):
+    assert snapshot.cmdline(42) is None
+
+
+def test_socket_inodes(procdir, snapshot):
+    piddir = make_proc(procdir, 42)
+    os.symlink('socket:[1234]', str(piddir.join('fd', '3')))
+    os.symlink('socket:[1234]', str(piddir.join('fd', '4')))
+    os.symlink('/dev/null', str(piddir.join('fd', '5')))
+    os.symlink('socket:[5678]', str(piddir.join('fd', '6')))
+    inodes = snapshot.socket_inodes(42)
+    assert sorted(inodes['1234']) == [(42, 3), (42, 4)]
+    assert inodes['5678'] == [(42, 6)]
+    assert len(inodes) == 2
+
+
+def test_socket_inodes_real_process():
+    sock = socket.socket()
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        snapshot = entityd.procfs.Snapshot()
+        inodes = snapshot.socket_inodes(os.getpid())
+        assert inodes[inode] == [(os.getpid(), sock.fileno())]
+    finally:
+        sock.close()
+
+
+def test_socket_inodes_vanished(snapshot):
+    assert snapshot.socket_inodes(42) == {}
+
+
+def test_fd_table_reused(procdir, monkeypatch):
+    piddir = make_proc(procdir, 42)
+    os.symlink('/dev/null', str(piddir.join('fd', '2')))
+    os.symlink('socket:[1234]', str(piddir.join('fd', '3')))
+    first = entityd.procfs.Snapshot(str(procdir))
+    assert first.socket_inodes(42) == {'1234': [(42, 3)]}
+    readlink = pytest.Mock(wraps=os.readlink)
+    monkeypatch.setattr(os, 'readlink', readlink)
+    second = entityd.procfs.Snapshot(str(procdir), fd_tables=first.fd_tables)
+    assert second.socket_inodes(42) == {'1234': [(42, 3)]}
+    assert second.fd_tables == first.fd_tables
+    readlink.assert_called_once_with(str(piddir.join('fd', '3')))
+
+
+def test_fd_table_socket_replaced(procdir):
+    piddir = make_proc(procdir, 42)
+    os.symlink('socket:[1234]', str(piddir.join('fd', '3')))
+    first = entityd.procfs.Snapshot(str(procdir))
+    assert first.socket_inodes(42) == {'1234': [(42, 3)]}
+    piddir.join('fd', '3').remove()
+    os.symlink('socket:[5678]', str(piddir.join('fd', '3')))
+    second = entityd.procfs.Snapshot(str(procdir), fd_tables=first.fd_tables)
+    assert second.socket_inodes(42) == {'5678': [(42, 3)]}
+
+
+def test_fd_table_socket_reopened():
+    # Closing a socket and opening a new one reuses the fd number
+    sock = socket.socket()
+    fd = sock.fileno()
+    first = entityd.procfs.Snapshot()
+    first.socket_inodes(os.getpid())
+    sock.close()
+    sock = socket.socket()
+    try:
+        assert sock.fileno() == fd
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        second = entityd.procfs.Snapshot(fd_tables=first.fd_tables)
+        assert second.socket_inodes(os.getpid())[inode] == [(os.getpid(), fd)]
+    finally:
+        sock.close()
+
+
+def test_fd_table_changed(procdir):
+    piddir = make_proc(procdir, 42)
+    os.symlink('socket:[1234]', str(piddir.join('fd', '3')))
+    first = entityd.procfs.Snapshot(str(procdir))
+    first.socket_inodes(42)
+    os.symlink('socket:[5678]', str(piddir.join('fd', '4')))
+    second = entityd.procfs.Snapshot(str(procdir), fd_tables=first.fd_tables)
+    assert second.socket_inodes(42) == {'1234': [(42, 3)], '5678': [(42, 4)]}
+
+
+def test_fd_table_expired(procdir):
+    piddir = make_proc(procdir, 42)
+    os.symlink('/dev/null', str(piddir.join('fd', '3')))
+    first = entityd.procfs.Snapshot(str(procdir))
+    assert first.socket_inodes(42) == {}
+    piddir.join('fd', '3').remove()
+    os.symlink('socket:[1234]', str(piddir.join('fd', '3')))
+    second = entityd.procfs.Snapshot(str(procdir), fd_tables=first.fd_tables)
+    assert second.socket_inodes(42) == {}
+    second.timestamp += entityd.procfs.FD_TABLE_MAX_AGE
+    third = entityd.procfs.Snapshot(str(procdir), fd_tables=first.fd_tables)
+    third.timestamp = second.timestamp
+    assert third.socket_inodes(42) == {'1234': [(42, 3)]}
+
+
+def test_fd_table_new_process(procdir):
+    piddir = make_proc(procdir, 42, starttime=1000)
+    os.symlink('socket:[1234]', str(piddir.join('fd', '3')))
+    first = entityd.procfs.Snapshot(str(procdir))
+    first.socket_inodes(42)
+    piddir.remove()
+    piddir = make_proc(procdir, 42, starttime=2000)
+    os.symlink('socket:[5678]', str(piddir.join('fd', '3')))
+    second = entityd.procfs.Snapshot(str(procdir), fd_tables=first.fd_tables)
+    assert second.socket_inodes(42) == {'5678': [(42, 3)]}
+    assert list(second.fd_tables) == [(42, 2000)]
+
+
+@pytest.mark.parametrize('threads', [0, 2])
+def test_socket_index(procdir, threads):
+    make_proc(procdir, 1, ppid=0)
+    for pid in [42, 43]:
+        piddir = make_proc(procdir, pid)
+        os.symlink('socket:[1234]', str(piddir.join('fd', '3')))
+        os.symlink('socket:[{}]'.format(pid), str(piddir.join('fd', '4')))
+    snapshot = entityd.procfs.Snapshot(str(procdir), threads=threads)
+    index = snapshot.socket_index()
+    assert sorted(index['1234']) == [(42, 3), (43, 3)]
+    assert index['42'] == [(42, 4)]
+    assert index['43'] == [(43, 4)]
+    assert len(index) == 3
+    assert snapshot.socket_index() is index
+    assert snapshot.socket_inodes(42) == {'1234': [(42, 3)], '42': [(42, 4)]}
+
+
+def test_children(procdir, snapshot):
+    make_proc(procdir, 1, ppid=0)
+    make_proc(procdir, 2, ppid=1)
+    make_proc(procdir, 3, ppid=2)
+    make_proc(procdir, 4, ppid=2)
+    make_proc(procdir, 5, ppid=1)
+    assert sorted(snapshot.children(1)) == [2, 5]
+    assert sorted(snapshot.children(2)) == [3, 4]
+    assert snapshot.children(3) == []
+    assert sorted(snapshot.descendants(1)) == [2, 3, 4, 5]
+    assert sorted(snapshot.descendants(2)) == [3, 4]
+
+
+CONTAINERID = 'a' * 32 + '0123456789abcdef' * 2
+
+
+@pytest.mark.parametrize(('cgroup', 'path'), [
+    (['12:pids:/docker/' + CONTAINERID, '1:name=systemd:/docker/' +
+      CONTAINERID], '/pids/docker/' + CONTAINERID),
+    (['1:name=systemd:/system.slice/docker-' + CONTAINERID + '.scope'],
+     '/systemd/system.slice/docker-' + CONTAINERID + '.scope'),
+    (['0::/system.slice/docker-' + CONTAINERID + '.scope'],
+     '/system.slice/docker-' + CONTAINERID + '.scope'),
+    (['4:cpu,cpuacct:/kubepods/besteffort/pod1234/' + CONTAINERID],
+     '/cpu,cpuacct/kubepods/besteffort/pod1234/' + CONTAINERID),
+    (['0::/kubepods.slice/kubepods-pod1234.slice/cri-containerd-' +
+      CONTAINERID + '.scope'],
+     '/kubepods.slice/kubepods-pod1234.slice/cri-containerd-' +
+     CONTAINERID + '.scope'),
+    (['0::/kubepods.slice/crio-' + CONTAINERID + '.scope'],
+     '/kubepods.slice/crio-' + CONTAINERID + '.scope'),
+])
+def test_parse_container_cgroup(cgroup, path):
+    container = entityd.procfs.parse_container_cgroup(cgroup)
+    assert container.id == CONTAINERID
+    assert container.path == path
+
+
+@pytest.mark.parametrize('cgroup', [
+    ['0::/'],
+    ['0::/user.slice/user-1000.slice/session-2.scope'],
+    ['12:pids:/docker', '11:memory:/docker/abc'],
+    [],
+])
+def test_parse_container_cgroup_none(cgroup):
+    assert entityd.procfs.parse_container_cgroup(cgroup) is None
+
+
+def test_cgroup_procs(tmpdir):
+    tmpdir.join('docker', CONTAINERID, 'cgroup.procs').write(
+        '1\n42\n', ensure=True)
+    assert entityd.procfs.cgroup_procs(
+        '/docker/' + CONTAINERID, str(tmpdir)) == [1, 42]
+
+
+def test_cgroup_procs_missing(tmpdir):
+    assert entityd.procfs.cgroup_procs('/docker/gone', str(tmpdir)) is None
+
+
+def test_container(procdir, snapshot):
+    make_proc(procdir, 42, cgroup='0::/docker/' + CONTAINERID)
+    make_proc(procdir, 43)
+    assert snapshot.container(42).id == CONTAINERID
+    assert snapshot.container(43) is None
+    assert snapshot.container(44) is None
+    assert snapshot.containers == {
+        (42, 1000): snapshot.container(42),
+        (43, 1000): None,
+    }
+
+
+def test_container_carried_over(procdir, snapshot):
+    piddir = make_proc(procdir, 42, cgroup='0::/docker/' + CONTAINERID)
+    container = snapshot.container(42)
+    piddir.join('cgroup').remove()
+    snapshot = entityd.procfs.Snapshot(str(procdir), snapshot.containers)
+    assert snapshot.container(42) is container
+
+
+def test_container_pid_reused(procdir, snapshot):
+    piddir = make_proc(procdir, 42, cgroup='0::/docker/' + CONTAINERID)
+    snapshot.container(42)
+    piddir.remove()
+    make_proc(procdir, 42, starttime=2000)
+    snapshot = entityd.procfs.Snapshot(str(procdir), snapshot.containers)
+    assert snapshot.container(42) is None
+
+
+class TestProcFS:
+
+    @pytest.fixture
+    def procfs(self, pm, config):
+        procfs = entityd.procfs.ProcFS()
+        pm.register(procfs, 'entityd.procfs.ProcFS')
+        return procfs
+
+    def test_addoption(self, procfs):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--procpath', default='/proc')
+        procfs.entityd_addoption(parser)
+        args = parser.parse_args(['--procpath', '/foo'])
+        assert args.procpath == '/foo'
+        assert args.cgrouppath == '/sys/fs/cgroup'
+        assert args.fd_scan_threads == 0
+
+    def test_sessionstart(self, procfs, session, procdir):
+        session.config.args.procpath = str(procdir)
+        procfs.entityd_sessionstart(session)
+        assert session.svc.procfs is procfs
+        assert procfs.procpath == str(procdir)
+
+    def test_snapshot_per_cycle(self, procfs, session):
+        procfs.entityd_sessionstart(session)
+        procfs.entityd_collection_before(session)
+        snapshot = procfs.snapshot()
+        assert procfs.snapshot() is snapshot
+        assert entityd.procfs.snapshot(session) is snapshot
+        procfs.entityd_collection_after(session, ())
+        assert procfs.snapshot() is not snapshot
+        procfs.entityd_collection_before(session)
+        assert procfs.snapshot() is not snapshot
+
+    def test_snapshot_outside_cycle(self, procfs, session):
+        procfs.entityd_sessionstart(session)
+        assert procfs.snapshot() is not procfs.snapshot()
+
+    def test_containers_kept_between_cycles(self, procfs, session, procdir):
+        session.config.args.procpath = str(procdir)
+        make_proc(procdir, 42, cgroup='0::/docker/' + CONTAINERID)
+        procfs.entityd_sessionstart(session)
+        procfs.entityd_collection_before(session)
+        container = procfs.snapshot().container(42)
+        procfs.entityd_collection_after(session, ())
+        procdir.join('42', 'cgroup').remove()
+        procfs.entityd_collection_before(session)
+        assert procfs.snapshot().container(42) is container
+
+    def test_fd_tables_kept_between_cycles(self, procfs, session, procdir):
+        session.config.args.procpath = str(procdir)
+        session.config.args.fd_scan_threads = 4
+        piddir = make_proc(procdir, 42)
+        os.symlink('socket:[1234]', str(piddir.join('fd', '3')))
+        procfs.entityd_sessionstart(session)
+        procfs.entityd_collection_before(session)
+        assert procfs.snapshot().threads == 4
+        table = procfs.snapshot().socket_index()
+        procfs.entityd_collection_after(session, ())
+        procfs.entityd_collection_before(session)
+        assert procfs.snapshot().socket_index() == table
+        assert procfs.snapshot().fd_tables[(42, 1000)].sockets == table
+
+    def test_container_pids(self, procfs, session, tmpdir):
+        tmpdir.join('docker', CONTAINERID, 'cgroup.procs').write(
+            '7\n', ensure=True)
+        session.config.args.cgrouppath = str(tmpdir)
+        procfs.entityd_sessionstart(session)
+        container = entityd.procfs.ContainerCgroup(
+            CONTAINERID, '/docker/' + CONTAINERID)
+        assert procfs.container_pids(container) == [7]
+
+    def test_snapshot_procpath(self, procfs, session, procdir):
+        session.config.args.procpath = str(procdir)
+        procfs.entityd_sessionstart(session)
+        procfs.entityd_collection_before(session)
+        assert procfs.snapshot().procpath == str(procdir)
+
+
+def test_snapshot_no_service(session, procdir):
+    snapshot = entityd.procfs.snapshot(session, str(procdir))
+    assert isinstance(snapshot, entityd.procfs.Snapshot)
+    assert snapshot.procpath == str(procdir)
+
+
+def test_snapshot_no_session():
+    assert entityd.procfs.snapshot(None).procpath == '/proc'
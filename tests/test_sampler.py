@@ -0,0 +1,340 @@
+import os
+import threading
+import time
+
+import pytest
+
+import entityd.sampler
+
+
+@pytest.fixture
+def procdir(tmpdir):
+    """A synthetic procfs tree with the files sampled."""
+    procdir = tmpdir.join('proc')
+    procdir.join('stat').write(
+        'cpu  100 0 100 700 100 0 0 0 0 0\n'
+        'cpu0 50 0 50 350 50 0 0 0 0 0\n'
+        'cpu1 50 0 50 350 50 0 0 0 0 0\n'
+        'intr 1 2 3\n', ensure=True)
+    procdir.join('meminfo').write(
+        'MemTotal:       1000 kB\n'
+        'MemFree:         200 kB\n'
+        'Buffers:         100 kB\n'
+        'Cached:          100 kB\n')
+    procdir.join('loadavg').write('0.50 0.25 0.10 1/100 4242\n')
+    procdir.join('diskstats').write(
+        '   7       0 loop0 1 0 100 0 1 0 100 0 0 0 0\n'
+        '   8       0 sda 1 0 10 0 1 0 20 0 0 0 0\n'
+        '   8       1 sda1 1 0 10 0 1 0 20 0 0 0 0\n'
+        '  65     160 sdaa 1 0 5 0 1 0 6 0 0 0 0\n'
+        ' 259       0 nvme0n1 1 0 30 0 1 0 40 0 0 0 0\n'
+        ' 259       1 nvme0n1p1 1 0 30 0 1 0 40 0 0 0 0\n'
+        ' 253       1 dm-1 1 0 50 0 1 0 50 0 0 0 0\n'
+        ' 253      10 dm-10 1 0 50 0 1 0 50 0 0 0 0\n'
+        '   9      10 md10 1 0 70 0 1 0 70 0 0 0 0\n')
+    procdir.join('net', 'dev').write(
+        'Inter-|   Receive                            |  Transmit\n'
+        ' face |bytes    packets errs drop fifo frame compressed multicast'
+        '|bytes    packets errs drop fifo colls carrier compressed\n'
+        '    lo: 5000 1 0 0 0 0 0 0 5000 1 0 0 0 0 0 0\n'
+        '  eth0: 1000 1 0 0 0 0 0 0 2000 1 0 0 0 0 0 0\n'
+        '  eth1: 100 1 0 0 0 0 0 0 200 1 0 0 0 0 0 0\n', ensure=True)
+    return procdir
+
+
+def make_block(sysdir, name, parent=None, virtual=False):
+    """Create a block device in a sysfs tree."""
+    if virtual:
+        device = sysdir.join('devices', 'virtual', 'block', name)
+    elif parent:
+        device = sysdir.join('devices', 'pci0000:00', 'block', parent, name)
+        device.join('partition').write('1', ensure=True)
+    else:
+        device = sysdir.join('devices', 'pci0000:00', 'block', name)
+    device.ensure_dir()
+    sysdir.join('class', 'block').ensure_dir()
+    os.symlink(str(device), str(sysdir.join('class', 'block', name)))
+    if not parent:
+        sysdir.join('block').ensure_dir()
+        os.symlink(str(device), str(sysdir.join('block', name)))
+
+
+@pytest.fixture
+def sysdir(tmpdir):
+    """A synthetic sysfs tree with the block devices of procdir."""
+    sysdir = tmpdir.join('sys')
+    for name in ['sda', 'sdaa', 'nvme0n1']:
+        make_block(sysdir, name)
+    make_block(sysdir, 'sda1', parent='sda')
+    make_block(sysdir, 'nvme0n1p1', parent='nvme0n1')
+    for name in ['loop0', 'dm-1', 'dm-10', 'md10']:
+        make_block(sysdir, name, virtual=True)
+    return sysdir
+
+
+@pytest.fixture
+def sampler(procdir, sysdir):
+    return entityd.sampler.HostSampler(procpath=str(procdir),
+                                       syspath=str(sysdir), budget=1)
+
+
+def test_summarise():
+    summary = entityd.sampler.summarise(list(range(100, 0, -1)))
+    assert summary == entityd.sampler.Summary(min=1, max=100,
+                                              avg=50.5, p95=95)
+    assert entityd.sampler.summarise([3]) == (3, 3, 3, 3)
+
+
+def test_read_cputimes(procdir):
+    times = entityd.sampler.read_cputimes(str(procdir))
+    assert times == {'cpu': (200, 1000), 'cpu0': (100, 500),
+                     'cpu1': (100, 500)}
+
+
+def test_read_memory(procdir):
+    assert entityd.sampler.read_memory(str(procdir)) == 600 * 1024
+
+
+def test_read_loadavg(procdir):
+    assert entityd.sampler.read_loadavg(str(procdir)) == 0.5
+
+
+def test_read_diskstats(procdir, sysdir):
+    assert entityd.sampler.read_diskstats(
+        str(procdir), str(sysdir)) == (45 * 512, 66 * 512)
+
+
+def test_whole_disks(sysdir):
+    names = ['sda', 'sda1', 'sdaa', 'nvme0n1', 'nvme0n1p1',
+             'loop0', 'dm-1', 'dm-10', 'md10']
+    assert entityd.sampler.whole_disks(names, str(sysdir)) == {
+        'sda', 'sdaa', 'nvme0n1'}
+
+
+def test_whole_disks_prefixes(sysdir):
+    # Devices whose names extend another's are not partitions
+    make_block(sysdir, 'sdb')
+    make_block(sysdir, 'sdbb')
+    assert entityd.sampler.whole_disks(['sdb', 'sdbb'], str(sysdir)) == {
+        'sdb', 'sdbb'}
+
+
+def test_whole_disks_without_sysfs(tmpdir):
+    names = ['sda', 'sda1', 'sdaa', 'nvme0n1', 'nvme0n1p1',
+             'loop0', 'dm-1', 'dm-10', 'md10', 'md1']
+    assert entityd.sampler.whole_disks(names, str(tmpdir)) == {
+        'sda', 'sdaa', 'nvme0n1'}
+
+
+def test_read_netdev(procdir):
+    assert entityd.sampler.read_netdev(str(procdir)) == (1100, 2200)
+
+
+def test_read_real_procfs():
+    assert 'cpu' in entityd.sampler.read_cputimes()
+    assert entityd.sampler.read_memory() > 0
+    entityd.sampler.read_loadavg()
+    entityd.sampler.read_diskstats()
+    entityd.sampler.read_netdev()
+
+
+def test_sample(sampler, procdir, monkeypatch):
+    now = iter([10, 12])
+    monkeypatch.setattr(entityd.sampler.time, 'monotonic',
+                        lambda: next(now))
+    sampler.sample()
+    stat = procdir.join('stat').read()
+    procdir.join('stat').write(stat.replace(
+        'cpu  100 0 100 700', 'cpu  200 0 200 800').replace(
+            'cpu0 50 0 50 350', 'cpu0 150 0 150 350'))
+    procdir.join('net', 'dev').write(procdir.join('net', 'dev').read()
+                                     .replace('eth0: 1000', 'eth0: 1400'))
+    sampler.sample()
+    samples = {name: list(samples)
+               for name, samples in sampler._samples.items()}  # pylint: disable=protected-access
+    assert samples['cpu'] == [200 / 300 * 100]
+    assert samples['cpu0'] == [100]
+    assert 'cpu1' not in samples
+    assert samples['memory:used'] == [600 * 1024] * 2
+    assert samples['loadavg_1'] == [0.5] * 2
+    assert samples['net:rx'] == [200]
+    assert samples['net:tx'] == [0]
+    assert samples['disk:read'] == [0]
+    assert sampler.metrics['cpu'].traits == {'metric:gauge', 'unit:percent'}
+    assert sampler.metrics['net:rx'].traits == {'metric:gauge',
+                                                'unit:bytes/s'}
+
+
+def test_summary(sampler):
+    sampler.sample()
+    sampler.sample()
+    summaries = dict(sampler.summary())
+    metrics = {metric.name for metric in summaries}
+    assert metrics == {'memory:used', 'loadavg_1', 'disk:read',
+                       'disk:write', 'net:rx', 'net:tx'}
+    assert summaries[sampler.metrics['loadavg_1']] == (0.5, 0.5, 0.5, 0.5)
+    assert not sampler.summary()
+
+
+def test_ring_buffer(procdir, sysdir):
+    sampler = entityd.sampler.HostSampler(procpath=str(procdir),
+                                          syspath=str(sysdir), size=3)
+    for _ in range(5):
+        sampler.sample()
+    assert len(sampler._samples['loadavg_1']) == 3  # pylint: disable=protected-access
+
+
+def test_overhead_budget(sampler):
+    sampler.task = entityd.sampler.Task('host-metrics', sampler.sample, 1)
+    sampler.budget = 0
+    sampler.sample()
+    sampler.summary()
+    assert sampler.overhead > 0
+    assert sampler.task.interval == 2
+    assert sampler.interval == 1
+
+
+def test_overhead_cpu_time(sampler, monkeypatch):
+    # Time spent waiting for I/O is not counted
+    cputime = iter([5, 5.001])
+    monkeypatch.setattr(entityd.sampler, 'thread_time',
+                        lambda: next(cputime))
+    sampler.summary()
+    sampler.sample()
+    time.sleep(0.05)
+    sampler.summary()
+    assert 0 < sampler.overhead < 0.1
+
+
+def test_overhead_recovers(sampler):
+    sampler.task = entityd.sampler.Task('host-metrics', sampler.sample, 8)
+    sampler.budget = 0.4
+    sampler.overhead = 0.2
+    sampler.adapt_interval()
+    assert sampler.task.interval == 8
+    sampler.overhead = 0.01
+    for interval in [4, 2, 1, 1]:
+        sampler.adapt_interval()
+        assert sampler.task.interval == interval
+
+
+def test_adapt_interval_without_task(sampler):
+    sampler.budget = 0
+    sampler.overhead = 1
+    sampler.adapt_interval()
+    assert sampler.interval == 1
+
+
+@pytest.fixture
+def service(request):
+    service = entityd.sampler.SamplerService()
+    request.addfinalizer(service.stop)
+    return service
+
+
+def wait_for(condition):
+    """Wait up to 2s for a condition to become true."""
+    deadline = time.monotonic() + 2
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_sessionstart(session):
+    service = entityd.sampler.SamplerService()
+    service.entityd_sessionstart(session)
+    assert session.svc.sampler is service
+    assert entityd.sampler.service(session) is service
+
+
+def test_service_registered(session):
+    service = entityd.sampler.service(session)
+    assert isinstance(service, entityd.sampler.SamplerService)
+    assert session.svc.sampler is service
+
+
+def test_task(service):
+    calls = []
+    task = service.add('test', lambda: calls.append(1) or len(calls), 0.01)
+    assert task.result == 1
+    assert wait_for(lambda: len(calls) >= 3)
+    assert task.result >= 3
+    assert service.tasks == [task]
+
+
+def test_host_sampler_start(service, sampler):
+    task = sampler.start(service)
+    assert sampler.task is task
+    assert task in service.tasks
+    assert task.func == sampler.sample
+    assert task.interval == sampler.interval
+
+
+def test_intervals(service):
+    fast = pytest.Mock(return_value=None)
+    slow = pytest.Mock(return_value=None)
+    service.add('fast', fast, 0.01)
+    service.add('slow', slow, 60)
+    assert wait_for(lambda: fast.call_count >= 5)
+    assert slow.call_count == 1
+
+
+def test_interval_changed(service):
+    func = pytest.Mock(return_value=None)
+    task = service.add('test', func, 60)
+    assert func.call_count == 1
+    task.interval = 0.01
+    service.add('wakeup', lambda: None, 60)
+    assert not wait_for(lambda: func.call_count > 1)
+    service.remove(task)
+    task = service.add('test', func, 0.01)
+    assert wait_for(lambda: func.call_count > 3)
+
+
+def test_error_isolated(service, monkeypatch):
+    monkeypatch.setattr(entityd.sampler, 'log', pytest.Mock())
+    good = pytest.Mock(return_value=1)
+    bad = service.add('bad', pytest.Mock(side_effect=ZeroDivisionError),
+                      0.01)
+    service.add('good', good, 0.01)
+    assert wait_for(lambda: bad.func.call_count >= 2)
+    assert wait_for(lambda: good.call_count >= 2)
+    assert bad.result is None
+    assert entityd.sampler.log.exception.called
+
+
+def test_remove_last_task_stops_thread(service):
+    threads = threading.active_count()
+    task = service.add('test', lambda: None, 0.01)
+    assert threading.active_count() == threads + 1
+    service.remove(task)
+    assert task.cancelled
+    assert threading.active_count() == threads
+    service.add('test', lambda: None, 0.01)
+    assert threading.active_count() == threads + 1
+
+
+def test_remove_from_task(service):
+    tasks = []
+    tasks.append(service.add('test', lambda: service.remove(tasks[0]), 0.01))
+    assert wait_for(lambda: not service.tasks)
+
+
+def test_stop(service):
+    func = pytest.Mock(return_value=None)
+    service.add('first', func, 0.01)
+    service.add('second', func, 0.01)
+    service.entityd_sessionfinish()
+    assert not service.tasks
+    calls = func.call_count
+    time.sleep(0.05)
+    assert func.call_count == calls
+
+
+def test_host_sampler_task(service, procdir, sysdir):
+    sampler = entityd.sampler.HostSampler(procpath=str(procdir),
+                                          syspath=str(sysdir))
+    task = service.add('host-metrics', sampler.sample, 0.01)
+    assert wait_for(lambda: sampler._samples.get('net:rx'))  # pylint: disable=protected-access
+    service.remove(task)
+    assert len(sampler.summary()) == 6
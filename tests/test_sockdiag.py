@@ -0,0 +1,130 @@
+import os
+import socket
+import struct
+
+import pytest
+
+import entityd.connections
+import entityd.procfs
+import entityd.sockdiag
+
+
+def has_sockdiag():
+    """Check whether sock_diag can be used on this host."""
+    try:
+        entityd.sockdiag.inet_sockets(socket.AF_INET, socket.IPPROTO_TCP)
+    except OSError:
+        return False
+    return True
+
+
+sockdiag = pytest.mark.skipif(not has_sockdiag(),
+                              reason='sock_diag is not available')
+
+
+def has_ipv6():
+    """Check whether IPv6 loopback sockets can be bound."""
+    try:
+        with socket.socket(socket.AF_INET6) as sock:
+            sock.bind(('::1', 0))
+    except OSError:
+        return False
+    return True
+
+
+@pytest.fixture
+def sockets(request):
+    """Listening, connected and UDP sockets owned by this process."""
+    families = [(socket.AF_INET, '127.0.0.1')]
+    if has_ipv6():
+        families.append((socket.AF_INET6, '::1'))
+    socks = []
+    for family, addr in families:
+        server = socket.socket(family, socket.SOCK_STREAM)
+        server.bind((addr, 0))
+        server.listen(1)
+        client = socket.socket(family, socket.SOCK_STREAM)
+        client.connect(server.getsockname())
+        peer, _ = server.accept()
+        udp = socket.socket(family, socket.SOCK_DGRAM)
+        udp.bind((addr, 0))
+        socks.extend([server, client, peer, udp])
+    for sock in socks:
+        request.addfinalizer(sock.close)
+    return socks
+
+
+def test_parse_inet_diag_msg():
+    payload = struct.pack('=BBBB', socket.AF_INET, 10, 0, 0)
+    payload += struct.pack('>HH', 8080, 0)
+    payload += socket.inet_pton(socket.AF_INET, '10.0.0.5') + b'\0' * 12
+    payload += b'\0' * 16
+    payload += struct.pack('=I8s', 0, b'')
+    payload += struct.pack('=IIIII', 0, 0, 0, 1000, 4242)
+    sock = entityd.sockdiag.parse_inet_diag_msg(payload)
+    assert sock == entityd.sockdiag.InetSocket(
+        socket.AF_INET, 10, '10.0.0.5', 8080, '0.0.0.0', 0, 1000, '4242')
+
+
+@sockdiag
+def test_inet_sockets(sockets):
+    server = sockets[0]
+    socks = entityd.sockdiag.inet_sockets(socket.AF_INET, socket.IPPROTO_TCP)
+    inode = str(os.fstat(server.fileno()).st_ino)
+    sock, = [s for s in socks if s.inode == inode]
+    assert sock.family == socket.AF_INET
+    assert sock.state == 10
+    assert (sock.src, sock.sport) == server.getsockname()
+    assert sock.uid == os.getuid()
+
+
+@sockdiag
+def test_inet_sockets_states(sockets):
+    socks = entityd.sockdiag.inet_sockets(
+        socket.AF_INET, socket.IPPROTO_TCP, states=1 << 10)
+    assert socks
+    assert all(sock.state == 10 for sock in socks)
+
+
+def test_inet_sockets_error(monkeypatch):
+    nlmsg = struct.pack('=IHHIIi', 20, entityd.sockdiag.NLMSG_ERROR,
+                        0, 1, 0, -2)
+    netlink = pytest.MagicMock()
+    netlink.__enter__.return_value.recv.return_value = nlmsg
+    monkeypatch.setattr(socket, 'socket', pytest.Mock(return_value=netlink))
+    with pytest.raises(FileNotFoundError):
+        entityd.sockdiag.inet_sockets(socket.AF_INET, socket.IPPROTO_UDP)
+
+
+@sockdiag
+@pytest.mark.parametrize('kind', ['tcp', 'udp', 'inet'])
+def test_equivalent_to_procfs(sockets, kind):  # pylint: disable=unused-argument
+    procfs = entityd.connections.Connections()
+    netlink = entityd.connections.Connections(backend='netlink')
+    expected = procfs.retrieve(kind, pid=os.getpid())
+    conns = netlink.retrieve(kind, pid=os.getpid())
+    assert netlink.backend == 'netlink'
+    assert expected
+    assert sorted(conns) == sorted(expected)
+
+
+@sockdiag
+def test_equivalent_to_procfs_all_processes(sockets):  # pylint: disable=unused-argument
+    snapshot = entityd.procfs.Snapshot()
+    procfs = entityd.connections.Connections(snapshot)
+    netlink = entityd.connections.Connections(snapshot, backend='netlink')
+    own = lambda conns: sorted(c for c in conns if c.bound_pid == os.getpid())
+    expected = own(procfs.retrieve('inet'))
+    assert expected
+    assert own(netlink.retrieve('inet')) == expected
+
+
+def test_fallback(monkeypatch, sockets):  # pylint: disable=unused-argument
+    monkeypatch.setattr(entityd.sockdiag, 'inet_sockets',
+                        pytest.Mock(side_effect=PermissionError))
+    expected = entityd.connections.Connections().retrieve(
+        'inet', pid=os.getpid())
+    netlink = entityd.connections.Connections(backend='netlink')
+    assert netlink.retrieve('inet', pid=os.getpid()) == expected
+    assert netlink.backend == 'procfs'
+    assert entityd.sockdiag.inet_sockets.call_count == 1